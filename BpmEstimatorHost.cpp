@@ -0,0 +1,197 @@
+/*
+  Host Harness for the Autocorrelation BPM Estimator
+  Replays a PpgGenerator.py trace through the WearableCore.h BPM estimator the way
+  the sketches feed it - only while the IR level says a finger is on the sensor,
+  cleared whenever it is lifted - and measures for every finger placement how long
+  it takes until the first valid reading. Every sample also goes through the
+  signal quality gate, with the true beats standing in for the beat detector, and
+  an estimate only counts when the gate passes it. As in SensingDeviceNew, the
+  estimate is what gets sent until the beat average holds RATE_SIZE gated beats.
+
+  Reported:
+  - Time to first valid reading after each placement, against a perfect beat
+    detector whose beats pass the same gate, RATE_SIZE of them to fill rates[]
+  - Error of every valid reading against the true mean rate over the same window
+    (readings in motion bursts are reported separately)
+  - Valid estimates the gate held back, and estimates sent during motion - there
+    must be none of those
+  - CPU per estimator update and per input sample
+
+  Build and run:
+    python PpgGenerator.py generate trace.ppg --hours 1 --gaps 60
+    python PpgGenerator.py generate motion.ppg --hours 1 --motion 30 --gaps 20
+    g++ -O2 -std=c++11 -o bpm_host BpmEstimatorHost.cpp
+    ./bpm_host trace.ppg
+    ./bpm_host motion.ppg
+*/
+
+#include <algorithm>
+#include <chrono>
+#include <cmath>
+#include <cstdio>
+#include <cstdlib>
+#include <vector>
+
+#define WEARABLE_BPM_ESTIMATOR 1
+#define WEARABLE_SIGNAL_QUALITY 1
+#include "WearableCore.h"
+#include "PpgTrace.h"
+
+#define FINGER_IR_THRESHOLD 50000   // The sketches' "finger" config default
+#define RATE_SIZE 4                 // SensingDeviceNew's beat average
+#define LOCK_TARGET_S 2.0
+
+// True mean rate over the 'span' samples before 'end', from the ground-truth beats
+double trueBpm(const PpgTrace &trace, uint32_t end, uint32_t span) {
+  uint32_t begin = end > span ? end - span : 0;
+  const uint32_t* first = std::lower_bound(trace.beatIndex, trace.beatIndex + trace.beats, begin);
+  const uint32_t* last = std::upper_bound(trace.beatIndex, trace.beatIndex + trace.beats, end);
+  if (last - first < 2) {
+    return 0;
+  }
+  return 60.0 * trace.sampleRate * (last - first - 1) / (*(last - 1) - *first);
+}
+
+double percentile(std::vector<double> values, double p) {
+  if (values.empty()) {
+    return 0;
+  }
+  std::sort(values.begin(), values.end());
+  return values[(size_t)(p * (values.size() - 1) + 0.5)];
+}
+
+int main(int argc, char** argv) {
+  if (argc < 2) {
+    fprintf(stderr, "usage: %s trace.ppg [finger threshold]\n", argv[0]);
+    return 2;
+  }
+  long threshold = argc > 2 ? atol(argv[2]) : FINGER_IR_THRESHOLD;
+  PpgTrace trace;
+  if (!loadPpgTrace(argv[1], trace)) {
+    fprintf(stderr, "cannot read %s\n", argv[1]);
+    return 2;
+  }
+
+  BpmEstimator est;
+  resetBpmEstimator(est, trace.sampleRate);
+  SignalQuality quality = {};
+  uint32_t span = (uint32_t)(BPM_WINDOW_MAX * est.factor);
+
+  std::vector<double> lockTimes, baselineTimes, errors, motionErrors;
+  long placements = 0;
+  long missed = 0;         // Placements that ended before any reading
+  long heldInMotion = 0;   // Valid estimates the quality gate kept back during motion
+  long heldClean = 0;      // ... and outside motion
+  long sentInMotion = 0;   // Estimates the sketch would send during motion
+  bool finger = false;
+  bool locked = false;
+  uint32_t placedAt = 0;
+  uint32_t nextBeat = 0;
+  uint32_t lastBeat = 0;
+  int gatedBeats = 0;      // Beats the rates[] average has taken since the placement
+  double updateNs = 0;
+  double maxUpdateNs = 0;
+  double totalNs = 0;
+  long fed = 0;
+
+  for (uint32_t i = 0; i < trace.samples; i++) {
+    unsigned long now = (unsigned long)((uint64_t)i * 1000 / trace.sampleRate);
+    bool on = trace.ir[i] >= (uint32_t)threshold;
+    if (on != finger) {
+      finger = on;
+      if (on) {
+        placements++;
+        placedAt = i;
+        locked = false;
+        gatedBeats = 0;
+      } else {
+        missed += !locked;
+        clearBpmEstimator(est);
+        restartSignalQuality(quality);
+      }
+    }
+    bool beat = nextBeat < trace.beats && trace.beatIndex[nextBeat] == i;
+    if (beat) {
+      nextBeat++;
+    }
+    if (!on) {
+      continue;
+    }
+    addQualitySample(quality, trace.ir[i], now);
+    if (beat) {
+      if (lastBeat > 0) {
+        addQualityBeat(quality, (long)((uint64_t)(i - lastBeat) * 1000 / trace.sampleRate));
+      }
+      // The beat average only takes beats the gate passes
+      if (lastBeat >= placedAt && lastBeat > 0 && signalGood(quality) && ++gatedBeats == RATE_SIZE) {
+        baselineTimes.push_back((double)(i - placedAt) / trace.sampleRate);
+      }
+      lastBeat = i;
+    }
+
+    auto start = std::chrono::steady_clock::now();
+    bool updated = addBpmSample(est, trace.ir[i]);
+    double ns = std::chrono::duration<double, std::nano>(std::chrono::steady_clock::now() - start).count();
+    totalNs += ns;
+    fed++;
+    if (!updated) {
+      continue;
+    }
+    updateNs += ns;
+    maxUpdateNs = std::max(maxUpdateNs, ns);
+
+    bool inMotion = trace.flags[i] & PPG_FLAG_MOTION;
+    if (est.valid && !signalGood(quality)) {
+      heldInMotion += inMotion;
+      heldClean += !inMotion;
+    } else if (est.valid) {
+      sentInMotion += inMotion && gatedBeats < RATE_SIZE;
+      if (!locked) {
+        locked = true;
+        lockTimes.push_back((double)(i - placedAt) / trace.sampleRate);
+      }
+      double truth = trueBpm(trace, i, std::min(span, (uint32_t)est.filled * est.factor));
+      if (truth > 0) {
+        double error = std::fabs(est.bpm - truth);
+        (inMotion ? motionErrors : errors).push_back(error);
+      }
+    }
+  }
+  missed += finger && !locked;
+
+  long within = std::count_if(lockTimes.begin(), lockTimes.end(),
+                              [](double t) { return t <= LOCK_TARGET_S; });
+  long close = std::count_if(errors.begin(), errors.end(), [](double e) { return e <= 5.0; });
+  double meanError = 0;
+  for (double e : errors) {
+    meanError += e;
+  }
+  meanError = errors.empty() ? 0 : meanError / errors.size();
+
+  printf("Trace %s: %u samples at %u Hz, %u beats, %ld finger placements\n",
+         argv[1], trace.samples, trace.sampleRate, trace.beats, placements);
+  printf("Estimator: %.1f Hz after averaging x%u, %d-sample window, update every %u samples\n",
+         est.rate, est.factor, BPM_WINDOW_MAX, est.hop);
+  printf("Time to first valid: median %.2f s, p90 %.2f s, max %.2f s, %ld of %ld placements "
+         "within %.0f s, %ld never locked\n",
+         percentile(lockTimes, 0.5), percentile(lockTimes, 0.9), percentile(lockTimes, 1.0),
+         within, placements, LOCK_TARGET_S, missed);
+  printf("Perfect beat detector + %d-beat average: median %.2f s, p90 %.2f s\n",
+         RATE_SIZE, percentile(baselineTimes, 0.5), percentile(baselineTimes, 0.9));
+  printf("Valid readings: %zu, mean error %.2f BPM, %.1f %% within 5 BPM; %zu in motion, "
+         "median error %.1f BPM\n",
+         errors.size(), meanError, errors.empty() ? 0.0 : 100.0 * close / errors.size(),
+         motionErrors.size(), percentile(motionErrors, 0.5));
+  printf("Held by the quality gate: %ld in motion, %ld outside; sent during motion: %ld\n",
+         heldInMotion, heldClean, sentInMotion);
+  printf("CPU per update: mean %.2f us, max %.2f us (%u updates); per input sample %.1f ns\n",
+         est.updates ? updateNs / est.updates / 1000.0 : 0.0, maxUpdateNs / 1000.0, est.updates,
+         fed ? totalNs / fed : 0.0);
+
+  freePpgTrace(trace);
+  // Locking later than the beat average would, wrong readings, or an estimate sent
+  // during motion means the estimator or its gate is broken
+  bool ok = percentile(lockTimes, 0.5) <= LOCK_TARGET_S + 0.5 &&
+            (errors.empty() || (double)close / errors.size() >= 0.9) && sentInMotion == 0;
+  return ok ? 0 : 1;
+}
@@ -4,33 +4,38 @@
 #include <BLEScan.h>
 #include <BLEAdvertisedDevice.h>
 
+// Shared components from WearableCore.h - only these are compiled into this image
+#define WEARABLE_STEPPER 1
+#define WEARABLE_HEAP_WATCH 1
+#define WEARABLE_SCAN 1
+#define WEARABLE_LINK_SUPERVISOR 1
+#define WEARABLE_BLE_CLIENT 1
+#define LINK_STALE_MS 15000          // The server sends a keepalive every 10 s
+#define LINK_RESUBSCRIBE_MS 20000
+#define LINK_RECONNECT_MS 30000
+#include "WearableCore.h"
+
 // LED and Stepper motor pins - MAKE SURE THESE MATCH YOUR WIRING
 #define LED_PIN 9  // LED connected to pin 9
 #define COIL_A1 2  // Stepper motor coil A1
 #define COIL_A2 5  // Stepper motor coil A2
 #define COIL_B1 3  // Stepper motor coil B1
 #define COIL_B2 4  // Stepper motor coil B2
+const StepperPins stepper = {COIL_A1, COIL_A2, COIL_B1, COIL_B2};
 
 // Service UUID and Characteristic UUID - must match the server exactly
 static BLEUUID serviceUUID("5e581872-a389-465c-98cd-dbc5dc8e04c1");
 static BLEUUID charUUID("144f76b9-5840-4455-b89f-c7589a1e6756");
 
-// Stepper motor step sequence (full step mode)
-const int stepSequence[4][4] = {
-    {1, 0, 1, 0}, // Step 1
-    {0, 1, 1, 0}, // Step 2
-    {0, 1, 0, 1}, // Step 3
-    {1, 0, 0, 1}  // Step 4
-};
-
 // Connection state variables
 static boolean doConnect = false;
 static boolean connected = false;
-static boolean scanning = false;
+static volatile boolean disconnectPending = false;
 static BLERemoteCharacteristic* pRemoteCharacteristic;
-static BLEAdvertisedDevice* myDevice;
-unsigned long lastConnectionAttempt = 0;
-const int CONNECTION_RETRY_INTERVAL = 5000; // 5 seconds between connection attempts
+static esp_bd_addr_t serverAddress;       // Found by the last scan - kept by value, no allocation per hit
+static esp_ble_addr_type_t serverAddressType = BLE_ADDR_TYPE_PUBLIC;
+static boolean haveServerAddress = false;
+static BLEClient* pClient = NULL;          // Created once, reused on every reconnect
 
 // Variables to track heart rate and device state
 int currentHeartRate = 0;
@@ -42,7 +47,11 @@ bool ledState = false;
 int ledBlinkCount = 0;
 bool motorMoving = false;        // Flag to indicate motor is currently moving
 unsigned long lastMotorMove = 0;
-unsigned long lastHeartRateUpdate = 0;
+
+// Boot sequencing - scanning starts first, the pin self-test runs in the background
+volatile bool selfTestRunning = false;
+unsigned long timeToScan = 0;         // millis() since power-on when scanning started
+unsigned long timeToFirstSample = 0;  // millis() since power-on of the first notification
 
 // Notification callback function to handle data from server
 static void notifyCallback(
@@ -55,10 +64,17 @@ static void notifyCallback(
     memcpy(heartRateStr, pData, length);
     heartRateStr[length] = 0; // Null terminator
     
+    if (timeToFirstSample == 0) {
+        timeToFirstSample = millis();
+        Serial.print("Boot: time to first sample ");
+        Serial.print(timeToFirstSample);
+        Serial.println(" ms");
+    }
+    
     // Parse the heart rate value
     previousHeartRate = currentHeartRate;
     currentHeartRate = atoi(heartRateStr);
-    lastHeartRateUpdate = millis();
+    markLinkData();
     
     Serial.print("Received heart rate: ");
     Serial.println(currentHeartRate);
@@ -79,7 +95,7 @@ static void notifyCallback(
 
 // Function to control the stepper motor
 void stepMotor(bool clockwise, int steps, int stepDelay) {
-    if (motorMoving) return; // Prevent interrupting an ongoing movement
+    if (motorMoving || selfTestRunning) return; // Prevent interrupting an ongoing movement or the pin test
     
     Serial.print("Moving motor ");
     Serial.print(clockwise ? "clockwise" : "counterclockwise");
@@ -88,23 +104,7 @@ void stepMotor(bool clockwise, int steps, int stepDelay) {
     
     motorMoving = true;
     
-    for (int i = 0; i < steps; i++) {
-        for (int step = 0; step < 4; step++) {
-            int s = clockwise ? step : (3 - step); // Direction control
-            
-            digitalWrite(COIL_A1, stepSequence[s][0] ? HIGH : LOW);
-            digitalWrite(COIL_A2, stepSequence[s][1] ? HIGH : LOW);
-            digitalWrite(COIL_B1, stepSequence[s][2] ? HIGH : LOW);
-            digitalWrite(COIL_B2, stepSequence[s][3] ? HIGH : LOW);
-            delay(stepDelay);
-        }
-    }
-    
-    // Turn off all coils to save power and reduce heat
-    digitalWrite(COIL_A1, LOW);
-    digitalWrite(COIL_A2, LOW);
-    digitalWrite(COIL_B1, LOW);
-    digitalWrite(COIL_B2, LOW);
+    stepperMove(stepper, clockwise, steps, stepDelay);
     
     Serial.println("Motor movement complete");
     motorMoving = false;
@@ -119,6 +119,8 @@ class MyClientCallback : public BLEClientCallbacks {
 
   void onDisconnect(BLEClient* pclient) {
     connected = false;
+    restartScanning();
+    disconnectPending = true;  // Heap is reported from loop(), not the BLE task
     Serial.println("Disconnected from server");
     // Turn off LED when disconnected
     digitalWrite(LED_PIN, LOW);
@@ -131,48 +133,27 @@ class MyClientCallback : public BLEClientCallbacks {
 };
 
 bool connectToServer() {
-    if (myDevice == nullptr) {
+    if (!haveServerAddress) {
         Serial.println("No device to connect to");
         return false;
     }
     
-    Serial.print("Connecting to ");
-    Serial.println(myDevice->getAddress().toString().c_str());
-
-    BLEClient* pClient = BLEDevice::createClient();
-    Serial.println("Created client");
-
-    pClient->setClientCallbacks(new MyClientCallback());
+    // The client and its callbacks live for the whole sketch
+    static MyClientCallback clientCallbacks;
+    if (pClient == NULL) {
+        pClient = BLEDevice::createClient();
+        pClient->setClientCallbacks(&clientCallbacks);
+        Serial.println("Created client");
+    }
 
-    // Connect to the remote BLE Server with timeout
-    if (!pClient->connect(myDevice)) {
-        Serial.println("Connection failed");
+    // Connect and look up the data characteristic, the link is dropped if either is missing
+    pRemoteCharacteristic = connectCharacteristic(pClient, serverAddress, serverAddressType,
+                                                  serviceUUID, charUUID);
+    if (pRemoteCharacteristic == NULL) {
         return false;
     }
-    
-    Serial.println("Connected to server");
     pClient->setMTU(517); // Set client to request maximum MTU from server
 
-    // Obtain a reference to the service we are after in the remote BLE server
-    BLERemoteService* pRemoteService = pClient->getService(serviceUUID);
-    if (pRemoteService == nullptr) {
-      Serial.print("Failed to find our service UUID: ");
-      Serial.println(serviceUUID.toString().c_str());
-      pClient->disconnect();
-      return false;
-    }
-    Serial.println("Found our service");
-
-    // Obtain a reference to the characteristic in the service of the remote BLE server
-    pRemoteCharacteristic = pRemoteService->getCharacteristic(charUUID);
-    if (pRemoteCharacteristic == nullptr) {
-      Serial.print("Failed to find our characteristic UUID: ");
-      Serial.println(charUUID.toString().c_str());
-      pClient->disconnect();
-      return false;
-    }
-    Serial.println("Found our characteristic");
-
     // Read the value of the characteristic
     if(pRemoteCharacteristic->canRead()) {
       String value = pRemoteCharacteristic->readValue();
@@ -184,7 +165,6 @@ bool connectToServer() {
       previousHeartRate = currentHeartRate;
       highHeartRate = (currentHeartRate >= 70);
       previousHighHeartRate = highHeartRate;
-      lastHeartRateUpdate = millis();
     }
 
     if(pRemoteCharacteristic->canNotify()) {
@@ -192,25 +172,22 @@ bool connectToServer() {
       Serial.println("Registered for notifications");
     }
 
+    startLinkSupervision();
     return true;
 }
 
 // Scan for BLE servers
 class MyAdvertisedDeviceCallbacks: public BLEAdvertisedDeviceCallbacks {
   void onResult(BLEAdvertisedDevice advertisedDevice) {
-    Serial.print("BLE Device found: ");
-    Serial.println(advertisedDevice.toString().c_str());
-
     // Check if this is the device we're looking for
     if (advertisedDevice.haveServiceUUID() && advertisedDevice.isAdvertisingService(serviceUUID)) {
       BLEDevice::getScan()->stop();
-      scanning = false;
+      endScan();
       
-      // Save device for connection
-      if (myDevice != nullptr) {
-        delete myDevice;
-      }
-      myDevice = new BLEAdvertisedDevice(advertisedDevice);
+      // Save the address for connection
+      memcpy(serverAddress, *advertisedDevice.getAddress().getNative(), ESP_BD_ADDR_LEN);
+      serverAddressType = advertisedDevice.getAddressType();
+      haveServerAddress = true;
       doConnect = true;
       
       Serial.println("Found HeartRate-ESP32 device. Will attempt to connect.");
@@ -241,6 +218,18 @@ void testPins() {
     Serial.println("Pin test complete");
 }
 
+// Run the pin self-test in its own task so it does not hold up scanning
+void selfTestTask(void* parameter) {
+    testPins();
+    selfTestRunning = false;
+    vTaskDelete(NULL);
+}
+
+void startBackgroundSelfTest() {
+    selfTestRunning = true;
+    xTaskCreate(selfTestTask, "selfTest", 4096, NULL, 1, NULL);
+}
+
 void setup() {
   Serial.begin(115200);
   while (!Serial && millis() < 3000); // Short wait for serial to initialize
@@ -249,70 +238,61 @@ void setup() {
   
   // Initialize IO pins
   pinMode(LED_PIN, OUTPUT);
-  pinMode(COIL_A1, OUTPUT);
-  pinMode(COIL_A2, OUTPUT);
-  pinMode(COIL_B1, OUTPUT);
-  pinMode(COIL_B2, OUTPUT);
+  stepperBegin(stepper);  // Coils start released
   
-  // Turn off LED and stepper motor pins initially
+  // Turn off LED initially
   digitalWrite(LED_PIN, LOW);
-  digitalWrite(COIL_A1, LOW);
-  digitalWrite(COIL_A2, LOW);
-  digitalWrite(COIL_B1, LOW);
-  digitalWrite(COIL_B2, LOW);
   
-  // Test pins
-  testPins();
+  // Pin self-test runs alongside scanning instead of before everything else
+  startBackgroundSelfTest();
   
-  // Initialize BLE client
-  BLEDevice::init("HeartRateClient");
-  
-  // Start scan for heart rate server
-  BLEScan* pBLEScan = BLEDevice::getScan();
-  pBLEScan->setAdvertisedDeviceCallbacks(new MyAdvertisedDeviceCallbacks());
-  pBLEScan->setInterval(1349);
-  pBLEScan->setWindow(449);
-  pBLEScan->setActiveScan(true);
+  // Initialize BLE client, the scan looks for the heart rate server
+  beginBleClient("HeartRateClient", new MyAdvertisedDeviceCallbacks());
   
   Serial.println("Starting initial BLE scan...");
-  scanning = true;
-  pBLEScan->start(10, false); // 10-second initial scan
+  restartScanning();
+  serviceScan(connected || doConnect, false);
+  markHeapBaseline();
+  timeToScan = millis();
+  Serial.print("Boot: time to scan ");
+  Serial.print(timeToScan);
+  Serial.println(" ms");
 }
 
 void loop() {
   // Attempt connection if device found
   if (doConnect) {
+    reportScanDiscovery();
+    BLEDevice::getScan()->clearResults();  // Free the scan hits before connecting
     if (connectToServer()) {
       Serial.println("Connected to the BLE Server successfully");
+      reportHeap("connect");
       doConnect = false;
-      lastConnectionAttempt = millis();
     } else {
       Serial.println("Failed to connect to the server");
       doConnect = false;
-      lastConnectionAttempt = millis();
       // Wait a bit before trying to scan again
       delay(1000);
-      scanning = false;
+      restartScanning();
     }
   }
 
-  // If not connected and not scanning, start scan after delay
-  if (!connected && !scanning && (millis() - lastConnectionAttempt > CONNECTION_RETRY_INTERVAL)) {
-    Serial.println("Starting new BLE scan...");
-    BLEDevice::getScan()->start(5, false);
-    scanning = true;
-    lastConnectionAttempt = millis();
+  // If not connected, run the next scan burst of the current phase
+  serviceScan(connected || doConnect, false);
+
+  // Heap must come back to the same level after every reconnect
+  if (disconnectPending) {
+    disconnectPending = false;
+    reportHeap("disconnect");
   }
+  serviceHeapReport();
 
   // Handle heart rate data and control outputs
   if (connected) {
     unsigned long currentMillis = millis();
     
-    // No need to disconnect if no heart rate updates were received for 10 seconds
-    // Simply skip the disconnect logic and keep the connection alive
-    if (currentMillis - lastHeartRateUpdate > 10000) {
-      Serial.println("No heart rate updates received for 10 seconds, but staying connected...");
-    }
+    // Readings stopped arriving - flag it, resubscribe, and reconnect as a last resort
+    superviseLink(pClient, pRemoteCharacteristic, notifyCallback);
     
     // Handle high heart rate condition
     if (highHeartRate) {
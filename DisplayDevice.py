@@ -4,6 +4,14 @@
 #include <BLEScan.h>
 #include <BLEAdvertisedDevice.h>
 
+// Shared components from WearableCore.h - only these are compiled into this image
+#define WEARABLE_STEPPER 1
+#define WEARABLE_TOUCH_QUEUE 1
+#define WEARABLE_HEAP_WATCH 1
+#define WEARABLE_SCAN 1
+#define WEARABLE_BLE_CLIENT 1
+#include "WearableCore.h"
+
 // Pin definitions - DOUBLE CHECK THESE MATCH YOUR WIRING
 #define LED_PIN 10  // LED connected to pin 9
 #define COIL_A1 21  // Stepper motor coil A1
@@ -11,6 +19,7 @@
 #define COIL_B1 3  // Stepper motor coil B1
 #define COIL_B2 4  // Stepper motor coil B2
 #define TOUCH_PIN 2 // Capacitive touch sensor pin
+const StepperPins stepper = {COIL_A1, COIL_A2, COIL_B1, COIL_B2};
 
 // Service UUID and Characteristic UUID - must match the server exactly
 static BLEUUID serviceUUID("5e581872-a389-465c-98cd-dbc5dc8e04c1");
@@ -19,11 +28,12 @@ static BLEUUID charUUID("144f76b9-5840-4455-b89f-c7589a1e6756");
 // Connection state variables
 static boolean doConnect = false;
 static boolean connected = false;
-static boolean scanning = false;
+static volatile boolean disconnectPending = false;
 static BLERemoteCharacteristic* pRemoteCharacteristic;
-static BLEAdvertisedDevice* myDevice;
-unsigned long lastConnectionAttempt = 0;
-const int CONNECTION_RETRY_INTERVAL = 5000; // 5 seconds between connection attempts
+static esp_bd_addr_t serverAddress;       // Found by the last scan - kept by value, no allocation per hit
+static esp_ble_addr_type_t serverAddressType = BLE_ADDR_TYPE_PUBLIC;
+static boolean haveServerAddress = false;
+static BLEClient* pClient = NULL;          // Created once, reused on every reconnect
 
 // Variables to track sensor states
 int serverHeartRate = 0;
@@ -32,7 +42,6 @@ int serverMotorPosition = 0;
 int localTouchState = 0;
 bool sensorTriggered = false;
 bool lastSensorTriggered = false;
-unsigned long lastTouchRead = 0;
 unsigned long lastStatusPrint = 0;
 
 // Motor state tracking
@@ -40,6 +49,12 @@ bool motorAtForwardPosition = false;
 unsigned long lastMotorMove = 0;
 bool motorBusy = false;
 
+// Boot sequencing - scanning starts first, the motor self-test runs in the background
+volatile bool selfTestRunning = false;
+volatile bool selfTestFinished = false;
+unsigned long timeToScan = 0;         // millis() since power-on when scanning started
+unsigned long timeToFirstSample = 0;  // millis() since power-on of the first notification
+
 // SIMPLIFIED MOTOR CONTROL - Direct approach
 void moveMotorForward() {
     if (motorAtForwardPosition) {
@@ -50,42 +65,8 @@ void moveMotorForward() {
     Serial.println("Moving motor FORWARD");
     motorBusy = true;
     
-    // Step sequence to move forward
-    for (int i = 0; i < 200; i++) { // Adjust steps as needed (200 is example)
-        // Step 1
-        digitalWrite(COIL_A1, HIGH);
-        digitalWrite(COIL_A2, LOW);
-        digitalWrite(COIL_B1, HIGH);
-        digitalWrite(COIL_B2, LOW);
-        delay(10);
-        
-        // Step 2
-        digitalWrite(COIL_A1, LOW);
-        digitalWrite(COIL_A2, HIGH);
-        digitalWrite(COIL_B1, HIGH);
-        digitalWrite(COIL_B2, LOW);
-        delay(10);
-        
-        // Step 3
-        digitalWrite(COIL_A1, LOW);
-        digitalWrite(COIL_A2, HIGH);
-        digitalWrite(COIL_B1, LOW);
-        digitalWrite(COIL_B2, HIGH);
-        delay(10);
-        
-        // Step 4
-        digitalWrite(COIL_A1, HIGH);
-        digitalWrite(COIL_A2, LOW);
-        digitalWrite(COIL_B1, LOW);
-        digitalWrite(COIL_B2, HIGH);
-        delay(10);
-    }
-    
-    // Turn off all coils to save power and reduce heat
-    digitalWrite(COIL_A1, LOW);
-    digitalWrite(COIL_A2, LOW);
-    digitalWrite(COIL_B1, LOW);
-    digitalWrite(COIL_B2, LOW);
+    // 200 full sequences, coils released afterwards
+    stepperMove(stepper, true, 200, 10);
     
     motorAtForwardPosition = true;
     motorBusy = false;
@@ -102,42 +83,8 @@ void moveMotorBackward() {
     Serial.println("Moving motor BACKWARD");
     motorBusy = true;
     
-    // Step sequence to move backward
-    for (int i = 0; i < 200; i++) { // Adjust steps as needed (200 is example)
-        // Step 4
-        digitalWrite(COIL_A1, HIGH);
-        digitalWrite(COIL_A2, LOW);
-        digitalWrite(COIL_B1, LOW);
-        digitalWrite(COIL_B2, HIGH);
-        delay(10);
-        
-        // Step 3
-        digitalWrite(COIL_A1, LOW);
-        digitalWrite(COIL_A2, HIGH);
-        digitalWrite(COIL_B1, LOW);
-        digitalWrite(COIL_B2, HIGH);
-        delay(10);
-        
-        // Step 2
-        digitalWrite(COIL_A1, LOW);
-        digitalWrite(COIL_A2, HIGH);
-        digitalWrite(COIL_B1, HIGH);
-        digitalWrite(COIL_B2, LOW);
-        delay(10);
-        
-        // Step 1
-        digitalWrite(COIL_A1, HIGH);
-        digitalWrite(COIL_A2, LOW);
-        digitalWrite(COIL_B1, HIGH);
-        digitalWrite(COIL_B2, LOW);
-        delay(10);
-    }
-    
-    // Turn off all coils to save power and reduce heat
-    digitalWrite(COIL_A1, LOW);
-    digitalWrite(COIL_A2, LOW);
-    digitalWrite(COIL_B1, LOW);
-    digitalWrite(COIL_B2, LOW);
+    // 200 full sequences, coils released afterwards
+    stepperMove(stepper, false, 200, 10);
     
     motorAtForwardPosition = false;
     motorBusy = false;
@@ -158,6 +105,19 @@ void testMotor() {
     Serial.println("Motor test complete!");
 }
 
+// Run the motor self-test in its own task so it does not hold up scanning
+void selfTestTask(void* parameter) {
+    testMotor();
+    selfTestRunning = false;
+    selfTestFinished = true;
+    vTaskDelete(NULL);
+}
+
+void startBackgroundSelfTest() {
+    selfTestRunning = true;
+    xTaskCreate(selfTestTask, "selfTest", 4096, NULL, 1, NULL);
+}
+
 // Check if any sensor is triggered
 bool checkSensorsTrigger() {
     return (serverTouchState == 1 || localTouchState == HIGH || 
@@ -175,24 +135,27 @@ static void notifyCallback(
     memcpy(dataStr, pData, length);
     dataStr[length] = 0; // Null terminator
     
-    // Parse the data (format: "heartRate,touchState,motorPosition")
-    String data = String(dataStr);
-    int commaIndex1 = data.indexOf(',');
+    // Parse the data in place (format: "heartRate,touchState,motorPosition")
+    const char* comma1 = strchr(dataStr, ',');
     
-    if (commaIndex1 > 0) {
+    if (comma1 != NULL && comma1 > dataStr) {
+        if (timeToFirstSample == 0) {
+            timeToFirstSample = millis();
+            Serial.print("Boot: time to first sample ");
+            Serial.print(timeToFirstSample);
+            Serial.println(" ms");
+        }
+
         // Get heart rate
-        String heartRateStr = data.substring(0, commaIndex1);
-        serverHeartRate = heartRateStr.toInt();
+        serverHeartRate = atoi(dataStr);
         
         // Get touch state from server
-        int commaIndex2 = data.indexOf(',', commaIndex1 + 1);
-        String touchStateStr = data.substring(commaIndex1 + 1, commaIndex2);
-        serverTouchState = touchStateStr.toInt();
+        serverTouchState = atoi(comma1 + 1);
         
         // Get motor position from server
-        if (commaIndex2 > 0) {
-            String positionStr = data.substring(commaIndex2 + 1);
-            serverMotorPosition = positionStr.toInt();
+        const char* comma2 = strchr(comma1 + 1, ',');
+        if (comma2 != NULL) {
+            serverMotorPosition = atoi(comma2 + 1);
         }
         
         Serial.print("Received: HR=");
@@ -216,11 +179,11 @@ static void notifyCallback(
             
             // Move motor based on trigger state
             if (sensorTriggered) {
-                if (!motorBusy && !motorAtForwardPosition) {
+                if (!motorBusy && !selfTestRunning && !motorAtForwardPosition) {
                     moveMotorForward();
                 }
             } else {
-                if (!motorBusy && motorAtForwardPosition) {
+                if (!motorBusy && !selfTestRunning && motorAtForwardPosition) {
                     moveMotorBackward();
                 }
             }
@@ -236,6 +199,8 @@ class MyClientCallback : public BLEClientCallbacks {
 
   void onDisconnect(BLEClient* pclient) {
     connected = false;
+    restartScanning();
+    disconnectPending = true;  // Heap is reported from loop(), not the BLE task
     Serial.println("Disconnected from server");
     // Turn off LED when disconnected
     digitalWrite(LED_PIN, LOW);
@@ -247,48 +212,27 @@ class MyClientCallback : public BLEClientCallbacks {
 };
 
 bool connectToServer() {
-    if (myDevice == nullptr) {
+    if (!haveServerAddress) {
         Serial.println("No device to connect to");
         return false;
     }
     
-    Serial.print("Connecting to ");
-    Serial.println(myDevice->getAddress().toString().c_str());
-
-    BLEClient* pClient = BLEDevice::createClient();
-    Serial.println("Created client");
-
-    pClient->setClientCallbacks(new MyClientCallback());
+    // The client and its callbacks live for the whole sketch
+    static MyClientCallback clientCallbacks;
+    if (pClient == NULL) {
+        pClient = BLEDevice::createClient();
+        pClient->setClientCallbacks(&clientCallbacks);
+        Serial.println("Created client");
+    }
 
-    // Connect to the remote BLE Server
-    if (!pClient->connect(myDevice)) {
-        Serial.println("Connection failed");
+    // Connect and look up the data characteristic, the link is dropped if either is missing
+    pRemoteCharacteristic = connectCharacteristic(pClient, serverAddress, serverAddressType,
+                                                  serviceUUID, charUUID);
+    if (pRemoteCharacteristic == NULL) {
         return false;
     }
-    
-    Serial.println("Connected to server");
     pClient->setMTU(517); // Request maximum MTU
 
-    // Obtain a reference to the service we are after in the remote BLE server
-    BLERemoteService* pRemoteService = pClient->getService(serviceUUID);
-    if (pRemoteService == nullptr) {
-      Serial.print("Failed to find our service UUID: ");
-      Serial.println(serviceUUID.toString().c_str());
-      pClient->disconnect();
-      return false;
-    }
-    Serial.println("Found our service");
-
-    // Obtain a reference to the characteristic in the service of the remote BLE server
-    pRemoteCharacteristic = pRemoteService->getCharacteristic(charUUID);
-    if (pRemoteCharacteristic == nullptr) {
-      Serial.print("Failed to find our characteristic UUID: ");
-      Serial.println(charUUID.toString().c_str());
-      pClient->disconnect();
-      return false;
-    }
-    Serial.println("Found our characteristic");
-
     // Read the value of the characteristic
     if(pRemoteCharacteristic->canRead()) {
       String value = pRemoteCharacteristic->readValue();
@@ -307,19 +251,15 @@ bool connectToServer() {
 // Scan for BLE servers
 class MyAdvertisedDeviceCallbacks: public BLEAdvertisedDeviceCallbacks {
   void onResult(BLEAdvertisedDevice advertisedDevice) {
-    Serial.print("BLE Device found: ");
-    Serial.println(advertisedDevice.toString().c_str());
-
     // Check if this is the device we're looking for
     if (advertisedDevice.haveServiceUUID() && advertisedDevice.isAdvertisingService(serviceUUID)) {
       BLEDevice::getScan()->stop();
-      scanning = false;
+      endScan();
       
-      // Save device for connection
-      if (myDevice != nullptr) {
-        delete myDevice;
-      }
-      myDevice = new BLEAdvertisedDevice(advertisedDevice);
+      // Save the address for connection
+      memcpy(serverAddress, *advertisedDevice.getAddress().getNative(), ESP_BD_ADDR_LEN);
+      serverAddressType = advertisedDevice.getAddressType();
+      haveServerAddress = true;
       doConnect = true;
       
       Serial.println("Found HeartRate-ESP32 device. Will attempt to connect.");
@@ -333,94 +273,101 @@ void setup() {
   
   // Initialize IO pins
   pinMode(LED_PIN, OUTPUT);
-  pinMode(COIL_A1, OUTPUT);
-  pinMode(COIL_A2, OUTPUT);
-  pinMode(COIL_B1, OUTPUT);
-  pinMode(COIL_B2, OUTPUT);
+  stepperBegin(stepper);  // Coils start released
   pinMode(TOUCH_PIN, INPUT);
+  initTouchInterrupt(TOUCH_PIN);
+  localTouchState = lastQueuedTouchLevel;
   
-  // Turn off LED and stepper motor pins initially
+  // Turn off LED initially
   digitalWrite(LED_PIN, LOW);
-  digitalWrite(COIL_A1, LOW);
-  digitalWrite(COIL_A2, LOW);
-  digitalWrite(COIL_B1, LOW);
-  digitalWrite(COIL_B2, LOW);
   
-  // IMPORTANT: Test motor function first to ensure it's working
-  testMotor();
+  // Motor self-test runs alongside scanning instead of before everything else
+  startBackgroundSelfTest();
   
-  // Initialize BLE client
-  BLEDevice::init("HeartRateClient");
-  
-  // Start scan for heart rate server
-  BLEScan* pBLEScan = BLEDevice::getScan();
-  pBLEScan->setAdvertisedDeviceCallbacks(new MyAdvertisedDeviceCallbacks());
-  pBLEScan->setInterval(1349);
-  pBLEScan->setWindow(449);
-  pBLEScan->setActiveScan(true);
+  // Initialize BLE client, the scan looks for the heart rate server
+  beginBleClient("HeartRateClient", new MyAdvertisedDeviceCallbacks());
   
   Serial.println("Starting BLE scan...");
-  scanning = true;
-  pBLEScan->start(10, false); // 10-second initial scan
+  restartScanning();
+  serviceScan(connected || doConnect, false);
+  markHeapBaseline();
+  timeToScan = millis();
+  Serial.print("Boot: time to scan ");
+  Serial.print(timeToScan);
+  Serial.println(" ms");
 }
 
 void loop() {
   // Attempt connection if device found
   if (doConnect) {
+    reportScanDiscovery();
+    BLEDevice::getScan()->clearResults();  // Free the scan hits before connecting
     if (connectToServer()) {
       Serial.println("Connected to the BLE Server successfully");
+      reportHeap("connect");
       doConnect = false;
-      lastConnectionAttempt = millis();
     } else {
       Serial.println("Failed to connect to the server");
       doConnect = false;
-      lastConnectionAttempt = millis();
       delay(1000);
-      scanning = false;
+      restartScanning();
     }
   }
 
-  // If not connected and not scanning, start scan after delay
-  if (!connected && !scanning && (millis() - lastConnectionAttempt > CONNECTION_RETRY_INTERVAL)) {
-    Serial.println("Starting new BLE scan...");
-    BLEDevice::getScan()->start(5, false);
-    scanning = true;
-    lastConnectionAttempt = millis();
-  }
-
-  // Read local touch sensor
-  if (millis() - lastTouchRead > 50) {  // Read every 50ms
-      int newTouchState = digitalRead(TOUCH_PIN);
-      if (localTouchState != newTouchState) {
-          localTouchState = newTouchState;
-          Serial.print("Local touch sensor state changed to: ");
-          Serial.println(localTouchState == HIGH ? "TOUCHED" : "NOT TOUCHED");
+  // Handle local touch edges queued by the interrupt
+  checkTouchSettled();
+  TouchEdge edge;
+  bool touched = false;
+  while (popTouchEdge(edge)) {
+      touched = true;
+      localTouchState = edge.level;
+      Serial.print("Local touch sensor state changed to: ");
+      Serial.print(localTouchState == HIGH ? "TOUCHED" : "NOT TOUCHED");
+      Serial.print(" at ");
+      Serial.print(edge.timestamp);
+      Serial.println(" ms");
+      
+      // Update sensor triggered state with local sensor
+      lastSensorTriggered = sensorTriggered;
+      sensorTriggered = checkSensorsTrigger();
+      
+      // Handle trigger state change
+      if (sensorTriggered != lastSensorTriggered) {
+          Serial.print("SENSOR TRIGGER STATE CHANGED TO: ");
+          Serial.println(sensorTriggered ? "TRIGGERED" : "NOT TRIGGERED");
           
-          // Update sensor triggered state with local sensor
-          lastSensorTriggered = sensorTriggered;
-          sensorTriggered = checkSensorsTrigger();
+          // Update LED immediately based on sensor state
+          digitalWrite(LED_PIN, sensorTriggered ? HIGH : LOW);
           
-          // Handle trigger state change
-          if (sensorTriggered != lastSensorTriggered) {
-              Serial.print("SENSOR TRIGGER STATE CHANGED TO: ");
-              Serial.println(sensorTriggered ? "TRIGGERED" : "NOT TRIGGERED");
-              
-              // Update LED immediately based on sensor state
-              digitalWrite(LED_PIN, sensorTriggered ? HIGH : LOW);
-              
-              // Move motor based on trigger state
-              if (sensorTriggered) {
-                  if (!motorBusy && !motorAtForwardPosition) {
-                      moveMotorForward();
-                  }
-              } else {
-                  if (!motorBusy && motorAtForwardPosition) {
-                      moveMotorBackward();
-                  }
+          // Move motor based on trigger state
+          if (sensorTriggered) {
+              if (!motorBusy && !selfTestRunning && !motorAtForwardPosition) {
+                  moveMotorForward();
+              }
+          } else {
+              if (!motorBusy && !selfTestRunning && motorAtForwardPosition) {
+                  moveMotorBackward();
               }
           }
       }
-      lastTouchRead = millis();
+  }
+
+  // If not connected, run the next scan burst - touching the sensor scans fast again
+  serviceScan(connected || doConnect, touched);
+
+  // Heap must come back to the same level after every reconnect
+  if (disconnectPending) {
+    disconnectPending = false;
+    reportHeap("disconnect");
+  }
+  serviceHeapReport();
+
+  // The self-test leaves the motor at BACKWARD, catch up with any trigger seen meanwhile
+  if (selfTestFinished) {
+      selfTestFinished = false;
+      if (sensorTriggered) {
+          moveMotorForward();
+      }
   }
 
   // Print status periodically
@@ -2,11 +2,16 @@
   BLE Heart Rate & Hydration Monitor Client with TFT Display, Stepper Motor, and LED
   Receives heart rate and hydration data from a BLE server and displays it on a TFT screen
   Controls a stepper motor and LED based on heart rate threshold
+  Connection screens are a non-blocking state machine, so notifications, the needle
+  and the LED keep running while a status message is up
+  Samples its own battery and integrates the estimated charge of the MCU, radio,
+  stepper coils, status LED and backlight, reported on serial once a minute
   
   Hardware:
   - ESP32 with TFT display
   - Stepper motor connected to pins 25, 27, 14, 12
   - LED connected to pin 36
+  - LiPo battery + through a 100k/100k divider to GPIO35
   
   Libraries:
   - TFT_eSPI must be installed and configured for your specific display
@@ -20,6 +25,17 @@
 #include <BLEAdvertisedDevice.h>
 #include <TFT_eSPI.h>
 
+// Shared components from WearableCore.h - only these are compiled into this image
+#define WEARABLE_STEPPER 1
+#define WEARABLE_HR_MESSAGE 1
+#define WEARABLE_HEAP_WATCH 1
+#define WEARABLE_BOOT_PROFILE 1
+#define WEARABLE_ENERGY 1
+#define WEARABLE_SCAN 1
+#define WEARABLE_LINK_SUPERVISOR 1
+#define WEARABLE_BLE_CLIENT 1
+#include "WearableCore.h"
+
 // If Free_Fonts.h is in a different location, modify this include
 // If you copied Free_Fonts.h to your sketch directory, use:
 #include "Free_Fonts.h"
@@ -38,28 +54,71 @@ TFT_eSPI tft = TFT_eSPI();
 #define COIL_A2 27  // Connect to stepper motor coil A2
 #define COIL_B1 14  // Connect to stepper motor coil B1
 #define COIL_B2 12  // Connect to stepper motor coil B2
+const StepperPins stepper = {COIL_A1, COIL_A2, COIL_B1, COIL_B2};
 
 // Define pin for LED
 #define LED_PIN 13  // Connect LED to GPIO 36 (must be a HIGH active LED)
 
-// Stepper motor step sequence (full step mode)
-const int stepSequence[4][4] = {
-    {1, 0, 1, 0}, // Step 1
-    {0, 1, 1, 0}, // Step 2
-    {0, 1, 0, 1}, // Step 3
-    {1, 0, 0, 1}  // Step 4
-};
+// BOOT button - press to go back to fast scanning while disconnected
+#define WAKE_BUTTON_PIN 0
+
+// TFT backlight enable
+#define BACKLIGHT_PIN 15
+
+// Battery divider (ADC1, input only)
+#define BATTERY_PIN 35
+#define BATTERY_DIVIDER 2                  // Battery voltage / ADC pin voltage
+#define BATTERY_SAMPLES 8                  // Readings averaged per update
+int batteryMillivolts = 0;
+int batteryLevel = 100;
+unsigned long lastBatteryUpdate = 0;
+const unsigned long BATTERY_UPDATE_INTERVAL = 10000;
+
+// Energy accounting - estimated charge per subsystem since boot, reported once a minute.
+// The stepper coils and the radio are counted by WearableCore.h. Currents are estimates at 3.3 V.
+#define BATTERY_CAPACITY_MAH 1000
+#define MCU_ACTIVE_UA 30000        // ESP32 running, radio idle (power model: ~100 mW)
+#define LED_ON_UA 10000            // Status LED through its resistor
+#define BACKLIGHT_ON_UA 40000      // TFT backlight LEDs at full brightness
+#define CONN_INTERVAL_MS 30.0      // The server's live profile - worst case for an idle link
+#define CONN_EVENT_RADIO_MS 1.0    // Estimated radio-on time of an empty connection event
+const unsigned long ENERGY_REPORT_INTERVAL = 60000;
+EnergyChannel mcuEnergy = {"mcu", MCU_ACTIVE_UA, true, 0, 0, 0};  // On from boot
+EnergyChannel ledEnergy = {"led", LED_ON_UA, false, 0, 0, 0};
+EnergyChannel backlightEnergy = {"backlight", BACKLIGHT_ON_UA, false, 0, 0, 0};
+EnergyChannel* const energyChannels[] = {&mcuEnergy, &radioEnergy, &stepperEnergy,
+                                         &ledEnergy, &backlightEnergy};
+const uint8_t ENERGY_CHANNEL_COUNT = sizeof(energyChannels) / sizeof(energyChannels[0]);
+unsigned long radioAccountedAt = 0;
+unsigned long lastEnergyReport = 0;
 
 // BLE client variables
 BLEClient* pClient = NULL;
 BLERemoteCharacteristic* pRemoteCharacteristic = NULL;
-BLEAdvertisedDevice* myDevice = NULL;
+esp_bd_addr_t serverAddress;          // Found by the last scan - kept by value, no allocation per hit
+esp_ble_addr_type_t serverAddressType = BLE_ADDR_TYPE_PUBLIC;
 bool doConnect = false;
 bool connected = false;
-bool doScan = true;
 bool newDataReceived = false;
 int heartRate = 0;
 bool isHydrated = false;
+int hydrationLevel = -1;       // Graded level (%) from a capacitive-mode server, -1 if none sent
+int hydrationConfidence = 0;   // Its confidence (%)
+#define HYDRATION_MIN_CONFIDENCE 50  // Below this the level is shown greyed out
+int glucoseReading = 0;  // Photodiode spectral reading (ADC counts), 0 if the server does not send it
+
+// Parsed once instead of on every scan hit and connection
+BLEUUID serviceUUID(SERVICE_UUID);
+BLEUUID charUUID(CHARACTERISTIC_UUID);
+
+// Heap soak test - set to 1 to drop the link after SOAK_CONNECTED_MS and reconnect, over
+// and over, so the heap report after each disconnect shows whether anything leaks on the
+// real stack. HeapSoakHost.cpp runs the same path for thousands of cycles on the host and
+// fails if the live blocks after a disconnect do not stay at one level.
+#define HEAP_SOAK_TEST 0
+const unsigned long SOAK_CONNECTED_MS = 5000;
+unsigned long soakCycles = 0;
+unsigned long connectedSince = 0;
 
 // Stepper motor and LED control variables
 int currentStepPosition = 0;
@@ -74,12 +133,34 @@ bool ledState = false;
 // Heart rate history for 1-minute trend and average
 const int HISTORY_SIZE = 60;  // Store 1 minute of data
 int heartRateHistory[HISTORY_SIZE];
+unsigned long heartRateTimes[HISTORY_SIZE];  // Local millis() each sample was taken on the sensing device
+const unsigned long HISTORY_WINDOW = 60000;  // Graph and average cover the last 60 s
 int historyIndex = 0;
 bool historyFilled = false;
 int minuteAverage = 0;
 unsigned long lastDisplayUpdateTime = 0;
 unsigned long lastMinuteUpdateTime = 0;
 
+// Clock sync with the sensing device (NTP-style four timestamp exchange)
+// We write "SYNC:<t1>", the server answers "SYNCR:<t1>,<t2>,<t3>" and we note t4 on arrival
+const unsigned long SYNC_INTERVAL_FAST = 2000;  // Until the first SYNC_LOCK_SAMPLES are in
+const unsigned long SYNC_INTERVAL = 30000;      // Once locked
+const int SYNC_LOCK_SAMPLES = 4;
+const long SYNC_RTT_SLACK = 20;                 // Accept samples up to this much slower than the best RTT
+unsigned long lastSyncRequest = 0;
+int syncSamples = 0;
+bool clockSynced = false;
+long clockOffset = 0;                // Server clock minus local clock (ms) at clockOffsetTime
+unsigned long clockOffsetTime = 0;   // Local time the offset was measured
+float clockDrift = 0;                // Offset change per local ms (server clock rate error)
+long minSyncRtt = 0x7FFFFFFF;
+
+// One-way latency from sample time on the sensing device to arrival here
+long lastLatency = 0;
+long maxLatency = 0;
+float avgLatency = 0;
+unsigned long lastLatencyReport = 0;
+
 // Display layout - split screen
 const int LEFT_AREA_WIDTH = 150;  // Width of left panel
 
@@ -107,11 +188,8 @@ void moveStepperOneStep(bool clockwise) {
     stepIndex = (stepIndex + 3) % 4;  // +3 is same as -1 with wrap around
   }
   
-  // Set the coils according to the step sequence
-  digitalWrite(COIL_A1, stepSequence[stepIndex][0]);
-  digitalWrite(COIL_A2, stepSequence[stepIndex][1]);
-  digitalWrite(COIL_B1, stepSequence[stepIndex][2]);
-  digitalWrite(COIL_B2, stepSequence[stepIndex][3]);
+  // Set the coils according to the full-step sequence
+  stepperWrite(stepper, stepIndex);
 }
 
 // Move stepper motor to the target position gradually but faster
@@ -148,6 +226,12 @@ void updateStepperPosition() {
   }
 }
 
+// Drive the status LED and account for its on-time
+void setStatusLed(bool on) {
+  digitalWrite(LED_PIN, on ? HIGH : LOW);
+  energySet(ledEnergy, on, millis());
+}
+
 // Update LED based on heart rate condition - try direct digitalWrite
 void updateLed() {
   // Check if LED needs to be on (heart rate >= 60)
@@ -156,30 +240,30 @@ void updateLed() {
     if (!previousConditionTriggered) {
       ledBlinkCount = 0;  // Reset blink count
       ledState = true;    // Start with LED on
-      digitalWrite(LED_PIN, HIGH);
+      setStatusLed(true);
       lastLedBlinkTime = millis();
     }
     
     // Handle LED blinking (blink twice when condition is first triggered)
     if (ledBlinkCount < 4 && millis() - lastLedBlinkTime >= LED_BLINK_INTERVAL) {
       ledState = !ledState;
-      digitalWrite(LED_PIN, ledState ? HIGH : LOW);
+      setStatusLed(ledState);
       lastLedBlinkTime = millis();
       ledBlinkCount++;
       
       // After blinking twice (4 state changes), keep LED on
       if (ledBlinkCount >= 4) {
-        digitalWrite(LED_PIN, HIGH);
+        setStatusLed(true);
       }
     } 
     // Keep LED on when condition is triggered (after initial blinks)
     else if (ledBlinkCount >= 4) {
-      digitalWrite(LED_PIN, HIGH);
+      setStatusLed(true);
     }
   } 
   // Turn LED off when condition is not triggered
   else if (!conditionTriggered) {
-    digitalWrite(LED_PIN, LOW);
+    setStatusLed(false);
   }
   
   // Debug output for LED status
@@ -200,69 +284,168 @@ void updateLed() {
 // Callback for when a device is found during scan
 class MyAdvertisedDeviceCallbacks: public BLEAdvertisedDeviceCallbacks {
   void onResult(BLEAdvertisedDevice advertisedDevice) {
-    Serial.print("Found device: ");
-    Serial.println(advertisedDevice.toString().c_str());
-
     // Check if the device provides the service we're looking for
-    if (advertisedDevice.haveServiceUUID() && advertisedDevice.isAdvertisingService(BLEUUID(SERVICE_UUID))) {
+    if (advertisedDevice.haveServiceUUID() && advertisedDevice.isAdvertisingService(serviceUUID)) {
       BLEDevice::getScan()->stop();
-      myDevice = new BLEAdvertisedDevice(advertisedDevice);
+      endScan();
+      memcpy(serverAddress, *advertisedDevice.getAddress().getNative(), ESP_BD_ADDR_LEN);
+      serverAddressType = advertisedDevice.getAddressType();
       doConnect = true;
-      doScan = false;
       Serial.println("Found HR Monitor Server!");
     }
   }
 };
 
+// Map a sensing-device timestamp to our local millis()
+unsigned long serverToLocal(unsigned long serverTime) {
+  long offset = clockOffset + (long)(clockDrift * (long)(millis() - clockOffsetTime));
+  return serverTime - offset;
+}
+
+// Fold one sync exchange into the offset and drift estimates
+void handleSyncReply(const char* message, unsigned long t4) {
+  unsigned long t1, t2, t3;
+  if (sscanf(message, "SYNCR:%lu,%lu,%lu", &t1, &t2, &t3) != 3) {
+    return;
+  }
+  
+  long rtt = (long)(t4 - t1) - (long)(t3 - t2);
+  long offset = ((long)(t2 - t1) + (long)(t3 - t4)) / 2;
+  
+  // Slow round trips are asymmetric more often than not, skip them
+  if (rtt < minSyncRtt) {
+    minSyncRtt = rtt;
+  }
+  if (rtt > minSyncRtt + SYNC_RTT_SLACK) {
+    Serial.print("Sync sample skipped, RTT ");
+    Serial.println(rtt);
+    return;
+  }
+  
+  if (clockSynced && t4 - clockOffsetTime >= SYNC_INTERVAL / 2) {
+    float drift = (float)(offset - clockOffset) / (float)(t4 - clockOffsetTime);
+    clockDrift = (syncSamples <= SYNC_LOCK_SAMPLES) ? drift : 0.8 * clockDrift + 0.2 * drift;
+  }
+  clockOffset = offset;
+  clockOffsetTime = t4;
+  clockSynced = true;
+  syncSamples++;
+  
+  Serial.print("Clock sync: offset=");
+  Serial.print(clockOffset);
+  Serial.print(" ms, RTT=");
+  Serial.print(rtt);
+  Serial.print(" ms, drift=");
+  Serial.print(clockDrift * 1e6, 1);
+  Serial.println(" ppm");
+}
+
+// Send a sync request, fast until locked then at a slow keep-up rate
+void requestClockSync() {
+  unsigned long interval = syncSamples < SYNC_LOCK_SAMPLES ? SYNC_INTERVAL_FAST : SYNC_INTERVAL;
+  if (pRemoteCharacteristic == NULL || !pRemoteCharacteristic->canWrite() ||
+      millis() - lastSyncRequest < interval) {
+    return;
+  }
+  lastSyncRequest = millis();
+  
+  char request[24];
+  snprintf(request, sizeof(request), "SYNC:%lu", millis());
+  pRemoteCharacteristic->writeValue((uint8_t*)request, strlen(request), true);
+}
+
+// Reset sync state, the sensing device may have rebooted while we were away
+void resetClockSync() {
+  syncSamples = 0;
+  clockSynced = false;
+  clockOffset = 0;
+  clockDrift = 0;
+  minSyncRtt = 0x7FFFFFFF;
+  lastSyncRequest = 0;
+}
+
 // Callback for received notifications from the BLE server
 static void notifyCallback(BLERemoteCharacteristic* pBLERemoteCharacteristic, 
                             uint8_t* pData, size_t length, bool isNotify) {
-  String message = "";
-  for (int i = 0; i < length; i++) {
-    message += (char)pData[i];
-  }
+  unsigned long receivedAt = millis();
+  // Copied into a fixed buffer and parsed in place - no String per notification
+  static char message[64];
+  size_t n = min(length, sizeof(message) - 1);
+  memcpy(message, pData, n);
+  message[n] = '\0';
   
   Serial.print("Received notification: ");
   Serial.println(message);
   
+  // Clock sync replies share the characteristic with the readings
+  if (strncmp(message, "SYNCR:", 6) == 0) {
+    handleSyncReply(message, receivedAt);
+    return;
+  }
+  
+  // Graded hydration arrives on its own, slower than the readings
+  if (parseHydrationLevel(message, hydrationLevel, hydrationConfidence)) {
+    Serial.print("Hydration level: ");
+    Serial.print(hydrationLevel);
+    Serial.print(" % (confidence ");
+    Serial.print(hydrationConfidence);
+    Serial.println(" %)");
+    newDataReceived = true;
+    markLinkData();
+    return;
+  }
+  
   // Parse the heart rate value and hydration status
-  // Format: "HR:X,HYD:Y" where X is heart rate and Y is 1 (hydrated) or 0 (not hydrated)
-  if (message.startsWith("HR:")) {
-    // Find heart rate
-    int hydIndex = message.indexOf(",HYD:");
-    if (hydIndex > 0) {
-      // Parse heart rate
-      heartRate = message.substring(3, hydIndex).toInt();
-      
-      // Parse hydration status
-      isHydrated = (message.substring(hydIndex + 5).toInt() == 1);
-      
-      // Add heart rate to history array
-      heartRateHistory[historyIndex] = heartRate;
-      historyIndex = (historyIndex + 1) % HISTORY_SIZE;
-      
-      // If we've filled one complete cycle, mark as filled
-      if (historyIndex == 0) {
-        historyFilled = true;
-      }
-      
-      // Calculate minute average if we have data
-      calculateMinuteAverage();
-      
-      // Check if the condition for stepper motor and LED is triggered
-      previousConditionTriggered = conditionTriggered;
-      conditionTriggered = (heartRate >= 60);
-      
-      // Flag new data received for display update
-      newDataReceived = true;
-      
-      Serial.print("Heart Rate: ");
-      Serial.print(heartRate);
-      Serial.print(" - Hydration: ");
-      Serial.print(isHydrated ? "Hydrated" : "Less Hydrated");
-      Serial.print(" - Condition triggered: ");
-      Serial.println(conditionTriggered);
+  // Format: "HR:X,HYD:Y[,GLU:Z][,TS:T][,SQ:Q]" where X is heart rate, Y is 1 (hydrated) or 0 (not hydrated),
+  // Z is the glucose photodiode reading and T is the sensing device's millis() for the sample
+  HrMessage reading;
+  if (parseHrMessage(message, reading)) {
+    heartRate = reading.heartRate;
+    isHydrated = reading.hydrated;
+    
+    // Glucose channel reading is optional, older servers only send HR and HYD
+    if (reading.glucose >= 0) {
+      glucoseReading = reading.glucose;
+    }
+    
+    // Place the sample at the time it was taken, not when it arrived
+    unsigned long sampleLocalTime = receivedAt;
+    if (reading.hasTimestamp && clockSynced) {
+      sampleLocalTime = serverToLocal(reading.timestamp);
+      lastLatency = (long)(receivedAt - sampleLocalTime);
+      maxLatency = max(maxLatency, lastLatency);
+      avgLatency = (avgLatency == 0) ? lastLatency : 0.9 * avgLatency + 0.1 * lastLatency;
     }
+    
+    // Add heart rate to history array
+    heartRateHistory[historyIndex] = heartRate;
+    heartRateTimes[historyIndex] = sampleLocalTime;
+    historyIndex = (historyIndex + 1) % HISTORY_SIZE;
+    
+    // If we've filled one complete cycle, mark as filled
+    if (historyIndex == 0) {
+      historyFilled = true;
+    }
+    
+    // Calculate minute average if we have data
+    calculateMinuteAverage();
+    
+    // Check if the condition for stepper motor and LED is triggered
+    previousConditionTriggered = conditionTriggered;
+    conditionTriggered = (heartRate >= 60);
+    
+    // Flag new data received for display update
+    newDataReceived = true;
+    markLinkData();
+    
+    Serial.print("Heart Rate: ");
+    Serial.print(heartRate);
+    Serial.print(" - Hydration: ");
+    Serial.print(isHydrated ? "Hydrated" : "Less Hydrated");
+    Serial.print(" - Glucose: ");
+    Serial.print(glucoseReading);
+    Serial.print(" - Condition triggered: ");
+    Serial.println(conditionTriggered);
   }
 }
 
@@ -271,9 +454,10 @@ void calculateMinuteAverage() {
   int sum = 0;
   int count = 0;
   int validPoints = historyFilled ? HISTORY_SIZE : historyIndex;
+  unsigned long now = millis();
   
   for (int i = 0; i < validPoints; i++) {
-    if (heartRateHistory[i] > 0) {
+    if (heartRateHistory[i] > 0 && (long)(now - heartRateTimes[i]) <= (long)HISTORY_WINDOW) {
       sum += heartRateHistory[i];
       count++;
     }
@@ -284,48 +468,25 @@ void calculateMinuteAverage() {
 
 // Connect to a BLE server
 bool connectToServer() {
-  Serial.print("Connecting to server: ");
-  Serial.println(myDevice->getAddress().toString().c_str());
-  
-  pClient = BLEDevice::createClient();
-  
-  // Connect to the remote BLE server
-  pClient->connect(myDevice);
-  if (!pClient->isConnected()) {
-    Serial.println("Failed to connect to server");
-    return false;
+  // One client for the life of the sketch, reused on every reconnect
+  if (pClient == NULL) {
+    pClient = BLEDevice::createClient();
   }
   
-  // Obtain a reference to the service in the remote BLE server
-  BLERemoteService* pRemoteService = pClient->getService(BLEUUID(SERVICE_UUID));
-  if (pRemoteService == nullptr) {
-    Serial.println("Failed to find our service");
-    pClient->disconnect();
+  pRemoteCharacteristic = connectCharacteristic(pClient, serverAddress, serverAddressType,
+                                                serviceUUID, charUUID);
+  if (pRemoteCharacteristic == NULL) {
     return false;
   }
   
-  // Obtain a reference to the characteristic in the service of the remote BLE server
-  pRemoteCharacteristic = pRemoteService->getCharacteristic(BLEUUID(CHARACTERISTIC_UUID));
-  if (pRemoteCharacteristic == nullptr) {
-    Serial.println("Failed to find our characteristic");
-    pClient->disconnect();
-    return false;
-  }
-  
-  // Read the value of the characteristic
-  if (pRemoteCharacteristic->canRead()) {
-    String valueStr = pRemoteCharacteristic->readValue();
-    String value = String(valueStr.c_str());
-    Serial.print("Initial value: ");
-    Serial.println(value);
-  }
-  
   // Register for notifications if the characteristic supports it
   if (pRemoteCharacteristic->canNotify()) {
     pRemoteCharacteristic->registerForNotify(notifyCallback);
   }
   
   connected = true;
+  connectedSince = millis();
+  startLinkSupervision();
   lastMinuteUpdateTime = millis();
   lastDisplayUpdateTime = millis();
   return true;
@@ -378,6 +539,7 @@ void drawGraph() {
   // Draw points and connect them with lines
   int count = historyFilled ? HISTORY_SIZE : historyIndex;
   int start = historyFilled ? historyIndex : 0;
+  unsigned long now = millis();
   
   if (count > 1) {
     for (int i = 0; i < count - 1; i++) {
@@ -387,13 +549,17 @@ void drawGraph() {
       int hr1 = heartRateHistory[idx1];
       int hr2 = heartRateHistory[idx2];
       
-      // Only plot if we have valid heart rates
-      if (hr1 > 0 && hr2 > 0) {
+      // Age of each sample decides where it sits on the 60s..0s axis
+      long age1 = (long)(now - heartRateTimes[idx1]);
+      long age2 = (long)(now - heartRateTimes[idx2]);
+      
+      // Only plot if we have valid heart rates inside the window
+      if (hr1 > 0 && hr2 > 0 && age1 <= (long)HISTORY_WINDOW && age2 >= 0) {
         // Map heart rate to graph coordinates
-        int x1 = map(i, 0, HISTORY_SIZE - 1, GRAPH_X, GRAPH_X + GRAPH_WIDTH);
+        int x1 = map(HISTORY_WINDOW - age1, 0, HISTORY_WINDOW, GRAPH_X, GRAPH_X + GRAPH_WIDTH);
         int y1 = map(hr1, GRAPH_MIN_HR, GRAPH_MAX_HR, GRAPH_Y + GRAPH_HEIGHT, GRAPH_Y);
         
-        int x2 = map(i + 1, 0, HISTORY_SIZE - 1, GRAPH_X, GRAPH_X + GRAPH_WIDTH);
+        int x2 = map(HISTORY_WINDOW - age2, 0, HISTORY_WINDOW, GRAPH_X, GRAPH_X + GRAPH_WIDTH);
         int y2 = map(hr2, GRAPH_MIN_HR, GRAPH_MAX_HR, GRAPH_Y + GRAPH_HEIGHT, GRAPH_Y);
         
         // Draw line segment with color based on heart rate
@@ -452,8 +618,10 @@ void updateHeartRateDisplay() {
   tft.setCursor(10, 60);
   tft.print("Current HR");
   
-  // Heart rate value with color coding
-  if (heartRate < 60) {
+  // Heart rate value with color coding, greyed out while no readings arrive
+  if (linkStage != LINK_OK) {
+    tft.setTextColor(TFT_DARKGREY, TFT_BLACK); // Stale
+  } else if (heartRate < 60) {
     tft.setTextColor(TFT_CYAN, TFT_BLACK); // Low
   } else if (heartRate < 100) {
     tft.setTextColor(TFT_GREEN, TFT_BLACK); // Normal
@@ -467,7 +635,7 @@ void updateHeartRateDisplay() {
   tft.setFreeFont(FSS24);
   int hrXpos = 40;
   int hrYpos = 100;
-  tft.drawString(String(heartRate), hrXpos, hrYpos, GFXFF);
+  tft.drawNumber(heartRate, hrXpos, hrYpos, GFXFF);
   
   // BPM label
   tft.setTextColor(TFT_WHITE, TFT_BLACK);
@@ -501,8 +669,16 @@ void updateHeartRateDisplay() {
   tft.setCursor(10, 160);
   tft.print("Hydration: ");
   
-  // Color code the hydration status
-  if (isHydrated) {
+  // Color code the hydration status - a capacitive-mode server also sends a graded level
+  if (hydrationLevel >= 0) {
+    if (hydrationConfidence < HYDRATION_MIN_CONFIDENCE) {
+      tft.setTextColor(TFT_DARKGREY, TFT_BLACK);
+    } else {
+      tft.setTextColor(isHydrated ? TFT_GREEN : TFT_YELLOW, TFT_BLACK);
+    }
+    tft.print(hydrationLevel);
+    tft.print(" %");
+  } else if (isHydrated) {
     tft.setTextColor(TFT_GREEN, TFT_BLACK);
     tft.print("Hydrated");
   } else {
@@ -522,6 +698,14 @@ void updateHeartRateDisplay() {
     tft.print("Standby");
   }
   
+  // Mark the readings as stale and show what the link supervisor is doing about it
+  if (linkStage != LINK_OK) {
+    tft.setTextColor(TFT_RED, TFT_BLACK);
+    tft.setCursor(10, 200);
+    tft.print("No data - ");
+    tft.print(linkStage == LINK_STALE ? "waiting" : LINK_STAGE_NAMES[linkStage]);
+  }
+  
   // Draw divider line
   drawDivider();
 }
@@ -532,6 +716,166 @@ void updateDisplay() {
   drawGraph();
 }
 
+// UI screens - each screen is drawn once when it is entered and the timed ones move on
+// from serviceUi(), so loop() never waits on the display. Status screens share one layout
+// and only repaint their message band; a full clear happens only when switching between
+// the status layout and the live layout.
+enum UiScreen {
+  UI_SCANNING,
+  UI_CONNECTING,
+  UI_CONNECTED,     // Splash, moves on to live after CONNECTED_SPLASH_MS
+  UI_LIVE,
+  UI_FAILED,        // Moves on to scanning after FAILED_SPLASH_MS
+  UI_DISCONNECTED
+};
+
+enum UiLayout {
+  LAYOUT_NONE,
+  LAYOUT_STATUS,    // Title plus a two-line message
+  LAYOUT_LIVE       // Header, divider, heart rate panel and graph
+};
+
+const char* const UI_SCREEN_NAMES[] = {"scanning", "connecting", "connected", "live", "failed", "disconnected"};
+const unsigned long CONNECTED_SPLASH_MS = 1000;
+const unsigned long FAILED_SPLASH_MS = 3000;
+
+UiScreen uiScreen = UI_SCANNING;
+UiLayout uiLayout = LAYOUT_NONE;
+unsigned long uiEnteredAt = 0;
+unsigned long uiFullClears = 0;
+
+// Title on a cleared screen, or just the message band when the title is already up
+void drawStatusScreen(const char* message, uint16_t color, const char* detail) {
+  if (uiLayout != LAYOUT_STATUS) {
+    tft.fillScreen(TFT_BLACK);
+    uiFullClears++;
+    uiLayout = LAYOUT_STATUS;
+    tft.setTextColor(TFT_WHITE, TFT_BLACK);
+    tft.setFreeFont(FSS18);
+    tft.drawString("Heart Rate Monitor", tft.width()/2, 40, GFXFF);
+  } else {
+    tft.fillRect(0, 70, tft.width(), 80, TFT_BLACK);
+  }
+  tft.setTextColor(color, TFT_BLACK);
+  tft.setFreeFont(FSS12);
+  tft.drawString(message, tft.width()/2, 80, GFXFF);
+  if (detail != NULL) {
+    tft.setTextColor(TFT_WHITE, TFT_BLACK);
+    tft.setFreeFont(FSS9);
+    tft.drawString(detail, tft.width()/2, 120, GFXFF);
+  }
+}
+
+void drawLiveLayout() {
+  tft.fillScreen(TFT_BLACK);
+  uiFullClears++;
+  uiLayout = LAYOUT_LIVE;
+  
+  // Draw header
+  tft.setTextColor(TFT_WHITE, TFT_BLACK);
+  tft.setFreeFont(FSS12);
+  tft.drawString("Heart Rate Monitor", tft.width()/2, 20, GFXFF);
+  
+  // Draw initial layout
+  drawDivider();
+}
+
+// Switch screens and draw the new one - never blocks
+void enterUi(UiScreen screen) {
+  if (screen == uiScreen && uiLayout != LAYOUT_NONE) {
+    return;
+  }
+  if (uiLayout != LAYOUT_NONE) {
+    Serial.print("UI: ");
+    Serial.print(UI_SCREEN_NAMES[uiScreen]);
+    Serial.print(" -> ");
+    Serial.print(UI_SCREEN_NAMES[screen]);
+    Serial.print(" (full clears so far: ");
+    Serial.print(uiFullClears);
+    Serial.println(")");
+  }
+  uiScreen = screen;
+  uiEnteredAt = millis();
+  
+  switch (screen) {
+    case UI_SCANNING:
+      drawStatusScreen("Scanning for device...", TFT_WHITE, NULL);
+      break;
+    case UI_CONNECTING:
+      drawStatusScreen("Connecting...", TFT_WHITE, NULL);
+      break;
+    case UI_CONNECTED:
+      drawStatusScreen("Connected!", TFT_GREEN, "Waiting for data...");
+      break;
+    case UI_LIVE:
+      drawLiveLayout();
+      if (newDataReceived) {
+        updateDisplay();  // Data that arrived during the splash
+        newDataReceived = false;
+      }
+      break;
+    case UI_FAILED:
+      drawStatusScreen("Connection Failed", TFT_RED, "Scanning again...");
+      break;
+    case UI_DISCONNECTED:
+      drawStatusScreen("Disconnected", TFT_RED, "Scanning for device...");
+      break;
+  }
+}
+
+// Timed transitions
+void serviceUi() {
+  unsigned long elapsed = millis() - uiEnteredAt;
+  if (uiScreen == UI_CONNECTED && elapsed >= CONNECTED_SPLASH_MS) {
+    enterUi(UI_LIVE);
+  } else if (uiScreen == UI_FAILED && elapsed >= FAILED_SPLASH_MS) {
+    enterUi(UI_SCANNING);
+  }
+}
+
+// Average a few divider readings into the battery voltage and level
+void updateBatteryLevel() {
+  if (lastBatteryUpdate != 0 && millis() - lastBatteryUpdate < BATTERY_UPDATE_INTERVAL) {
+    return;
+  }
+  lastBatteryUpdate = millis();
+  uint32_t sum = 0;
+  for (int i = 0; i < BATTERY_SAMPLES; i++) {
+    sum += analogReadMilliVolts(BATTERY_PIN);
+  }
+  batteryMillivolts = sum * BATTERY_DIVIDER / BATTERY_SAMPLES;
+  batteryLevel = batteryPercent(batteryMillivolts);
+}
+
+// Radio-on time while connected: the empty connection events since the last call plus
+// one longer event per notification received. Scans are added in endScan().
+void accountRadioCharge(unsigned long now) {
+  static unsigned long accountedData = 0;
+  unsigned long elapsed = now - radioAccountedAt;
+  unsigned long notifications = dataCount - accountedData;
+  radioAccountedAt = now;
+  accountedData = dataCount;
+  if (!connected) {
+    return;
+  }
+  float radioMs = elapsed / CONN_INTERVAL_MS * CONN_EVENT_RADIO_MS;
+  energyAccrue(radioEnergy, radioMs * 1000 + notifications * NOTIFY_RADIO_US, RADIO_ON_UA);
+}
+
+// Battery and per-subsystem charge, with a one-line diagnostics record for logging tools
+void reportDiagnostics(unsigned long now) {
+  static char record[112];
+  Serial.print("Battery: ");
+  Serial.print(batteryMillivolts);
+  Serial.print(" mV (");
+  Serial.print(batteryLevel);
+  Serial.println(" %)");
+  reportEnergy(energyChannels, ENERGY_CHANNEL_COUNT, BATTERY_CAPACITY_MAH, now);
+  formatEnergyRecord(record, sizeof(record), energyChannels, ENERGY_CHANNEL_COUNT,
+                     batteryMillivolts, batteryLevel, now);
+  Serial.println(record);
+}
+
 void setup() {
   Serial.begin(115200);
   Serial.println("Starting BLE Heart Rate & Hydration Monitor Client");
@@ -539,125 +883,118 @@ void setup() {
   // Initialize heart rate history array
   for (int i = 0; i < HISTORY_SIZE; i++) {
     heartRateHistory[i] = 0;
+    heartRateTimes[i] = 0;
   }
   
-  // Initialize stepper motor pins with explicit pin definitions
-  pinMode(COIL_A1, OUTPUT); // Pin 25
-  pinMode(COIL_A2, OUTPUT); // Pin 27
-  pinMode(COIL_B1, OUTPUT); // Pin 14
-  pinMode(COIL_B2, OUTPUT); // Pin 12
-  
-  // Turn off all coils at startup
-  digitalWrite(COIL_A1, LOW);
-  digitalWrite(COIL_A2, LOW);
-  digitalWrite(COIL_B1, LOW);
-  digitalWrite(COIL_B2, LOW);
+  // Initialize stepper motor pins, all coils off at startup
+  stepperBegin(stepper);
+  bootMark("stepper");
   
   // Initialize LED pin
   pinMode(LED_PIN, OUTPUT); // Pin 36
   
   // Test the LED at startup to confirm it works
-  digitalWrite(LED_PIN, HIGH);
+  setStatusLed(true);
   delay(500);
-  digitalWrite(LED_PIN, LOW);
+  setStatusLed(false);
   
   Serial.println("LED test complete - should have seen LED blink once");
+  bootMark("led");
   
   // Initialize display
   tft.begin();
   tft.setRotation(1); // Landscape mode
-  tft.fillScreen(TFT_BLACK);
-  tft.setTextColor(TFT_WHITE, TFT_BLACK);
   
   // Display startup message
-  tft.setFreeFont(FSS18);
-  tft.drawString("Heart Rate Monitor", tft.width()/2, 40, GFXFF);
-  tft.setFreeFont(FSS12);
-  tft.drawString("Scanning for device...", tft.width()/2, 100, GFXFF);
+  enterUi(UI_SCANNING);
   
   // Set backlight to maximum brightness (if your screen supports it)
-  pinMode(15, OUTPUT);
-  digitalWrite(15, HIGH);
+  pinMode(BACKLIGHT_PIN, OUTPUT);
+  digitalWrite(BACKLIGHT_PIN, HIGH);
+  energySet(backlightEnergy, true, millis());
+  bootMark("display");
   
-  // Initialize BLE
-  BLEDevice::init("");
-
-  // Configure BLE scan
-  BLEScan* pBLEScan = BLEDevice::getScan();
-  pBLEScan->setAdvertisedDeviceCallbacks(new MyAdvertisedDeviceCallbacks());
-  pBLEScan->setInterval(1349);
-  pBLEScan->setWindow(449);
-  pBLEScan->setActiveScan(true);
-  pBLEScan->start(5, false);
+  // Initialize BLE and configure the scan
+  beginBleClient("", new MyAdvertisedDeviceCallbacks());
+  pinMode(WAKE_BUTTON_PIN, INPUT_PULLUP);
+  restartScanning();
+  serviceScan(connected || doConnect, false);
+  
+  bootMark("ble");
   
   Serial.println("Scanning for BLE devices...");
+  
+  markHeapBaseline();
+  reportHeap("setup");
+  reportBootProfile();
 }
 
 void loop() {
   // Connect to server if device was found
   if (doConnect) {
+    reportScanDiscovery();
+    BLEDevice::getScan()->clearResults();  // Free the scan hits before connecting
+    enterUi(UI_CONNECTING);
     if (connectToServer()) {
       Serial.println("Connected to the BLE Server.");
-      
-      // Update display to show connected
-      tft.fillScreen(TFT_BLACK);
-      tft.setTextColor(TFT_GREEN, TFT_BLACK);
-      tft.setFreeFont(FSS18);
-      tft.drawString("Connected!", tft.width()/2, 80, GFXFF);
-      tft.setTextColor(TFT_WHITE, TFT_BLACK);
-      tft.setFreeFont(FSS12);
-      tft.drawString("Waiting for data...", tft.width()/2, 120, GFXFF);
-      
-      delay(1000);
-      tft.fillScreen(TFT_BLACK);
-      
-      // Draw header
-      tft.setTextColor(TFT_WHITE, TFT_BLACK);
-      tft.setFreeFont(FSS12);
-      tft.drawString("Heart Rate Monitor", tft.width()/2, 20, GFXFF);
-      
-      // Draw initial layout
-      drawDivider();
+      reportHeap("connect");
+      enterUi(UI_CONNECTED);  // Splash, serviceUi() switches to the live screen
     } else {
       Serial.println("Failed to connect to the server.");
       
-      // Update display
-      tft.fillScreen(TFT_BLACK);
-      tft.setTextColor(TFT_RED, TFT_BLACK);
-      tft.setFreeFont(FSS18);
-      tft.drawString("Connection Failed", tft.width()/2, 100, GFXFF);
-      
-      // Wait a bit and try scanning again
-      delay(3000);
-      doScan = true;
+      // Scan again right away, the failure message stays up for a while on its own
+      enterUi(UI_FAILED);
+      restartScanning();
     }
     doConnect = false;
   }
   
-  // If disconnected and should scan, start scanning again
-  if (!connected && doScan) {
-    BLEDevice::getScan()->start(0);
-  }
+  serviceUi();
+  
+  // If disconnected, run the next scan burst - the BOOT button scans fast again
+  serviceScan(connected || doConnect, digitalRead(WAKE_BUTTON_PIN) == LOW);
   
   // Update display at regular intervals (not on every new data)
   unsigned long currentMillis = millis();
-  if (connected && newDataReceived && 
+  if (connected && uiScreen == UI_LIVE && newDataReceived &&
       (currentMillis - lastDisplayUpdateTime >= DISPLAY_UPDATE_INTERVAL)) {
     lastDisplayUpdateTime = currentMillis;
     updateDisplay();
     newDataReceived = false;
   }
   
+  // Mark stale readings and recover a link that stopped delivering them
+  if (connected && superviseLink(pClient, pRemoteCharacteristic, notifyCallback) && uiScreen == UI_LIVE) {
+    updateHeartRateDisplay();
+  }
+  
   // Check if a minute has passed to update the average 
   // (this ensures the display updates even without new data)
   if (connected && (currentMillis - lastMinuteUpdateTime >= 60000)) {
     calculateMinuteAverage();
-    updateDisplay();
+    if (uiScreen == UI_LIVE) {
+      updateDisplay();
+    }
     lastMinuteUpdateTime = currentMillis;
     Serial.print("Updated 1-minute average: ");
     Serial.println(minuteAverage);
   }
   
+  // Keep the clock estimate fresh and report one-way latency
+  if (connected) {
+    requestClockSync();
+    if (clockSynced && currentMillis - lastLatencyReport >= 10000) {
+      lastLatencyReport = currentMillis;
+      Serial.print("Latency: last=");
+      Serial.print(lastLatency);
+      Serial.print(" ms, avg=");
+      Serial.print(avgLatency, 1);
+      Serial.print(" ms, max=");
+      Serial.print(maxLatency);
+      Serial.println(" ms");
+    }
+  }
+  
   // Update stepper motor position
   if (connected) {
     updateStepperPosition();
@@ -668,26 +1005,38 @@ void loop() {
     updateLed();
   }
   
+#if HEAP_SOAK_TEST
+  // Soak test - drop the link on purpose, it comes back through the normal reconnect path
+  if (connected && millis() - connectedSince >= SOAK_CONNECTED_MS) {
+    soakCycles++;
+    Serial.print("Soak cycle ");
+    Serial.println(soakCycles);
+    pClient->disconnect();
+  }
+#endif
+  
+  serviceHeapReport();
+  
+  // Battery and energy accounting run whether or not we are connected
+  updateBatteryLevel();
+  accountRadioCharge(currentMillis);
+  if (currentMillis - lastEnergyReport >= ENERGY_REPORT_INTERVAL) {
+    lastEnergyReport = currentMillis;
+    reportDiagnostics(currentMillis);
+  }
+  
   // Check if client is still connected
   if (connected && !pClient->isConnected()) {
     connected = false;
     Serial.println("Disconnected from server");
+    reportHeap("disconnect");
     
     // Update display
-    tft.fillScreen(TFT_BLACK);
-    tft.setTextColor(TFT_RED, TFT_BLACK);
-    tft.setFreeFont(FSS18);
-    tft.drawString("Disconnected", tft.width()/2, 80, GFXFF);
-    tft.setTextColor(TFT_WHITE, TFT_BLACK);
-    tft.setFreeFont(FSS12);
-    tft.drawString("Scanning for device...", tft.width()/2, 120, GFXFF);
+    enterUi(UI_DISCONNECTED);
     
     // Turn off LED and stepper motor when disconnected
-    digitalWrite(LED_PIN, LOW);
-    digitalWrite(COIL_A1, LOW);
-    digitalWrite(COIL_A2, LOW);
-    digitalWrite(COIL_B1, LOW);
-    digitalWrite(COIL_B2, LOW);
+    setStatusLed(false);
+    stepperRelease(stepper);
     
     // Reset data
     for (int i = 0; i < HISTORY_SIZE; i++) {
@@ -697,9 +1046,10 @@ void loop() {
     historyFilled = false;
     minuteAverage = 0;
     currentStepPosition = 0;
+    resetClockSync();
     
     // Start scanning again
-    doScan = true;
+    restartScanning();
   }
   
   delay(5); // Reduced delay for faster response
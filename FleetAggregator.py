@@ -0,0 +1,456 @@
+"""
+Fleet Aggregator - host-side collector for many sensing devices.
+
+Ingests the notification stream of every sensing device (the same payloads the
+sketches notify, e.g. "HR:72,HYD:1,GLU:2040,TS:123456") through a pluggable
+transport, keeps a bounded ring buffer of readings per device and applies
+backpressure instead of growing without limit when ingest falls behind.
+
+Transports:
+  SocketTransport  - local TCP stand-in, one line per notification:
+                     "<device_id> <sent_ns> <payload>\\n" (sent_ns 0 if unknown)
+  BleakTransport   - real BLE devices through bleak (optional dependency)
+
+Usage:
+  python FleetAggregator.py serve --port 7514
+  python FleetAggregator.py bench --devices 1000 --rate 10 --duration 30
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import random
+import statistics
+import time
+from array import array
+from collections import deque
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Deque, Dict, List, NamedTuple, Optional, Set
+
+# UUIDs - MUST match SensingDeviceNew.py
+SERVICE_UUID = "153d58a2-6e5d-46b3-8df2-7288b3ef3c4e"
+CHARACTERISTIC_UUID = "537a9060-3f8a-4cd9-86ce-a9cd306bc3cb"
+
+# Field order of the older comma-only payloads
+# SensingDevice.py sends "heartRate,touchState,motorPosition", SensingServer_Bluetooth.py sends "heartRate"
+POSITIONAL_FIELDS = ("HR", "TOUCH", "MOTOR")
+
+# Latency samples kept for the percentiles - a uniform reservoir over the whole run
+LATENCY_SAMPLES = 100_000
+
+Sink = Callable[[str, int, str], Awaitable[None]]
+
+
+class Reading(NamedTuple):
+    received_ns: int        # Host clock when the reading was ingested
+    sent_ns: int            # Transport send time, 0 if the transport does not know it
+    fields: Dict[str, int]  # Parsed payload, e.g. {"HR": 72, "HYD": 1}
+
+
+def parse_payload(payload: str) -> Dict[str, int]:
+    """Parse a notification payload into a field dict.
+
+    Accepts "KEY:VALUE" lists from SensingDeviceNew.py as well as the
+    positional "72,1,0" / "72" formats of the older sketches. Malformed
+    fields are skipped rather than failing the whole reading.
+    """
+    fields = {}
+    for index, part in enumerate(payload.strip().split(",")):
+        key, sep, value = part.partition(":")
+        if not sep:
+            if index >= len(POSITIONAL_FIELDS):
+                continue
+            key, value = POSITIONAL_FIELDS[index], part
+        try:
+            fields[key] = int(value)
+        except ValueError:
+            continue
+    return fields
+
+
+class Transport:
+    """Delivers notifications to the aggregator.
+
+    run() calls sink(device_id, sent_ns, payload) for every notification and
+    must await the sink, which is where backpressure is applied.
+    """
+
+    async def run(self, sink: Sink) -> None:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+class SocketTransport(Transport):
+    """Local TCP stand-in for the BLE link, used by tests and benchmarks."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 7514):
+        self.host = host
+        self.port = port
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.ready = asyncio.Event()
+
+    async def run(self, sink: Sink) -> None:
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    parts = line.decode("ascii", "replace").rstrip("\n").split(" ", 2)
+                    if len(parts) != 3:
+                        continue
+                    device_id, sent, payload = parts
+                    # Awaiting the sink stops this reader, the socket buffer fills
+                    # and the sender blocks in drain() - backpressure end to end
+                    await sink(device_id, int(sent) if sent.isdigit() else 0, payload)
+            finally:
+                writer.close()
+
+        self.server = await asyncio.start_server(handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.ready.set()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+class BleakTransport(Transport):
+    """Subscribes to every advertising sensing device over BLE (needs bleak).
+
+    Notifications cannot be refused, so a device with max_in_flight readings
+    still waiting on the sink is unsubscribed until they are through.
+    """
+
+    def __init__(self, service_uuid: str = SERVICE_UUID, char_uuid: str = CHARACTERISTIC_UUID,
+                 scan_interval: float = 10.0, max_in_flight: int = 32):
+        self.service_uuid = service_uuid
+        self.char_uuid = char_uuid
+        self.scan_interval = scan_interval
+        self.max_in_flight = max_in_flight  # Notifications per device waiting on the sink
+        self.clients = {}
+        self.pauses = 0
+
+    async def run(self, sink: Sink) -> None:
+        try:
+            from bleak import BleakClient, BleakScanner
+        except ImportError as exc:
+            raise RuntimeError("BleakTransport needs the 'bleak' package") from exc
+
+        loop = asyncio.get_running_loop()
+
+        async def subscribe(device) -> None:
+            client = BleakClient(device)
+            await client.connect()
+            self.clients[device.address] = client
+            in_flight: Set[Future] = set()
+            paused = False
+
+            async def drain() -> None:
+                # With notifications off the sketch keeps its change pending and sends the
+                # latest value once we subscribe again - the device end of the backpressure
+                nonlocal paused
+                try:
+                    await client.stop_notify(self.char_uuid)
+                    if in_flight:
+                        await asyncio.wait([asyncio.wrap_future(f) for f in list(in_flight)])
+                    await client.start_notify(self.char_uuid, on_notify)
+                except Exception as exc:  # Disconnected - the scan loop reconnects it
+                    print(f"BLE: {device.address} did not resume after backpressure: {exc}")
+                finally:
+                    paused = False
+
+            def settled(future: Future) -> None:
+                in_flight.discard(future)
+                if not future.cancelled() and future.exception() is not None:
+                    print(f"BLE: sink failed for {device.address}: {future.exception()}")
+
+            def on_notify(_, data: bytearray) -> None:
+                nonlocal paused
+                payload = data.decode("ascii", "replace")
+                future = asyncio.run_coroutine_threadsafe(sink(device.address, 0, payload), loop)
+                in_flight.add(future)
+                future.add_done_callback(settled)
+                # The sink is waiting on a full queue - stop this device until it catches up
+                if len(in_flight) >= self.max_in_flight and not paused:
+                    paused = True
+                    self.pauses += 1
+                    asyncio.run_coroutine_threadsafe(drain(), loop)
+
+            await client.start_notify(self.char_uuid, on_notify)
+
+        while True:
+            devices = await BleakScanner.discover(service_uuids=[self.service_uuid])
+            for device in devices:
+                client = self.clients.get(device.address)
+                if client is None or not client.is_connected:
+                    try:
+                        await subscribe(device)
+                    except Exception as exc:  # Keep the rest of the fleet going
+                        print(f"BLE: failed to subscribe to {device.address}: {exc}")
+            await asyncio.sleep(self.scan_interval)
+
+    async def close(self) -> None:
+        for client in self.clients.values():
+            await client.disconnect()
+
+
+class Aggregator:
+    """Bounded ingest queue feeding per-device ring buffers."""
+
+    def __init__(self, history: int = 600, queue_size: int = 10000, workers: int = 1):
+        self.history = history
+        self.queue: "asyncio.Queue[tuple]" = asyncio.Queue(maxsize=queue_size)
+        self.workers = workers
+        self.buffers: Dict[str, Deque[Reading]] = {}
+        self.listeners: List[Callable[[str, Reading], None]] = []
+        self.tasks: List[asyncio.Task] = []
+
+        # Stats
+        self.ingested = 0
+        self.parse_errors = 0
+        self.listener_errors = 0
+        self.backpressure_waits = 0
+        self.queue_high_water = 0
+        self.latencies_ms = array("d")  # Reservoir of at most LATENCY_SAMPLES
+        self.latency_count = 0
+        self.latency_max_ms = 0.0
+
+    async def submit(self, device_id: str, sent_ns: int, payload: str) -> None:
+        """Transport sink - waits when the queue is full instead of dropping."""
+        if self.queue.full():
+            self.backpressure_waits += 1
+        await self.queue.put((device_id, sent_ns, payload))
+        depth = self.queue.qsize()
+        if depth > self.queue_high_water:
+            self.queue_high_water = depth
+
+    def start(self) -> None:
+        for _ in range(self.workers):
+            self.tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def _worker(self) -> None:
+        while True:
+            device_id, sent_ns, payload = await self.queue.get()
+            now = time.time_ns()
+            fields = parse_payload(payload)
+            if not fields:
+                self.parse_errors += 1
+                continue
+
+            buffer = self.buffers.get(device_id)
+            if buffer is None:
+                buffer = self.buffers[device_id] = deque(maxlen=self.history)
+            reading = Reading(now, sent_ns, fields)
+            buffer.append(reading)
+            self.ingested += 1
+            if sent_ns:
+                self._record_latency((now - sent_ns) / 1e6)
+            for listener in self.listeners:
+                # A failing listener (e.g. a full disk under the store) must not take
+                # down the worker and stall ingest behind it
+                try:
+                    listener(device_id, reading)
+                except Exception as exc:
+                    self.listener_errors += 1
+                    if self.listener_errors == 1:
+                        print(f"Listener failed for {device_id}: {exc!r} (further errors only counted)")
+
+    def _record_latency(self, latency_ms: float) -> None:
+        """Reservoir sampling, so a long serve keeps a fixed amount of latency data."""
+        self.latency_count += 1
+        self.latency_max_ms = max(self.latency_max_ms, latency_ms)
+        if len(self.latencies_ms) < LATENCY_SAMPLES:
+            self.latencies_ms.append(latency_ms)
+            return
+        slot = random.randrange(self.latency_count)
+        if slot < LATENCY_SAMPLES:
+            self.latencies_ms[slot] = latency_ms
+
+    def latest(self, device_id: str) -> Optional[Reading]:
+        buffer = self.buffers.get(device_id)
+        return buffer[-1] if buffer else None
+
+
+async def simulate_devices(host: str, port: int, devices: int, rate: float,
+                           duration: float, connections: int) -> int:
+    """Send 'devices' simulated wearables at 'rate' Hz each over 'connections' sockets.
+
+    Each socket stands in for a gateway carrying a slice of the fleet. Returns
+    the number of notifications sent.
+    """
+    per_connection = [list(range(i, devices, connections)) for i in range(connections)]
+    sent = 0
+
+    async def run_connection(ids: List[int]) -> None:
+        nonlocal sent
+        reader, writer = await asyncio.open_connection(host, port)
+        period = 1.0 / rate
+        start = time.monotonic()
+        tick = 0
+        while time.monotonic() - start < duration:
+            now_ns = time.time_ns()
+            lines = []
+            for device in ids:
+                hr = 60 + (device + tick) % 40
+                hyd = (device + tick // 50) % 2
+                lines.append(f"dev{device:04d} {now_ns} HR:{hr},HYD:{hyd},GLU:2040,TS:{tick * 100}\n")
+            writer.write("".join(lines).encode("ascii"))
+            await writer.drain()
+            sent += len(lines)
+            tick += 1
+            delay = start + tick * period - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        writer.close()
+        await writer.wait_closed()
+
+    await asyncio.gather(*(run_connection(ids) for ids in per_connection if ids))
+    return sent
+
+
+def _simulator_process(host: str, port: int, devices: int, rate: float, duration: float,
+                       connections: int, result: "multiprocessing.Queue") -> None:
+    result.put(asyncio.run(simulate_devices(host, port, devices, rate, duration, connections)))
+
+
+def percentile(values: List[float], pct: float) -> float:
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+async def benchmark(devices: int, rate: float, duration: float, connections: int,
+                    queue_size: int, history: int) -> None:
+    aggregator = Aggregator(history=history, queue_size=queue_size)
+    transport = SocketTransport(port=0)
+    aggregator.start()
+    server_task = asyncio.create_task(transport.run(aggregator.submit))
+    await transport.ready.wait()
+
+    # The simulator runs in its own process so its CPU is not counted here
+    result: "multiprocessing.Queue" = multiprocessing.Queue()
+    simulator = multiprocessing.Process(
+        target=_simulator_process,
+        args=(transport.host, transport.port, devices, rate, duration, connections, result))
+
+    cpu_start = time.process_time()
+    wall_start = time.monotonic()
+    simulator.start()
+    sent = await asyncio.get_running_loop().run_in_executor(None, result.get)
+    simulator.join()
+
+    # Let the queue drain before stopping the clock
+    while not aggregator.queue.empty():
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.1)
+    wall = time.monotonic() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    await transport.close()
+    server_task.cancel()
+    await aggregator.stop()
+
+    latencies = sorted(aggregator.latencies_ms)
+    print(f"Devices: {devices} at {rate:g} Hz over {connections} connections, {duration:g} s")
+    print(f"Sent: {sent}, ingested: {aggregator.ingested}, parse errors: {aggregator.parse_errors}, "
+          f"listener errors: {aggregator.listener_errors}")
+    print(f"Throughput: {aggregator.ingested / wall:.0f} readings/s")
+    print(f"Aggregator CPU: {cpu:.2f} s over {wall:.2f} s wall ({100.0 * cpu / wall:.1f}% of one core), "
+          f"{1e6 * cpu / max(1, aggregator.ingested):.1f} us/reading")
+    if latencies:
+        print(f"Latency ms ({len(latencies)} of {aggregator.latency_count} sampled): "
+              f"p50={percentile(latencies, 50):.2f} p95={percentile(latencies, 95):.2f} "
+              f"p99={percentile(latencies, 99):.2f} max={aggregator.latency_max_ms:.2f} "
+              f"mean={statistics.fmean(latencies):.2f}")
+    print(f"Queue high water: {aggregator.queue_high_water}/{queue_size}, "
+          f"backpressure waits: {aggregator.backpressure_waits}")
+    print(f"Devices buffered: {len(aggregator.buffers)}, readings held: "
+          f"{sum(len(b) for b in aggregator.buffers.values())} (max {history} per device)")
+
+
+async def serve(host: str, port: int, history: int, queue_size: int, use_ble: bool,
+                store_root: Optional[str] = None, flush_interval: float = 30.0) -> None:
+    aggregator = Aggregator(history=history, queue_size=queue_size)
+    transport = BleakTransport() if use_ble else SocketTransport(host, port)
+    store = None
+    if store_root:
+        from TimeSeriesStore import TimeSeriesStore
+        store = TimeSeriesStore(store_root)
+        aggregator.listeners.append(
+            lambda device_id, reading: store.append_reading(device_id, reading.received_ns // 1_000_000,
+                                                            reading.fields))
+    aggregator.start()
+
+    async def report() -> None:
+        while True:
+            await asyncio.sleep(10)
+            print(f"Devices: {len(aggregator.buffers)}, ingested: {aggregator.ingested}, "
+                  f"queue: {aggregator.queue.qsize()}, backpressure waits: {aggregator.backpressure_waits}, "
+                  f"listener errors: {aggregator.listener_errors}")
+
+    async def flush_store() -> None:
+        # Open tails otherwise live only in memory until exit - a crash would lose
+        # everything since the last full chunk. Each flush appends only the new points to
+        # the series' tail log and leaves the chunk open, so chunks still fill to
+        # CHUNK_POINTS. Runs on the loop, between listener calls.
+        while True:
+            await asyncio.sleep(flush_interval)
+            store.flush()
+
+    tasks = [asyncio.create_task(report())]
+    if store is not None:
+        tasks.append(asyncio.create_task(flush_store()))
+    try:
+        await transport.run(aggregator.submit)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await transport.close()
+        await aggregator.stop()
+        if store is not None:
+            store.flush()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Aggregate notifications from a fleet of sensing devices")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    serve_cmd = sub.add_parser("serve", help="run the aggregator")
+    serve_cmd.add_argument("--host", default="127.0.0.1")
+    serve_cmd.add_argument("--port", type=int, default=7514)
+    serve_cmd.add_argument("--ble", action="store_true", help="use BLE (bleak) instead of the socket stand-in")
+    serve_cmd.add_argument("--history", type=int, default=600, help="readings kept per device")
+    serve_cmd.add_argument("--queue-size", type=int, default=10000)
+    serve_cmd.add_argument("--store", help="also persist readings to a TimeSeriesStore at this path")
+    serve_cmd.add_argument("--flush-interval", type=float, default=30.0,
+                           help="seconds between store flushes (each one logs the open tail of every series)")
+
+    bench_cmd = sub.add_parser("bench", help="drive simulated devices through the socket transport")
+    bench_cmd.add_argument("--devices", type=int, default=1000)
+    bench_cmd.add_argument("--rate", type=float, default=10.0, help="notifications per second per device")
+    bench_cmd.add_argument("--duration", type=float, default=30.0, help="seconds")
+    bench_cmd.add_argument("--connections", type=int, default=50, help="simulated gateway sockets")
+    bench_cmd.add_argument("--history", type=int, default=600, help="readings kept per device")
+    bench_cmd.add_argument("--queue-size", type=int, default=10000)
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        asyncio.run(serve(args.host, args.port, args.history, args.queue_size, args.ble, args.store,
+                          args.flush_interval))
+    else:
+        asyncio.run(benchmark(args.devices, args.rate, args.duration, args.connections,
+                              args.queue_size, args.history))
+
+
+if __name__ == "__main__":
+    main()
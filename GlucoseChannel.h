@@ -0,0 +1,104 @@
+/*
+  Hamamatsu G11193-10R Glucose Channel - Decimation Stage
+  The InGaAs photodiode (through its transimpedance amp) is oversampled by the
+  ADC in DMA bursts. Each burst is run through a CIC decimator down to the PPG
+  sample rate, and the PPG-aligned samples are averaged again down to a low-rate
+  spectral reading that goes into the sensing payload.
+
+  Pipeline (default settings):
+    ADC 12800 Hz --CIC (order 2, R = 128)--> 100 Hz --average (x100)--> 1 Hz
+
+  This header has no Arduino dependencies so the same code runs in the sketch
+  and in the host harness (GlucoseChannelHost.cpp).
+*/
+
+#ifndef GLUCOSE_CHANNEL_H
+#define GLUCOSE_CHANNEL_H
+
+#include <stdint.h>
+
+// ADC and filter settings
+#define GLUCOSE_ADC_BITS 12          // ESP32 continuous ADC resolution
+#define GLUCOSE_ADC_RATE_HZ 12800    // Oversampling rate of the photodiode channel
+#define GLUCOSE_BURST_SIZE 256       // Samples per DMA burst (two CIC outputs)
+#define GLUCOSE_CIC_ORDER 2          // Number of integrator / comb stages
+#define GLUCOSE_CIC_LOG2_R 7         // Decimation ratio R = 128 -> 100 Hz, the PPG rate
+#define GLUCOSE_AVERAGE_COUNT 100    // PPG-aligned samples per spectral reading (1 Hz)
+
+#define GLUCOSE_CIC_R (1 << GLUCOSE_CIC_LOG2_R)
+#define GLUCOSE_CIC_GAIN_SHIFT (GLUCOSE_CIC_ORDER * GLUCOSE_CIC_LOG2_R)
+
+// CIC registers wrap modulo 2^32, which is exact as long as the full gain fits
+static_assert(GLUCOSE_ADC_BITS + GLUCOSE_CIC_GAIN_SHIFT <= 32,
+              "CIC register width too small for this order / decimation ratio");
+
+// CIC decimator state
+struct CicDecimator {
+  uint32_t integrator[GLUCOSE_CIC_ORDER];
+  uint32_t comb[GLUCOSE_CIC_ORDER];   // Previous input of each comb stage
+  uint16_t phase;                     // Input samples since the last output
+};
+
+// Second stage - plain average of PPG-aligned CIC outputs
+struct GlucoseAverager {
+  uint32_t sum;
+  uint16_t count;
+  uint16_t reading;   // Last completed low-rate reading (ADC counts)
+  bool ready;         // A new reading is waiting to be sent
+};
+
+inline void resetCic(CicDecimator &cic) {
+  for (int i = 0; i < GLUCOSE_CIC_ORDER; i++) {
+    cic.integrator[i] = 0;
+    cic.comb[i] = 0;
+  }
+  cic.phase = 0;
+}
+
+inline void resetAverager(GlucoseAverager &avg) {
+  avg.sum = 0;
+  avg.count = 0;
+  avg.reading = 0;
+  avg.ready = false;
+}
+
+// Run one DMA burst through the CIC, returns the number of outputs written.
+// 'out' must hold at least n / GLUCOSE_CIC_R + 1 samples.
+inline int processCicBurst(CicDecimator &cic, const uint16_t* in, int n, uint16_t* out) {
+  int written = 0;
+  for (int i = 0; i < n; i++) {
+    // Integrators run at the ADC rate
+    uint32_t acc = in[i];
+    for (int s = 0; s < GLUCOSE_CIC_ORDER; s++) {
+      cic.integrator[s] += acc;
+      acc = cic.integrator[s];
+    }
+
+    if (++cic.phase < GLUCOSE_CIC_R) {
+      continue;
+    }
+    cic.phase = 0;
+
+    // Combs run at the decimated rate
+    for (int s = 0; s < GLUCOSE_CIC_ORDER; s++) {
+      uint32_t delayed = cic.comb[s];
+      cic.comb[s] = acc;
+      acc -= delayed;
+    }
+    out[written++] = (uint16_t)(acc >> GLUCOSE_CIC_GAIN_SHIFT);
+  }
+  return written;
+}
+
+// Feed one PPG-aligned sample, sets avg.ready when a low-rate reading completes
+inline void addGlucoseSample(GlucoseAverager &avg, uint16_t sample) {
+  avg.sum += sample;
+  if (++avg.count >= GLUCOSE_AVERAGE_COUNT) {
+    avg.reading = (uint16_t)(avg.sum / avg.count);
+    avg.sum = 0;
+    avg.count = 0;
+    avg.ready = true;
+  }
+}
+
+#endif
@@ -0,0 +1,419 @@
+/*
+  Host Harness for the Display's Connect/Disconnect Heap Soak
+  Runs DisplayDeviceNew's BLE path - scan, connect, subscribe, link supervision,
+  disconnect, scan again - thousands of times against the stand-in BLE library in
+  HostStubs/, with every allocation counted. The WearableCore.h scan, client, link
+  supervisor and heap watch code is the real one; heap_caps_get_info() reports the
+  counted blocks, so markHeapBaseline() and reportHeap() are what the sketch runs.
+
+  Every cycle takes one of the ways a link ends on the desk:
+  - The sketch drops it after SOAK_CONNECTED_MS (the HEAP_SOAK_TEST path)
+  - The server drops it, refuses the connection, or comes up without our service
+  - The server goes silent and the link supervisor resubscribes, then reconnects
+  - The server forgets the subscription and resubscribing brings the data back
+  The server is sometimes away for a while, so scans run out and the slow phase
+  and onScanComplete() get their share. Other devices advertise throughout.
+
+  Reported, for the sketch as built and for a variant that creates a new client on
+  every connection (what the sketch used to do):
+  - Live blocks and bytes against the setup() baseline after each disconnect
+  - Their spread and their trend per 1000 cycles once the first cycles are past
+  The sketch as built must come back to the same count after every disconnect, and
+  the leaking variant must show up as a trend - otherwise the harness is blind.
+
+  Build and run:
+    g++ -O2 -std=c++17 -I HostStubs -o heap_soak_host HeapSoakHost.cpp
+    ./heap_soak_host [cycles] [seed]
+*/
+
+#include <algorithm>
+#include <cstdio>
+#include <cstddef>
+#include <cstdlib>
+#include <new>
+#include <random>
+#include <vector>
+
+#define WEARABLE_SCAN 1
+#define WEARABLE_BLE_CLIENT 1
+#define WEARABLE_LINK_SUPERVISOR 1
+#define WEARABLE_HEAP_WATCH 1
+#include "WearableCore.h"
+
+// Counting allocator - every new/delete of the stubs, the header and the harness
+// passes here, and heap_caps_get_info() reports the totals. Kept out of line, or GCC
+// sees free() on what it takes for an operator new pointer and warns.
+const size_t BLOCK_HEADER = alignof(std::max_align_t);
+
+__attribute__((noinline)) void* operator new(size_t size) {
+  char* block = (char*)malloc(size + BLOCK_HEADER);
+  if (block == nullptr) {
+    throw std::bad_alloc();
+  }
+  *(size_t*)block = size;
+  hostLiveBlocks++;
+  hostLiveBytes += size;
+  if (hostLiveBytes > hostPeakBytes) {
+    hostPeakBytes = hostLiveBytes;
+  }
+  return block + BLOCK_HEADER;
+}
+
+__attribute__((noinline)) void operator delete(void* p) noexcept {
+  if (p == nullptr) {
+    return;
+  }
+  char* block = (char*)p - BLOCK_HEADER;
+  hostLiveBlocks--;
+  hostLiveBytes -= *(size_t*)block;
+  free(block);
+}
+
+void* operator new[](size_t size) { return operator new(size); }
+void operator delete[](void* p) noexcept { operator delete(p); }
+void operator delete(void* p, size_t) noexcept { operator delete(p); }
+void operator delete[](void* p, size_t) noexcept { operator delete(p); }
+
+// DisplayDeviceNew's UUIDs and soak hold time
+#define SERVICE_UUID        "153d58a2-6e5d-46b3-8df2-7288b3ef3c4e"
+#define CHARACTERISTIC_UUID "537a9060-3f8a-4cd9-86ce-a9cd306bc3cb"
+const unsigned long SOAK_CONNECTED_MS = 5000;
+
+// The server's GATT table - ours last, so dropping the count hides it
+const char* const GAP_CHARS[] = {"00002a00-0000-1000-8000-00805f9b34fb", "00002a01-0000-1000-8000-00805f9b34fb"};
+const char* const GATT_CHARS[] = {"00002a05-0000-1000-8000-00805f9b34fb"};
+const char* const HR_CHARS[] = {CHARACTERISTIC_UUID};
+const HostGattService SERVER_SERVICES[] = {
+  {"00001800-0000-1000-8000-00805f9b34fb", GAP_CHARS, 2},
+  {"00001801-0000-1000-8000-00805f9b34fb", GATT_CHARS, 1},
+  {SERVICE_UUID, HR_CHARS, 1},
+};
+const int SERVER_SERVICE_COUNT = 3;
+
+const uint8_t SERVER_ADDRESS[ESP_BD_ADDR_LEN] = {0x24, 0x6f, 0x28, 0x51, 0x0a, 0x3e};
+
+// ---------------------------------------------------------------------------
+// The sketch side - DisplayDeviceNew's BLE path with the display, stepper and LED
+// left out
+
+BLEClient* pClient = NULL;
+BLERemoteCharacteristic* pRemoteCharacteristic = NULL;
+esp_bd_addr_t serverAddress;
+esp_ble_addr_type_t serverAddressType = BLE_ADDR_TYPE_PUBLIC;
+bool doConnect = false;
+bool connected = false;
+unsigned long connectedSince = 0;
+BLEUUID serviceUUID(SERVICE_UUID);
+BLEUUID charUUID(CHARACTERISTIC_UUID);
+
+bool clientPerConnection = false;  // The leaking variant
+
+static void notifyCallback(BLERemoteCharacteristic* pBLERemoteCharacteristic,
+                           uint8_t* pData, size_t length, bool isNotify) {
+  markLinkData();
+}
+
+class MyAdvertisedDeviceCallbacks: public BLEAdvertisedDeviceCallbacks {
+  void onResult(BLEAdvertisedDevice advertisedDevice) {
+    if (advertisedDevice.haveServiceUUID() && advertisedDevice.isAdvertisingService(serviceUUID)) {
+      BLEDevice::getScan()->stop();
+      endScan();
+      memcpy(serverAddress, *advertisedDevice.getAddress().getNative(), ESP_BD_ADDR_LEN);
+      serverAddressType = advertisedDevice.getAddressType();
+      doConnect = true;
+    }
+  }
+};
+
+bool connectToServer() {
+  if (pClient == NULL || clientPerConnection) {
+    pClient = BLEDevice::createClient();
+  }
+
+  pRemoteCharacteristic = connectCharacteristic(pClient, serverAddress, serverAddressType,
+                                                serviceUUID, charUUID);
+  if (pRemoteCharacteristic == NULL) {
+    return false;
+  }
+
+  if (pRemoteCharacteristic->canNotify()) {
+    pRemoteCharacteristic->registerForNotify(notifyCallback);
+  }
+
+  connected = true;
+  connectedSince = millis();
+  startLinkSupervision();
+  return true;
+}
+
+void setupSketch() {
+  pClient = NULL;
+  pRemoteCharacteristic = NULL;
+  doConnect = false;
+  connected = false;
+  linkStage = LINK_OK;
+  linkOutages = 0;
+  memset(outagesFixedBy, 0, sizeof(outagesFixedBy));
+  beginBleClient("", new MyAdvertisedDeviceCallbacks());
+  restartScanning();
+  serviceScan(connected || doConnect, false);
+  markHeapBaseline();
+  reportHeap("setup");
+}
+
+// One pass of loop(), returns true when the link was just lost or never came up
+bool loopSketch(unsigned long holdMs) {
+  bool ended = false;
+  if (doConnect) {
+    reportScanDiscovery();
+    BLEDevice::getScan()->clearResults();
+    if (connectToServer()) {
+      reportHeap("connect");
+    } else {
+      restartScanning();
+      ended = true;
+    }
+    doConnect = false;
+  }
+
+  serviceScan(connected || doConnect, false);
+
+  if (connected) {
+    superviseLink(pClient, pRemoteCharacteristic, notifyCallback);
+  }
+
+  // HEAP_SOAK_TEST, with the hold time set per cycle
+  if (connected && millis() - connectedSince >= holdMs) {
+    pClient->disconnect();
+  }
+
+  if (connected && !pClient->isConnected()) {
+    connected = false;
+    reportHeap("disconnect");
+    restartScanning();
+    ended = true;
+  }
+
+  delay(5);
+  return ended;
+}
+
+// ---------------------------------------------------------------------------
+// The world side - the server and the devices around it
+
+enum CycleKind { CYCLE_SOAK, CYCLE_SERVER_DROP, CYCLE_SILENT, CYCLE_LOST_SUBSCRIPTION, CYCLE_KINDS };
+const char* const CYCLE_NAMES[] = {"soak drop", "server drop", "server silent", "lost subscription"};
+
+struct World {
+  std::mt19937 rng;
+  unsigned long serverVisibleAt;  // The scan hears the server from here on
+  CycleKind kind;
+  unsigned long eventAt;          // Server drop / silence / lost subscription
+  unsigned long holdMs;           // When the sketch drops the link itself
+  unsigned long lastNotify;
+  bool serverQuiet;
+
+  explicit World(unsigned seed) : rng(seed), serverVisibleAt(0), kind(CYCLE_SOAK), eventAt(0),
+                                  holdMs(SOAK_CONNECTED_MS), lastNotify(0), serverQuiet(false) {}
+
+  double uniform() { return std::uniform_real_distribution<double>(0.0, 1.0)(rng); }
+  unsigned long between(unsigned long lo, unsigned long hi) {
+    return std::uniform_int_distribution<unsigned long>(lo, hi)(rng);
+  }
+
+  // A new search - mostly the server is right there, sometimes it is away long
+  // enough for the fast phase to run out
+  void planSearch() {
+    serverVisibleAt = millis() + (uniform() < 0.85 ? between(50, 3000) : between(30000, 90000));
+  }
+
+  // Heard by the scan - decide how this connection goes
+  void planConnection() {
+    hostRefuseConnect = uniform() < 0.05;
+    hostServerServiceCount = uniform() < 0.03 ? SERVER_SERVICE_COUNT - 1 : SERVER_SERVICE_COUNT;
+    double pick = uniform();
+    kind = pick < 0.70 ? CYCLE_SOAK : pick < 0.80 ? CYCLE_SERVER_DROP : pick < 0.90 ? CYCLE_SILENT
+                                                                       : CYCLE_LOST_SUBSCRIPTION;
+    holdMs = SOAK_CONNECTED_MS;
+    eventAt = millis() + between(500, 4500);
+    if (kind == CYCLE_SILENT) {
+      holdMs = 60000;  // Long enough for the supervisor to reconnect first
+    } else if (kind == CYCLE_LOST_SUBSCRIPTION) {
+      holdMs = LINK_RESUBSCRIBE_MS + 6000;  // Long enough for the resubscribe to show
+    }
+    lastNotify = 0;
+    serverQuiet = false;
+  }
+
+  void tick(BLEClient* client, BLERemoteCharacteristic* characteristic) {
+    BLEScan* scan = BLEDevice::getScan();
+    if (scan->hostRunning()) {
+      // Other devices around, a few distinct ones per scan
+      if (uniform() < 0.01) {
+        uint8_t address[ESP_BD_ADDR_LEN] = {0x10, 0x20, 0x30, 0x40, 0x50, (uint8_t)between(0, 7)};
+        scan->hostAdvertisement(BLEAdvertisedDevice(address, "Someone else's fitness tracker", nullptr));
+      }
+      if (millis() >= serverVisibleAt) {
+        planConnection();
+        scan->hostAdvertisement(BLEAdvertisedDevice(SERVER_ADDRESS, "HR Monitor Server (sensing)", SERVICE_UUID));
+      }
+      scan->hostTick();
+    }
+
+    if (client == NULL || !client->isConnected() || characteristic == NULL) {
+      return;
+    }
+    unsigned long now = millis();
+    if (now >= eventAt) {
+      if (kind == CYCLE_SERVER_DROP) {
+        client->hostLinkLost();
+        return;
+      }
+      if (kind == CYCLE_SILENT) {
+        serverQuiet = true;
+      } else if (kind == CYCLE_LOST_SUBSCRIPTION) {
+        characteristic->hostForgetSubscription();
+        kind = CYCLE_SOAK;  // Once - the resubscribe has to fix it
+      }
+    }
+    if (!serverQuiet && now - lastNotify >= 1000) {
+      lastNotify = now;
+      characteristic->hostNotify("HR:72,HYD:1,T:123456");
+    }
+  }
+};
+
+// ---------------------------------------------------------------------------
+
+struct SoakResult {
+  long cycles;
+  long cyclesOf[CYCLE_KINDS];
+  long failedConnects;
+  std::vector<long> blocks;  // Live blocks since setup() after each disconnect
+  std::vector<long> bytes;
+  long blockSpread;
+  long byteSpread;
+  double blockTrend;         // Blocks per 1000 cycles
+  double byteTrend;
+  unsigned long fixedBy[4];  // Link supervisor outages, by the stage that ended them
+  size_t peakBytes;          // Above the setup() baseline
+};
+
+const long WARMUP_CYCLES = 10;  // The client the sketch keeps is made on the first connect
+
+// Least squares slope, per 1000 samples
+double trendPer1000(const std::vector<long>& values, size_t from) {
+  double n = 0, sx = 0, sy = 0, sxx = 0, sxy = 0;
+  for (size_t i = from; i < values.size(); i++) {
+    n++;
+    sx += i;
+    sy += values[i];
+    sxx += (double)i * i;
+    sxy += (double)i * values[i];
+  }
+  double d = n * sxx - sx * sx;
+  return d > 0 ? 1000.0 * (n * sxy - sx * sy) / d : 0;
+}
+
+long spread(const std::vector<long>& values, size_t from) {
+  long lo = values[from], hi = values[from];
+  for (size_t i = from; i < values.size(); i++) {
+    lo = std::min(lo, values[i]);
+    hi = std::max(hi, values[i]);
+  }
+  return hi - lo;
+}
+
+void runSoak(bool leakClient, long cycles, unsigned seed, SoakResult& result) {
+  result = SoakResult();
+  result.blocks.reserve(cycles);  // Before the baseline, so the log does not count
+  result.bytes.reserve(cycles);
+  clientPerConnection = leakClient;
+  World world(seed);
+  hostServerServices = SERVER_SERVICES;
+  hostServerServiceCount = SERVER_SERVICE_COUNT;
+
+  setupSketch();
+  hostPeakBytes = hostLiveBytes;
+  world.planSearch();
+  bool wasConnected = false;
+  CycleKind kind = CYCLE_SOAK;
+  while (result.cycles < cycles) {
+    world.tick(pClient, connected ? pRemoteCharacteristic : NULL);
+    if (connected && !wasConnected) {
+      kind = world.kind;
+    }
+    wasConnected = connected;
+    bool failing = doConnect;
+    if (!loopSketch(world.holdMs)) {
+      continue;
+    }
+    if (failing && !connected && !wasConnected) {
+      result.failedConnects++;
+    } else {
+      result.cyclesOf[kind]++;
+    }
+    wasConnected = false;
+    result.cycles++;
+
+    multi_heap_info_t info;
+    heap_caps_get_info(&info, MALLOC_CAP_DEFAULT);
+    result.blocks.push_back((long)info.allocated_blocks - (long)heapBaselineBlocks);
+    result.bytes.push_back((long)heapBaselineFree - (long)info.total_free_bytes);
+    world.planSearch();
+  }
+
+  // Leave the scan idle for the next run
+  BLEDevice::getScan()->stop();
+  endScan();
+  BLEDevice::getScan()->clearResults();
+
+  size_t from = std::min((size_t)WARMUP_CYCLES, result.blocks.size() - 1);
+  result.blockSpread = spread(result.blocks, from);
+  result.byteSpread = spread(result.bytes, from);
+  result.blockTrend = trendPer1000(result.blocks, from);
+  result.byteTrend = trendPer1000(result.bytes, from);
+  memcpy(result.fixedBy, outagesFixedBy, sizeof(result.fixedBy));
+  result.peakBytes = hostPeakBytes - (hostHeapSize - heapBaselineFree);
+}
+
+void printResult(const char* name, const SoakResult& r) {
+  printf("%s\n", name);
+  printf("  Cycles:                   %ld (", r.cycles);
+  for (int k = 0; k < CYCLE_KINDS; k++) {
+    printf("%s %ld, ", CYCLE_NAMES[k], r.cyclesOf[k]);
+  }
+  printf("failed connect %ld)\n", r.failedConnects);
+  printf("  Live blocks since setup:  %ld after cycle %ld, %ld after the last\n",
+         r.blocks[std::min((size_t)WARMUP_CYCLES, r.blocks.size() - 1)], WARMUP_CYCLES, r.blocks.back());
+  printf("  Spread after warm-up:     %ld blocks, %ld bytes\n", r.blockSpread, r.byteSpread);
+  printf("  Trend:                    %.2f blocks, %.1f bytes per 1000 cycles\n", r.blockTrend, r.byteTrend);
+  printf("  Link supervisor:          %lu outages came back, %lu fixed by resubscribing, %lu by reconnecting\n",
+         r.fixedBy[LINK_STALE], r.fixedBy[LINK_RESUBSCRIBED], r.fixedBy[LINK_RECONNECTING]);
+  printf("  Peak heap above setup:    %zu bytes\n", r.peakBytes);
+}
+
+int main(int argc, char** argv) {
+  long cycles = argc > 1 ? atol(argv[1]) : 5000;
+  unsigned seed = argc > 2 ? (unsigned)atoi(argv[2]) : 514;
+  if (cycles <= WARMUP_CYCLES) {
+    fprintf(stderr, "Need more than %ld cycles\n", WARMUP_CYCLES);
+    return 2;
+  }
+
+  SoakResult asBuilt, leaking;
+  runSoak(false, cycles, seed, asBuilt);
+  runSoak(true, cycles, seed, leaking);
+
+  printf("Heap soak over %ld connect/disconnect cycles (seed %u)\n\n", cycles, seed);
+  printResult("As built (one client, reused)", asBuilt);
+  printResult("New client per connection", leaking);
+
+  bool flat = asBuilt.blockSpread == 0 && asBuilt.byteSpread == 0;
+  bool caught = leaking.blockTrend >= 500.0;  // One client per connection at least
+  printf("\n%s\n", flat ? "OK: the live heap comes back to the same level after every disconnect"
+                        : "FAIL: the live heap drifts across disconnects");
+  printf("%s\n", caught ? "OK: the leaking variant shows up as a trend"
+                        : "FAIL: the leaking variant was not caught");
+  return flat && caught ? 0 : 1;
+}
@@ -2,21 +2,29 @@
   Heart Rate Monitor using MAX30105
   Measures heart rate for 5 seconds and displays a summary
   Based on SparkFun's PBA algorithm example
+  The IR LED current follows the finger (LED AGC), so the signal is neither starved nor saturated
+  An autocorrelation estimate covers the first seconds, before enough beats are averaged
 */
 
 #include <Wire.h>
 #include "MAX30105.h"
 #include "heartRate.h"
 
+// Shared components from WearableCore.h - only these are compiled into this image
+#define WEARABLE_RATE_AVERAGE 1
+#define WEARABLE_BPM_ESTIMATOR 1
+#define WEARABLE_LED_AGC 1
+#include "WearableCore.h"
+
 MAX30105 particleSensor;
 
 // Heart rate variables
 const byte RATE_SIZE = 8; // Increased for better averaging over 5 seconds
-byte rates[RATE_SIZE];
-byte rateSpot = 0;
+RateAverager beatRates = {{0}, RATE_SIZE, 0, 0};
 long lastBeat = 0;
 float beatsPerMinute;
 int beatAvg = 0;
+BpmEstimator bpmEstimator;  // setup() runs 400 Hz with 4x averaging -> 100 samples/s
 
 // Timing for 5-second sampling
 unsigned long startTime;
@@ -24,6 +32,9 @@ const unsigned long samplingPeriod = 5000; // 5 seconds in milliseconds
 bool samplingComplete = false;
 bool fingerDetected = false;
 
+// LED AGC state - the controller is in WearableCore.h
+LedAgc agc;
+
 void setup() {
   Serial.begin(115200);
   Serial.println("Heart Rate Monitor - 5 Second Summary");
@@ -39,6 +50,8 @@ void setup() {
   particleSensor.setup();
   particleSensor.setPulseAmplitudeRed(0x0A); // Turn Red LED to low to indicate sensor is running
   particleSensor.setPulseAmplitudeGreen(0);  // Turn off Green LED
+  resetLedAgc(agc, 0x1F, 400);  // IR amplitude and sample rate that setup() selects
+  resetBpmEstimator(bpmEstimator, 100);
   
   Serial.println("Place your index finger on the sensor with steady pressure.");
   
@@ -48,6 +61,9 @@ void setup() {
 
 void loop() {
   long irValue = particleSensor.getIR();
+  if (serviceLedAgc(agc, particleSensor, irValue, millis())) {
+    clearBpmEstimator(bpmEstimator);  // The step would show up as a rhythm
+  }
   
   // Check if finger is detected
   if (irValue < 50000) {
@@ -55,6 +71,7 @@ void loop() {
       Serial.println("Finger removed. Please place finger on sensor.");
       fingerDetected = false;
       resetMeasurement();
+      clearBpmEstimator(bpmEstimator);
     }
     return;
   } else if (!fingerDetected) {
@@ -63,6 +80,8 @@ void loop() {
     resetMeasurement();
   }
   
+  addBpmSample(bpmEstimator, irValue);
+  
   // Beat detection
   if (checkForBeat(irValue)) {
     long delta = millis() - lastBeat;
@@ -70,22 +89,10 @@ void loop() {
     
     beatsPerMinute = 60 / (delta / 1000.0);
     
-    if (beatsPerMinute < 255 && beatsPerMinute > 20) {
-      rates[rateSpot++] = (byte)beatsPerMinute;
-      rateSpot %= RATE_SIZE;
-      
-      // Calculate average BPM
-      beatAvg = 0;
-      byte validValues = 0;
-      for (byte x = 0; x < RATE_SIZE; x++) {
-        if (rates[x] > 0) {
-          beatAvg += rates[x];
-          validValues++;
-        }
-      }
-      if (validValues > 0) {
-        beatAvg /= validValues;
-      }
+    // Skip beats while the signal settles after an AGC step
+    if (beatsPerMinute < 255 && beatsPerMinute > 20 && !agcSettling(agc, millis())) {
+      // Average over the beats collected so far
+      beatAvg = addRate(beatRates, (byte)beatsPerMinute);
     }
   }
   
@@ -104,23 +111,30 @@ void loop() {
     Serial.print(", BPM=");
     Serial.print(beatsPerMinute);
     Serial.print(", Avg BPM=");
-    Serial.println(beatAvg);
+    Serial.print(beatAvg);
+    Serial.print(", Est=");
+    Serial.println(bpmEstimator.valid ? bpmEstimator.bpm : 0.0f, 1);
     lastStatusTime = millis();
   }
 }
 
 void displaySummary() {
   Serial.println("\n--- 5-SECOND MEASUREMENT SUMMARY ---");
-  if (beatAvg > 0) {
+  // Too few beats for an average right after placement - fall back to the estimate
+  int heartRate = beatAvg;
+  if (heartRate == 0 && bpmEstimator.valid) {
+    heartRate = (int)(bpmEstimator.bpm + 0.5f);
+  }
+  if (heartRate > 0) {
     Serial.print("Average Heart Rate: ");
-    Serial.print(beatAvg);
-    Serial.println(" BPM");
+    Serial.print(heartRate);
+    Serial.println(beatAvg > 0 ? " BPM" : " BPM (autocorrelation estimate)");
     
     // Add a simple heart rate status
     Serial.print("Status: ");
-    if (beatAvg < 60) Serial.println("Low heart rate");
-    else if (beatAvg < 100) Serial.println("Normal heart rate");
-    else if (beatAvg < 120) Serial.println("Elevated heart rate");
+    if (heartRate < 60) Serial.println("Low heart rate");
+    else if (heartRate < 100) Serial.println("Normal heart rate");
+    else if (heartRate < 120) Serial.println("Elevated heart rate");
     else Serial.println("High heart rate");
   } else {
     Serial.println("Unable to determine heart rate. Please check sensor position.");
@@ -134,8 +148,5 @@ void resetMeasurement() {
   samplingComplete = false;
   
   // Clear the rates array
-  for (byte i = 0; i < RATE_SIZE; i++) {
-    rates[i] = 0;
-  }
-  rateSpot = 0;
+  resetRates(beatRates, RATE_SIZE);
 }
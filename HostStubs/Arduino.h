@@ -0,0 +1,47 @@
+/*
+  Host Stand-in for the Arduino Core
+  Just enough of Arduino.h for the WearableCore.h blocks the host harnesses build
+  with it: a millis() clock the harness moves forward itself, and a Serial that
+  prints to a FILE (or nowhere) instead of the UART.
+*/
+
+#ifndef HOST_ARDUINO_H
+#define HOST_ARDUINO_H
+
+#include <stddef.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <string.h>
+
+#define HEX 16
+
+// Simulated time - only delay() and the harness move it
+inline unsigned long hostMillis = 0;
+
+inline unsigned long millis() {
+  return hostMillis;
+}
+
+inline void delay(unsigned long ms) {
+  hostMillis += ms;
+}
+
+class HostSerial {
+public:
+  FILE* out = nullptr;  // nullptr drops the output
+
+  void print(const char* s) { if (out) fputs(s, out); }
+  void print(char c) { if (out) fputc(c, out); }
+  void print(int v, int base = 10) { print((long)v, base); }
+  void print(unsigned int v, int base = 10) { print((unsigned long)v, base); }
+  void print(long v, int base = 10) { if (out) fprintf(out, base == HEX ? "%lX" : "%ld", v); }
+  void print(unsigned long v, int base = 10) { if (out) fprintf(out, base == HEX ? "%lX" : "%lu", v); }
+  void print(double v, int digits = 2) { if (out) fprintf(out, "%.*f", digits, v); }
+  void println() { print('\n'); }
+  template <typename T> void println(T v) { print(v); println(); }
+  template <typename T> void println(T v, int format) { print(v, format); println(); }
+};
+
+inline HostSerial Serial;
+
+#endif
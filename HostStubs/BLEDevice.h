@@ -0,0 +1,312 @@
+/*
+  Host Stand-in for the ESP32 Arduino BLE Client
+  The scan and client side of BLEDevice.h as WearableCore.h and DisplayDeviceNew use
+  it, with no radio behind it. What it keeps is where the library allocates and frees:
+  - BLEScan keeps a heap copy of every device it hears until clearResults() or the
+    next start(), and hands onResult() another copy by value
+  - BLEClient builds its service, characteristic and descriptor tree with new on the
+    first lookup of a connection and deletes all of it when the link goes down
+  - BLEDevice::createClient() allocates a client the sketch owns for good
+  The harness plays the radio through the host*() calls: advertisements heard,
+  notifications sent, the server dropping the link or forgetting the subscription.
+*/
+
+#ifndef HOST_BLE_DEVICE_H
+#define HOST_BLE_DEVICE_H
+
+#include <functional>
+#include <map>
+#include <string>
+#include <Arduino.h>
+
+typedef uint8_t esp_bd_addr_t[6];
+#define ESP_BD_ADDR_LEN 6
+typedef enum { BLE_ADDR_TYPE_PUBLIC = 0, BLE_ADDR_TYPE_RANDOM = 1 } esp_ble_addr_type_t;
+
+class BLEUUID {
+public:
+  BLEUUID() { text[0] = '\0'; }
+  BLEUUID(const char* uuid) { snprintf(text, sizeof(text), "%s", uuid); }
+  BLEUUID(uint16_t uuid) { snprintf(text, sizeof(text), "0000%04x-0000-1000-8000-00805f9b34fb", uuid); }
+  bool equals(const BLEUUID& other) const { return strcmp(text, other.text) == 0; }
+  std::string toString() const { return text; }
+
+private:
+  char text[37];  // Held inline like the library's esp_bt_uuid_t, no allocation
+};
+
+class BLEAddress {
+public:
+  BLEAddress(const uint8_t* address) { memcpy(native, address, ESP_BD_ADDR_LEN); }
+  esp_bd_addr_t* getNative() { return &native; }
+  std::string toString() const {
+    char text[18];
+    snprintf(text, sizeof(text), "%02x:%02x:%02x:%02x:%02x:%02x",
+             native[0], native[1], native[2], native[3], native[4], native[5]);
+    return text;
+  }
+
+private:
+  esp_bd_addr_t native;
+};
+
+class BLEAdvertisedDevice {
+public:
+  BLEAdvertisedDevice(const uint8_t* address, const char* name, const char* serviceUuid)
+      : address(address), name(name), service(serviceUuid ? serviceUuid : "") {}
+  bool haveServiceUUID() { return !service.toString().empty(); }
+  bool isAdvertisingService(BLEUUID uuid) { return service.equals(uuid); }
+  BLEAddress getAddress() { return address; }
+  esp_ble_addr_type_t getAddressType() { return BLE_ADDR_TYPE_PUBLIC; }
+
+private:
+  BLEAddress address;
+  std::string name;  // Stands in for the name and payload the library copies around
+  BLEUUID service;
+};
+
+class BLEScanResults {
+public:
+  explicit BLEScanResults(int count) : count(count) {}
+  int getCount() { return count; }
+
+private:
+  int count;
+};
+
+class BLEAdvertisedDeviceCallbacks {
+public:
+  virtual ~BLEAdvertisedDeviceCallbacks() {}
+  virtual void onResult(BLEAdvertisedDevice advertisedDevice) = 0;
+};
+
+class BLEScan {
+public:
+  ~BLEScan() { clearResults(); }
+
+  void setAdvertisedDeviceCallbacks(BLEAdvertisedDeviceCallbacks* callbacks, bool wantDuplicates = false,
+                                    bool shouldParse = true) {
+    this->callbacks = callbacks;
+    this->wantDuplicates = wantDuplicates;
+    (void)shouldParse;
+  }
+  void setActiveScan(bool active) { (void)active; }
+  void setInterval(uint16_t interval) { (void)interval; }
+  void setWindow(uint16_t window) { (void)window; }
+
+  // Non-blocking, 'complete' runs when 'duration' seconds have passed
+  bool start(uint32_t duration, void (*complete)(BLEScanResults), bool is_continue = false) {
+    if (!is_continue) {
+      clearResults();
+    }
+    running = true;
+    startedAt = millis();
+    durationMs = duration * 1000UL;
+    this->complete = complete;
+    return true;
+  }
+  void stop() { running = false; }  // Does not run the completion callback
+
+  void clearResults() {
+    for (auto& entry : results) {
+      delete entry.second;
+    }
+    results.clear();
+  }
+
+  // Radio side, driven by the harness
+  bool hostRunning() const { return running; }
+  size_t hostResultCount() const { return results.size(); }
+
+  void hostAdvertisement(const BLEAdvertisedDevice& device) {
+    if (!running) {
+      return;
+    }
+    BLEAdvertisedDevice heard = device;
+    std::string key = heard.getAddress().toString();
+    auto found = results.find(key);
+    if (found != results.end() && !wantDuplicates) {
+      return;
+    }
+    if (found == results.end()) {
+      results[key] = new BLEAdvertisedDevice(device);
+    }
+    if (callbacks != nullptr) {
+      callbacks->onResult(heard);
+    }
+  }
+
+  void hostTick() {
+    if (running && millis() - startedAt >= durationMs) {
+      running = false;
+      if (complete != nullptr) {
+        complete(BLEScanResults((int)results.size()));
+      }
+    }
+  }
+
+private:
+  BLEAdvertisedDeviceCallbacks* callbacks = nullptr;
+  bool wantDuplicates = false;
+  bool running = false;
+  unsigned long startedAt = 0;
+  unsigned long durationMs = 0;
+  void (*complete)(BLEScanResults) = nullptr;
+  std::map<std::string, BLEAdvertisedDevice*> results;
+};
+
+// What the simulated server exposes - set up by the harness before the first connect
+struct HostGattService {
+  const char* uuid;
+  const char* const* characteristics;
+  int characteristicCount;
+};
+
+inline const HostGattService* hostServerServices = nullptr;
+inline int hostServerServiceCount = 0;
+inline bool hostRefuseConnect = false;
+
+class BLERemoteDescriptor {
+public:
+  explicit BLERemoteDescriptor(BLEUUID uuid) : uuid(uuid) {}
+
+private:
+  BLEUUID uuid;
+};
+
+class BLERemoteCharacteristic;
+typedef std::function<void(BLERemoteCharacteristic*, uint8_t*, size_t, bool)> notify_callback;
+
+class BLERemoteCharacteristic {
+public:
+  explicit BLERemoteCharacteristic(BLEUUID uuid) : uuid(uuid) {}
+  ~BLERemoteCharacteristic() {
+    for (auto& entry : descriptors) {
+      delete entry.second;
+    }
+  }
+
+  BLEUUID getUUID() { return uuid; }
+  bool canNotify() { return true; }
+
+  // Looks up the CCCD on first use and writes it, as the library does
+  void registerForNotify(notify_callback callback, bool notifications = true,
+                         bool descriptorRequiresRegistration = true) {
+    (void)notifications;
+    (void)descriptorRequiresRegistration;
+    if (descriptors.empty()) {
+      BLEUUID cccd((uint16_t)0x2902);
+      descriptors[cccd.toString()] = new BLERemoteDescriptor(cccd);
+    }
+    notify = callback;
+    subscribed = callback != nullptr;
+  }
+
+  // Server side, driven by the harness
+  void hostNotify(const char* text) {
+    if (subscribed && notify) {
+      notify(this, (uint8_t*)text, strlen(text), true);
+    }
+  }
+  void hostForgetSubscription() { subscribed = false; }
+
+private:
+  BLEUUID uuid;
+  std::map<std::string, BLERemoteDescriptor*> descriptors;
+  notify_callback notify;
+  bool subscribed = false;
+};
+
+class BLERemoteService {
+public:
+  explicit BLERemoteService(const HostGattService& service) : uuid(service.uuid), service(service) {}
+  ~BLERemoteService() {
+    for (auto& entry : characteristics) {
+      delete entry.second;
+    }
+  }
+
+  BLERemoteCharacteristic* getCharacteristic(BLEUUID charUuid) {
+    if (characteristics.empty()) {
+      for (int i = 0; i < service.characteristicCount; i++) {
+        BLEUUID found(service.characteristics[i]);
+        characteristics[found.toString()] = new BLERemoteCharacteristic(found);
+      }
+    }
+    auto found = characteristics.find(charUuid.toString());
+    return found == characteristics.end() ? nullptr : found->second;
+  }
+
+private:
+  BLEUUID uuid;
+  const HostGattService& service;
+  std::map<std::string, BLERemoteCharacteristic*> characteristics;
+};
+
+class BLEClient {
+public:
+  ~BLEClient() { clearServices(); }
+
+  bool connect(BLEAddress address, esp_ble_addr_type_t type = BLE_ADDR_TYPE_PUBLIC, uint32_t timeout = 30000) {
+    (void)address;
+    (void)type;
+    (void)timeout;
+    clearServices();  // Anything left from the previous connection
+    if (hostRefuseConnect) {
+      return false;
+    }
+    connected = true;
+    return true;
+  }
+
+  // The first lookup of a connection discovers every service the server has
+  BLERemoteService* getService(BLEUUID serviceUuid) {
+    if (!connected) {
+      return nullptr;
+    }
+    if (services.empty()) {
+      for (int i = 0; i < hostServerServiceCount; i++) {
+        services[BLEUUID(hostServerServices[i].uuid).toString()] = new BLERemoteService(hostServerServices[i]);
+      }
+    }
+    auto found = services.find(serviceUuid.toString());
+    return found == services.end() ? nullptr : found->second;
+  }
+
+  void disconnect() { hostLinkLost(); }
+  bool isConnected() { return connected; }
+
+  // The disconnect event - whichever side closed the link, the remote tree goes
+  void hostLinkLost() {
+    connected = false;
+    clearServices();
+  }
+
+private:
+  void clearServices() {
+    for (auto& entry : services) {
+      delete entry.second;
+    }
+    services.clear();
+  }
+
+  bool connected = false;
+  std::map<std::string, BLERemoteService*> services;
+};
+
+class BLEDevice {
+public:
+  static void init(const char* name) {
+    (void)name;
+    if (scan == nullptr) {
+      scan = new BLEScan();
+    }
+  }
+  static BLEScan* getScan() { return scan; }
+  static BLEClient* createClient() { return new BLEClient(); }
+
+private:
+  static inline BLEScan* scan = nullptr;
+};
+
+#endif
@@ -0,0 +1,42 @@
+/*
+  Host Stand-in for the ESP-IDF Heap Capabilities API
+  heap_caps_get_info() reports the blocks and bytes the harness counts in its own
+  operator new/delete, so markHeapBaseline() and reportHeap() run unchanged.
+*/
+
+#ifndef HOST_ESP_HEAP_CAPS_H
+#define HOST_ESP_HEAP_CAPS_H
+
+#include <stddef.h>
+#include <stdint.h>
+
+#define MALLOC_CAP_DEFAULT (1 << 12)
+
+typedef struct {
+  size_t total_free_bytes;
+  size_t total_allocated_bytes;
+  size_t largest_free_block;
+  size_t minimum_free_bytes;
+  size_t allocated_blocks;
+  size_t free_blocks;
+  size_t total_blocks;
+} multi_heap_info_t;
+
+// Kept up to date by the harness's allocator
+inline size_t hostHeapSize = 320 * 1024;  // Roughly the ESP32's DRAM heap
+inline size_t hostLiveBlocks = 0;
+inline size_t hostLiveBytes = 0;
+inline size_t hostPeakBytes = 0;
+
+inline void heap_caps_get_info(multi_heap_info_t* info, uint32_t caps) {
+  (void)caps;
+  info->total_free_bytes = hostHeapSize - hostLiveBytes;
+  info->total_allocated_bytes = hostLiveBytes;
+  info->largest_free_block = hostHeapSize - hostLiveBytes;
+  info->minimum_free_bytes = hostHeapSize - hostPeakBytes;
+  info->allocated_blocks = hostLiveBlocks;
+  info->free_blocks = 1;
+  info->total_blocks = hostLiveBlocks + 1;
+}
+
+#endif
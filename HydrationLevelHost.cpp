@@ -0,0 +1,207 @@
+/*
+  Host Harness for the Graded Hydration Filter
+  Feeds the WearableCore.h hydration filter with synthetic touchRead() bursts the
+  way SensingDeviceNew's capacitive mode takes them - one burst every 200 ms - and
+  scores the level against the hydration the electrode was given.
+
+  The synthetic electrode (S2/S3 style, contact raises the reading):
+  - No-contact baseline drifting by temperature: a slow swing plus a steady ramp
+  - Gaussian sample noise and occasional spikes (radio bursts, a shifting contact)
+  - Contact sessions at a random hydration level, pressed on over half a second,
+    separated by gaps without contact
+
+  Reported, for the filter as built and for two stripped-down variants (a single
+  sample per reading, and a baseline fixed at power-on):
+  - Level error once contact has settled, and how much of it is within 10 %
+  - Readings that claim contact without any, and contact readings missed
+  - Time from contact to the first reading with confidence >= 50
+  - CPU per addHydrationBurst() call (touchRead() itself is timed on the device)
+  - Bursts too short to trim: an empty one must change nothing, three samples must
+    read as their median and leave the noise estimate alone
+
+  Build and run:
+    g++ -O2 -std=c++11 -o hydration_host HydrationLevelHost.cpp
+    ./hydration_host [hours] [seed]
+*/
+
+#include <algorithm>
+#include <chrono>
+#include <cmath>
+#include <cstdio>
+#include <cstdlib>
+#include <random>
+#include <vector>
+
+#define WEARABLE_HYDRATION_LEVEL 1
+#include "WearableCore.h"
+
+#define READ_MS 200                // SensingDeviceNew's HYDRATION_READ_MS
+#define BURST 16                   // SensingDeviceNew's HYDRATION_BURST
+#define DRY_DELTA 2000             // Calibration the sensor is given
+#define WET_DELTA 12000
+#define BASELINE 30000             // No-contact reading at power-on
+#define DRIFT_SWING 2500           // Temperature swing of the baseline
+#define DRIFT_PERIOD_S 1800
+#define DRIFT_PER_HOUR 1000
+#define NOISE_SIGMA 80
+#define SPIKE_CHANCE 0.02
+#define SPIKE_SIZE 1500
+#define CONTACT_S 60
+#define GAP_S 30
+#define PRESS_S 0.5
+#define SETTLED_S 2.0              // Contact readings scored after this long
+#define CONFIDENT 50
+
+enum Variant { FULL, SINGLE_SAMPLE, FIXED_BASELINE, VARIANTS };
+const char* VARIANT_NAMES[VARIANTS] = {"as built", "1 sample/reading", "fixed baseline"};
+
+struct Score {
+  std::vector<double> errors;
+  long falseContact = 0;
+  long missedContact = 0;
+  long idleReadings = 0;
+  long settledReadings = 0;
+  std::vector<double> confidentAfter;
+  double confidenceSum = 0;
+};
+
+double percentile(std::vector<double> values, double p) {
+  if (values.empty()) {
+    return 0;
+  }
+  std::sort(values.begin(), values.end());
+  return values[(size_t)(p * (values.size() - 1) + 0.5)];
+}
+
+int main(int argc, char** argv) {
+  double hours = argc > 1 ? atof(argv[1]) : 2.0;
+  unsigned seed = argc > 2 ? (unsigned)atoi(argv[2]) : 514;
+  std::mt19937 rng(seed);
+  std::normal_distribution<double> noise(0.0, NOISE_SIGMA);
+  std::uniform_real_distribution<double> unit(0.0, 1.0);
+
+  HydrationSensor sensors[VARIANTS];
+  Score scores[VARIANTS];
+  bool confident[VARIANTS] = {false};
+  for (int v = 0; v < VARIANTS; v++) {
+    resetHydrationSensor(sensors[v], true, DRY_DELTA, WET_DELTA);
+  }
+  int32_t powerOnBaseline = 0;
+  double filterNs = 0;
+  double maxFilterNs = 0;
+
+  long readings = (long)(hours * 3600 * 1000 / READ_MS);
+  double sessionStart = GAP_S;
+  double trueLevel = 100 * unit(rng);
+  for (long n = 0; n < readings; n++) {
+    double t = n * READ_MS / 1000.0;
+    if (t >= sessionStart + CONTACT_S + GAP_S) {
+      sessionStart += CONTACT_S + GAP_S;
+      trueLevel = 100 * unit(rng);
+    }
+    double inContact = t - sessionStart;
+    bool contact = inContact >= 0 && inContact < CONTACT_S;
+    double press = contact ? std::min(1.0, inContact / PRESS_S) : 0.0;
+    double baseline = BASELINE + DRIFT_SWING * sin(2 * M_PI * t / DRIFT_PERIOD_S) +
+                      DRIFT_PER_HOUR * t / 3600;
+    double delta = press * (DRY_DELTA + trueLevel / 100 * (WET_DELTA - DRY_DELTA));
+
+    uint32_t burst[BURST];
+    for (int i = 0; i < BURST; i++) {
+      double sample = baseline + delta + noise(rng);
+      if (unit(rng) < SPIKE_CHANCE) {
+        sample += (unit(rng) < 0.5 ? -1 : 1) * SPIKE_SIZE;
+      }
+      burst[i] = (uint32_t)std::max(0.0, sample);
+    }
+
+    for (int v = 0; v < VARIANTS; v++) {
+      HydrationSensor &h = sensors[v];
+      uint32_t samples[BURST];
+      std::copy(burst, burst + BURST, samples);
+      if (v == FIXED_BASELINE && h.readings > 0) {
+        h.baseline = powerOnBaseline;
+      }
+      auto start = std::chrono::steady_clock::now();
+      addHydrationBurst(h, samples, v == SINGLE_SAMPLE ? 1 : BURST);
+      double ns = std::chrono::duration<double, std::nano>(std::chrono::steady_clock::now() - start).count();
+      if (v == FULL) {
+        filterNs += ns;
+        maxFilterNs = std::max(maxFilterNs, ns);
+      }
+      if (v == FIXED_BASELINE && h.readings == 1) {
+        powerOnBaseline = h.baseline;
+      }
+
+      Score &score = scores[v];
+      if (!contact) {
+        score.idleReadings++;
+        score.falseContact += h.contact;
+        confident[v] = false;
+        continue;
+      }
+      if (!confident[v] && h.confidence >= CONFIDENT) {
+        confident[v] = true;
+        score.confidentAfter.push_back(inContact);
+      }
+      if (inContact >= SETTLED_S) {
+        score.settledReadings++;
+        score.missedContact += !h.contact;
+        score.confidenceSum += h.confidence;
+        score.errors.push_back(fabs(h.level - trueLevel));
+      }
+    }
+  }
+
+  printf("Synthetic electrode: %.1f h, %ld readings of %d samples every %d ms, seed %u\n",
+         hours, readings, BURST, READ_MS, seed);
+  printf("Baseline %d +-%d over %d s, +%d/h; noise sigma %d, %.0f %% spikes of %d; "
+         "dry %d, wet %d\n",
+         BASELINE, DRIFT_SWING, DRIFT_PERIOD_S, DRIFT_PER_HOUR, NOISE_SIGMA,
+         100 * SPIKE_CHANCE, SPIKE_SIZE, DRY_DELTA, WET_DELTA);
+  printf("%-18s%11s%10s%10s%10s%10s%11s%10s\n", "Variant", "mean err", "p95 err", "<=10 %",
+         "false", "missed", "confident", "mean conf");
+  for (int v = 0; v < VARIANTS; v++) {
+    Score &score = scores[v];
+    double mean = 0;
+    long close = 0;
+    for (double e : score.errors) {
+      mean += e;
+      close += e <= 10.0;
+    }
+    mean = score.errors.empty() ? 0 : mean / score.errors.size();
+    printf("%-18s%10.1f%%%9.1f%%%9.1f%%%9.2f%%%9.2f%%%9.1f s%9.0f%%\n", VARIANT_NAMES[v], mean,
+           percentile(score.errors, 0.95),
+           score.errors.empty() ? 0.0 : 100.0 * close / score.errors.size(),
+           score.idleReadings ? 100.0 * score.falseContact / score.idleReadings : 0.0,
+           score.settledReadings ? 100.0 * score.missedContact / score.settledReadings : 0.0,
+           percentile(score.confidentAfter, 0.5),
+           score.settledReadings ? score.confidenceSum / score.settledReadings : 0.0);
+  }
+  printf("CPU per reading (addHydrationBurst, %d samples): mean %.0f ns, max %.0f ns\n", BURST,
+         filterNs / readings, maxFilterNs);
+
+  HydrationSensor edge;
+  resetHydrationSensor(edge, true, DRY_DELTA, WET_DELTA);
+  uint32_t none[1] = {BASELINE};
+  addHydrationBurst(edge, none, 0);
+  bool emptyIgnored = edge.readings == 0 && edge.baseline == 0;
+  uint32_t three[3] = {BASELINE + SPIKE_SIZE, BASELINE, BASELINE + 10};
+  addHydrationBurst(edge, three, 3);
+  int32_t medianRead = hydrationBaseline(edge);
+  HydrationSensor settled = sensors[FULL];
+  uint32_t two[2] = {BASELINE, BASELINE + SPIKE_SIZE};
+  addHydrationBurst(settled, two, 2);
+  bool noiseKept = settled.noise == sensors[FULL].noise;
+  printf("Short bursts: empty %s, 3 samples read %d (median %d), 2 samples %s the noise\n",
+         emptyIgnored ? "ignored" : "CHANGED THE SENSOR", (int)medianRead, BASELINE + 10,
+         noiseKept ? "keep" : "CHANGE");
+
+  // A filter that misreads settled contact, claims contact without any, or reads a short
+  // burst as anything but its median is broken
+  Score &full = scores[FULL];
+  long close = std::count_if(full.errors.begin(), full.errors.end(), [](double e) { return e <= 10.0; });
+  bool ok = !full.errors.empty() && (double)close / full.errors.size() >= 0.9 &&
+            full.falseContact == 0 && emptyIgnored && medianRead == BASELINE + 10 && noiseKept;
+  return ok ? 0 : 1;
+}
@@ -0,0 +1,544 @@
+"""
+Power Model - battery life from the power-model spreadsheet, swept over firmware settings.
+
+The "Simple Power Model" workbook lists the power of every component mode, the share
+of time each mode is used in three profiles ("off", "sensing", "interactive") and the
+hours per day spent in each profile. Its answer is
+
+    days = capacity x voltage x efficiency / sum over profiles(hours x sum(power x duty))
+
+This tool reads the workbook itself (an .xlsx is a zip of XML, no spreadsheet library
+needed) and evaluates the same formula, with the duty cycles taken from the sheet,
+overridden on the command line, or measured from a host simulation of the sketches:
+
+  sensing   MAX3010x sampling at --rate (LED pulses and one loop() pass per FIFO
+            sample), the HR publish policy deciding what goes on air, connection
+            events on the live or background profile
+  display   redraws at most every --refresh ms when new data is in, the needle moved
+            by the HR >= 60 condition, status LED, backlight, connection events
+
+The simulation replays a synthetic heart-rate day (AnomalyDetector.synthetic_history)
+through the firmware's scheduling rules in 100 ms steps for the hours the device is
+awake; the sheet's "off" profile covers the rest of the day. Sheet rows the simulation
+does not model keep the sheet's duty cycles. The radio, LEDs, stepper and backlight
+have no usable rows in the sheet (its radio rows are 0), so their power comes from the
+same current estimates as the sketches' energy accounting (WearableCore.h).
+
+Motor policies: "hold" is what DisplayDeviceNew does - the coils stay energised from
+the first step until the link drops; "release" de-energises them after every move;
+"off" leaves the needle out.
+
+  model      the sheet's own numbers, optionally with --duty overrides
+  simulate   one configuration, with the power breakdown of both devices
+  sweep      a grid of sample rate, notify interval, display refresh and motor policy
+             run in a process pool; prints the configurations on the Pareto front of
+             battery life (whichever device runs flat first) against the age of the
+             value on screen
+  measured   battery life from the DIAG records in serial logs of real devices
+
+Usage:
+  python PowerModel.py model
+  python PowerModel.py --capacity 1000 model --duty interactive:MAX30100.On=0.5
+  python PowerModel.py simulate --rate 100 --notify 1000 --refresh 1000 --motor release
+  python PowerModel.py sweep --workers 8
+  python PowerModel.py measured sensing.log display.log
+"""
+
+import argparse
+import itertools
+import re
+import time
+import xml.etree.ElementTree as ET
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+REPO = Path(__file__).resolve().parent
+DEFAULT_WORKBOOK = REPO / "Simple_ Power Model for TECHIN514_Yishuai Zheng.xlsx"
+SHEET_NAME = "System Parameters"
+XLSX_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+
+# Firmware constants the simulation follows
+STEP_MS = 100                 # SensingDeviceNew updateInterval - how often the policy runs
+HR_THRESHOLD = 60             # hrPolicy threshold and the display's conditionTriggered level
+HR_DEADBAND = 2
+HR_KEEPALIVE_MS = 5000
+SAMPLE_AVERAGE = 4            # MAX3010x FIFO averaging, one loop() pass per averaged sample
+LED_PULSE_US = 411            # AGC_PULSE_WIDTH_US
+LED_MA_PER_STEP = 0.2
+IR_AMPLITUDE = 0x1F           # Config defaults "ir" and "red"
+RED_AMPLITUDE = 0x0A
+LIVE_INTERVAL_MS = 30.0       # LIVE_PROFILE max interval
+BACKGROUND_EVENT_MS = 2500.0  # BACKGROUND_PROFILE: 500 ms interval, latency 4
+PROFILE_IDLE_MS = 30000       # No finger for this long drops to background
+NEEDLE_STEPS = 160            # TOTAL_STEPS
+NEEDLE_STEP_MS = 5            # MOTOR_UPDATE_INTERVAL
+
+# Estimates for what the sheet leaves out - the sketches' energy accounting uses the same
+SUPPLY_V = 3.3
+RADIO_ON_MW = 100 * SUPPLY_V  # RADIO_ON_UA
+CONN_EVENT_RADIO_MS = 1.0
+NOTIFY_RADIO_MS = 0.5
+STEPPER_MW = 130 * SUPPLY_V   # STEPPER_COIL_UA
+STATUS_LED_MW = 10 * SUPPLY_V
+BACKLIGHT_MW = 40 * SUPPLY_V
+LOOP_PASS_US = 600            # Sensing loop() per FIFO sample: I2C read, beat filter, SQI, debug line
+NOTIFY_CPU_US = 300           # Formatting and handing a notification to the stack
+REDRAW_MS = 45                # DisplayDeviceNew updateDisplay() over SPI
+
+MOTOR_POLICIES = ("hold", "release", "off")
+DIAG_RECORD = re.compile(r"DIAG:(\S+)")
+
+
+class PowerModel(NamedTuple):
+    power: Dict[str, float]                # "Component.Mode" -> mW
+    profiles: Dict[str, Dict[str, float]]  # Profile -> "Component.Mode" -> share of time
+    hours: Dict[str, float]                # Profile -> hours per day
+    capacity_mah: float
+    voltage: float
+    efficiency: float
+    sheet_days: Optional[float]            # The workbook's cached "Days of Use"
+
+
+class Config(NamedTuple):
+    rate: int          # MAX3010x sample rate (Hz), before FIFO averaging
+    notify: int        # hrPolicy minInterval (ms)
+    refresh: int       # Display redraw interval (ms)
+    motor: str         # "hold", "release" or "off"
+
+
+class Run(NamedTuple):
+    config: Config
+    sensing_mw: Dict[str, float]   # Awake power per load
+    display_mw: Dict[str, float]
+    sensing_days: float
+    display_days: float
+    age_s: float                   # Mean age of the heart rate on screen
+    notifications_per_hour: float
+    redraws_per_hour: float
+
+
+def split_ref(ref: str):
+    letters = ref.rstrip("0123456789")
+    return letters, int(ref[len(letters):])
+
+
+def read_cells(path: Path, sheet: str) -> Dict[str, object]:
+    """Cell reference -> value (float or str) of one worksheet, cached results for formulas."""
+    with zipfile.ZipFile(path) as book:
+        strings: List[str] = []
+        if "xl/sharedStrings.xml" in book.namelist():
+            root = ET.fromstring(book.read("xl/sharedStrings.xml"))
+            strings = ["".join(t.text or "" for t in item.iter(f"{{{XLSX_NS}}}t"))
+                       for item in root.findall(f"{{{XLSX_NS}}}si")]
+        workbook = ET.fromstring(book.read("xl/workbook.xml"))
+        rel_id = next((s.get(f"{{{REL_NS}}}id") for s in workbook.iter(f"{{{XLSX_NS}}}sheet")
+                       if s.get("name") == sheet), None)
+        if rel_id is None:
+            raise ValueError(f"no sheet named {sheet!r} in {path.name}")
+        rels = ET.fromstring(book.read("xl/_rels/workbook.xml.rels"))
+        target = next(r.get("Target") for r in rels if r.get("Id") == rel_id)
+        target = target.lstrip("/")
+        root = ET.fromstring(book.read(target if target.startswith("xl/") else "xl/" + target))
+
+    cells: Dict[str, object] = {}
+    for cell in root.iter(f"{{{XLSX_NS}}}c"):
+        kind = cell.get("t")
+        value = cell.find(f"{{{XLSX_NS}}}v")
+        if kind == "inlineStr":
+            cells[cell.get("r")] = "".join(t.text or "" for t in cell.iter(f"{{{XLSX_NS}}}t"))
+        elif value is None or value.text is None:
+            continue
+        elif kind == "s":
+            cells[cell.get("r")] = strings[int(value.text)]
+        elif kind in ("str", "e"):
+            cells[cell.get("r")] = value.text
+        else:
+            cells[cell.get("r")] = float(value.text)
+    return cells
+
+
+def load_model(path: Path) -> PowerModel:
+    """Find the tables by their labels, so moved rows or extra components still load."""
+    cells = read_cells(path, SHEET_NAME)
+    rows: Dict[int, Dict[str, object]] = {}
+    for ref, value in cells.items():
+        column, row = split_ref(ref)
+        rows.setdefault(row, {})[column] = value
+
+    def text(row: int, column: str) -> str:
+        value = rows.get(row, {}).get(column)
+        return value.strip() if isinstance(value, str) else ""
+
+    # Profile names are the quoted labels in one row, e.g. "off" "sensing" "interactive"
+    header_row, columns = next(
+        (row, [c for c, v in sorted(values.items()) if isinstance(v, str) and v.startswith('"')])
+        for row, values in sorted(rows.items())
+        if sum(isinstance(v, str) and v.startswith('"') for v in values.values()) >= 2)
+    names = {column: text(header_row, column).strip('"') for column in columns}
+
+    power: Dict[str, float] = {}
+    profiles: Dict[str, Dict[str, float]] = {names[c]: {} for c in columns}
+    hours: Dict[str, float] = {}
+    battery: Dict[str, float] = {}
+    sheet_days = None
+    component = ""
+    for row in sorted(rows):
+        values = rows[row]
+        label = text(row, "A")
+        if any("hours/day" in v for v in values.values() if isinstance(v, str)):
+            hours = {names[c]: float(values.get(c, 0.0)) for c in columns}
+            continue
+        for column, value in values.items():
+            if value == "Days of Use":
+                next_column = chr(ord(column) + 1)
+                sheet_days = values.get(next_column)
+        if row <= header_row or not label:
+            continue
+        if label in ("Capacity", "Nominal Voltage", "Regulator Efficiency"):
+            battery[label] = float(values["B"])
+        elif "B" not in values:
+            component = label                     # Group heading, e.g. "Processor"
+        elif text(row, "C") == "mW" and component:
+            key = f"{component}.{label}"
+            power[key] = float(values["B"])
+            for column in columns:
+                profiles[names[column]][key] = float(values.get(column, 0.0))
+
+    return PowerModel(power, profiles, hours, battery["Capacity"], battery["Nominal Voltage"],
+                      battery["Regulator Efficiency"], sheet_days)
+
+
+def effective_mwh(model: PowerModel) -> float:
+    return model.capacity_mah * model.voltage * model.efficiency
+
+
+def profile_power(model: PowerModel, profile: str) -> float:
+    """SUMPRODUCT of component power and duty for one profile (mW)."""
+    return sum(model.power[key] * duty for key, duty in model.profiles[profile].items())
+
+
+def days_of_use(model: PowerModel) -> float:
+    daily_mwh = sum(hours * profile_power(model, profile) for profile, hours in model.hours.items())
+    return effective_mwh(model) / daily_mwh
+
+
+def apply_duty(model: PowerModel, overrides: List[str]) -> PowerModel:
+    """Apply "profile:Component.Mode=share" overrides."""
+    profiles = {name: dict(duties) for name, duties in model.profiles.items()}
+    for override in overrides:
+        target, _, share = override.partition("=")
+        profile, _, key = target.partition(":")
+        if profile not in profiles or key not in model.power:
+            raise SystemExit(f"unknown duty {target!r} - profiles: {', '.join(profiles)}, "
+                             f"rows: {', '.join(model.power)}")
+        profiles[profile][key] = float(share)
+    return model._replace(profiles=profiles)
+
+
+def awake_profiles(model: PowerModel) -> List[str]:
+    return [name for name in model.hours if name != "off"]
+
+
+def sheet_awake_duty(model: PowerModel, key: str) -> float:
+    """Hours-weighted duty of a row over the awake profiles."""
+    awake = awake_profiles(model)
+    total = sum(model.hours[name] for name in awake)
+    return sum(model.hours[name] * model.profiles[name].get(key, 0.0) for name in awake) / total
+
+
+def battery_days(model: PowerModel, awake_mw: float) -> float:
+    """The sheet's formula with the awake profiles replaced by one simulated awake power."""
+    off_hours = model.hours.get("off", 0.0)
+    awake_hours = sum(model.hours[name] for name in awake_profiles(model))
+    off_mw = profile_power(model, "off") if "off" in model.profiles else 0.0
+    return effective_mwh(model) / (off_hours * off_mw + awake_hours * awake_mw)
+
+
+def heart_rate_day(hours: float, seed: int) -> np.ndarray:
+    """Per-second heart rate for the awake hours, 0 when the finger is off."""
+    from AnomalyDetector import synthetic_history
+    _, values, _ = synthetic_history(max(1.0, np.ceil(hours / 24)), seed)
+    return values[:int(hours * 3600)].astype(np.int64)
+
+
+class Schedule(NamedTuple):
+    """What the firmware did over the run - depends only on the notify and refresh settings."""
+    total_ms: int
+    notifications: int
+    conn_events: float
+    redraws: int
+    age_ms: float          # Mean age of the value on screen
+    toggles: int           # Needle moves
+    first_move: Optional[int]
+    triggered_ms: int      # Time the status LED was on
+
+
+def schedule(hr: np.ndarray, notify: int, refresh: int) -> Schedule:
+    """Step the publish policy and the display through the awake hours."""
+    total_ms = len(hr) * 1000
+    last_sent, last_sent_time, pending = 0, 0, False
+    last_activity = 0
+    notifications = 0
+    conn_events = 0.0
+    received, received_at, new_data = 0, 0, False
+    shown_at, last_redraw, redraws = 0, -refresh, 0
+    age_sum = 0
+    triggered, toggles, triggered_steps = False, 0, 0
+    first_move = None
+
+    for now in range(0, total_ms, STEP_MS):
+        value = int(hr[now // 1000])
+        if value > 0:
+            last_activity = now
+        live = now - last_activity < PROFILE_IDLE_MS
+        conn_events += STEP_MS / (LIVE_INTERVAL_MS if live else BACKGROUND_EVENT_MS)
+
+        # checkPublish() / markPublished() of the HR policy
+        if abs(value - last_sent) > HR_DEADBAND or (last_sent >= HR_THRESHOLD) != (value >= HR_THRESHOLD):
+            pending = True
+        elapsed = now - last_sent_time
+        if (pending and elapsed >= notify) or elapsed >= max(HR_KEEPALIVE_MS, notify):
+            last_sent, last_sent_time, pending = value, now, False
+            notifications += 1
+            received, received_at, new_data = value, now, True
+
+        # Display: redraw on new data at most every refresh interval
+        if new_data and now - last_redraw >= refresh:
+            last_redraw, shown_at, new_data = now, received_at, False
+            redraws += 1
+        age_sum += now - shown_at
+
+        # Needle and status LED follow the condition on the received value
+        condition = received >= HR_THRESHOLD
+        if condition != triggered:
+            triggered = condition
+            toggles += 1
+            if first_move is None:
+                first_move = now
+        triggered_steps += triggered
+
+    return Schedule(total_ms, notifications, conn_events, redraws, age_sum / (total_ms / STEP_MS),
+                    toggles, first_move, triggered_steps * STEP_MS)
+
+
+def simulate(model: PowerModel, config: Config, events: Schedule) -> Run:
+    """Turn a schedule into the awake power of both devices for one configuration."""
+    total_ms = events.total_ms
+    seconds = total_ms / 1000
+    samples = config.rate / SAMPLE_AVERAGE * seconds
+    radio_ms = events.conn_events * CONN_EVENT_RADIO_MS + events.notifications * NOTIFY_RADIO_MS
+
+    def active(ms: float) -> float:
+        return min(1.0, ms / total_ms)
+
+    # Sensing device - the sheet's processor and sensor rows, plus what it leaves out
+    cpu = active(samples * LOOP_PASS_US / 1000 + events.notifications * NOTIFY_CPU_US / 1000)
+    led_mw = ((IR_AMPLITUDE + RED_AMPLITUDE) * LED_MA_PER_STEP * SUPPLY_V *
+              LED_PULSE_US * 1e-6 * config.rate)
+    modelled = {"Processor.Active", "Processor.Idle", "Processor.Sleep", "MAX30100.On", "MAX30100.Off (leakage)"}
+    sensing = {
+        "processor": model.power["Processor.Active"] * cpu + model.power["Processor.Idle"] * (1 - cpu),
+        "max30100": model.power.get("MAX30100.On", 0.0),
+        "max leds": led_mw,
+        "radio": RADIO_ON_MW * active(radio_ms),
+        "other rows": sum(power * sheet_awake_duty(model, key)
+                          for key, power in model.power.items() if key not in modelled),
+    }
+
+    # Display device - processor rows of the sheet, the rest estimated
+    cpu = active(events.redraws * REDRAW_MS)
+    move_ms = events.toggles * NEEDLE_STEPS * NEEDLE_STEP_MS
+    if config.motor == "hold":
+        coil_ms = total_ms - events.first_move if events.first_move is not None else 0
+    elif config.motor == "release":
+        coil_ms = move_ms
+    else:
+        coil_ms = 0
+    display = {
+        "processor": model.power["Processor.Active"] * cpu + model.power["Processor.Idle"] * (1 - cpu),
+        "radio": RADIO_ON_MW * active(radio_ms),
+        "stepper": STEPPER_MW * active(coil_ms),
+        "status led": STATUS_LED_MW * active(events.triggered_ms),
+        "backlight": BACKLIGHT_MW,
+    }
+
+    sample_delay = SAMPLE_AVERAGE / config.rate
+    hours = seconds / 3600
+    return Run(config, sensing, display,
+               battery_days(model, sum(sensing.values())), battery_days(model, sum(display.values())),
+               events.age_ms / 1000 + sample_delay,
+               events.notifications / hours, events.redraws / hours)
+
+
+# Each pool worker builds the heart-rate day once instead of receiving it with every task,
+# and steps each notify/refresh pair once - rate and motor policy only change the power
+_worker_model: Optional[PowerModel] = None
+_worker_hr: Optional[np.ndarray] = None
+_worker_schedules: Dict[tuple, Schedule] = {}
+
+
+def _init_worker(model: PowerModel, hours: float, seed: int) -> None:
+    global _worker_model, _worker_hr
+    _worker_model = model
+    _worker_hr = heart_rate_day(hours, seed)
+    _worker_schedules.clear()
+
+
+def _simulate_task(config: Config) -> Run:
+    key = (config.notify, config.refresh)
+    if key not in _worker_schedules:
+        _worker_schedules[key] = schedule(_worker_hr, config.notify, config.refresh)
+    return simulate(_worker_model, config, _worker_schedules[key])
+
+
+def life_days(run: Run) -> float:
+    return min(run.sensing_days, run.display_days)
+
+
+def pareto_front(runs: List[Run]) -> List[Run]:
+    """Runs no other run beats on both battery life and freshness, freshest first."""
+    front: List[Run] = []
+    # Among equal lives the one that is better for the other device wins
+    for run in sorted(runs, key=lambda r: (r.age_s, -life_days(r), -(r.sensing_days + r.display_days))):
+        if not front or life_days(run) > life_days(front[-1]):
+            front.append(run)
+    return front
+
+
+def awake_hours(model: PowerModel) -> float:
+    return sum(model.hours[name] for name in awake_profiles(model))
+
+
+def report_model(model: PowerModel) -> None:
+    print(f"Battery: {model.capacity_mah:g} mAh x {model.voltage:g} V x {model.efficiency:g} "
+          f"= {effective_mwh(model):g} mWh")
+    for profile, hours in model.hours.items():
+        print(f"  {profile:<12}{profile_power(model, profile):>9.2f} mW  {hours:>5.1f} h/day")
+    days = days_of_use(model)
+    print(f"Days of use: {days:.3f} ({days * 24:.1f} h)", end="")
+    print(f", workbook says {model.sheet_days:.3f}" if model.sheet_days is not None else "")
+
+
+def report_run(run: Run) -> None:
+    config = run.config
+    print(f"rate {config.rate} Hz, notify {config.notify} ms, refresh {config.refresh} ms, "
+          f"motor {config.motor}: {run.notifications_per_hour:.0f} notifications/h, "
+          f"{run.redraws_per_hour:.0f} redraws/h, value on screen {run.age_s:.2f} s old")
+    for name, loads, days in (("Sensing", run.sensing_mw, run.sensing_days),
+                              ("Display", run.display_mw, run.display_days)):
+        total = sum(loads.values())
+        print(f"{name}: {total:.1f} mW awake, {days:.2f} days")
+        for load, mw in sorted(loads.items(), key=lambda item: -item[1]):
+            print(f"  {load:<12}{mw:>9.2f} mW {100 * mw / total:>6.1f} %")
+
+
+def sweep(model: PowerModel, hours: float, seed: int, rates: List[int], notifies: List[int],
+          refreshes: List[int], motors: List[str], workers: Optional[int]) -> None:
+    grid = [Config(rate, notify, refresh, motor) for notify, refresh, rate, motor
+            in itertools.product(notifies, refreshes, rates, motors)]
+    start = time.perf_counter()
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(model, hours, seed)) as pool:
+        runs = list(pool.map(_simulate_task, grid, chunksize=len(rates) * len(motors)))
+    elapsed = time.perf_counter() - start
+    print(f"{len(runs)} configurations x {hours:g} awake h in {elapsed:.1f} s; "
+          f"battery {model.capacity_mah:g} mAh, life is the device that runs flat first")
+    front = pareto_front(runs)
+    print(f"Pareto front ({len(front)} of {len(runs)}):")
+    print(f"{'Rate':>6}{'Notify':>8}{'Refresh':>9}{'Motor':>9}{'Age (s)':>9}"
+          f"{'Sensing (d)':>13}{'Display (d)':>13}{'Life (h)':>10}")
+    for run in front:
+        config = run.config
+        print(f"{config.rate:>6}{config.notify:>8}{config.refresh:>9}{config.motor:>9}{run.age_s:>9.2f}"
+              f"{run.sensing_days:>13.2f}{run.display_days:>13.2f}{24 * life_days(run):>10.1f}")
+
+
+def parse_diag(record: str) -> Dict[str, float]:
+    fields = {}
+    for item in record.split(","):
+        key, _, value = item.partition("=")
+        try:
+            fields[key] = float(value)
+        except ValueError:
+            pass
+    return fields
+
+
+def report_measured(model: PowerModel, logs: List[Path]) -> None:
+    """Average current per subsystem from the last DIAG record of each log (charge since boot)."""
+    for log in logs:
+        records = DIAG_RECORD.findall(log.read_text(errors="replace"))
+        if not records:
+            print(f"{log}: no DIAG records")
+            continue
+        fields = parse_diag(records[-1])
+        hours = fields.pop("UP", 0.0) / 3600
+        millivolts = fields.pop("BAT", 0.0)
+        level = fields.pop("PCT", 0.0)
+        if hours <= 0:
+            print(f"{log}: record has no uptime")
+            continue
+        total = sum(fields.values())
+        print(f"{log}: {hours:.2f} h up, battery {millivolts:.0f} mV ({level:.0f} %), "
+              f"{total / hours:.2f} mA average, ~{model.capacity_mah * hours / total:.1f} h "
+              f"on {model.capacity_mah:g} mAh" if total > 0 else f"{log}: no charge recorded")
+        for name, charge in sorted(fields.items(), key=lambda item: -item[1]):
+            print(f"  {name:<12}{charge / hours:>8.2f} mA {100 * charge / total if total else 0:>6.1f} %")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Battery life from the power-model spreadsheet")
+    parser.add_argument("--workbook", type=Path, default=DEFAULT_WORKBOOK)
+    parser.add_argument("--capacity", type=float, help="battery capacity (mAh) instead of the sheet's")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    model_cmd = sub.add_parser("model", help="evaluate the sheet's profiles")
+    model_cmd.add_argument("--duty", action="append", default=[],
+                           help="override a duty cycle, profile:Component.Mode=share")
+
+    def add_run_options(command):
+        command.add_argument("--hours", type=float, help="awake hours to simulate (default: the sheet's)")
+        command.add_argument("--seed", type=int, default=514)
+
+    simulate_cmd = sub.add_parser("simulate", help="simulate one configuration")
+    add_run_options(simulate_cmd)
+    simulate_cmd.add_argument("--rate", type=int, default=400)
+    simulate_cmd.add_argument("--notify", type=int, default=250)
+    simulate_cmd.add_argument("--refresh", type=int, default=1000)
+    simulate_cmd.add_argument("--motor", choices=MOTOR_POLICIES, default="hold")
+
+    sweep_cmd = sub.add_parser("sweep", help="Pareto front of battery life vs freshness")
+    add_run_options(sweep_cmd)
+    sweep_cmd.add_argument("--rates", type=int, nargs="+", default=[50, 100, 200, 400])
+    sweep_cmd.add_argument("--notifies", type=int, nargs="+", default=[250, 1000, 2000, 5000, 15000])
+    sweep_cmd.add_argument("--refreshes", type=int, nargs="+", default=[250, 1000, 2000, 5000])
+    sweep_cmd.add_argument("--motors", choices=MOTOR_POLICIES, nargs="+", default=list(MOTOR_POLICIES))
+    sweep_cmd.add_argument("--workers", type=int, help="processes (default: one per CPU)")
+
+    measured_cmd = sub.add_parser("measured", help="battery life from DIAG records in serial logs")
+    measured_cmd.add_argument("logs", nargs="+", type=Path)
+
+    args = parser.parse_args()
+    model = load_model(args.workbook)
+    if args.capacity:
+        model = model._replace(capacity_mah=args.capacity)
+
+    if args.command == "model":
+        report_model(apply_duty(model, args.duty))
+    elif args.command == "simulate":
+        hr = heart_rate_day(args.hours or awake_hours(model), args.seed)
+        config = Config(args.rate, args.notify, args.refresh, args.motor)
+        report_run(simulate(model, config, schedule(hr, config.notify, config.refresh)))
+    elif args.command == "sweep":
+        sweep(model, args.hours or awake_hours(model), args.seed, args.rates, args.notifies,
+              args.refreshes, args.motors, args.workers)
+    else:
+        report_measured(model, args.logs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+"""
+PPG Generator - synthetic MAX3010x IR/red streams with ground-truth beats.
+
+Benchmarks of the heart-rate code should not need a finger on the sensor. This
+tool writes traces with known beat times that a host build of the sketches
+replays sample by sample (PpgTrace.h loads them), so both the throughput and
+the accuracy of a checkForBeat() loop can be scored.
+
+The signal model, per sample at --rate Hz:
+  beats        RR intervals around --hr with --hrv ms of beat-to-beat spread,
+               respiratory sinus arrhythmia and a slow drift of the mean rate
+  pulse        systolic peak plus dicrotic wave, scaled so AC/DC is --pi %.
+               More blood means less light back, so the raw counts dip at each
+               beat like the real sensor's do
+  baseline     respiration and slow DC wander on top of --dc counts
+  noise        white noise of --noise counts
+  motion       --motion bursts per hour, 1-6 s of large 0.5-4 Hz swings
+  finger off   --gaps gaps per hour, 2-20 s of ambient light only (no beats)
+Everything is clipped to the 18-bit ADC range.
+
+Generation is whole-array NumPy (cumulative sums for the beat clock, one
+searchsorted to map samples onto beats), so hours of data take about a second.
+
+File format (little-endian):
+  char     magic[4]          "PPG1"
+  uint32   sample_rate       Hz
+  uint32   samples           n
+  uint32   beats             m
+  uint32   ir[n]             18-bit ADC counts
+  uint32   red[n]
+  uint8    flags[n]          FLAG_FINGER_OFF | FLAG_MOTION
+  uint32   beat_index[m]     sample index of each true systolic peak
+
+A run under test writes the sample index of every beat it detects, one per
+line, and "score" matches them against the ground truth.
+
+Usage:
+  python PpgGenerator.py generate trace.ppg --hours 1 --hr 72 --motion 6
+  python PpgGenerator.py info trace.ppg
+  python PpgGenerator.py score trace.ppg detected.txt
+  python PpgGenerator.py bench --hours 10
+"""
+
+import argparse
+import time
+from typing import NamedTuple
+
+import numpy as np
+
+MAGIC = b"PPG1"
+HEADER = np.dtype([("magic", "S4"), ("sample_rate", "<u4"), ("samples", "<u4"), ("beats", "<u4")])
+ADC_MAX = (1 << 18) - 1      # MAX3010x 18-bit full scale
+AMBIENT_LEVEL = 2000         # Counts with no finger over the sensor
+
+FLAG_FINGER_OFF = 1
+FLAG_MOTION = 2
+
+SYSTOLIC_PHASE = 0.18        # Position of the systolic peak within the beat (fraction of RR)
+MATCH_TOLERANCE_MS = 150     # A detection this close to a true beat counts as a hit
+
+
+class Trace(NamedTuple):
+    sample_rate: int
+    ir: np.ndarray           # uint32
+    red: np.ndarray          # uint32
+    flags: np.ndarray        # uint8
+    beat_index: np.ndarray   # uint32, sample index of each true systolic peak
+
+
+def beat_times(duration: float, hr: float, hrv_ms: float, rng: np.random.Generator) -> np.ndarray:
+    """Onset time (s) of every beat up to duration, from a modulated RR series."""
+    mean_rr = 60.0 / hr
+    count = int(duration / mean_rr * 1.3) + 8   # Generous - the series is trimmed below
+    index = np.arange(count)
+    onset_guess = index * mean_rr
+    drift = 1.0 + 0.08 * np.sin(2 * np.pi * onset_guess / 1800.0)       # Slow change of the mean rate
+    rsa = 0.5 * hrv_ms / 1000.0 * np.sin(2 * np.pi * 0.25 * onset_guess)  # Respiratory sinus arrhythmia
+    rr = mean_rr * drift + rsa + rng.normal(0.0, hrv_ms / 1000.0, count)
+    rr = np.clip(rr, 0.3, 2.0)
+    first = rng.uniform(0, mean_rr)                  # One random phase for the whole series
+    onsets = first + np.concatenate(([0.0], np.cumsum(rr)))
+    # Every score is measured against these - the first interval must be rr[0] like the rest
+    if not (np.all(np.diff(onsets) > 0) and np.isclose(onsets[1] - onsets[0], rr[0])):
+        raise RuntimeError("beat onsets are not the cumulative RR series")
+    return onsets[onsets < duration]
+
+
+def pulse_shape(phase: np.ndarray) -> np.ndarray:
+    """Normalised blood-volume pulse over one beat (phase 0..1), peak 1 at SYSTOLIC_PHASE."""
+    systolic = np.exp(-0.5 * ((phase - SYSTOLIC_PHASE) / 0.07) ** 2)
+    dicrotic = 0.35 * np.exp(-0.5 * ((phase - 0.45) / 0.09) ** 2)
+    return (systolic + dicrotic) / (1.0 + 0.35 * np.exp(-0.5 * ((SYSTOLIC_PHASE - 0.45) / 0.09) ** 2))
+
+
+def event_mask(n: int, starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Boolean mask of the union of [start, start + length) intervals, without a Python loop."""
+    edges = np.zeros(n + 1, dtype=np.int32)
+    np.add.at(edges, np.minimum(starts, n), 1)
+    np.add.at(edges, np.minimum(starts + lengths, n), -1)
+    return np.cumsum(edges[:-1]) > 0
+
+
+def generate(hours: float, rate: int = 100, hr: float = 72.0, hrv_ms: float = 40.0, pi: float = 1.5,
+             dc: float = 120000.0, noise: float = 40.0, motion_per_hour: float = 6.0,
+             gaps_per_hour: float = 6.0, seed: int = 514) -> Trace:
+    if hours <= 0 or rate <= 0 or hr <= 0:
+        raise ValueError(f"hours, rate and hr must be positive (got {hours}, {rate}, {hr})")
+    rng = np.random.default_rng(seed)
+    duration = hours * 3600.0
+    n = int(duration * rate)
+    t = np.arange(n) / rate
+
+    # Map every sample onto its beat and phase within it. A trace shorter than the
+    # first onset has no beats and no pulse.
+    onsets = beat_times(duration, hr, hrv_ms, rng)
+    if len(onsets):
+        rr = np.diff(np.append(onsets, onsets[-1] + 60.0 / hr))
+        beat = np.maximum(np.searchsorted(onsets, t, side="right") - 1, 0)
+        phase = np.clip((t - onsets[beat]) / rr[beat], 0.0, 1.0)
+        pulse = np.where(t >= onsets[0], pulse_shape(phase), 0.0)
+    else:
+        rr = np.zeros(0)
+        pulse = np.zeros(n)
+
+    # Slow baseline: respiration plus DC wander
+    baseline = dc * (1.0 + 0.004 * np.sin(2 * np.pi * 0.25 * t)
+                     + 0.02 * np.sin(2 * np.pi * t / 300.0 + rng.uniform(0, 2 * np.pi)))
+    ir = baseline * (1.0 - pi / 100.0 * pulse)
+    # Red: lower DC and, at normal SpO2, about half the relative pulse (ratio of ratios ~0.5)
+    red = 0.8 * baseline * (1.0 - 0.5 * pi / 100.0 * pulse)
+
+    flags = np.zeros(n, dtype=np.uint8)
+
+    # Motion bursts - a few random 0.5-4 Hz components, much larger than the pulse
+    bursts = rng.poisson(motion_per_hour * hours)
+    if bursts:
+        starts = np.sort(rng.integers(0, n, bursts))
+        lengths = (rng.uniform(1.0, 6.0, bursts) * rate).astype(np.int64)
+        inside = np.flatnonzero(event_mask(n, starts, lengths))
+        which = np.searchsorted(starts, inside, side="right") - 1   # Burst each sample belongs to
+        freqs = rng.uniform(0.5, 4.0, (bursts, 3))[which]
+        phases = rng.uniform(0, 2 * np.pi, (bursts, 3))[which]
+        scale = rng.uniform(2.0, 15.0, bursts)[which] * pi / 100.0 * dc
+        wiggle = scale * np.sin(2 * np.pi * freqs * t[inside, None] + phases).sum(axis=1) / 3.0
+        ir[inside] += wiggle
+        red[inside] += 0.8 * wiggle
+        flags[inside] |= FLAG_MOTION
+
+    # Finger-off gaps - ambient light only
+    gaps = rng.poisson(gaps_per_hour * hours)
+    finger_off = np.zeros(n, dtype=bool)
+    if gaps:
+        starts = rng.integers(0, n, gaps)
+        lengths = (rng.uniform(2.0, 20.0, gaps) * rate).astype(np.int64)
+        finger_off = event_mask(n, starts, lengths)
+        ir = np.where(finger_off, AMBIENT_LEVEL, ir)
+        red = np.where(finger_off, AMBIENT_LEVEL, red)
+        flags[finger_off] |= FLAG_FINGER_OFF
+
+    ir = ir + rng.normal(0.0, noise, n)
+    red = red + rng.normal(0.0, noise, n)
+
+    # Ground truth: systolic peaks that fall inside the trace and not in a gap
+    peaks = np.round((onsets + SYSTOLIC_PHASE * rr) * rate).astype(np.int64)
+    peaks = peaks[peaks < n]
+    peaks = peaks[~finger_off[peaks]]
+
+    return Trace(rate,
+                 np.clip(ir, 0, ADC_MAX).astype(np.uint32),
+                 np.clip(red, 0, ADC_MAX).astype(np.uint32),
+                 flags,
+                 peaks.astype(np.uint32))
+
+
+def write_trace(path: str, trace: Trace) -> None:
+    header = np.array([(MAGIC, trace.sample_rate, len(trace.ir), len(trace.beat_index))], dtype=HEADER)
+    with open(path, "wb") as f:
+        header.tofile(f)
+        trace.ir.astype("<u4").tofile(f)
+        trace.red.astype("<u4").tofile(f)
+        trace.flags.tofile(f)
+        trace.beat_index.astype("<u4").tofile(f)
+
+
+def read_trace(path: str) -> Trace:
+    with open(path, "rb") as f:
+        header = np.fromfile(f, dtype=HEADER, count=1)
+        if len(header) != 1 or header["magic"][0] != MAGIC:
+            raise ValueError(f"{path} is not a PPG1 trace")
+        n = int(header["samples"][0])
+        m = int(header["beats"][0])
+        ir = np.fromfile(f, dtype="<u4", count=n)
+        red = np.fromfile(f, dtype="<u4", count=n)
+        flags = np.fromfile(f, dtype=np.uint8, count=n)
+        beats = np.fromfile(f, dtype="<u4", count=m)
+    if len(ir) != n or len(red) != n or len(flags) != n or len(beats) != m:
+        raise ValueError(f"{path} is truncated")
+    return Trace(int(header["sample_rate"][0]), ir, red, flags, beats)
+
+
+class Score(NamedTuple):
+    true_beats: int
+    detected: int
+    hits: int
+    sensitivity: float       # hits / true beats
+    precision: float         # hits / detections
+    mean_error_ms: float     # Timing error of the hits
+
+
+def score(trace: Trace, detected: np.ndarray, tolerance_ms: float = MATCH_TOLERANCE_MS) -> Score:
+    """Match detections to true beats, each true beat can be claimed once."""
+    truth = trace.beat_index.astype(np.int64)
+    detected = np.sort(np.asarray(detected, dtype=np.int64))
+    tolerance = tolerance_ms * trace.sample_rate / 1000.0
+    if len(truth) == 0 or len(detected) == 0:
+        return Score(len(truth), len(detected), 0, 0.0, 0.0, 0.0)
+
+    # Nearest true beat for every detection
+    right = np.clip(np.searchsorted(truth, detected), 0, len(truth) - 1)
+    left = np.clip(right - 1, 0, len(truth) - 1)
+    nearest = np.where(np.abs(truth[left] - detected) <= np.abs(truth[right] - detected), left, right)
+    error = np.abs(truth[nearest] - detected)
+    close = error <= tolerance
+
+    # Keep only the first detection per true beat, later ones are false positives
+    claimed = nearest[close]
+    first = np.concatenate(([True], claimed[1:] != claimed[:-1]))
+    hits = int(first.sum())
+    mean_error = float(error[close][first].mean() * 1000.0 / trace.sample_rate) if hits else 0.0
+    return Score(len(truth), len(detected), hits, hits / len(truth), hits / len(detected), mean_error)
+
+
+def describe(trace: Trace) -> None:
+    n = len(trace.ir)
+    seconds = n / trace.sample_rate
+    rr = np.diff(trace.beat_index.astype(np.int64)) / trace.sample_rate
+    rr = rr[rr < 2.0]   # Leave out the spans across finger-off gaps
+    print(f"{n} samples at {trace.sample_rate} Hz ({seconds / 3600:.2f} h), {len(trace.beat_index)} beats")
+    if len(rr):
+        print(f"Mean HR {60.0 / rr.mean():.1f} BPM, RR SD {1000 * rr.std():.1f} ms, "
+              f"RMSSD {1000 * np.sqrt(np.mean(np.diff(rr) ** 2)):.1f} ms")
+    print(f"Finger off {100.0 * np.mean(trace.flags & FLAG_FINGER_OFF > 0):.2f} %, "
+          f"motion {100.0 * np.mean(trace.flags & FLAG_MOTION > 0):.2f} % of samples")
+    print(f"IR range {trace.ir.min()}-{trace.ir.max()}, clipped samples {int(np.sum(trace.ir >= ADC_MAX))}")
+
+
+def benchmark(hours: float, rate: int) -> None:
+    start = time.perf_counter()
+    trace = generate(hours, rate=rate)
+    elapsed = time.perf_counter() - start
+    print(f"Generated {hours:g} h at {rate} Hz ({len(trace.ir)} samples, {len(trace.beat_index)} beats) "
+          f"in {elapsed:.2f} s - {hours / elapsed:.1f} h of data per second, "
+          f"{len(trace.ir) / elapsed / 1e6:.1f} M samples/s")
+
+    # Sanity check of the scorer: the truth itself scores perfectly, jittered truth nearly so
+    perfect = score(trace, trace.beat_index)
+    rng = np.random.default_rng(1)
+    jittered = trace.beat_index.astype(np.int64) + rng.integers(-3, 4, len(trace.beat_index))
+    noisy = score(trace, jittered)
+    print(f"Scorer check: truth sensitivity {perfect.sensitivity:.3f} precision {perfect.precision:.3f}, "
+          f"+-30 ms jitter mean error {noisy.mean_error_ms:.1f} ms")
+
+    # Beat clock check: beat_times() raises if an onset series is out of order or its
+    # first interval is not the first RR interval
+    shortest = min(np.diff(beat_times(600.0, 72.0, 40.0, np.random.default_rng(seed))).min()
+                   for seed in range(200))
+    print(f"Beat clock check: 200 seeds in order, shortest interval {1000 * shortest:.0f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Synthetic PPG traces with ground-truth beats")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    gen = sub.add_parser("generate", help="write a trace file")
+    gen.add_argument("output")
+    gen.add_argument("--hours", type=float, default=1.0)
+    gen.add_argument("--rate", type=int, default=100, help="samples per second")
+    gen.add_argument("--hr", type=float, default=72.0, help="mean heart rate (BPM)")
+    gen.add_argument("--hrv", type=float, default=40.0, help="beat-to-beat RR spread (ms)")
+    gen.add_argument("--pi", type=float, default=1.5, help="perfusion index, AC/DC in %%")
+    gen.add_argument("--dc", type=float, default=120000.0, help="IR DC level (counts)")
+    gen.add_argument("--noise", type=float, default=40.0, help="white noise (counts)")
+    gen.add_argument("--motion", type=float, default=6.0, help="motion bursts per hour")
+    gen.add_argument("--gaps", type=float, default=6.0, help="finger-off gaps per hour")
+    gen.add_argument("--seed", type=int, default=514)
+
+    info = sub.add_parser("info", help="summarise a trace file")
+    info.add_argument("trace")
+
+    score_cmd = sub.add_parser("score", help="score detected beats against the ground truth")
+    score_cmd.add_argument("trace")
+    score_cmd.add_argument("detected", help="text file, one detected beat sample index per line")
+    score_cmd.add_argument("--tolerance", type=float, default=MATCH_TOLERANCE_MS, help="match window (ms)")
+
+    bench = sub.add_parser("bench", help="time generation")
+    bench.add_argument("--hours", type=float, default=10.0)
+    bench.add_argument("--rate", type=int, default=100)
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        if args.hours <= 0 or args.rate <= 0 or args.hr <= 0:
+            parser.error("--hours, --rate and --hr must be positive")
+        trace = generate(args.hours, args.rate, args.hr, args.hrv, args.pi, args.dc, args.noise,
+                         args.motion, args.gaps, args.seed)
+        write_trace(args.output, trace)
+        describe(trace)
+    elif args.command == "info":
+        describe(read_trace(args.trace))
+    elif args.command == "score":
+        result = score(read_trace(args.trace), np.loadtxt(args.detected, dtype=np.int64, ndmin=1),
+                       args.tolerance)
+        print(f"True beats {result.true_beats}, detected {result.detected}, hits {result.hits}")
+        print(f"Sensitivity {result.sensitivity:.3f}, precision {result.precision:.3f}, "
+              f"mean timing error {result.mean_error_ms:.1f} ms")
+    else:
+        benchmark(args.hours, args.rate)
+
+
+if __name__ == "__main__":
+    main()
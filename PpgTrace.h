@@ -0,0 +1,84 @@
+/*
+  PPG Trace Loader - host side only
+  Reads the synthetic IR/red traces written by PpgGenerator.py so a host build of
+  the heart-rate code can replay them sample by sample and score its beats
+  against the ground truth (PpgGenerator.py score).
+
+  File layout (little-endian, see PpgGenerator.py):
+    "PPG1", uint32 sampleRate, uint32 samples, uint32 beats,
+    uint32 ir[samples], uint32 red[samples], uint8 flags[samples],
+    uint32 beatIndex[beats]
+
+  Typical replay loop:
+    PpgTrace trace;
+    if (!loadPpgTrace("trace.ppg", trace)) return 1;
+    for (uint32_t i = 0; i < trace.samples; i++) {
+      if (checkForBeat(trace.ir[i])) fprintf(out, "%u\n", i);
+    }
+    freePpgTrace(trace);
+*/
+
+#ifndef PPG_TRACE_H
+#define PPG_TRACE_H
+
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+#define PPG_FLAG_FINGER_OFF 1
+#define PPG_FLAG_MOTION 2
+
+struct PpgTrace {
+  uint32_t sampleRate;
+  uint32_t samples;
+  uint32_t beats;
+  uint32_t* ir;
+  uint32_t* red;
+  uint8_t* flags;
+  uint32_t* beatIndex;   // Sample index of each true systolic peak
+};
+
+inline void freePpgTrace(PpgTrace &trace) {
+  free(trace.ir);
+  free(trace.red);
+  free(trace.flags);
+  free(trace.beatIndex);
+  memset(&trace, 0, sizeof(trace));
+}
+
+// Load a whole trace into memory, returns false on a missing, foreign or truncated file
+inline bool loadPpgTrace(const char* path, PpgTrace &trace) {
+  memset(&trace, 0, sizeof(trace));
+  FILE* f = fopen(path, "rb");
+  if (f == NULL) {
+    return false;
+  }
+  char magic[4];
+  uint32_t header[3];
+  bool ok = fread(magic, 1, 4, f) == 4 && memcmp(magic, "PPG1", 4) == 0 &&
+            fread(header, sizeof(uint32_t), 3, f) == 3;
+  if (ok) {
+    trace.sampleRate = header[0];
+    trace.samples = header[1];
+    trace.beats = header[2];
+    trace.ir = (uint32_t*)malloc(trace.samples * sizeof(uint32_t));
+    trace.red = (uint32_t*)malloc(trace.samples * sizeof(uint32_t));
+    trace.flags = (uint8_t*)malloc(trace.samples);
+    trace.beatIndex = (uint32_t*)malloc(trace.beats * sizeof(uint32_t));
+    // malloc(0) may return NULL, which is fine for a trace without samples or beats
+    ok = (trace.samples == 0 || (trace.ir != NULL && trace.red != NULL && trace.flags != NULL)) &&
+         (trace.beats == 0 || trace.beatIndex != NULL) &&
+         fread(trace.ir, sizeof(uint32_t), trace.samples, f) == trace.samples &&
+         fread(trace.red, sizeof(uint32_t), trace.samples, f) == trace.samples &&
+         fread(trace.flags, 1, trace.samples, f) == trace.samples &&
+         fread(trace.beatIndex, sizeof(uint32_t), trace.beats, f) == trace.beats;
+  }
+  fclose(f);
+  if (!ok) {
+    freePpgTrace(trace);
+  }
+  return ok;
+}
+
+#endif
@@ -7,6 +7,17 @@
 #include <BLEUtils.h>
 #include <BLE2902.h>
 
+// Shared components from WearableCore.h - only these are compiled into this image
+#define WEARABLE_STEPPER 1
+#define WEARABLE_TOUCH_QUEUE 1
+#define WEARABLE_PUBLISH_POLICY 1
+#define WEARABLE_LED_AGC 1
+#define WEARABLE_HEAP_WATCH 1
+#define WEARABLE_ADVERTISING 1
+#define WEARABLE_CONN_PROFILE 1
+#define WEARABLE_BLE_SERVER 1
+#include "WearableCore.h"
+
 // Pin definitions - DOUBLE CHECK THESE MATCH YOUR WIRING
 #define LED_PIN 10       // LED connected to pin 9
 #define COIL_A1 21       // Stepper motor coil A1
@@ -14,21 +25,34 @@
 #define COIL_B1 3       // Stepper motor coil B1
 #define COIL_B2 4       // Stepper motor coil B2
 #define TOUCH_PIN 2    // Capacitive touch sensor connected to GPIO20
+const StepperPins stepper = {COIL_A1, COIL_A2, COIL_B1, COIL_B2};
 
 MAX30105 particleSensor;
 
 // BLE Server
 BLEServer* pServer = NULL;
-BLECharacteristic* pCharacteristic = NULL;
+BLECharacteristic* pCharacteristic = NULL;         // Legacy "heartRate,touchState,motorPosition" text
+BLECharacteristic* pTouchCharacteristic = NULL;
+BLECharacteristic* pMotorCharacteristic = NULL;
 bool deviceConnected = false;
+bool oldDeviceConnected = false;
 
 // Service and Characteristic UUIDs
 #define SERVICE_UUID        "5e581872-a389-465c-98cd-dbc5dc8e04c1"
 #define CHARACTERISTIC_UUID "144f76b9-5840-4455-b89f-c7589a1e6756"
+#define TOUCH_CHARACTERISTIC_UUID "144f76ba-5840-4455-b89f-c7589a1e6756"  // uint8, 1 = touched
+#define MOTOR_CHARACTERISTIC_UUID "144f76bb-5840-4455-b89f-c7589a1e6756"  // uint8, 1 = forward
 
 // Heart rate variables
 int beatAvg = 0;
 unsigned long lastBLENotification = 0;
+unsigned long lastPublishStats = 0;
+const unsigned long PUBLISH_CHECK_INTERVAL = 100;  // Evaluate the publish policy every 100ms
+
+// Heart rate: +-2 BPM deadband. Touch and motor: any change. Keepalive every 10 s
+PublishPolicy hrPolicy = {2, NO_THRESHOLD, 1000, 10000};
+PublishPolicy touchPolicy = {0, NO_THRESHOLD, 1000, 10000};
+PublishPolicy motorPolicy = {0, NO_THRESHOLD, 1000, 10000};
 
 // Sensor state tracking
 bool sensorTriggered = false;
@@ -36,14 +60,26 @@ bool lastSensorTriggered = false;
 
 // Capacitive touch variables
 int touchState = 0;
-int lastTouchState = 0;
-unsigned long lastTouchRead = 0;
 
 // Motor state tracking
 bool motorAtForwardPosition = false;
 unsigned long lastMotorMove = 0;
 bool motorBusy = false;
 
+// Boot sequencing - BLE and the sensor come up first, self-tests run in the background
+volatile bool selfTestRunning = false;
+volatile bool selfTestFinished = false;
+bool sensorReady = false;
+int sensorInitAttempts = 0;
+unsigned long lastSensorInitAttempt = 0;
+const int SENSOR_INIT_MAX_ATTEMPTS = 5;
+const unsigned long SENSOR_INIT_RETRY_INTERVAL = 1000;  // ms between MAX30105 retries
+int sensorErrorBlinks = 0;            // LED toggles left after the last failed attempt
+unsigned long lastSensorErrorBlink = 0;
+const unsigned long SENSOR_ERROR_BLINK_MS = 200;
+unsigned long timeToAdvertise = 0;    // millis() since power-on when advertising started
+unsigned long timeToFirstSample = 0;  // millis() since power-on of the first IR sample
+
 // BLE Server Callbacks
 class MyServerCallbacks : public BLEServerCallbacks {
     void onConnect(BLEServer* pServer) {
@@ -51,8 +87,14 @@ class MyServerCallbacks : public BLEServerCallbacks {
         Serial.println("Client connected");
     };
 
+    void onConnect(BLEServer* pServer, esp_ble_gatts_cb_param_t* param) {
+        beginConnectionProfile(param);
+    }
+
     void onDisconnect(BLEServer* pServer) {
         deviceConnected = false;
+        BLECharacteristic* characteristics[] = {pCharacteristic, pTouchCharacteristic, pMotorCharacteristic};
+        resetSubscriptions(characteristics, sizeof(characteristics) / sizeof(characteristics[0]));
         Serial.println("Client disconnected");
     }
 };
@@ -67,42 +109,8 @@ void moveMotorForward() {
     Serial.println("Moving motor FORWARD");
     motorBusy = true;
     
-    // Step sequence to move forward
-    for (int i = 0; i < 200; i++) { // Adjust steps as needed (200 is example)
-        // Step 1
-        digitalWrite(COIL_A1, HIGH);
-        digitalWrite(COIL_A2, LOW);
-        digitalWrite(COIL_B1, HIGH);
-        digitalWrite(COIL_B2, LOW);
-        delay(10);
-        
-        // Step 2
-        digitalWrite(COIL_A1, LOW);
-        digitalWrite(COIL_A2, HIGH);
-        digitalWrite(COIL_B1, HIGH);
-        digitalWrite(COIL_B2, LOW);
-        delay(10);
-        
-        // Step 3
-        digitalWrite(COIL_A1, LOW);
-        digitalWrite(COIL_A2, HIGH);
-        digitalWrite(COIL_B1, LOW);
-        digitalWrite(COIL_B2, HIGH);
-        delay(10);
-        
-        // Step 4
-        digitalWrite(COIL_A1, HIGH);
-        digitalWrite(COIL_A2, LOW);
-        digitalWrite(COIL_B1, LOW);
-        digitalWrite(COIL_B2, HIGH);
-        delay(10);
-    }
-    
-    // Turn off all coils to save power and reduce heat
-    digitalWrite(COIL_A1, LOW);
-    digitalWrite(COIL_A2, LOW);
-    digitalWrite(COIL_B1, LOW);
-    digitalWrite(COIL_B2, LOW);
+    // 200 full sequences, coils released afterwards
+    stepperMove(stepper, true, 200, 10);
     
     motorAtForwardPosition = true;
     motorBusy = false;
@@ -119,42 +127,8 @@ void moveMotorBackward() {
     Serial.println("Moving motor BACKWARD");
     motorBusy = true;
     
-    // Step sequence to move backward
-    for (int i = 0; i < 200; i++) { // Adjust steps as needed (200 is example)
-        // Step 4
-        digitalWrite(COIL_A1, HIGH);
-        digitalWrite(COIL_A2, LOW);
-        digitalWrite(COIL_B1, LOW);
-        digitalWrite(COIL_B2, HIGH);
-        delay(10);
-        
-        // Step 3
-        digitalWrite(COIL_A1, LOW);
-        digitalWrite(COIL_A2, HIGH);
-        digitalWrite(COIL_B1, LOW);
-        digitalWrite(COIL_B2, HIGH);
-        delay(10);
-        
-        // Step 2
-        digitalWrite(COIL_A1, LOW);
-        digitalWrite(COIL_A2, HIGH);
-        digitalWrite(COIL_B1, HIGH);
-        digitalWrite(COIL_B2, LOW);
-        delay(10);
-        
-        // Step 1
-        digitalWrite(COIL_A1, HIGH);
-        digitalWrite(COIL_A2, LOW);
-        digitalWrite(COIL_B1, HIGH);
-        digitalWrite(COIL_B2, LOW);
-        delay(10);
-    }
-    
-    // Turn off all coils to save power and reduce heat
-    digitalWrite(COIL_A1, LOW);
-    digitalWrite(COIL_A2, LOW);
-    digitalWrite(COIL_B1, LOW);
-    digitalWrite(COIL_B2, LOW);
+    // 200 full sequences, coils released afterwards
+    stepperMove(stepper, false, 200, 10);
     
     motorAtForwardPosition = false;
     motorBusy = false;
@@ -175,29 +149,137 @@ void testMotor() {
     Serial.println("Motor test complete!");
 }
 
+// Run the motor self-test in its own task so it does not hold up advertising
+void selfTestTask(void* parameter) {
+    testMotor();
+    selfTestRunning = false;
+    selfTestFinished = true;
+    vTaskDelete(NULL);
+}
+
+void startBackgroundSelfTest() {
+    selfTestRunning = true;
+    xTaskCreate(selfTestTask, "selfTest", 4096, NULL, 1, NULL);
+}
+
+// LED AGC state - the controller is in WearableCore.h
+LedAgc agc;
+
+// Try to bring up the MAX30105 once, returns true when it is ready
+bool tryInitSensor() {
+    sensorInitAttempts++;
+    lastSensorInitAttempt = millis();
+    if (!particleSensor.begin(Wire, I2C_SPEED_FAST)) {
+        Serial.println("MAX30105 not found. Retrying...");
+        if (sensorInitAttempts >= SENSOR_INIT_MAX_ATTEMPTS) {
+            Serial.println("MAX30105 initialization failed. Check wiring/power and reset the device.");
+            // Blink LED to indicate error - five blinks, stepped from loop()
+            sensorErrorBlinks = 10;
+            lastSensorErrorBlink = millis() - SENSOR_ERROR_BLINK_MS;
+        }
+        return false;
+    }
+
+    Serial.println("MAX30105 found and initialized!");
+    // Configure sensor with better settings for reliability
+    particleSensor.setup();
+    particleSensor.setPulseAmplitudeRed(0x1F);  // Increased power for better readings
+    particleSensor.setPulseAmplitudeGreen(0);
+    resetLedAgc(agc, 0x1F, 400);  // IR amplitude and sample rate that setup() selects
+    sensorReady = true;
+    return true;
+}
+
+// Retry the sensor from loop() instead of blocking setup() with delay(1000)
+void retrySensorInit() {
+    if (sensorReady || sensorInitAttempts >= SENSOR_INIT_MAX_ATTEMPTS) {
+        return;
+    }
+    if (millis() - lastSensorInitAttempt >= SENSOR_INIT_RETRY_INTERVAL) {
+        tryInitSensor();
+    }
+}
+
+// Step the failed-sensor blink without holding up loop(), then give the LED back to
+// the trigger state
+void serviceSensorErrorBlink() {
+    if (sensorErrorBlinks == 0 || millis() - lastSensorErrorBlink < SENSOR_ERROR_BLINK_MS) {
+        return;
+    }
+    lastSensorErrorBlink = millis();
+    sensorErrorBlinks--;
+    if (sensorErrorBlinks > 0) {
+        digitalWrite(LED_PIN, sensorErrorBlinks % 2 ? HIGH : LOW);
+    } else {
+        digitalWrite(LED_PIN, lastSensorTriggered ? HIGH : LOW);
+    }
+}
+
 // Function to check if sensors are triggered
 bool checkSensorsTrigger() {
     // Check if capacitive touch sensor is touched
     bool touchDetected = (touchState == HIGH);
     
     // Check if finger is detected on heart rate sensor (IR value > 50000)
-    long irValue = particleSensor.getIR();
-    bool fingerDetected = (irValue > 50000);
+    bool fingerDetected = false;
+    if (sensorReady) {
+        long irValue = particleSensor.getIR();
+        serviceLedAgc(agc, particleSensor, irValue, millis());
+        fingerDetected = (irValue > 50000);
+        if (timeToFirstSample == 0) {
+            timeToFirstSample = millis();
+            Serial.print("Boot: time to first sample ");
+            Serial.print(timeToFirstSample);
+            Serial.println(" ms");
+        }
+    }
     
     // Return true if either sensor is triggered
     return touchDetected || fingerDetected;
 }
 
-// Function to send BLE notification with sensor status
+// Function to send BLE notification with sensor status when the publish policy allows
 void sendSensorStatus() {
-    if (deviceConnected && (millis() - lastBLENotification > 1000)) {
-        String statusStr = String(beatAvg) + "," + String(touchState) + "," + String(motorAtForwardPosition ? 1 : 0);
-        pCharacteristic->setValue(statusStr.c_str());
+    unsigned long now = millis();
+    if (!deviceConnected || now - lastBLENotification < PUBLISH_CHECK_INTERVAL) {
+        return;
+    }
+
+    int motorValue = motorAtForwardPosition ? 1 : 0;
+    PublishReason hrReason = checkPublish(hrPolicy, beatAvg, now);
+    PublishReason touchReason = checkPublish(touchPolicy, touchState, now);
+    PublishReason motorReason = checkPublish(motorPolicy, motorValue, now);
+
+    // Legacy text characteristic - carries every field, so any due value sends it
+    bool textSent = false;
+    if ((hrReason != PUBLISH_NONE || touchReason != PUBLISH_NONE || motorReason != PUBLISH_NONE) &&
+        notificationsEnabled(pCharacteristic)) {
+        static char statusStr[24];
+        int length = snprintf(statusStr, sizeof(statusStr), "%d,%d,%d", beatAvg, touchState, motorValue);
+        pCharacteristic->setValue((uint8_t*)statusStr, length);
         pCharacteristic->notify();
-        lastBLENotification = millis();
+        textSent = true;
         Serial.print("Sent status: ");
         Serial.println(statusStr);
     }
+
+    // Per-value characteristics - one byte each, only to subscribers
+    bool touchSent = false;
+    if (touchReason != PUBLISH_NONE) {
+        uint8_t touched = touchState == HIGH ? 1 : 0;
+        touchSent = publishValue(pTouchCharacteristic, &touched, 1);
+    }
+
+    bool motorSent = false;
+    if (motorReason != PUBLISH_NONE) {
+        uint8_t forward = motorValue;
+        motorSent = publishValue(pMotorCharacteristic, &forward, 1);
+    }
+
+    finishPublish(hrPolicy, hrReason, textSent, beatAvg, now);
+    finishPublish(touchPolicy, touchReason, touchSent || textSent, touchState, now);
+    finishPublish(motorPolicy, motorReason, motorSent || textSent, motorValue, now);
+    lastBLENotification = now;
 }
 
 void setup() {
@@ -206,56 +288,18 @@ void setup() {
 
     // Configure pins
     pinMode(LED_PIN, OUTPUT);
-    pinMode(COIL_A1, OUTPUT);
-    pinMode(COIL_A2, OUTPUT);
-    pinMode(COIL_B1, OUTPUT);
-    pinMode(COIL_B2, OUTPUT);
+    stepperBegin(stepper);  // Coils start released
     pinMode(TOUCH_PIN, INPUT);
+    initTouchInterrupt(TOUCH_PIN);
+    touchState = lastQueuedTouchLevel;
     
     // Turn all pins LOW initially
     digitalWrite(LED_PIN, LOW);
-    digitalWrite(COIL_A1, LOW);
-    digitalWrite(COIL_A2, LOW);
-    digitalWrite(COIL_B1, LOW);
-    digitalWrite(COIL_B2, LOW);
 
-    // IMPORTANT: Test motor function first to ensure it's working
-    testMotor();
-    
-    // Initialize heart rate sensor with retry
-    int sensorInitAttempts = 0;
-    while (!particleSensor.begin(Wire, I2C_SPEED_FAST)) {
-        Serial.println("MAX30105 not found. Retrying...");
-        sensorInitAttempts++;
-        delay(1000);
-        
-        if (sensorInitAttempts >= 5) {
-            Serial.println("MAX30105 initialization failed. Check wiring/power and reset the device.");
-            // Blink LED to indicate error
-            for (int i = 0; i < 5; i++) {
-                digitalWrite(LED_PIN, HIGH);
-                delay(200);
-                digitalWrite(LED_PIN, LOW);
-                delay(200);
-            }
-            break;  // Continue anyway, motor might still work
-        }
-    }
-    
-    if (sensorInitAttempts < 5) {
-        Serial.println("MAX30105 found and initialized!");
-        // Configure sensor with better settings for reliability
-        particleSensor.setup();
-        particleSensor.setPulseAmplitudeRed(0x1F);  // Increased power for better readings
-        particleSensor.setPulseAmplitudeGreen(0);
-    }
-    
     Serial.println("Place your finger on the sensor or touch the capacitive sensor.");
 
     // Initialize BLE
-    BLEDevice::init("HeartRate-ESP32");
-    pServer = BLEDevice::createServer();
-    pServer->setCallbacks(new MyServerCallbacks());
+    pServer = beginBleServer("HeartRate-ESP32", new MyServerCallbacks());
 
     BLEService *pService = pServer->createService(SERVICE_UUID);
     pCharacteristic = pService->createCharacteristic(
@@ -268,31 +312,88 @@ void setup() {
     pCharacteristic->addDescriptor(new BLE2902());
     pCharacteristic->setValue("0,0,0");  // Format: "heartRate,touchState,motorPosition"
 
+    // One characteristic per value for clients that only want that value
+    pTouchCharacteristic = pService->createCharacteristic(
+        TOUCH_CHARACTERISTIC_UUID,
+        BLECharacteristic::PROPERTY_READ |
+        BLECharacteristic::PROPERTY_NOTIFY
+    );
+    pTouchCharacteristic->addDescriptor(new BLE2902());
+
+    pMotorCharacteristic = pService->createCharacteristic(
+        MOTOR_CHARACTERISTIC_UUID,
+        BLECharacteristic::PROPERTY_READ |
+        BLECharacteristic::PROPERTY_NOTIFY
+    );
+    pMotorCharacteristic->addDescriptor(new BLE2902());
+
     pService->start();
 
     BLEAdvertising *pAdvertising = BLEDevice::getAdvertising();
     pAdvertising->addServiceUUID(SERVICE_UUID);
     pAdvertising->setScanResponse(true);
     pAdvertising->setMinPreferred(0x06);
-    BLEDevice::startAdvertising();
+    restartAdvertising();
 
+    timeToAdvertise = millis();
     Serial.println("BLE server ready. Waiting for connections...");
+    Serial.print("Boot: time to advertise ");
+    Serial.print(timeToAdvertise);
+    Serial.println(" ms");
+
+    // Sensor comes up after advertising, failed attempts are retried from loop()
+    tryInitSensor();
+
+    // Motor self-test runs alongside loop() instead of before everything else
+    startBackgroundSelfTest();
+
+    markHeapBaseline();
+    reportHeap("setup");
 }
 
 void loop() {
-    // Read capacitive touch sensor (with debounce)
-    if (millis() - lastTouchRead > 50) {  // Read every 50ms
-        touchState = digitalRead(TOUCH_PIN);
-        if (touchState != lastTouchState) {
-            Serial.print("Touch sensor state changed to: ");
-            Serial.println(touchState == HIGH ? "TOUCHED" : "NOT TOUCHED");
-            lastTouchState = touchState;
-        }
-        lastTouchRead = millis();
+    retrySensorInit();
+    serviceSensorErrorBlink();
+
+    // Apply touch edges queued by the interrupt (debounced in the ISR)
+    checkTouchSettled();
+    TouchEdge edge;
+    while (popTouchEdge(edge)) {
+        touchState = edge.level;
+        Serial.print("Touch sensor state changed to: ");
+        Serial.print(touchState == HIGH ? "TOUCHED" : "NOT TOUCHED");
+        Serial.print(" at ");
+        Serial.print(edge.timestamp);
+        Serial.println(" ms");
     }
 
     // Check if sensors are triggered
     sensorTriggered = checkSensorsTrigger();
+
+    // Touch or a finger keeps the link on the live profile
+    updateConnectionProfile(pServer, deviceConnected, sensorTriggered);
+    reportConnectionParams();
+    serviceAdvertising(deviceConnected, sensorTriggered);
+
+    // Restart advertising in the fast phase after a disconnect
+    if (!deviceConnected && oldDeviceConnected) {
+        restartAdvertising();
+        reportHeap("disconnect");
+        oldDeviceConnected = deviceConnected;
+    }
+    if (deviceConnected && !oldDeviceConnected) {
+        reportAdvertisingDiscovery();
+        reportHeap("connect");
+        oldDeviceConnected = deviceConnected;
+    }
+
+    // The self-test leaves the motor at BACKWARD, catch up with any trigger seen meanwhile
+    if (selfTestFinished) {
+        selfTestFinished = false;
+        if (lastSensorTriggered) {
+            moveMotorForward();
+        }
+    }
     
     // Handle sensor trigger state change
     if (sensorTriggered != lastSensorTriggered) {
@@ -302,7 +403,7 @@ void loop() {
             digitalWrite(LED_PIN, HIGH);
             
             // Only move motor if not already busy and time since last move > 1 second
-            if (!motorBusy && (millis() - lastMotorMove > 1000)) {
+            if (!motorBusy && !selfTestRunning && (millis() - lastMotorMove > 1000)) {
                 moveMotorForward();
             }
         } else {
@@ -311,21 +412,26 @@ void loop() {
             digitalWrite(LED_PIN, LOW);
             
             // Only move motor if not already busy and time since last move > 1 second
-            if (!motorBusy && (millis() - lastMotorMove > 1000)) {
+            if (!motorBusy && !selfTestRunning && (millis() - lastMotorMove > 1000)) {
                 moveMotorBackward();
             }
         }
         
         // Update last state
         lastSensorTriggered = sensorTriggered;
-        
-        // Send status update over BLE
-        sendSensorStatus();
     }
     
-    // Also send periodic updates over BLE
-    if (millis() - lastBLENotification > 2000) {
-        sendSensorStatus();
+    // Send status over BLE when something changed or the keepalive is due
+    sendSensorStatus();
+    
+    serviceHeapReport();
+
+    // Report how much airtime the policy is saving
+    if (millis() - lastPublishStats >= 60000) {
+        lastPublishStats = millis();
+        printPublishStats("HR", hrPolicy);
+        printPublishStats("Touch", touchPolicy);
+        printPublishStats("Motor", motorPolicy);
     }
 
     // Small delay for stability
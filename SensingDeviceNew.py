@@ -1,12 +1,30 @@
 /*
   BLE Heart Rate & Hydration Monitor Server
   Reads heart rate data from MAX30102 sensor and hydration status from capacitive touch sensor
-  Sends both data points to a client via BLE
+  Samples the Hamamatsu G11193-10R photodiode for a low-rate spectral (blood sugar) reading
+  Sends all data points to a client via BLE
+  Also exposes the standard Heart Rate Service (0x180D, with RR intervals), a Battery
+  Service (0x180F) and one characteristic per metric, so generic clients can subscribe
+  to just what they need. Only characteristics with notifications enabled go on air.
+  A per-window signal quality index keeps motion artefacts out of the readings, and an
+  LED AGC holds the IR level in a target band with as little LED current as it needs.
+  Beat-to-beat intervals also feed a sliding HRV window (RMSSD, SDNN, pNN50) that is
+  published at a low rate on its own characteristic.
+  The estimated charge used by the MCU, radio and sensor LEDs is integrated from boot and
+  sent once a minute with the battery voltage on a diagnostics characteristic.
+  Sensor, publish and finger-detection settings can be changed at runtime with CFG
+  commands written to the data characteristic and are persisted in NVS.
+  With HYDRATION_CAPACITIVE the TTP223B is replaced by a bare electrode read with the
+  chip's touch peripheral, which gives a graded hydration level with a confidence.
+  That needs an ESP32, S2 or S3 - the XIAO ESP32C3 has no touch peripheral.
   
   Hardware:
   - ESP32 XIAO
   - MAX30102 Heart Rate Sensor
-  - TTP223B Capacitive Touch Sensor (connected to GPIO2)
+  - TTP223B Capacitive Touch Sensor (connected to GPIO2), or a bare electrode on a touch
+    pin (GPIO2 is T2 on the ESP32 and TOUCH2 on the S2/S3) with HYDRATION_CAPACITIVE
+  - Hamamatsu G11193-10R InGaAs photodiode + transimpedance amp (connected to A1 / GPIO3)
+  - LiPo battery sensed through a 2:1 resistor divider (connected to A2 / GPIO4)
   
   Connections:
   - MAX30102 SDA to ESP32 SDA
@@ -16,6 +34,8 @@
   - TTP223B SIG to ESP32 GPIO2
   - TTP223B VCC to ESP32 3.3V
   - TTP223B GND to ESP32 GND
+  - Photodiode TIA output to ESP32 A1 (GPIO3, ADC1 channel 3)
+  - Battery + through 100k/100k divider to ESP32 A2 (GPIO4, ADC1 channel 4)
 */
 
 #include <Arduino.h>
@@ -26,37 +46,555 @@
 #include <BLE2902.h>
 #include "MAX30105.h"
 #include "heartRate.h"
+#include "esp_adc/adc_continuous.h"
+#include "GlucoseChannel.h"
+#include <Preferences.h>
+
+// Hydration sensing - 0: TTP223B module, HYDRATED/LESS from its digital output on an
+// interrupt. 1: bare electrode read with touchRead(), graded level and confidence.
+#define HYDRATION_CAPACITIVE 0
+
+// Shared components from WearableCore.h - only these are compiled into this image
+#define WEARABLE_RATE_AVERAGE 1
+#define WEARABLE_BPM_ESTIMATOR 1
+#define WEARABLE_SIGNAL_QUALITY 1
+#define WEARABLE_TOUCH_QUEUE !HYDRATION_CAPACITIVE  // Only the digital TTP223B mode uses it
+#define WEARABLE_PUBLISH_POLICY 1
+#define WEARABLE_HYDRATION_LEVEL HYDRATION_CAPACITIVE
+#define WEARABLE_LED_AGC 1
+#define WEARABLE_HEAP_WATCH 1
+#define WEARABLE_BOOT_PROFILE 1
+#define WEARABLE_ENERGY 1
+#define WEARABLE_ADVERTISING 1
+#define WEARABLE_CONN_PROFILE 1
+#define WEARABLE_BLE_SERVER 1
+#define WEARABLE_CONFIG 1
+#include "WearableCore.h"
+
+#if HYDRATION_CAPACITIVE && !SOC_TOUCH_SENSOR_SUPPORTED
+#error "HYDRATION_CAPACITIVE needs a chip with a touch peripheral (ESP32, S2, S3) - the ESP32C3 has none"
+#endif
 
 // Define touch sensor pin
-#define TOUCH_PIN 2  // TTP223B SIG connected to GPIO2
+#define TOUCH_PIN 2  // TTP223B SIG connected to GPIO2 (the electrode in capacitive mode)
+
+// Glucose photodiode channel - oversampled by the ADC DMA, decimated in GlucoseChannel.h
+#define GLUCOSE_ADC_CHANNEL ADC_CHANNEL_3  // A1 / GPIO3 on the XIAO ESP32C3
+
+// Battery divider - sampled in the same DMA pattern as the glucose channel
+#define BATTERY_ADC_CHANNEL ADC_CHANNEL_4  // A2 / GPIO4 on the XIAO ESP32C3
+#define BATTERY_DIVIDER 2                  // Battery voltage / ADC pin voltage
+#define ADC_FULL_SCALE_MV 3300             // Nominal full scale at 12 dB attenuation (uncalibrated)
 
 // BLE Server Variables
 BLEServer* pServer = NULL;
-BLECharacteristic* pCharacteristic = NULL;
+BLECharacteristic* pCharacteristic = NULL;              // Legacy "HR:X,HYD:Y,..." text, used by the display
+BLECharacteristic* pHeartRateMeasurement = NULL;
+BLECharacteristic* pBodySensorLocation = NULL;
+BLECharacteristic* pBatteryLevel = NULL;
+BLECharacteristic* pHydrationCharacteristic = NULL;
+BLECharacteristic* pGlucoseCharacteristic = NULL;
+BLECharacteristic* pHrvCharacteristic = NULL;
+BLECharacteristic* pDiagnosticsCharacteristic = NULL;
 bool deviceConnected = false;
 bool oldDeviceConnected = false;
 
 // UUIDs - MUST match the client
 #define SERVICE_UUID "153d58a2-6e5d-46b3-8df2-7288b3ef3c4e"
 #define CHARACTERISTIC_UUID "537a9060-3f8a-4cd9-86ce-a9cd306bc3cb"
+#define HYDRATION_CHARACTERISTIC_UUID "537a9061-3f8a-4cd9-86ce-a9cd306bc3cb"  // uint8, 1 = hydrated
+#define GLUCOSE_CHARACTERISTIC_UUID "537a9062-3f8a-4cd9-86ce-a9cd306bc3cb"    // uint16 LE, ADC counts
+#define HRV_CHARACTERISTIC_UUID "537a9063-3f8a-4cd9-86ce-a9cd306bc3cb"        // RMSSD, SDNN (uint16 LE, 0.1 ms), pNN50 %, intervals
+#define DIAGNOSTICS_CHARACTERISTIC_UUID "537a9064-3f8a-4cd9-86ce-a9cd306bc3cb" // "DIAG:BAT=mV,PCT=%,<subsystem>=mAh,...,UP=s" text
+
+// Standard SIG services - any heart rate app or OS battery widget understands these
+#define HEART_RATE_SERVICE_UUID BLEUUID((uint16_t)0x180D)
+#define HEART_RATE_MEASUREMENT_UUID BLEUUID((uint16_t)0x2A37)
+#define BODY_SENSOR_LOCATION_UUID BLEUUID((uint16_t)0x2A38)
+#define BATTERY_SERVICE_UUID BLEUUID((uint16_t)0x180F)
+#define BATTERY_LEVEL_UUID BLEUUID((uint16_t)0x2A19)
+
+// Heart Rate Measurement flags (8-bit HR value, no energy expended field)
+#define HRM_FLAG_CONTACT_DETECTED 0x02
+#define HRM_FLAG_CONTACT_SUPPORTED 0x04
+#define HRM_FLAG_RR_PRESENT 0x10
+#define BODY_SENSOR_LOCATION_FINGER 3
 
 // MAX30102 Sensor
 MAX30105 particleSensor;
+#define PPG_SAMPLE_AVERAGE 4  // FIFO averaging, getIR() returns one sample per 4 taken
 
 // Heart Rate Variables
 const byte RATE_SIZE = 4; // Increase for more averaging. 4 is good
-byte rates[RATE_SIZE]; // Array of heart rates
-byte rateSpot = 0;
+RateAverager beatRates = {{0}, RATE_SIZE, 0, 0};
 long lastBeat = 0; // Time at which the last beat occurred
 float beatsPerMinute;
 int beatAvg;
+BpmEstimator bpmEstimator;  // Reading while beatRates is still filling after placement
+SignalQuality quality;      // Gate for beats and estimates, see WearableCore.h
+long fingerIrThreshold = 50000;  // IR below this means no finger on the sensor (runtime config "finger")
+
+// RR intervals (1/1024 s) since the last Heart Rate Measurement. 9 fit in a default
+// 20-byte notification next to the flags and 8-bit HR, the measurement is flushed when full
+#define RR_PER_MEASUREMENT 9
+uint16_t rrIntervals[RR_PER_MEASUREMENT];
+byte rrCount = 0;
+unsigned long droppedRRIntervals = 0;
 
 // Hydration Variables
 bool isHydrated = false;
 
+// Glucose Channel Variables
+adc_continuous_handle_t glucoseAdc = NULL;
+CicDecimator glucoseCic;
+GlucoseAverager glucoseAvg;
+uint16_t glucoseLatest = 0;        // Newest CIC output, held until the next PPG sample
+bool glucoseHaveSample = false;
+int glucoseReading = 0;            // Last 1 Hz spectral reading (ADC counts), sent as GLU
+volatile unsigned long glucoseOverruns = 0;  // DMA frames lost because loop() fell behind
+
+// Battery Variables
+uint32_t batteryRawSum = 0;        // Raw divider samples since the last level update
+uint32_t batteryRawCount = 0;
+int batteryMillivolts = 0;
+int batteryLevel = 100;            // Percent, sent on the Battery Level characteristic
+unsigned long lastBatteryUpdate = 0;
+const unsigned long BATTERY_UPDATE_INTERVAL = 10000;
+
+// Energy accounting - estimated charge per subsystem since boot, reported with the stats
+// and sent on the diagnostics characteristic. The radio channel and its notification cost
+// are in WearableCore.h. Currents are datasheet estimates at 3.3 V.
+#define BATTERY_CAPACITY_MAH 1000
+#define MCU_ACTIVE_UA 30000        // ESP32-C3 running, radio idle (power model: ~100 mW)
+EnergyChannel mcuEnergy = {"mcu", MCU_ACTIVE_UA, true, 0, 0, 0};  // On from boot
+EnergyChannel ledEnergy = {"leds", 0, false, 0, 0, 0};           // MAX3010x, duty-cycled
+EnergyChannel* const energyChannels[] = {&mcuEnergy, &radioEnergy, &ledEnergy};
+const uint8_t ENERGY_CHANNEL_COUNT = sizeof(energyChannels) / sizeof(energyChannels[0]);
+unsigned long radioAccountedAt = 0;
+
+#if HYDRATION_CAPACITIVE
+// Capacitive hydration - a burst of touchRead() samples every HYDRATION_READ_MS goes
+// through the WearableCore.h filter (trimmed mean, baseline tracking, smoothing). The
+// level is published on its own, slower policy; isHydrated still drives HYD:0/1.
+#define HYDRATION_BURST 16
+#define HYDRATION_READ_MS 200
+#if CONFIG_IDF_TARGET_ESP32
+#define HYDRATION_RISING false   // touchRead() falls with contact on the ESP32...
+#define HYDRATION_DRY_DELTA 15   // ...and moves a few tens of counts
+#define HYDRATION_WET_DELTA 45
+#else
+#define HYDRATION_RISING true    // ...and rises on the S2/S3, by thousands
+#define HYDRATION_DRY_DELTA 2000
+#define HYDRATION_WET_DELTA 12000
+#endif
+
+HydrationSensor hydration;
+unsigned long lastHydrationRead = 0;
+unsigned long hydrationReadUs = 0;     // touchRead() time summed since the last stats report
+unsigned long hydrationFilterUs = 0;   // addHydrationBurst() time, same period
+unsigned long hydrationMaxUs = 0;      // Longest burst + filter
+unsigned long hydrationBursts = 0;
+
+// Take a burst when one is due, returns true when Hydrated/Less Hydrated flipped
+bool serviceHydration(unsigned long now) {
+  if (now - lastHydrationRead < HYDRATION_READ_MS) {
+    return false;
+  }
+  lastHydrationRead = now;
+  uint32_t samples[HYDRATION_BURST];
+  unsigned long start = micros();
+  for (int i = 0; i < HYDRATION_BURST; i++) {
+    samples[i] = touchRead(TOUCH_PIN);
+  }
+  unsigned long read = micros();
+  addHydrationBurst(hydration, samples, HYDRATION_BURST);
+  unsigned long done = micros();
+  hydrationReadUs += read - start;
+  hydrationFilterUs += done - read;
+  hydrationMaxUs = max(hydrationMaxUs, done - start);
+  hydrationBursts++;
+
+  bool hydrated = hydration.contact && hydration.level >= HYDRATION_HYDRATED_LEVEL;
+  if (hydrated == isHydrated) {
+    return false;
+  }
+  isHydrated = hydrated;
+  Serial.print("Hydration changed to ");
+  Serial.print(isHydrated ? "Hydrated" : "Less Hydrated");
+  Serial.print(" (level ");
+  Serial.print(hydration.level);
+  Serial.print(" %, confidence ");
+  Serial.print(hydration.confidence);
+  Serial.print(" %) at ");
+  Serial.print(now);
+  Serial.println(" ms");
+  return true;
+}
+
+void printHydrationStats() {
+  Serial.print("Hydration: level ");
+  Serial.print(hydration.level);
+  Serial.print(" %, confidence ");
+  Serial.print(hydration.confidence);
+  Serial.print(" %, baseline ");
+  Serial.print(hydrationBaseline(hydration));
+  Serial.print(", per reading ");
+  Serial.print(hydrationBursts ? hydrationReadUs / hydrationBursts : 0);
+  Serial.print(" us touchRead + ");
+  Serial.print(hydrationBursts ? hydrationFilterUs / hydrationBursts : 0);
+  Serial.print(" us filter (max ");
+  Serial.print(hydrationMaxUs);
+  Serial.println(" us)");
+  hydrationReadUs = 0;
+  hydrationFilterUs = 0;
+  hydrationMaxUs = 0;
+  hydrationBursts = 0;
+}
+#endif
+
+// Clock Sync Variables - the display writes "SYNC:<t1>", we answer "SYNCR:<t1>,<t2>,<t3>"
+volatile bool syncRequestPending = false;
+volatile unsigned long syncT1 = 0;   // Display clock when the request was sent
+volatile unsigned long syncT2 = 0;   // Our clock when the request arrived
+unsigned long sampleTime = 0;        // Our clock when the current PPG sample was read, sent as TS
+
 // Timing Variables
 unsigned long previousMillis = 0;
-const long UPDATE_INTERVAL = 100; // Send data every 100ms
+unsigned long updateInterval = 100; // Evaluate the publish policy every 100ms (runtime config "upd")
+unsigned long lastPublishStats = 0;
+
+// HR: +-2 BPM deadband, send at once when crossing the display's 60 BPM trigger
+PublishPolicy hrPolicy = {2, 60, 250, 5000};
+// Hydration: any change, coalesced within 250 ms
+PublishPolicy hydPolicy = {0, NO_THRESHOLD, 250, 5000};
+// Glucose: 1 Hz reading, +-8 ADC counts deadband
+PublishPolicy gluPolicy = {8, NO_THRESHOLD, 1000, 5000};
+// Battery: every 1 % step, at most once a minute, keepalive every 10 minutes
+PublishPolicy batPolicy = {0, NO_THRESHOLD, 60000, 600000};
+// HRV: tracked on RMSSD in 0.1 ms, +-2 ms deadband, at most every 5 s, keepalive every minute
+PublishPolicy hrvPolicy = {20, NO_THRESHOLD, 5000, 60000};
+// Hydration level (capacitive mode): +-3 % deadband, at most every 2 s, keepalive every 30 s
+PublishPolicy hydLevelPolicy = {3, NO_THRESHOLD, 2000, 30000};
+
+// Remember the interval since the previous beat for the next Heart Rate Measurement
+void queueRRInterval(long deltaMs) {
+  if (rrCount >= RR_PER_MEASUREMENT) {
+    memmove(rrIntervals, rrIntervals + 1, (RR_PER_MEASUREMENT - 1) * sizeof(uint16_t));  // Keep the newest
+    rrCount--;
+    droppedRRIntervals++;
+  }
+  rrIntervals[rrCount++] = (uint16_t)((deltaMs * 1024) / 1000);
+}
+
+// Build and publish a Heart Rate Measurement (0x2A37) with any queued RR intervals
+bool publishHeartRateMeasurement(int heartRate, bool contact) {
+  uint8_t measurement[2 + 2 * RR_PER_MEASUREMENT];
+  size_t length = 0;
+  uint8_t flags = HRM_FLAG_CONTACT_SUPPORTED;
+  if (contact) {
+    flags |= HRM_FLAG_CONTACT_DETECTED;
+  }
+  if (rrCount > 0) {
+    flags |= HRM_FLAG_RR_PRESENT;
+  }
+  measurement[length++] = flags;
+  measurement[length++] = (uint8_t)constrain(heartRate, 0, 255);
+  for (byte i = 0; i < rrCount; i++) {
+    measurement[length++] = rrIntervals[i] & 0xFF;
+    measurement[length++] = rrIntervals[i] >> 8;
+  }
+  rrCount = 0;
+  return publishValue(pHeartRateMeasurement, measurement, length);
+}
+
+// LED AGC state - the controller is in WearableCore.h
+LedAgc agc;
+
+// HRV window - the last HRV_WINDOW RR intervals in a ring buffer with running sums, so
+// adding a beat (and dropping the oldest) is O(1) however long the window is.
+//   RMSSD = sqrt(mean of squared successive differences)
+//   SDNN  = standard deviation of the intervals
+//   pNN50 = share of successive differences larger than 50 ms
+#define HRV_WINDOW 64          // About a minute of beats at rest
+#define HRV_MIN_INTERVALS 16   // Fewer than this are too noisy to publish
+#define HRV_NN50_MS 50
+
+struct HrvWindow {
+  uint16_t rr[HRV_WINDOW];   // ms
+  uint8_t head;              // Oldest interval
+  uint8_t count;
+  uint32_t sum;
+  uint32_t sumSquares;
+  uint32_t sumDiffSquares;   // Over the count - 1 successive differences in the window
+  uint8_t nn50;
+};
+
+struct HrvMetrics {
+  float rmssd;   // ms
+  float sdnn;    // ms
+  float pnn50;   // %
+  uint8_t intervals;
+};
+
+HrvWindow hrv;
+
+void resetHrv() {
+  memset(&hrv, 0, sizeof(hrv));
+}
+
+void addHrvInterval(long deltaMs) {
+  uint16_t rr = (uint16_t)deltaMs;
+  if (hrv.count == HRV_WINDOW) {
+    // Drop the oldest interval and its difference to the one after it
+    uint16_t oldest = hrv.rr[hrv.head];
+    int32_t diff = (int32_t)hrv.rr[(hrv.head + 1) % HRV_WINDOW] - oldest;
+    hrv.sum -= oldest;
+    hrv.sumSquares -= (uint32_t)oldest * oldest;
+    hrv.sumDiffSquares -= (uint32_t)(diff * diff);
+    if (abs(diff) > HRV_NN50_MS) {
+      hrv.nn50--;
+    }
+    hrv.head = (hrv.head + 1) % HRV_WINDOW;
+    hrv.count--;
+  }
+  if (hrv.count > 0) {
+    int32_t diff = (int32_t)rr - hrv.rr[(hrv.head + hrv.count - 1) % HRV_WINDOW];
+    hrv.sumDiffSquares += (uint32_t)(diff * diff);
+    if (abs(diff) > HRV_NN50_MS) {
+      hrv.nn50++;
+    }
+  }
+  hrv.rr[(hrv.head + hrv.count) % HRV_WINDOW] = rr;
+  hrv.count++;
+  hrv.sum += rr;
+  hrv.sumSquares += (uint32_t)rr * rr;
+}
+
+// Metrics of the current window, false until there are enough intervals
+bool computeHrv(HrvMetrics &metrics) {
+  if (hrv.count < HRV_MIN_INTERVALS) {
+    return false;
+  }
+  // Double for the variance - sumSquares - sum^2 / n cancels most of its digits
+  double n = hrv.count;
+  double variance = (hrv.sumSquares - (double)hrv.sum * hrv.sum / n) / (n - 1);
+  metrics.rmssd = sqrtf(hrv.sumDiffSquares / (n - 1));
+  metrics.sdnn = sqrt(max(variance, 0.0));
+  metrics.pnn50 = 100.0f * hrv.nn50 / (n - 1);
+  metrics.intervals = hrv.count;
+  return true;
+}
+
+bool publishHrv(const HrvMetrics &metrics) {
+  uint16_t rmssd = (uint16_t)min(metrics.rmssd * 10.0f, 65535.0f);
+  uint16_t sdnn = (uint16_t)min(metrics.sdnn * 10.0f, 65535.0f);
+  uint8_t summary[6] = {
+    (uint8_t)(rmssd & 0xFF), (uint8_t)(rmssd >> 8),
+    (uint8_t)(sdnn & 0xFF), (uint8_t)(sdnn >> 8),
+    (uint8_t)(metrics.pnn50 + 0.5f), metrics.intervals
+  };
+  return publishValue(pHrvCharacteristic, summary, sizeof(summary));
+}
+
+// Turn the divider samples collected by the DMA into a battery level
+void updateBatteryLevel() {
+  if (millis() - lastBatteryUpdate < BATTERY_UPDATE_INTERVAL || batteryRawCount == 0) {
+    return;
+  }
+  lastBatteryUpdate = millis();
+  uint32_t raw = batteryRawSum / batteryRawCount;
+  batteryRawSum = 0;
+  batteryRawCount = 0;
+  batteryMillivolts = raw * ADC_FULL_SCALE_MV * BATTERY_DIVIDER / ((1 << GLUCOSE_ADC_BITS) - 1);
+  batteryLevel = batteryPercent(batteryMillivolts);
+}
+
+// DMA pool overflow - the oldest burst was dropped
+static bool IRAM_ATTR onGlucoseOverflow(adc_continuous_handle_t handle,
+                                        const adc_continuous_evt_data_t *edata, void *user_data) {
+  glucoseOverruns++;
+  return false;
+}
+
+// Start continuous (DMA) sampling of the photodiode channel and the battery divider
+bool initGlucoseChannel() {
+  resetCic(glucoseCic);
+  resetAverager(glucoseAvg);
+
+  adc_continuous_handle_cfg_t handleConfig = {};
+  handleConfig.max_store_buf_size = GLUCOSE_BURST_SIZE * SOC_ADC_DIGI_RESULT_BYTES * 4;
+  handleConfig.conv_frame_size = GLUCOSE_BURST_SIZE * SOC_ADC_DIGI_RESULT_BYTES;
+  if (adc_continuous_new_handle(&handleConfig, &glucoseAdc) != ESP_OK) {
+    Serial.println("Glucose ADC: failed to allocate DMA handle");
+    return false;
+  }
+
+  // Conversions alternate between the two channels, so the total rate is doubled
+  // to keep the photodiode at GLUCOSE_ADC_RATE_HZ
+  adc_digi_pattern_config_t pattern[2] = {};
+  pattern[0].atten = ADC_ATTEN_DB_12;
+  pattern[0].channel = GLUCOSE_ADC_CHANNEL;
+  pattern[0].unit = ADC_UNIT_1;
+  pattern[0].bit_width = GLUCOSE_ADC_BITS;
+  pattern[1] = pattern[0];
+  pattern[1].channel = BATTERY_ADC_CHANNEL;
+
+  adc_continuous_config_t config = {};
+  config.pattern_num = 2;
+  config.adc_pattern = pattern;
+  config.sample_freq_hz = GLUCOSE_ADC_RATE_HZ * 2;
+  config.conv_mode = ADC_CONV_SINGLE_UNIT_1;
+  config.format = ADC_DIGI_OUTPUT_FORMAT_TYPE2;
+  if (adc_continuous_config(glucoseAdc, &config) != ESP_OK) {
+    Serial.println("Glucose ADC: failed to configure channel");
+    return false;
+  }
+
+  adc_continuous_evt_cbs_t callbacks = {};
+  callbacks.on_pool_ovf = onGlucoseOverflow;
+  adc_continuous_register_event_callbacks(glucoseAdc, &callbacks, NULL);
+
+  if (adc_continuous_start(glucoseAdc) != ESP_OK) {
+    Serial.println("Glucose ADC: failed to start");
+    return false;
+  }
+  return true;
+}
+
+// Drain finished DMA bursts through the CIC, then pair the newest decimated
+// sample with the PPG sample just taken. Called once per PPG sample in loop().
+void serviceGlucoseChannel() {
+  static uint8_t frame[GLUCOSE_BURST_SIZE * SOC_ADC_DIGI_RESULT_BYTES];
+  static uint16_t burst[GLUCOSE_BURST_SIZE];
+  static uint16_t decimated[GLUCOSE_BURST_SIZE / GLUCOSE_CIC_R + 1];
+
+  if (glucoseAdc == NULL) {
+    return;
+  }
+
+  uint32_t bytesRead = 0;
+  while (adc_continuous_read(glucoseAdc, frame, sizeof(frame), &bytesRead, 0) == ESP_OK) {
+    int n = 0;
+    for (uint32_t i = 0; i < bytesRead; i += SOC_ADC_DIGI_RESULT_BYTES) {
+      adc_digi_output_data_t *p = (adc_digi_output_data_t*)&frame[i];
+      if (p->type2.channel == GLUCOSE_ADC_CHANNEL) {
+        burst[n++] = p->type2.data;
+      } else if (p->type2.channel == BATTERY_ADC_CHANNEL) {
+        batteryRawSum += p->type2.data;
+        batteryRawCount++;
+      }
+    }
+
+    int outputs = processCicBurst(glucoseCic, burst, n, decimated);
+    if (outputs > 0) {
+      glucoseLatest = decimated[outputs - 1];
+      glucoseHaveSample = true;
+    }
+  }
+
+  if (glucoseHaveSample) {
+    addGlucoseSample(glucoseAvg, glucoseLatest);
+    if (glucoseAvg.ready) {
+      glucoseAvg.ready = false;
+      glucoseReading = glucoseAvg.reading;
+    }
+  }
+}
+
+// Radio-on time of the empty connection or advertising events since the last call.
+// Notifications add their own time in publishValue().
+void accountRadioCharge(unsigned long now) {
+  unsigned long elapsed = now - radioAccountedAt;
+  radioAccountedAt = now;
+  float radioMs = 0;
+  if (deviceConnected) {
+    // Until the central grants parameters the link runs at about the live profile
+    uint16_t interval = achievedInterval > 0 ? achievedInterval : LIVE_PROFILE.maxInterval;
+    radioMs = elapsed / (interval * 1.25f * (achievedLatency + 1)) * CONN_EVENT_RADIO_MS;
+  } else if (advertisingPhase != NULL) {
+    float averageInterval = (advertisingPhase->minInterval + advertisingPhase->maxInterval) * 0.625 / 2;
+    radioMs = elapsed / averageInterval * ADV_EVENT_RADIO_MS;
+  }
+  energyAccrue(radioEnergy, radioMs * 1000, RADIO_ON_UA);
+}
+
+// Battery and energy record, readable at any time and notified to subscribers
+void publishDiagnostics(unsigned long now) {
+  static char record[96];
+  int length = formatEnergyRecord(record, sizeof(record), energyChannels, ENERGY_CHANNEL_COUNT,
+                                  batteryMillivolts, batteryLevel, now);
+  Serial.println(record);
+  publishValue(pDiagnosticsCharacteristic, (uint8_t*)record, length);
+}
+
+// Runtime configuration - the tunables below are kept in NVS and can be read or changed
+// with CFG commands written to the data characteristic, so a device is re-tuned without a rebuild.
+// The command set is in WearableCore.h.
+#define CONFIG_NAMESPACE "sensing"
+
+enum ConfigIndex {
+  CFG_SAMPLE_RATE = 0,   // MAX30102 sample rate (Hz), before its 4x averaging
+  CFG_IR_AMPLITUDE,      // IR LED current with no finger, where the AGC starts (0-255, ~0.2 mA per step)
+  CFG_RED_AMPLITUDE,     // Red LED current
+  CFG_UPDATE_INTERVAL,   // Publish policy evaluation period (ms)
+  CFG_HR_DEADBAND,       // hrPolicy fields
+  CFG_HR_THRESHOLD,
+  CFG_HR_MIN_INTERVAL,
+  CFG_HR_MAX_INTERVAL,
+  CFG_FINGER_THRESHOLD,  // IR level that counts as a finger on the sensor
+#if HYDRATION_CAPACITIVE
+  CFG_HYD_DRY,           // Electrode delta of dry skin (0 %) and of full hydration (100 %)
+  CFG_HYD_WET,
+#endif
+  CONFIG_COUNT
+};
+
+ConfigParam config[CONFIG_COUNT] = {
+  {"rate",   400,   50,   400,    400,   isSupportedSampleRate},
+  {"ir",     0x1F,  0,    255,    0x1F},
+  {"red",    0x0A,  0,    255,    0x0A},
+  {"upd",    100,   20,   5000,   100},
+  {"hrdb",   2,     0,    50,     2},
+  {"hrth",   60,    -1,   250,    60},     // -1 = NO_THRESHOLD
+  {"hrmin",  250,   0,    60000,  250},
+  {"hrmax",  5000,  1000, 600000, 5000},
+  {"finger", 50000, 1000, 250000, 50000},
+#if HYDRATION_CAPACITIVE
+  {"hdry",   HYDRATION_DRY_DELTA, 1, 1000000, HYDRATION_DRY_DELTA},
+  {"hwet",   HYDRATION_WET_DELTA, 2, 1000000, HYDRATION_WET_DELTA},
+#endif
+};
+
+// setup() on the sensor resets every LED, so the red and green settings go back on after it
+void applySensorConfig() {
+  particleSensor.setup(config[CFG_IR_AMPLITUDE].value, PPG_SAMPLE_AVERAGE, 3, config[CFG_SAMPLE_RATE].value, 411, 4096);
+  particleSensor.setPulseAmplitudeRed(config[CFG_RED_AMPLITUDE].value); // Red LED low to indicate sensor is running
+  particleSensor.setPulseAmplitudeGreen(0); // Turn off Green LED
+  resetLedAgc(agc, config[CFG_IR_AMPLITUDE].value, config[CFG_SAMPLE_RATE].value,
+              config[CFG_RED_AMPLITUDE].value, ledEnergy);
+  resetBpmEstimator(bpmEstimator, config[CFG_SAMPLE_RATE].value / PPG_SAMPLE_AVERAGE);
+}
+
+// Push one parameter into the variables and hardware that use it - the sensor ones
+// go through applySensorConfig()
+void applyConfig(int index) {
+  long value = config[index].value;
+  switch (index) {
+    case CFG_UPDATE_INTERVAL:  updateInterval = value; break;
+    case CFG_HR_DEADBAND:      hrPolicy.deadband = value; break;
+    case CFG_HR_THRESHOLD:     hrPolicy.threshold = value; break;
+    case CFG_HR_MIN_INTERVAL:  hrPolicy.minInterval = value; break;
+    case CFG_HR_MAX_INTERVAL:  hrPolicy.maxInterval = value; break;
+    case CFG_FINGER_THRESHOLD: fingerIrThreshold = value; break;
+#if HYDRATION_CAPACITIVE
+    case CFG_HYD_DRY:          hydration.dryDelta = value; break;
+    case CFG_HYD_WET:          hydration.wetDelta = value; break;
+#endif
+  }
+}
+
+RuntimeConfig runtimeConfig = {CONFIG_NAMESPACE, config, CONFIG_COUNT, CFG_RED_AMPLITUDE + 1,
+                               applyConfig, applySensorConfig};
 
 // BLE Server Callbacks
 class MyServerCallbacks: public BLEServerCallbacks {
@@ -65,21 +603,68 @@ class MyServerCallbacks: public BLEServerCallbacks {
     Serial.println("Device Connected!");
   };
 
+  void onConnect(BLEServer* pServer, esp_ble_gatts_cb_param_t* param) {
+    beginConnectionProfile(param);
+  }
+
   void onDisconnect(BLEServer* pServer) {
     deviceConnected = false;
+    BLECharacteristic* characteristics[] = {pCharacteristic, pHeartRateMeasurement, pBatteryLevel,
+                                            pHydrationCharacteristic, pGlucoseCharacteristic,
+                                            pHrvCharacteristic, pDiagnosticsCharacteristic};
+    resetSubscriptions(characteristics, sizeof(characteristics) / sizeof(characteristics[0]));
     Serial.println("Device Disconnected! Restarting advertisement...");
-    // Restart advertising when client disconnects
-    BLEDevice::startAdvertising();
+    // Advertising restarts from loop() in the fast phase
   }
 };
 
+// Characteristic Callbacks - writes carry clock sync requests from the display and CFG commands
+class MyCharacteristicCallbacks: public BLECharacteristicCallbacks {
+  void onWrite(BLECharacteristic* pChar) {
+    unsigned long receivedAt = millis();
+    // Parse straight from the attribute buffer, getValue() would build a String
+    char value[CONFIG_COMMAND_SIZE];
+    size_t length = min(pChar->getLength(), sizeof(value) - 1);
+    memcpy(value, pChar->getData(), length);
+    value[length] = '\0';
+    if (strncmp(value, "SYNC:", 5) == 0) {
+      syncT1 = strtoul(value + 5, NULL, 10);
+      syncT2 = receivedAt;
+      syncRequestPending = true;
+    } else if (strncmp(value, "CFG", 3) == 0) {
+      queueConfigCommand(runtimeConfig, (const uint8_t*)value, length);
+    }
+  }
+};
+
+// Answer a pending sync request from loop() so it never races a data notification
+void answerSyncRequest() {
+  if (!syncRequestPending) {
+    return;
+  }
+  syncRequestPending = false;
+  
+  char reply[48];
+  snprintf(reply, sizeof(reply), "SYNCR:%lu,%lu,%lu", syncT1, syncT2, millis());
+  publishValue(pCharacteristic, (uint8_t*)reply, strlen(reply));
+}
+
 void setup() {
   Serial.begin(115200);
   Serial.println("Initializing Heart Rate & Hydration Monitor Server...");
 
   // Initialize touch sensor pin
+#if HYDRATION_CAPACITIVE
+  // The first burst (first loop() pass) becomes the baseline, so nothing may touch the
+  // electrode at power-on
+  resetHydrationSensor(hydration, HYDRATION_RISING, HYDRATION_DRY_DELTA, HYDRATION_WET_DELTA);
+#else
   pinMode(TOUCH_PIN, INPUT);
+  initTouchInterrupt(TOUCH_PIN);
+  isHydrated = (lastQueuedTouchLevel == HIGH);
+#endif
   Serial.println("Touch sensor initialized");
+  bootMark("touch");
 
   // Initialize MAX30102 sensor
   if (!particleSensor.begin(Wire, I2C_SPEED_FAST)) {
@@ -88,17 +673,18 @@ void setup() {
   }
   Serial.println("MAX30105 sensor initialized");
 
-  // Configure MAX30102 with default settings
-  particleSensor.setup(); 
-  particleSensor.setPulseAmplitudeRed(0x0A); // Turn Red LED to low to indicate sensor is running
-  particleSensor.setPulseAmplitudeGreen(0); // Turn off Green LED
+  // Configure MAX30102 and the publish settings from the stored runtime config
+  loadConfig(runtimeConfig);
+  bootMark("sensor");
   
-  // Initialize BLE Device
-  BLEDevice::init("HR_Monitor");
+  // Start the glucose photodiode channel
+  if (initGlucoseChannel()) {
+    Serial.println("Glucose channel initialized");
+  }
+  bootMark("glucose");
   
-  // Create BLE Server
-  pServer = BLEDevice::createServer();
-  pServer->setCallbacks(new MyServerCallbacks());
+  // Initialize BLE Device and create the BLE Server
+  pServer = beginBleServer("HR_Monitor", new MyServerCallbacks());
   
   // Create BLE Service
   BLEService *pService = pServer->createService(SERVICE_UUID);
@@ -111,100 +697,364 @@ void setup() {
                       BLECharacteristic::PROPERTY_NOTIFY
                     );
   
+  // Handle clock sync writes from the display and CFG commands
+  pCharacteristic->setCallbacks(new MyCharacteristicCallbacks());
+  
   // Create a BLE Descriptor
   pCharacteristic->addDescriptor(new BLE2902());
   
+  // One characteristic per metric for clients that only want that value
+  pHydrationCharacteristic = pService->createCharacteristic(
+                               HYDRATION_CHARACTERISTIC_UUID,
+                               BLECharacteristic::PROPERTY_READ |
+                               BLECharacteristic::PROPERTY_NOTIFY
+                             );
+  pHydrationCharacteristic->addDescriptor(new BLE2902());
+  
+  pGlucoseCharacteristic = pService->createCharacteristic(
+                             GLUCOSE_CHARACTERISTIC_UUID,
+                             BLECharacteristic::PROPERTY_READ |
+                             BLECharacteristic::PROPERTY_NOTIFY
+                           );
+  pGlucoseCharacteristic->addDescriptor(new BLE2902());
+  
+  pHrvCharacteristic = pService->createCharacteristic(
+                         HRV_CHARACTERISTIC_UUID,
+                         BLECharacteristic::PROPERTY_READ |
+                         BLECharacteristic::PROPERTY_NOTIFY
+                       );
+  pHrvCharacteristic->addDescriptor(new BLE2902());
+  
+  pDiagnosticsCharacteristic = pService->createCharacteristic(
+                                 DIAGNOSTICS_CHARACTERISTIC_UUID,
+                                 BLECharacteristic::PROPERTY_READ |
+                                 BLECharacteristic::PROPERTY_NOTIFY
+                               );
+  pDiagnosticsCharacteristic->addDescriptor(new BLE2902());
+  
   // Start the service
   pService->start();
   
+  // Standard Heart Rate Service
+  BLEService *pHeartRateService = pServer->createService(HEART_RATE_SERVICE_UUID);
+  pHeartRateMeasurement = pHeartRateService->createCharacteristic(
+                            HEART_RATE_MEASUREMENT_UUID,
+                            BLECharacteristic::PROPERTY_NOTIFY
+                          );
+  pHeartRateMeasurement->addDescriptor(new BLE2902());
+  
+  pBodySensorLocation = pHeartRateService->createCharacteristic(
+                          BODY_SENSOR_LOCATION_UUID,
+                          BLECharacteristic::PROPERTY_READ
+                        );
+  uint8_t location = BODY_SENSOR_LOCATION_FINGER;
+  pBodySensorLocation->setValue(&location, 1);
+  pHeartRateService->start();
+  
+  // Standard Battery Service
+  BLEService *pBatteryService = pServer->createService(BATTERY_SERVICE_UUID);
+  pBatteryLevel = pBatteryService->createCharacteristic(
+                    BATTERY_LEVEL_UUID,
+                    BLECharacteristic::PROPERTY_READ |
+                    BLECharacteristic::PROPERTY_NOTIFY
+                  );
+  pBatteryLevel->addDescriptor(new BLE2902());
+  uint8_t level = batteryLevel;
+  pBatteryLevel->setValue(&level, 1);
+  pBatteryService->start();
+  
   // Start advertising
   BLEAdvertising *pAdvertising = BLEDevice::getAdvertising();
   pAdvertising->addServiceUUID(SERVICE_UUID);
   pAdvertising->setScanResponse(true);
+  
+  // The advertising data has no room for a second service UUID (the library widens
+  // every UUID to 128 bits), so the Heart Rate Service goes in the scan response
+  BLEAdvertisementData scanResponse;
+  scanResponse.setName("HR_Monitor");
+  scanResponse.setCompleteServices(HEART_RATE_SERVICE_UUID);
+  pAdvertising->setScanResponseData(scanResponse);
   pAdvertising->setMinPreferred(0x06);  // functions that help with iPhone connections
   pAdvertising->setMinPreferred(0x12);
-  BLEDevice::startAdvertising();
+  restartAdvertising();
+  bootMark("ble");
   
   Serial.println("BLE Heart Rate & Hydration Monitor Server Ready");
   Serial.println("Place your finger on the sensor with steady pressure.");
+  
+  markHeapBaseline();
+  reportHeap("setup");
+  reportBootProfile();
 }
 
 void loop() {
   // Read heart rate from the sensor
   long irValue = particleSensor.getIR();
+  sampleTime = millis();
+  
+  // Glucose samples are taken on the PPG sample clock
+  serviceGlucoseChannel();
+  if (serviceLedAgc(agc, particleSensor, irValue, sampleTime)) {
+    discardQualitySamples(quality);
+    clearBpmEstimator(bpmEstimator);  // The step would show up as a rhythm
+  }
+  if (irValue >= fingerIrThreshold) {
+    addQualitySample(quality, irValue, sampleTime);
+    addBpmSample(bpmEstimator, irValue);
+  } else {
+    restartSignalQuality(quality);  // The next placement is judged on its own signal
+  }
   
   // Check if a heartbeat is detected
   if (checkForBeat(irValue) == true) {
     // We sensed a beat!
     long delta = millis() - lastBeat;
     lastBeat = millis();
+    addQualityBeat(quality, delta);
     
     beatsPerMinute = 60 / (delta / 1000.0);
     
-    if (beatsPerMinute < 255 && beatsPerMinute > 20) {
-      rates[rateSpot++] = (byte)beatsPerMinute; // Store this reading in the array
-      rateSpot %= RATE_SIZE; // Wrap variable
-      
-      // Take average of readings
-      beatAvg = 0;
-      for (byte x = 0; x < RATE_SIZE; x++)
-        beatAvg += rates[x];
-      beatAvg /= RATE_SIZE;
+    // Beats from a low-quality window or right after an AGC step are dropped, so the
+    // average keeps its last good value
+    if (beatsPerMinute < 255 && beatsPerMinute > 20 && signalGood(quality) && !agcSettling(agc, sampleTime)) {
+      queueRRInterval(delta);
+      addHrvInterval(delta);
+      beatAvg = addRate(beatRates, (byte)beatsPerMinute);  // Average of the last RATE_SIZE beats
     }
   }
   
-  // Read from the touch sensor
-  int touchState = digitalRead(TOUCH_PIN);
-  isHydrated = (touchState == HIGH);
-  
-  // Create message to send via BLE
-  String message;
+#if HYDRATION_CAPACITIVE
+  bool hydrationChanged = serviceHydration(sampleTime);
+#else
+  // Update hydration only when the touch interrupt queued an edge
+  checkTouchSettled();
+  TouchEdge edge;
+  bool hydrationChanged = false;
+  while (popTouchEdge(edge)) {
+    hydrationChanged = true;
+    isHydrated = (edge.level == HIGH);
+    Serial.print("Hydration changed to ");
+    Serial.print(isHydrated ? "Hydrated" : "Less Hydrated");
+    Serial.print(" at ");
+    Serial.print(edge.timestamp);
+    Serial.println(" ms");
+  }
+#endif
   
   // Check if we have a valid heart rate reading
   int currentHR = 0;
-  if (irValue < 50000) {
+  if (irValue < fingerIrThreshold) {
     currentHR = 0; // No finger detected
+    if (hrv.count > 0) {
+      resetHrv();  // Successive differences across a gap mean nothing
+    }
+    if (bpmEstimator.filled > 0 || beatRates.count > 0) {
+      // The next placement starts from scratch instead of the last person's average
+      clearBpmEstimator(bpmEstimator);
+      resetRates(beatRates, RATE_SIZE);
+      beatAvg = 0;
+    }
     Serial.println("No finger detected");
   } else {
-    currentHR = beatAvg > 0 ? beatAvg : (int)beatsPerMinute;
+    // The beat average once it is full, the autocorrelation estimate until then. The
+    // estimate passes the same quality gate as the beats, and with neither there is no
+    // reading (0) - never the raw interval of the last, possibly artefact, beat.
+    if (beatRates.count >= RATE_SIZE) {
+      currentHR = beatAvg;
+    } else if (bpmEstimator.valid && signalGood(quality) && !agcSettling(agc, sampleTime)) {
+      currentHR = (int)(bpmEstimator.bpm + 0.5f);
+    } else {
+      currentHR = 0;
+    }
     Serial.print("IR=");
     Serial.print(irValue);
     Serial.print(", BPM=");
     Serial.print(beatsPerMinute);
     Serial.print(", Avg BPM=");
     Serial.print(beatAvg);
+    Serial.print(", Est=");
+    Serial.print(bpmEstimator.valid ? bpmEstimator.bpm : 0.0f, 1);
+    Serial.print(", SQI=");
+    Serial.print(quality.sqi);
+    if (!signalGood(quality)) {
+      Serial.print(" (low quality, held)");
+    }
   }
   
-  // Format message with HR and hydration status
-  // Format: "HR:X,HYD:Y" where X is heart rate and Y is 1 (hydrated) or 0 (not hydrated)
-  message = "HR:" + String(currentHR) + ",HYD:" + String(isHydrated ? 1 : 0);
-  
   // Debug print
   Serial.print(", Hydration=");
   Serial.print(isHydrated ? "Hydrated" : "Less Hydrated");
+#if HYDRATION_CAPACITIVE
+  Serial.print(", HydLevel=");
+  Serial.print(hydration.level);
+  Serial.print(", HydConf=");
+  Serial.print(hydration.confidence);
+#endif
+  Serial.print(", Glucose=");
+  Serial.print(glucoseReading);
   Serial.println();
   
-  // Send data via BLE at the specified interval
+  updateBatteryLevel();
+  accountRadioCharge(millis());
+  
+  // A finger on the sensor or a hydration change keeps the link on the live profile
+  updateConnectionProfile(pServer, deviceConnected, irValue >= fingerIrThreshold || hydrationChanged);
+  reportConnectionParams();
+  serviceAdvertising(deviceConnected, irValue >= fingerIrThreshold || hydrationChanged);
+  
+  // Answer clock sync requests before any data goes out
+  if (deviceConnected) {
+    answerSyncRequest();
+    handleConfigCommand(runtimeConfig, pCharacteristic);
+  }
+  
+  // Send data via BLE only when the publish policy asks for it
   unsigned long currentMillis = millis();
-  if (deviceConnected && (currentMillis - previousMillis >= UPDATE_INTERVAL)) {
+  if (deviceConnected && (currentMillis - previousMillis >= updateInterval)) {
     previousMillis = currentMillis;
     
-    // Send the message
-    pCharacteristic->setValue(message.c_str());
-    pCharacteristic->notify();
-    //Serial.println("Sent via BLE: " + message);
+    int hydValue = isHydrated ? 1 : 0;
+    PublishReason hrReason = checkPublish(hrPolicy, currentHR, currentMillis);
+    PublishReason hydReason = checkPublish(hydPolicy, hydValue, currentMillis);
+    PublishReason gluReason = checkPublish(gluPolicy, glucoseReading, currentMillis);
+    PublishReason batReason = checkPublish(batPolicy, batteryLevel, currentMillis);
+    HrvMetrics hrvMetrics;
+    bool hrvReady = computeHrv(hrvMetrics);
+    int hrvValue = hrvReady ? (int)(hrvMetrics.rmssd * 10.0f) : 0;
+    PublishReason hrvReason = hrvReady ? checkPublish(hrvPolicy, hrvValue, currentMillis) : PUBLISH_NONE;
+    
+    // Legacy text characteristic - carries every field, so any due metric sends it
+    bool textSent = false;
+    if ((hrReason != PUBLISH_NONE || hydReason != PUBLISH_NONE || gluReason != PUBLISH_NONE) &&
+        notificationsEnabled(pCharacteristic)) {
+      // Format message with HR, hydration status, glucose channel reading, sample time and quality
+      // Format: "HR:X,HYD:Y,GLU:Z,TS:T,SQ:Q" where X is heart rate, Y is 1 (hydrated) or 0 (not hydrated),
+      // Z is the 1 Hz photodiode reading in ADC counts, T is our millis() when the sample was read
+      // and Q is the signal quality index of the last window (HR is held while it is low)
+      static char message[48];
+      int length = snprintf(message, sizeof(message), "HR:%d,HYD:%d,GLU:%d,TS:%lu,SQ:%d",
+                            currentHR, hydValue, glucoseReading, sampleTime, quality.sqi);
+      
+      // Send the message
+      pCharacteristic->setValue((uint8_t*)message, length);
+      pCharacteristic->notify();
+      energyAccrue(radioEnergy, NOTIFY_RADIO_US, RADIO_ON_UA);
+      textSent = true;
+      //Serial.println("Sent via BLE: " + message);
+    }
+    
+    // Per-metric characteristics - binary values, only to subscribers
+    bool hrSent = false;
+    if (hrReason != PUBLISH_NONE || rrCount >= RR_PER_MEASUREMENT) {
+      hrSent = publishHeartRateMeasurement(currentHR, irValue >= fingerIrThreshold);
+    }
+    
+    bool hydSent = false;
+    if (hydReason != PUBLISH_NONE) {
+      uint8_t hydration = hydValue;
+      hydSent = publishValue(pHydrationCharacteristic, &hydration, 1);
+    }
+    
+    bool gluSent = false;
+    if (gluReason != PUBLISH_NONE) {
+      uint8_t glucose[2] = {(uint8_t)(glucoseReading & 0xFF), (uint8_t)(glucoseReading >> 8)};
+      gluSent = publishValue(pGlucoseCharacteristic, glucose, 2);
+    }
+    
+    bool batSent = false;
+    if (batReason != PUBLISH_NONE) {
+      uint8_t level = batteryLevel;
+      batSent = publishValue(pBatteryLevel, &level, 1);
+    }
+    
+    finishPublish(hrPolicy, hrReason, hrSent || textSent, currentHR, currentMillis);
+    finishPublish(hydPolicy, hydReason, hydSent || textSent, hydValue, currentMillis);
+    finishPublish(gluPolicy, gluReason, gluSent || textSent, glucoseReading, currentMillis);
+    bool hrvSent = false;
+    if (hrvReason != PUBLISH_NONE) {
+      hrvSent = publishHrv(hrvMetrics);
+    }
+    
+    finishPublish(batPolicy, batReason, batSent, batteryLevel, currentMillis);
+    finishPublish(hrvPolicy, hrvReason, hrvSent, hrvValue, currentMillis);
+    
+#if HYDRATION_CAPACITIVE
+    // Graded hydration shares the text characteristic (like SYNCR) at its own, slower cadence
+    PublishReason levelReason = checkPublish(hydLevelPolicy, hydration.level, currentMillis);
+    bool levelSent = false;
+    if (levelReason != PUBLISH_NONE) {
+      char levelMessage[24];
+      int length = snprintf(levelMessage, sizeof(levelMessage), "HYDL:%d,CONF:%d",
+                            hydration.level, hydration.confidence);
+      levelSent = publishValue(pCharacteristic, (uint8_t*)levelMessage, length);
+    }
+    finishPublish(hydLevelPolicy, levelReason, levelSent, hydration.level, currentMillis);
+#endif
+  }
+  
+  serviceHeapReport();
+  
+  // Report how much airtime the policy is saving
+  if (currentMillis - lastPublishStats >= 60000) {
+    lastPublishStats = currentMillis;
+    printPublishStats("HR", hrPolicy);
+    printPublishStats("HYD", hydPolicy);
+    printPublishStats("GLU", gluPolicy);
+    printPublishStats("BAT", batPolicy);
+    printPublishStats("HRV", hrvPolicy);
+#if HYDRATION_CAPACITIVE
+    printPublishStats("HYDL", hydLevelPolicy);
+    printHydrationStats();
+#endif
+    Serial.print("Battery: ");
+    Serial.print(batteryMillivolts);
+    Serial.print(" mV (");
+    Serial.print(batteryLevel);
+    Serial.print(" %), RR intervals dropped: ");
+    Serial.println(droppedRRIntervals);
+    reportEnergy(energyChannels, ENERGY_CHANNEL_COUNT, BATTERY_CAPACITY_MAH, currentMillis);
+    publishDiagnostics(currentMillis);
+    Serial.print("Glucose DMA overruns: ");
+    Serial.println(glucoseOverruns);
+    Serial.print("Signal quality: ");
+    Serial.print(quality.lowWindows);
+    Serial.print(" of ");
+    Serial.print(quality.windows);
+    Serial.println(" windows below SQI_GOOD");
+    Serial.print("LED AGC: IR amplitude ");
+    Serial.print(agc.amplitude);
+    Serial.print(" (configured ");
+    Serial.print(agc.fixedAmplitude);
+    Serial.print("), ADC range ");
+    Serial.print(2048 << agc.rangeIndex);
+    Serial.println(" nA");
+    HrvMetrics metrics;
+    if (computeHrv(metrics)) {
+      Serial.print("HRV: RMSSD=");
+      Serial.print(metrics.rmssd, 1);
+      Serial.print(" ms, SDNN=");
+      Serial.print(metrics.sdnn, 1);
+      Serial.print(" ms, pNN50=");
+      Serial.print(metrics.pnn50, 1);
+      Serial.print(" % over ");
+      Serial.print(metrics.intervals);
+      Serial.println(" intervals");
+    }
   }
   
   // Handle connection changes
   if (!deviceConnected && oldDeviceConnected) {
     delay(500); // Give the Bluetooth stack time to get ready
-    pServer->startAdvertising(); // Restart advertising
+    restartAdvertising(); // Restart advertising in the fast phase
+    reportHeap("disconnect");
     Serial.println("Started advertising");
     oldDeviceConnected = deviceConnected;
   }
   
   // Connected
   if (deviceConnected && !oldDeviceConnected) {
+    reportAdvertisingDiscovery();
+    reportHeap("connect");
     oldDeviceConnected = deviceConnected;
   }
   
@@ -5,6 +5,20 @@
 #include <BLEServer.h>
 #include <BLEUtils.h>
 #include <BLE2902.h>
+#include <Preferences.h>
+
+// Shared components from WearableCore.h - only these are compiled into this image
+#define WEARABLE_STEPPER 1
+#define WEARABLE_RATE_AVERAGE 1
+#define WEARABLE_SIGNAL_QUALITY 1
+#define WEARABLE_PUBLISH_POLICY 1
+#define WEARABLE_LED_AGC 1
+#define WEARABLE_HEAP_WATCH 1
+#define WEARABLE_ADVERTISING 1
+#define WEARABLE_CONN_PROFILE 1
+#define WEARABLE_BLE_SERVER 1
+#define WEARABLE_CONFIG 1
+#include "WearableCore.h"
 
 // Pin definitions
 #define LED_PIN 9  // LED connected to pin 9
@@ -12,6 +26,7 @@
 #define COIL_A2 5 // GPIO13 for stepper motor
 #define COIL_B1 3 // GPIO27 for stepper motor
 #define COIL_B2 4 // GPIO12 for stepper motor
+const StepperPins stepper = {COIL_A1, COIL_A2, COIL_B1, COIL_B2};
 
 MAX30105 particleSensor;
 
@@ -27,8 +42,8 @@ bool oldDeviceConnected = false;
 
 // Heart rate buffer
 const byte RATE_SIZE = 8;  // Increased buffer size for more stable averages
-byte rates[RATE_SIZE]; 
-byte rateSpot = 0;
+RateAverager beatRates = {{0}, RATE_SIZE, 0, 0};
+SignalQuality quality;  // Gate for the beats, see WearableCore.h
 long lastBeat = 0; 
 
 float beatsPerMinute;
@@ -37,14 +52,30 @@ int lastBeatAvg = 0;
 unsigned long lastBLENotification = 0;
 unsigned long lastMotorMove = 0;
 bool motorActive = false;
+unsigned long lastPublishStats = 0;
+const unsigned long PUBLISH_CHECK_INTERVAL = 100;  // Evaluate the publish policy every 100ms
 
-// Stepper motor step sequence
-const int stepSequence[4][4] = {
-    {1, 0, 1, 0}, // Step 1
-    {0, 1, 1, 0}, // Step 2
-    {0, 1, 0, 1}, // Step 3
-    {1, 0, 0, 1}  // Step 4
-};
+// Alert and motor settings - defaults here, changed at runtime with CFG commands
+long alertBpm = 70;              // Average BPM above this is an alert
+long motorSteps = 20;            // Steps per motor move
+long motorStepDelay = 15;        // ms per step
+unsigned long motorHoldOff = 5000;  // Minimum time between motor moves
+long fingerIrThreshold = 50000;  // IR below this means no finger on the sensor
+
+// Any BPM change, send at once when crossing the > 70 BPM alert level (71 and up),
+// changes inside 2 s are coalesced instead of dropped, keepalive every 10 s
+PublishPolicy hrPolicy = {0, 71, 2000, 10000};
+
+// LED AGC state - the controller is in WearableCore.h
+LedAgc agc;
+
+// Boot sequencing - advertising starts first, the sensor is retried from loop()
+bool sensorReady = false;
+int sensorInitAttempts = 0;
+unsigned long lastSensorInitAttempt = 0;
+const unsigned long SENSOR_INIT_RETRY_INTERVAL = 1000;  // ms between MAX30105 retries
+unsigned long timeToAdvertise = 0;    // millis() since power-on when advertising started
+unsigned long timeToFirstSample = 0;  // millis() since power-on of the first IR sample
 
 void stepMotor(bool clockwise, int steps, int stepDelay) {
     Serial.print("Moving motor ");
@@ -54,29 +85,138 @@ void stepMotor(bool clockwise, int steps, int stepDelay) {
     
     motorActive = true;
     
-    for (int i = 0; i < steps; i++) {
-        for (int step = 0; step < 4; step++) {
-            int s = clockwise ? step : (3 - step); // Direction control
-            
-            digitalWrite(COIL_A1, stepSequence[s][0] ? HIGH : LOW);
-            digitalWrite(COIL_A2, stepSequence[s][1] ? HIGH : LOW);
-            digitalWrite(COIL_B1, stepSequence[s][2] ? HIGH : LOW);
-            digitalWrite(COIL_B2, stepSequence[s][3] ? HIGH : LOW);
-            delay(stepDelay);
-        }
-    }
-    
-    // Turn off all coils to save power and reduce heat
-    digitalWrite(COIL_A1, LOW);
-    digitalWrite(COIL_A2, LOW);
-    digitalWrite(COIL_B1, LOW);
-    digitalWrite(COIL_B2, LOW);
+    stepperMove(stepper, clockwise, steps, stepDelay);
     
     Serial.println("Motor movement complete");
     motorActive = false;
     lastMotorMove = millis();
 }
 
+// Runtime configuration - the tunables below are kept in NVS and can be read or changed
+// with CFG commands written to the data characteristic, so a device is re-tuned without a rebuild.
+// The command set is in WearableCore.h.
+#define CONFIG_NAMESPACE "hrserver"
+
+enum ConfigIndex {
+    CFG_SAMPLE_RATE = 0,   // MAX30102 sample rate (Hz), before its 4x averaging
+    CFG_IR_AMPLITUDE,      // IR LED current with no finger, where the AGC starts (0-255, ~0.2 mA per step)
+    CFG_RED_AMPLITUDE,     // Red LED current
+    CFG_ALERT_BPM,         // Average BPM above this lights the LED and turns the motor clockwise
+    CFG_MOTOR_STEPS,       // Steps per motor move
+    CFG_MOTOR_STEP_DELAY,  // ms per step
+    CFG_MOTOR_HOLD_OFF,    // Minimum ms between motor moves
+    CFG_HR_DEADBAND,       // hrPolicy fields (the threshold follows the alert level)
+    CFG_HR_MIN_INTERVAL,
+    CFG_HR_MAX_INTERVAL,
+    CFG_FINGER_THRESHOLD,  // IR level that counts as a finger on the sensor
+    CONFIG_COUNT
+};
+
+ConfigParam config[CONFIG_COUNT] = {
+    {"rate",   400,   50,   400,    400,   isSupportedSampleRate},
+    {"ir",     0x1F,  0,    255,    0x1F},
+    {"red",    0x1F,  0,    255,    0x1F},
+    {"alert",  70,    30,   220,    70},
+    {"steps",  20,    1,    400,    20},
+    {"stepms", 15,    2,    100,    15},
+    {"hold",   5000,  0,    60000,  5000},
+    {"hrdb",   0,     0,    50,     0},
+    {"hrmin",  2000,  0,    60000,  2000},
+    {"hrmax",  10000, 1000, 600000, 10000},
+    {"finger", 50000, 1000, 250000, 50000}
+};
+
+// setup() on the sensor resets every LED, so the red and green settings go back on after it
+void applySensorConfig() {
+    if (!sensorReady) {
+        return;  // tryInitSensor() applies it once the sensor is found
+    }
+    particleSensor.setup(config[CFG_IR_AMPLITUDE].value, 4, 3, config[CFG_SAMPLE_RATE].value, 411, 4096);
+    particleSensor.setPulseAmplitudeRed(config[CFG_RED_AMPLITUDE].value);
+    particleSensor.setPulseAmplitudeGreen(0);
+    resetLedAgc(agc, config[CFG_IR_AMPLITUDE].value, config[CFG_SAMPLE_RATE].value);
+}
+
+// Push one parameter into the variables and hardware that use it - the sensor ones
+// go through applySensorConfig()
+void applyConfig(int index) {
+    long value = config[index].value;
+    switch (index) {
+        case CFG_ALERT_BPM:
+            alertBpm = value;
+            hrPolicy.threshold = value + 1;  // Send at once when crossing the alert level
+            break;
+        case CFG_MOTOR_STEPS:      motorSteps = value; break;
+        case CFG_MOTOR_STEP_DELAY: motorStepDelay = value; break;
+        case CFG_MOTOR_HOLD_OFF:   motorHoldOff = value; break;
+        case CFG_HR_DEADBAND:      hrPolicy.deadband = value; break;
+        case CFG_HR_MIN_INTERVAL:  hrPolicy.minInterval = value; break;
+        case CFG_HR_MAX_INTERVAL:  hrPolicy.maxInterval = value; break;
+        case CFG_FINGER_THRESHOLD: fingerIrThreshold = value; break;
+    }
+}
+
+RuntimeConfig runtimeConfig = {CONFIG_NAMESPACE, config, CONFIG_COUNT, CFG_RED_AMPLITUDE + 1,
+                               applyConfig, applySensorConfig};
+
+// Try to bring up the MAX30105 once, returns true when it is ready
+bool tryInitSensor() {
+    sensorInitAttempts++;
+    lastSensorInitAttempt = millis();
+    if (!particleSensor.begin(Wire, I2C_SPEED_FAST)) {
+        Serial.println("MAX30105 not found. Retrying...");
+        if (sensorInitAttempts >= 5) {
+            Serial.println("MAX30105 initialization failed. Check wiring/power and reset the device.");
+            // Toggle LED on every failed attempt to indicate error
+            digitalWrite(LED_PIN, !digitalRead(LED_PIN));
+        }
+        return false;
+    }
+
+    Serial.println("MAX30105 found and initialized!");
+    Serial.println("Place your finger on the sensor.");
+
+    // Configure sensor from the stored runtime config
+    digitalWrite(LED_PIN, LOW);
+    sensorReady = true;
+    applySensorConfig();
+    return true;
+}
+
+// Send heart rate over BLE when the publish policy allows
+void publishHeartRate() {
+    unsigned long now = millis();
+    if (!deviceConnected || now - lastBLENotification < PUBLISH_CHECK_INTERVAL) {
+        return;
+    }
+    lastBLENotification = now;
+
+    PublishReason reason = checkPublish(hrPolicy, beatAvg, now);
+    if (reason == PUBLISH_NONE) {
+        markSuppressed(hrPolicy);
+        return;
+    }
+
+    char heartRateStr[10];
+    int length = snprintf(heartRateStr, sizeof(heartRateStr), "%d", beatAvg);
+    bool sent = publishValue(pCharacteristic, (uint8_t*)heartRateStr, length);
+    finishPublish(hrPolicy, reason, sent, beatAvg, now);
+    if (sent) {
+        Serial.print("Sent heart rate: ");
+        Serial.println(heartRateStr);
+    }
+}
+
+// Characteristic Callbacks - writes carry CFG commands
+class MyCharacteristicCallbacks : public BLECharacteristicCallbacks {
+    void onWrite(BLECharacteristic* pChar) {
+        size_t length = pChar->getLength();
+        if (length >= 3 && strncmp((const char*)pChar->getData(), "CFG", 3) == 0) {
+            queueConfigCommand(runtimeConfig, pChar->getData(), length);
+        }
+    }
+};
+
 // BLE Server Callbacks
 class MyServerCallbacks : public BLEServerCallbacks {
     void onConnect(BLEServer* pServer) {
@@ -84,8 +224,13 @@ class MyServerCallbacks : public BLEServerCallbacks {
         Serial.println("Client connected");
     };
 
+    void onConnect(BLEServer* pServer, esp_ble_gatts_cb_param_t* param) {
+        beginConnectionProfile(param);
+    }
+
     void onDisconnect(BLEServer* pServer) {
         deviceConnected = false;
+        resetSubscriptions(&pCharacteristic, 1);
         Serial.println("Client disconnected");
     }
 };
@@ -96,46 +241,16 @@ void setup() {
 
     // Configure pins
     pinMode(LED_PIN, OUTPUT);
-    pinMode(COIL_A1, OUTPUT);
-    pinMode(COIL_A2, OUTPUT);
-    pinMode(COIL_B1, OUTPUT);
-    pinMode(COIL_B2, OUTPUT);
+    stepperBegin(stepper);  // Coils start released
     
     // Turn all pins LOW initially
     digitalWrite(LED_PIN, LOW);
-    digitalWrite(COIL_A1, LOW);
-    digitalWrite(COIL_A2, LOW);
-    digitalWrite(COIL_B1, LOW);
-    digitalWrite(COIL_B2, LOW);
-
-    // Initialize heart rate sensor with retry
-    int sensorInitAttempts = 0;
-    while (!particleSensor.begin(Wire, I2C_SPEED_FAST)) {
-        Serial.println("MAX30105 not found. Retrying...");
-        sensorInitAttempts++;
-        delay(1000);
-        
-        if (sensorInitAttempts >= 5) {
-            Serial.println("MAX30105 initialization failed. Check wiring/power and reset the device.");
-            digitalWrite(LED_PIN, HIGH);  // Turn on LED to indicate error
-            delay(500);
-            digitalWrite(LED_PIN, LOW);
-            delay(500);
-        }
-    }
-    
-    Serial.println("MAX30105 found and initialized!");
-    Serial.println("Place your finger on the sensor.");
 
-    // Configure sensor with better settings for reliability
-    particleSensor.setup();
-    particleSensor.setPulseAmplitudeRed(0x1F);  // Increased power for better readings
-    particleSensor.setPulseAmplitudeGreen(0);
+    // Stored alert, motor and sensor settings
+    loadConfig(runtimeConfig);
 
     // Initialize BLE
-    BLEDevice::init("HeartRate-ESP32");
-    pServer = BLEDevice::createServer();
-    pServer->setCallbacks(new MyServerCallbacks());
+    pServer = beginBleServer("HeartRate-ESP32", new MyServerCallbacks());
 
     BLEService *pService = pServer->createService(SERVICE_UUID);
     pCharacteristic = pService->createCharacteristic(
@@ -145,6 +260,7 @@ void setup() {
         BLECharacteristic::PROPERTY_NOTIFY
     );
 
+    pCharacteristic->setCallbacks(new MyCharacteristicCallbacks());
     pCharacteristic->addDescriptor(new BLE2902());
     pCharacteristic->setValue("0");
 
@@ -155,32 +271,114 @@ void setup() {
     pAdvertising->setScanResponse(true);
     pAdvertising->setMinPreferred(0x06);  // Helps with iPhone connections
     pAdvertising->setMinPreferred(0x12);
-    BLEDevice::startAdvertising();
+    restartAdvertising();
 
+    timeToAdvertise = millis();
     Serial.println("BLE server ready. Waiting for connections...");
+    Serial.print("Boot: time to advertise ");
+    Serial.print(timeToAdvertise);
+    Serial.println(" ms");
+
+    // Sensor comes up after advertising, failed attempts are retried from loop()
+    tryInitSensor();
+
+    markHeapBaseline();
+    reportHeap("setup");
+}
+
+// Connection profile, advertising, config commands, notifications and reports - runs
+// every loop, with or without a sensor
+void serviceLink(bool fingerOn) {
+    // A finger on the sensor keeps the link on the live profile
+    updateConnectionProfile(pServer, deviceConnected, fingerOn);
+    reportConnectionParams();
+    serviceAdvertising(deviceConnected, fingerOn);
+
+    // Config replies go out before any data
+    if (deviceConnected) {
+        handleConfigCommand(runtimeConfig, pCharacteristic);
+    }
+
+    // Publish changes, coalesced changes and keepalives
+    publishHeartRate();
+    serviceHeapReport();
+    if (millis() - lastPublishStats >= 60000) {
+        lastPublishStats = millis();
+        printPublishStats("HR", hrPolicy);
+        Serial.print("Signal quality: ");
+        Serial.print(quality.lowWindows);
+        Serial.print(" of ");
+        Serial.print(quality.windows);
+        Serial.println(" windows below SQI_GOOD");
+        Serial.print("LED AGC: IR amplitude ");
+        Serial.print(agc.amplitude);
+        Serial.print(" (configured ");
+        Serial.print(agc.fixedAmplitude);
+        Serial.print("), ADC range ");
+        Serial.print(2048 << agc.rangeIndex);
+        Serial.println(" nA");
+    }
+
+    // Disconnection handling - restart advertising if client disconnected
+    if (!deviceConnected && oldDeviceConnected) {
+        delay(500); // Give the bluetooth stack time to get ready
+        restartAdvertising(); // Restart advertising in the fast phase
+        reportHeap("disconnect");
+        Serial.println("Restarting advertising");
+        oldDeviceConnected = deviceConnected;
+    }
+    
+    // Connection handling
+    if (deviceConnected && !oldDeviceConnected) {
+        reportAdvertisingDiscovery();
+        reportHeap("connect");
+        oldDeviceConnected = deviceConnected;
+    }
 }
 
 void loop() {
+    // Keep retrying the sensor without blocking the BLE side - the link keeps running, so
+    // the keepalive (carrying 0) stops the display from dropping a connection meanwhile
+    if (!sensorReady) {
+        if (millis() - lastSensorInitAttempt >= SENSOR_INIT_RETRY_INTERVAL) {
+            tryInitSensor();
+        }
+        serviceLink(false);
+        delay(20);
+        return;
+    }
+
     long irValue = particleSensor.getIR();
     boolean validReading = false;
+    if (serviceLedAgc(agc, particleSensor, irValue, millis())) {
+        discardQualitySamples(quality);
+    }
+    if (irValue > fingerIrThreshold) {
+        addQualitySample(quality, irValue, millis());
+    } else {
+        restartSignalQuality(quality);  // The next placement is judged on its own signal
+    }
+
+    if (timeToFirstSample == 0) {
+        timeToFirstSample = millis();
+        Serial.print("Boot: time to first sample ");
+        Serial.print(timeToFirstSample);
+        Serial.println(" ms");
+    }
 
     // Check for a heartbeat
-    if (irValue > 50000 && checkForBeat(irValue)) {
+    if (irValue > fingerIrThreshold && checkForBeat(irValue)) {
         long delta = millis() - lastBeat;
         lastBeat = millis();
+        addQualityBeat(quality, delta);
 
         beatsPerMinute = 60 / (delta / 1000.0);
 
-        // Validate BPM is in reasonable range
-        if (beatsPerMinute < 220 && beatsPerMinute > 30) {
-            rates[rateSpot++] = (byte)beatsPerMinute;
-            rateSpot %= RATE_SIZE;
-
-            // Calculate average BPM
-            beatAvg = 0;
-            for (byte x = 0; x < RATE_SIZE; x++)
-                beatAvg += rates[x];
-            beatAvg /= RATE_SIZE;
+        // Validate BPM is in reasonable range and the signal can be trusted - a beat from
+        // a low-quality window or right after an AGC step neither moves the average nor
+        // drives the motor
+        if (beatsPerMinute < 220 && beatsPerMinute > 30 && signalGood(quality) && !agcSettling(agc, millis())) {
+            beatAvg = addRate(beatRates, (byte)beatsPerMinute);
             
             validReading = true;
         }
@@ -195,10 +393,14 @@ void loop() {
         Serial.print(beatsPerMinute);
         Serial.print(", Avg BPM=");
         Serial.print(beatAvg);
+        Serial.print(", SQI=");
+        Serial.print(quality.sqi);
 
-        if (irValue < 50000) {
+        if (irValue < fingerIrThreshold) {
             Serial.println(" No finger detected");
             digitalWrite(LED_PIN, LOW);
+        } else if (!signalGood(quality)) {
+            Serial.println(" Low signal quality, reading held");
         } else {
             Serial.println(" Reading valid");
         }
@@ -207,43 +409,23 @@ void loop() {
     }
 
     // Handle BPM threshold actions with debouncing
-    if (validReading && beatAvg > 70 && beatAvg != lastBeatAvg) {
+    if (validReading && beatAvg > alertBpm && beatAvg != lastBeatAvg) {
         digitalWrite(LED_PIN, HIGH);
         
-        // Only move motor if not already active and time since last move > 5 seconds
-        if (!motorActive && (millis() - lastMotorMove > 5000)) {
-            stepMotor(true, 20, 15);  // clockwise, 20 steps, 15ms delay
-        }
-        
-        // Send heart rate over BLE with rate limiting
-        if (deviceConnected && (millis() - lastBLENotification > 2000)) {
-            char heartRateStr[10];
-            sprintf(heartRateStr, "%d", beatAvg);
-            pCharacteristic->setValue(heartRateStr);
-            pCharacteristic->notify();
-            lastBLENotification = millis();
-            Serial.print("Sent heart rate: ");
-            Serial.println(heartRateStr);
+        // Only move motor if not already active and the hold-off has passed
+        if (!motorActive && (millis() - lastMotorMove > motorHoldOff)) {
+            stepMotor(true, motorSteps, motorStepDelay);  // clockwise
         }
+
     } 
-    else if (validReading && beatAvg <= 70 && beatAvg != lastBeatAvg) {
+    else if (validReading && beatAvg <= alertBpm && beatAvg != lastBeatAvg) {
         digitalWrite(LED_PIN, LOW);
         
-        // Only move motor if not already active and time since last move > 5 seconds
-        if (!motorActive && (millis() - lastMotorMove > 5000)) {
-            stepMotor(false, 20, 15);  // counter-clockwise, 20 steps, 15ms delay
-        }
-        
-        // Send heart rate over BLE with rate limiting
-        if (deviceConnected && (millis() - lastBLENotification > 2000)) {
-            char heartRateStr[10];
-            sprintf(heartRateStr, "%d", beatAvg);
-            pCharacteristic->setValue(heartRateStr);
-            pCharacteristic->notify();
-            lastBLENotification = millis();
-            Serial.print("Sent heart rate: ");
-            Serial.println(heartRateStr);
+        // Only move motor if not already active and the hold-off has passed
+        if (!motorActive && (millis() - lastMotorMove > motorHoldOff)) {
+            stepMotor(false, motorSteps, motorStepDelay);  // counter-clockwise
         }
+
     }
     
     // Save last BPM average for change detection
@@ -251,18 +433,7 @@ void loop() {
         lastBeatAvg = beatAvg;
     }
 
-    // Disconnection handling - restart advertising if client disconnected
-    if (!deviceConnected && oldDeviceConnected) {
-        delay(500); // Give the bluetooth stack time to get ready
-        pServer->startAdvertising(); // Restart advertising
-        Serial.println("Restarting advertising");
-        oldDeviceConnected = deviceConnected;
-    }
-    
-    // Connection handling
-    if (deviceConnected && !oldDeviceConnected) {
-        oldDeviceConnected = deviceConnected;
-    }
+    serviceLink(irValue > fingerIrThreshold);
 
     delay(20); // Short delay for stability
 }
@@ -0,0 +1,443 @@
+"""
+Serial Dashboard - live terminal plots of a sketch's serial debug stream.
+
+Reads the lines the sketches print over USB serial, e.g.
+
+  IR=104233, BPM=71.86, Avg BPM=72, Est=71.9, SQI=88, Hydration=Hydrated, Glucose=2040
+
+parses them incrementally as bytes arrive and redraws plots of IR, BPM, the beat
+average and hydration a fixed number of times per second. Every plotted field
+is decimated on arrival into per-column min/max buckets held in a ring, so
+memory and render cost depend on the terminal width and not on the input
+rate or on how long the dashboard runs.
+
+Sources:
+  a serial port   - opened raw through termios (the C3's USB-CDC ignores the baud)
+  PtyStandIn      - a pseudo-terminal fed by "simulate" in a child process, used by
+                    "bench" so the whole path runs without hardware. The simulator
+                    appends "SENT=<ns>" to each line so display latency can be
+                    measured end to end
+
+Usage:
+  python SerialDashboard.py watch /dev/ttyACM0
+  python SerialDashboard.py watch /dev/ttyACM0 --fields IR BPM Est SQI --window 30
+  python SerialDashboard.py bench --rate 1000 --duration 20
+  python SerialDashboard.py simulate --rate 1000 > /dev/pts/5
+"""
+
+import argparse
+import asyncio
+import io
+import math
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import termios
+import time
+import tty
+from collections import deque
+from typing import Deque, Dict, List, Optional, TextIO, Tuple
+
+DEFAULT_FIELDS = ("IR", "BPM", "Avg BPM", "Hydration")
+TEXT_VALUES = {"Hydrated": 1.0, "Less Hydrated": 0.0}
+SENT_FIELD = "SENT"       # Added by the simulator only, host send time in ns
+MAX_LINE = 512            # Longer runs without a newline are noise (wrong baud), dropped
+LATENCY_TARGET_MS = 100.0
+STATS_FRAMES = 72000      # Per-frame latency/render times kept (an hour at 20 fps)
+
+# Braille cells are 2 dots wide and 4 high - bit of each dot, left/right column, top to bottom
+BRAILLE_DOTS = ((0x01, 0x02, 0x04, 0x40), (0x08, 0x10, 0x20, 0x80))
+
+Bucket = Optional[Tuple[float, float]]
+
+
+def parse_line(line: str) -> Dict[str, float]:
+    """Parse one "KEY=VALUE, KEY=VALUE" debug line into numeric fields.
+
+    Hydration text maps to 1/0, trailing notes such as "SQI=12 (low quality,
+    held)" are cut at the first space and anything still not a number is
+    skipped, so status lines ("No finger detected") just contribute no fields.
+    """
+    fields = {}
+    for part in line.split(","):
+        key, sep, value = part.partition("=")
+        if not sep:
+            continue
+        value = value.strip()
+        number = TEXT_VALUES.get(value)
+        if number is None:
+            try:
+                number = float(value.split(" ", 1)[0].rstrip("%"))
+            except ValueError:
+                continue
+        fields[key.strip()] = number
+    return fields
+
+
+class LineSplitter:
+    """Turns arbitrary byte chunks into complete lines, keeping the partial tail."""
+
+    def __init__(self, max_line: int = MAX_LINE):
+        self.max_line = max_line
+        self.tail = b""
+        self.dropped = 0
+
+    def feed(self, data: bytes) -> List[str]:
+        lines = (self.tail + data).split(b"\n")
+        self.tail = lines.pop()
+        if len(self.tail) > self.max_line:
+            self.tail = b""
+            self.dropped += 1
+        return [line.decode("ascii", "replace").rstrip("\r") for line in lines if line]
+
+
+class Channel:
+    """One plotted field, decimated into a ring of time buckets.
+
+    Each bucket covers window / buckets of time and keeps only the min and max
+    seen in it; buckets without samples stay None so gaps show as gaps.
+    """
+
+    def __init__(self, name: str, window_ns: int, buckets: int):
+        self.name = name
+        self.span_ns = max(1, window_ns // buckets)
+        self.ring: Deque[Bucket] = deque(maxlen=buckets - 1)
+        self.index: Optional[int] = None   # Time bucket being filled
+        self.lo = 0.0
+        self.hi = 0.0
+        self.last: Optional[float] = None
+        self.samples = 0
+
+    def _advance(self, index: int) -> None:
+        if self.index is not None:
+            self.ring.append((self.lo, self.hi))
+            for _ in range(min(index - self.index - 1, self.ring.maxlen)):
+                self.ring.append(None)
+        self.index = index
+
+    def add(self, t_ns: int, value: float) -> None:
+        index = t_ns // self.span_ns
+        if index != self.index:
+            self._advance(index)
+            self.lo = self.hi = value
+        elif value < self.lo:
+            self.lo = value
+        elif value > self.hi:
+            self.hi = value
+        self.last = value
+        self.samples += 1
+
+    def series(self, now_ns: int) -> List[Bucket]:
+        """Oldest-first buckets up to now, padded so the plot scrolls while no data arrives."""
+        if self.index is None:
+            return [None] * (self.ring.maxlen + 1)
+        idle = min(now_ns // self.span_ns - self.index, self.ring.maxlen + 1)
+        series = list(self.ring) + [(self.lo, self.hi)] + [None] * max(0, idle)
+        return series[-(self.ring.maxlen + 1):]
+
+
+def render_plot(series: List[Bucket], rows: int) -> Tuple[List[str], float, float]:
+    """Braille plot of min/max buckets, two per cell. Returns the rows and the y range."""
+    values = [v for bucket in series if bucket is not None for v in bucket]
+    if not values:
+        return [" " * ((len(series) + 1) // 2)] * rows, 0.0, 0.0
+    low, high = min(values), max(values)
+    if high - low < 1e-9:
+        low, high = low - 1, high + 1
+    levels = rows * 4
+    scale = (levels - 1) / (high - low)
+    grid = [[0] * ((len(series) + 1) // 2) for _ in range(rows)]
+    for x, bucket in enumerate(series):
+        if bucket is None:
+            continue
+        cell, side = divmod(x, 2)
+        bottom = int((bucket[0] - low) * scale + 0.5)
+        top = int((bucket[1] - low) * scale + 0.5)
+        for y in range(bottom, top + 1):
+            grid[rows - 1 - y // 4][cell] |= BRAILLE_DOTS[side][3 - y % 4]
+    return ["".join(chr(0x2800 + dots) for dots in row) for row in grid], low, high
+
+
+class Dashboard:
+    """Parses the stream into channels and redraws them at a fixed frame rate."""
+
+    def __init__(self, fields: List[str], window: float, columns: int, rows: int,
+                 fps: float, out: TextIO, title: str = ""):
+        window_ns = int(window * 1e9)
+        self.channels = {name: Channel(name, window_ns, columns * 2) for name in fields}
+        self.rows = rows
+        self.fps = fps
+        self.out = out
+        self.title = title
+        self.window = window
+        self.splitter = LineSplitter()
+        self.lines = 0
+        self.unparsed = 0
+        self.first_pending_ns = 0   # Send/arrival time of the oldest sample not yet drawn
+        self.latencies_ms: Deque[float] = deque(maxlen=STATS_FRAMES)
+        self.frame_ms: Deque[float] = deque(maxlen=STATS_FRAMES)
+        self.ingest_ns = 0
+        self.closed = asyncio.Event()
+
+    def feed(self, data: bytes) -> None:
+        """Source callback - called with whatever bytes the read returned."""
+        start = time.perf_counter_ns()
+        now_ns = time.time_ns()
+        for line in self.splitter.feed(data):
+            self.lines += 1
+            fields = parse_line(line)
+            if not fields:
+                self.unparsed += 1
+                continue
+            if not self.first_pending_ns:
+                sent = fields.get(SENT_FIELD)
+                self.first_pending_ns = int(sent) if sent else now_ns
+            for name, channel in self.channels.items():
+                value = fields.get(name)
+                if value is not None:
+                    channel.add(now_ns, value)
+        self.ingest_ns += time.perf_counter_ns() - start
+
+    def frame(self, now_ns: int) -> str:
+        rate = self.lines / max(1e-9, (now_ns - self.started_ns) / 1e9)
+        latency = self.latencies_ms[-1] if self.latencies_ms else 0.0
+        parts = [f"\x1b[H{self.title}  {rate:.0f} lines/s, {self.unparsed} unparsed, "
+                 f"latency {latency:.0f} ms, last {self.window:g} s\x1b[K"]
+        for channel in self.channels.values():
+            plot, low, high = render_plot(channel.series(now_ns), self.rows)
+            last = "-" if channel.last is None else f"{channel.last:g}"
+            parts.append(f"{channel.name} = {last}  [{low:g} .. {high:g}]\x1b[K")
+            parts.extend(row + "\x1b[K" for row in plot)
+        return "\n".join(parts) + "\n\x1b[J"
+
+    async def run(self) -> None:
+        """Redraw every 1/fps s until the source closes."""
+        self.started_ns = time.time_ns()
+        period = 1.0 / self.fps
+        next_frame = time.monotonic()
+        self.out.write("\x1b[2J")
+        while not self.closed.is_set():
+            next_frame += period
+            start = time.perf_counter()
+            now_ns = time.time_ns()
+            self.out.write(self.frame(now_ns))
+            self.out.flush()
+            if self.first_pending_ns:
+                self.latencies_ms.append((time.time_ns() - self.first_pending_ns) / 1e6)
+                self.first_pending_ns = 0
+            self.frame_ms.append((time.perf_counter() - start) * 1000)
+            try:
+                await asyncio.wait_for(self.closed.wait(), max(0.0, next_frame - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+
+
+class SerialSource:
+    """Raw, non-blocking tty reader on the event loop (serial port or pty)."""
+
+    def __init__(self, path: str, baud: int = 115200):
+        self.path = path
+        self.baud = baud
+        self.fd = -1
+        self.chunks = 0
+
+    def open(self, dashboard: Dashboard) -> None:
+        self.fd = os.open(self.path, os.O_RDONLY | os.O_NOCTTY | os.O_NONBLOCK)
+        tty.setraw(self.fd)
+        speed = getattr(termios, f"B{self.baud}", None)
+        if speed is not None:
+            attrs = termios.tcgetattr(self.fd)
+            attrs[4] = attrs[5] = speed
+            termios.tcsetattr(self.fd, termios.TCSANOW, attrs)
+
+        def on_readable() -> None:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+            except OSError:      # EIO once the other end of a pty is gone
+                data = b""
+            if not data:
+                self.close()
+                dashboard.closed.set()
+                return
+            self.chunks += 1
+            dashboard.feed(data)
+
+        asyncio.get_running_loop().add_reader(self.fd, on_readable)
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            asyncio.get_running_loop().remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PtyStandIn:
+    """Pseudo-terminal whose far end is written by "simulate" in a child process.
+
+    The dashboard opens path like any serial port; the simulator runs in its own
+    process so its CPU is not counted against the dashboard.
+    """
+
+    def __init__(self, rate: float, duration: float):
+        self.rate = rate
+        self.duration = duration
+        self.master, self.slave = os.openpty()
+        self.path = os.ttyname(self.slave)
+        self.process: Optional[subprocess.Popen] = None
+
+    def start(self) -> None:
+        # Only the child keeps the master, so its exit ends the stream on our side
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "simulate",
+             "--rate", str(self.rate), "--duration", str(self.duration)],
+            stdout=self.master)
+        os.close(self.master)
+        os.close(self.slave)
+
+    def wait(self) -> int:
+        return self.process.wait() if self.process else 0
+
+
+def simulate(rate: float, duration: float, out) -> int:
+    """Write HeartRateCode/SensingDeviceNew-style lines at 'rate' per second to 'out'.
+
+    Lines due since the last write go out together every couple of ms, each
+    stamped with SENT. Returns the number of lines written.
+    """
+    start = time.monotonic()
+    written = 0
+    bpm = 72.0
+    while True:
+        elapsed = time.monotonic() - start
+        if elapsed >= duration:
+            break
+        due = int(elapsed * rate) - written
+        if due > 0:
+            sent_ns = time.time_ns()
+            lines = []
+            for n in range(written, written + due):
+                t = n / rate
+                phase = (t * bpm / 60.0) % 1.0
+                pulse = math.exp(-((phase - 0.2) / 0.08) ** 2) + 0.4 * math.exp(-((phase - 0.5) / 0.1) ** 2)
+                ir = int(100000 + 3000 * math.sin(2 * math.pi * 0.25 * t) - 1500 * pulse)
+                beat = bpm + 3 * math.sin(2 * math.pi * t / 30)
+                hydration = "Hydrated" if int(t / 20) % 2 == 0 else "Less Hydrated"
+                lines.append(f"IR={ir}, BPM={beat:.2f}, Avg BPM={int(beat)}, "
+                             f"Hydration={hydration}, {SENT_FIELD}={sent_ns}\n")
+            try:
+                out.write("".join(lines).encode("ascii"))
+                out.flush()
+            except BrokenPipeError:
+                break
+            written += due
+        time.sleep(0.002)
+    return written
+
+
+def percentile(values: List[float], pct: float) -> float:
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+async def watch(path: str, baud: int, fields: List[str], window: float, fps: float, rows: int) -> None:
+    columns = max(20, os.get_terminal_size(sys.stdout.fileno()).columns - 1)
+    dashboard = Dashboard(fields, window, columns, rows, fps, sys.stdout, title=path)
+    source = SerialSource(path, baud)
+    source.open(dashboard)
+    try:
+        await dashboard.run()
+    finally:
+        source.close()
+
+
+async def benchmark(rate: float, duration: float, fields: List[str], window: float, fps: float,
+                    rows: int, columns: int, show: bool) -> None:
+    stand_in = PtyStandIn(rate, duration)
+    out = sys.stdout if show else io.StringIO()
+    dashboard = Dashboard(fields, window, columns, rows, fps, out, title=f"pty {stand_in.path}")
+    source = SerialSource(stand_in.path)
+    source.open(dashboard)
+
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    cpu_start = time.process_time()
+    wall_start = time.monotonic()
+    stand_in.start()
+    if not show:
+        # Frames go to a StringIO - keep only the latest one
+        async def trim() -> None:
+            while not dashboard.closed.is_set():
+                out.seek(0)
+                out.truncate()
+                await asyncio.sleep(0.5)
+        trimmer = asyncio.create_task(trim())
+    await dashboard.run()
+    wall = time.monotonic() - wall_start
+    cpu = time.process_time() - cpu_start
+    stand_in.wait()
+    if not show:
+        trimmer.cancel()
+    rss_end = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    latencies = sorted(dashboard.latencies_ms)
+    frames = sorted(dashboard.frame_ms)
+    held = sum(len(channel.ring) + 1 for channel in dashboard.channels.values())
+    print(f"Input: {dashboard.lines} lines in {wall:.1f} s ({dashboard.lines / wall:.0f} lines/s, "
+          f"target {rate:g}) in {source.chunks} reads, {dashboard.unparsed} unparsed, "
+          f"{dashboard.splitter.dropped} overlong dropped")
+    print(f"Parse + decimate: {dashboard.ingest_ns / 1000 / max(1, dashboard.lines):.1f} us/line")
+    if frames:
+        print(f"Frames: {len(frames)} at {fps:g} fps, render p50={percentile(frames, 50):.2f} ms "
+              f"max={frames[-1]:.2f} ms")
+    if latencies:
+        print(f"Display latency ms (send -> drawn): p50={percentile(latencies, 50):.1f} "
+              f"p95={percentile(latencies, 95):.1f} p99={percentile(latencies, 99):.1f} "
+              f"max={latencies[-1]:.1f} mean={statistics.fmean(latencies):.1f} "
+              f"(target < {LATENCY_TARGET_MS:g})")
+    print(f"Dashboard CPU: {cpu:.2f} s over {wall:.2f} s wall ({100.0 * cpu / wall:.1f}% of one core)")
+    print(f"Memory: {held} buckets held for {len(dashboard.channels)} fields "
+          f"({columns * 2} per field, independent of rate and duration), "
+          f"max RSS grew {max(0, rss_end - rss_start)} kB")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Live plots of a sketch's serial debug stream")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def add_view_options(cmd: argparse.ArgumentParser) -> None:
+        cmd.add_argument("--fields", nargs="+", default=list(DEFAULT_FIELDS), help="fields to plot")
+        cmd.add_argument("--window", type=float, default=10.0, help="seconds shown")
+        cmd.add_argument("--fps", type=float, default=20.0, help="redraws per second")
+        cmd.add_argument("--rows", type=int, default=4, help="terminal rows per plot")
+
+    watch_cmd = sub.add_parser("watch", help="plot a serial port")
+    watch_cmd.add_argument("port")
+    watch_cmd.add_argument("--baud", type=int, default=115200)
+    add_view_options(watch_cmd)
+
+    bench_cmd = sub.add_parser("bench", help="drive the dashboard through the pty stand-in")
+    bench_cmd.add_argument("--rate", type=float, default=1000.0, help="lines per second")
+    bench_cmd.add_argument("--duration", type=float, default=20.0, help="seconds")
+    bench_cmd.add_argument("--columns", type=int, default=80, help="plot width in characters")
+    bench_cmd.add_argument("--show", action="store_true", help="draw to the terminal instead of discarding")
+    add_view_options(bench_cmd)
+
+    sim_cmd = sub.add_parser("simulate", help="write synthetic debug lines to stdout")
+    sim_cmd.add_argument("--rate", type=float, default=1000.0, help="lines per second")
+    sim_cmd.add_argument("--duration", type=float, default=math.inf, help="seconds")
+
+    args = parser.parse_args()
+    if args.command == "watch":
+        asyncio.run(watch(args.port, args.baud, args.fields, args.window, args.fps, args.rows))
+    elif args.command == "bench":
+        asyncio.run(benchmark(args.rate, args.duration, args.fields, args.window, args.fps,
+                              args.rows, args.columns, args.show))
+    else:
+        simulate(args.rate, args.duration, sys.stdout.buffer)
+
+
+if __name__ == "__main__":
+    main()
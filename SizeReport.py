@@ -0,0 +1,315 @@
+"""
+Size Report - flash, static RAM and boot time of the WearableCore.h features.
+
+Every sketch switches on only the WearableCore.h features it uses, so the cost of a
+feature is what it adds to an image. This tool measures it three ways:
+
+  features   builds a tiny probe sketch per feature (plus an empty baseline) with
+             arduino-cli and reports what each feature adds in flash and static RAM
+  sketches   builds the firmware sketches themselves and reports their totals
+             against the board limits, with the features each one compiles in
+  boot       reads serial logs captured after reset and summarises the
+             "Boot step" lines printed by reportBootProfile()
+
+The sketches are kept as .py files in this repository; they are staged into a
+temporary <name>/<name>.ino folder together with the repo's headers before
+building. Extra headers the sketches expect next to them (Free_Fonts.h from the
+TFT_eSPI examples) can be passed with --include.
+
+Usage:
+  python SizeReport.py features
+  python SizeReport.py sketches SensingDeviceNew DisplayDeviceNew
+  python SizeReport.py boot sensing_boot.log display_boot.log
+"""
+
+import argparse
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+REPO = Path(__file__).resolve().parent
+DEFAULT_FQBN = "esp32:esp32:XIAO_ESP32C3"
+FIRMWARE = ["SensingDevice", "SensingDeviceNew", "SensingServer_Bluetooth", "HeartRateCode",
+            "DisplayDevice", "DisplayDeviceNew", "DisplayClient_Bluetooth"]
+
+# What each probe calls, so the linker keeps the feature's code. 'sink' is volatile so
+# nothing can be folded away at compile time.
+FEATURE_PROBES = {
+    "STEPPER": """
+  StepperPins pins = {2, 3, 4, 5};
+  stepperBegin(pins);
+  stepperMove(pins, sink & 1, sink, 10);""",
+    "TOUCH_QUEUE": """
+  pinMode(2, INPUT);
+  initTouchInterrupt(2);
+  checkTouchSettled();
+  TouchEdge edge;
+  while (popTouchEdge(edge)) {
+    sink = edge.level + edge.timestamp;
+  }""",
+    "PUBLISH_POLICY": """
+  static PublishPolicy policy = {2, 60, 250, 5000};
+  PublishReason reason = checkPublish(policy, sink, millis());
+  finishPublish(policy, reason, sink & 1, sink, millis());
+  printPublishStats("probe", policy);""",
+    "RATE_AVERAGE": """
+  static RateAverager rates;
+  resetRates(rates, 8);
+  sink = addRate(rates, sink);""",
+    "BPM_ESTIMATOR": """
+  static BpmEstimator estimator;
+  resetBpmEstimator(estimator, 100);
+  if (addBpmSample(estimator, sink)) {
+    sink = estimator.bpm;
+  }""",
+    "SIGNAL_QUALITY": """
+  static SignalQuality quality;
+  addQualitySample(quality, sink, millis());
+  addQualityBeat(quality, sink);
+  if (!signalGood(quality)) {
+    restartSignalQuality(quality);
+  }
+  sink = quality.sqi;""",
+    "HYDRATION_LEVEL": """
+  static HydrationSensor hydration;
+  static uint32_t samples[16];
+  resetHydrationSensor(hydration, true, 2000, 12000);
+  samples[0] = sink;
+  addHydrationBurst(hydration, samples, 16);
+  sink = hydration.level;""",
+    "HR_MESSAGE": """
+  static char message[64];
+  message[0] = sink;
+  HrMessage reading;
+  if (parseHrMessage(message, reading)) {
+    sink = reading.heartRate + reading.glucose + reading.quality + reading.timestamp;
+  }
+  int level, confidence;
+  if (parseHydrationLevel(message, level, confidence)) {
+    sink = level + confidence;
+  }""",
+    "LED_AGC": """
+  static MAX30105 sensor;
+  static LedAgc agc;
+  resetLedAgc(agc, 0x1F, 400);
+  if (serviceLedAgc(agc, sensor, sink, millis())) {
+    sink = agc.amplitude;
+  }
+  sink = agcSettling(agc, millis());""",
+    "HEAP_WATCH": """
+  markHeapBaseline();
+  reportHeap("probe");
+  serviceHeapReport();""",
+    "BOOT_PROFILE": """
+  bootMark("probe");
+  reportBootProfile();""",
+    "ENERGY": """
+  static EnergyChannel channel = {"probe", 1000, false, 0, 0, 0};
+  static EnergyChannel* channels[] = {&channel};
+  static char record[64];
+  energySet(channel, sink & 1, millis());
+  energyAccrue(channel, sink, 1000);
+  formatEnergyRecord(record, sizeof(record), channels, 1, sink, batteryPercent(sink), millis());
+  reportEnergy(channels, 1, 1000, millis());""",
+    "ADVERTISING": """
+  BLEDevice::init("probe");
+  restartAdvertising();
+  serviceAdvertising(sink & 1, sink & 2);
+  reportAdvertisingDiscovery();""",
+    "CONN_PROFILE": """
+  BLEDevice::init("probe");
+  BLEDevice::setCustomGapHandler(onGapEvent);
+  BLEServer* server = BLEDevice::createServer();
+  updateConnectionProfile(server, sink & 1, sink & 2);
+  reportConnectionParams();""",
+    "BLE_SERVER": """
+  BLEServer* server = beginBleServer("probe", NULL);
+  BLEService* service = server->createService(BLEUUID((uint16_t)0x180D));
+  BLECharacteristic* characteristic = service->createCharacteristic(
+      BLEUUID((uint16_t)0x2A37), BLECharacteristic::PROPERTY_NOTIFY);
+  characteristic->addDescriptor(new BLE2902());
+  uint8_t value = sink;
+  publishValue(characteristic, &value, 1);
+  resetSubscriptions(&characteristic, 1);""",
+    "CONFIG": """
+  static ConfigParam params[] = {{"rate", 400, 50, 400, 400, isSupportedSampleRate},
+                                 {"probe", 0, 0, 100, 0}};
+  static RuntimeConfig config = {"probe", params, 2, 1, [](int index) { sink = index; },
+                                 [] { sink = 0; }};
+  static BLECharacteristic characteristic(BLEUUID((uint16_t)0x2A37));
+  loadConfig(config);
+  queueConfigCommand(config, (const uint8_t*)"CFG?", 4);
+  handleConfigCommand(config, &characteristic);""",
+    "SCAN": """
+  BLEDevice::init("probe");
+  restartScanning();
+  serviceScan(sink & 1, sink & 2);
+  endScan();
+  reportScanDiscovery();""",
+    "LINK_SUPERVISOR": """
+  markLinkData();
+  startLinkSupervision();
+  sink = superviseLink(BLEDevice::createClient(), NULL, nullptr);""",
+    "BLE_CLIENT": """
+  beginBleClient("probe", NULL);
+  static esp_bd_addr_t address;
+  address[0] = sink;
+  BLERemoteCharacteristic* characteristic = connectCharacteristic(
+      BLEDevice::createClient(), address, BLE_ADDR_TYPE_PUBLIC,
+      BLEUUID((uint16_t)0x180D), BLEUUID((uint16_t)0x2A37));
+  sink = characteristic != NULL;""",
+}
+
+# Features a probe cannot be built without - their cost is measured against a probe that
+# enables just these, with an empty body
+FEATURE_REQUIRES: Dict[str, Tuple[str, ...]] = {
+    "CONFIG": ("BLE_SERVER",),
+}
+
+SKETCH_USES = re.compile(r"Sketch uses (\d+) bytes .*?Maximum is (\d+) bytes")
+GLOBALS_USE = re.compile(r"Global variables use (\d+) bytes .*?Maximum is (\d+) bytes")
+FEATURE_DEFINE = re.compile(r"^#define WEARABLE_(\w+) 1", re.MULTILINE)
+BOOT_STEP = re.compile(r"Boot step (\S+): (\d+) us")
+BOOT_TOTAL = re.compile(r"Boot total: (\d+) us")
+
+
+class BuildSize(NamedTuple):
+    flash: int
+    flash_max: int
+    ram: int
+    ram_max: int
+
+
+def probe_source(feature: Optional[str], requires: Tuple[str, ...] = ()) -> str:
+    """Probe sketch that enables one feature and the ones it needs, or none for a baseline."""
+    define = "".join(f"#define WEARABLE_{name} 1\n" for name in requires + ((feature,) if feature else ()))
+    body = FEATURE_PROBES[feature] if feature else ""
+    return (f"{define}#include \"WearableCore.h\"\n\n"
+            "volatile int sink = 0;\n\n"
+            "void setup() {\n"
+            "  Serial.begin(115200);"
+            f"{body}\n"
+            "}\n\n"
+            "void loop() {\n"
+            "}\n")
+
+
+def stage(workdir: Path, name: str, source: str, includes: List[Path]) -> Path:
+    """Write <workdir>/<name>/<name>.ino next to the repo headers and any extra includes."""
+    sketch_dir = workdir / name
+    sketch_dir.mkdir(parents=True, exist_ok=True)
+    (sketch_dir / f"{name}.ino").write_text(source)
+    for header in list(REPO.glob("*.h")) + includes:
+        shutil.copy(header, sketch_dir / header.name)
+    return sketch_dir
+
+
+def parse_size(output: str) -> BuildSize:
+    """Sizes from arduino-cli's 'Sketch uses' / 'Global variables use' lines."""
+    sketch = SKETCH_USES.search(output)
+    globals_ = GLOBALS_USE.search(output)
+    if sketch is None or globals_ is None:
+        raise ValueError("no size lines in the arduino-cli output")
+    return BuildSize(int(sketch.group(1)), int(sketch.group(2)),
+                     int(globals_.group(1)), int(globals_.group(2)))
+
+
+def build(sketch_dir: Path, fqbn: str, cli: str) -> BuildSize:
+    result = subprocess.run([cli, "compile", "--fqbn", fqbn, str(sketch_dir)],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.stderr.write(result.stdout + result.stderr)
+        raise RuntimeError(f"build of {sketch_dir.name} failed")
+    return parse_size(result.stdout)
+
+
+def report_features(fqbn: str, cli: str, includes: List[Path]) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        baseline = build(stage(workdir, "probe_baseline", probe_source(None), includes), fqbn, cli)
+        print(f"Board {fqbn}: baseline probe {baseline.flash} B flash, {baseline.ram} B static RAM")
+        print(f"{'Feature':<17}{'Flash (B)':>11}{'RAM (B)':>10}")
+        baselines = {(): baseline}
+        for feature in FEATURE_PROBES:
+            requires = FEATURE_REQUIRES.get(feature, ())
+            base = baselines.get(requires)
+            if base is None:
+                name = "probe_with_" + "_".join(requires).lower()
+                base = baselines[requires] = build(stage(workdir, name, probe_source(None, requires), includes),
+                                                   fqbn, cli)
+            name = f"probe_{feature.lower()}"
+            size = build(stage(workdir, name, probe_source(feature, requires), includes), fqbn, cli)
+            note = f"  on top of {', '.join(requires)}" if requires else ""
+            print(f"{feature:<17}{size.flash - base.flash:>+11}{size.ram - base.ram:>+10}{note}")
+
+
+def report_sketches(names: List[str], fqbn: str, cli: str, includes: List[Path]) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        print(f"{'Sketch':<26}{'Flash (B)':>11}{'%':>7}{'RAM (B)':>10}{'%':>7}  Features")
+        for name in names:
+            source = (REPO / f"{name}.py").read_text()
+            features = ", ".join(FEATURE_DEFINE.findall(source)) or "-"
+            try:
+                size = build(stage(workdir, name, source, includes), fqbn, cli)
+            except RuntimeError as error:
+                print(f"{name:<26}{'':>11}{'':>7}{'':>10}{'':>7}  {error}")
+                continue
+            print(f"{name:<26}{size.flash:>11}{100 * size.flash / size.flash_max:>6.1f}%"
+                  f"{size.ram:>10}{100 * size.ram / size.ram_max:>6.1f}%  {features}")
+
+
+def parse_boot_log(text: str) -> Dict[str, List[int]]:
+    """Durations (us) per boot step, one entry per boot found in the log."""
+    steps: Dict[str, List[int]] = {}
+    for match in BOOT_STEP.finditer(text):
+        steps.setdefault(match.group(1), []).append(int(match.group(2)))
+    totals = [int(match.group(1)) for match in BOOT_TOTAL.finditer(text)]
+    if totals:
+        steps["total"] = totals
+    return steps
+
+
+def report_boot(logs: List[Path]) -> None:
+    for log in logs:
+        steps = parse_boot_log(log.read_text(errors="replace"))
+        if not steps:
+            print(f"{log}: no boot profile lines")
+            continue
+        print(f"{log} ({len(steps.get('total', []))} boots)")
+        print(f"  {'Step':<12}{'mean (ms)':>11}{'min':>9}{'max':>9}")
+        for step, durations in steps.items():
+            print(f"  {step:<12}{statistics.mean(durations) / 1000:>11.1f}"
+                  f"{min(durations) / 1000:>9.1f}{max(durations) / 1000:>9.1f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Footprint of the WearableCore.h features")
+    parser.add_argument("--fqbn", default=DEFAULT_FQBN, help="board to build for")
+    parser.add_argument("--cli", default="arduino-cli", help="arduino-cli executable")
+    parser.add_argument("--include", type=Path, action="append", default=[],
+                        help="extra header to copy next to every staged sketch")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    sub.add_parser("features", help="flash and static RAM added by each feature")
+    sketches = sub.add_parser("sketches", help="totals of the firmware sketches")
+    sketches.add_argument("names", nargs="*", default=FIRMWARE)
+    boot = sub.add_parser("boot", help="summarise boot profiles from serial logs")
+    boot.add_argument("logs", nargs="+", type=Path)
+
+    args = parser.parse_args()
+    if args.command == "features":
+        report_features(args.fqbn, args.cli, args.include)
+    elif args.command == "sketches":
+        report_sketches(args.names, args.fqbn, args.cli, args.include)
+    else:
+        report_boot(args.logs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+"""
+Time Series Store - append-only on-disk history for the host side.
+
+One series per (device, metric), e.g. ("dev0001", "HR"). Each series is three files:
+
+  <root>/<device>/<metric>.dat   compressed chunks, appended only
+  <root>/<device>/<metric>.idx   one fixed-size record per chunk:
+                                 start_ts, end_ts, offset, length, count, min, max, sum
+  <root>/<device>/<metric>.log   the open tail: the chunk number it belongs to, then
+                                 raw timestamp/value records
+
+A chunk holds up to CHUNK_POINTS points stored column by column (timestamp
+deltas, then values) and compressed with zlib. Deltas are 32-bit, so a gap of
+more than MAX_DELTA (~49.7 days) starts a new chunk. Queries mmap both files, binary
+search the index for the chunks that overlap the range and only decompress
+those. Downsampling uses the per-chunk min/max/sum to skip decompression when
+a whole chunk falls inside one bucket.
+
+flush() makes the open tail durable by appending its new points to the log - it
+does not seal it, so periodic flushes still leave full CHUNK_POINTS chunks. The
+log is replayed when the series is opened and emptied once its chunk is written;
+a log numbered for a chunk the index already has was sealed before a crash and is
+dropped.
+
+Timestamps are integer milliseconds, values are 32-bit integers (the units the
+sketches send: BPM, 0/1 hydration, ADC counts, motor position).
+
+Usage:
+  python TimeSeriesStore.py bench --root /tmp/tsdb --devices 300 --hours 24
+"""
+
+import argparse
+import mmap
+import os
+import shutil
+import struct
+import time
+import zlib
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+CHUNK_POINTS = 1024      # Points per full chunk
+COMPRESS_LEVEL = 1       # zlib level - ingest speed matters more than the last few %
+MAX_DELTA = 0xFFFFFFFF   # Largest timestamp delta a chunk can hold (uint32 ms)
+
+INDEX_RECORD = struct.Struct("<qqQIIiiq")  # start, end, offset, length, count, min, max, sum
+LOG_HEADER = struct.Struct("<Q")            # Number of the chunk the logged tail will become
+LOG_RECORD = struct.Struct("<qi")           # timestamp, value
+
+
+class ChunkInfo(NamedTuple):
+    start: int
+    end: int
+    offset: int
+    length: int
+    count: int
+    min: int
+    max: int
+    sum: int
+
+
+class Bucket(NamedTuple):
+    start: int    # Bucket start timestamp (ms)
+    count: int
+    mean: float
+    min: int
+    max: int
+
+
+def encode_chunk(timestamps: List[int], values: List[int]) -> bytes:
+    """Columnar encode: first timestamp, uint32 deltas, int32 values, then zlib."""
+    deltas = array("I", (b - a for a, b in zip(timestamps, timestamps[1:])))
+    body = struct.pack("<qI", timestamps[0], len(values)) + deltas.tobytes() + array("i", values).tobytes()
+    return zlib.compress(body, COMPRESS_LEVEL)
+
+
+def decode_chunk(data: bytes) -> Tuple[List[int], array]:
+    body = zlib.decompress(data)
+    first, count = struct.unpack_from("<qI", body)
+    split = 12 + 4 * (count - 1)
+    deltas = array("I")
+    deltas.frombytes(body[12:split])
+    values = array("i")
+    values.frombytes(body[split:])
+    return list(accumulate(deltas, initial=first)), values
+
+
+class Series:
+    """One (device, metric) series - buffered appends plus mmap reads."""
+
+    def __init__(self, data_path: str, index_path: str, log_path: str):
+        self.data_path = data_path
+        self.index_path = index_path
+        self.log_path = log_path
+        self.pending_ts: List[int] = []
+        self.pending_values: List[int] = []
+        self.logged = 0            # Pending points already in the log
+        self.last_ts: Optional[int] = None
+
+        chunks = self._chunk_count()
+        if chunks:
+            self.last_ts = self._read_index(chunks - 1).end
+        self._replay_log(chunks)
+
+    def _replay_log(self, chunks: int) -> None:
+        """Load the open tail left by the last run - read only, so a query never races the writer."""
+        try:
+            with open(self.log_path, "rb") as log:
+                blob = log.read()
+        except FileNotFoundError:
+            return
+        if len(blob) < LOG_HEADER.size or LOG_HEADER.unpack_from(blob)[0] != chunks:
+            return   # Sealed before a crash - the next flush() rewrites the log
+        count = (len(blob) - LOG_HEADER.size) // LOG_RECORD.size   # A torn last record is dropped
+        end = LOG_HEADER.size + count * LOG_RECORD.size
+        for timestamp, value in LOG_RECORD.iter_unpack(blob[LOG_HEADER.size:end]):
+            self.pending_ts.append(timestamp)
+            self.pending_values.append(value)
+        self.logged = count
+        if count:
+            self.last_ts = self.pending_ts[-1]
+
+    # Writing
+
+    def append(self, timestamp: int, value: int) -> None:
+        if self.last_ts is not None and timestamp < self.last_ts:
+            raise ValueError(f"out of order timestamp {timestamp} < {self.last_ts} in {self.data_path}")
+        if self.pending_ts and timestamp - self.pending_ts[-1] > MAX_DELTA:
+            self.seal()
+        self.pending_ts.append(timestamp)
+        self.pending_values.append(value)
+        self.last_ts = timestamp
+        if len(self.pending_values) >= CHUNK_POINTS:
+            self.seal()
+
+    def flush(self) -> None:
+        """Append the points not yet logged to the tail log - the tail stays open."""
+        if self.logged == len(self.pending_values):
+            return
+        records = b"".join(LOG_RECORD.pack(t, v) for t, v in
+                           zip(self.pending_ts[self.logged:], self.pending_values[self.logged:]))
+        if self.logged == 0:
+            with open(self.log_path, "wb") as log:
+                log.write(LOG_HEADER.pack(self._chunk_count()) + records)
+        else:
+            # Written at the end of the replayed records, over any torn one
+            with open(self.log_path, "r+b") as log:
+                log.seek(LOG_HEADER.size + self.logged * LOG_RECORD.size)
+                log.write(records)
+                log.truncate()
+        self.logged = len(self.pending_values)
+
+    def seal(self) -> None:
+        """Write buffered points as a chunk (data first, so a torn index never points past the data)."""
+        if not self.pending_values:
+            return
+        blob = encode_chunk(self.pending_ts, self.pending_values)
+        with open(self.data_path, "ab") as data:
+            offset = data.tell()
+            data.write(blob)
+        record = INDEX_RECORD.pack(self.pending_ts[0], self.pending_ts[-1], offset, len(blob),
+                                   len(self.pending_values), min(self.pending_values),
+                                   max(self.pending_values), sum(self.pending_values))
+        with open(self.index_path, "ab") as index:
+            index.write(record)
+        # The index now numbers the logged tail as sealed, so a crash before this is harmless
+        if self.logged:
+            os.truncate(self.log_path, 0)
+        self.pending_ts = []
+        self.pending_values = []
+        self.logged = 0
+
+    # Reading
+
+    def _chunk_count(self) -> int:
+        try:
+            return os.path.getsize(self.index_path) // INDEX_RECORD.size
+        except FileNotFoundError:
+            return 0
+
+    def _read_index(self, i: int, index_map=None) -> ChunkInfo:
+        if index_map is not None:
+            return ChunkInfo(*INDEX_RECORD.unpack_from(index_map, i * INDEX_RECORD.size))
+        with open(self.index_path, "rb") as index:
+            index.seek(i * INDEX_RECORD.size)
+            return ChunkInfo(*INDEX_RECORD.unpack(index.read(INDEX_RECORD.size)))
+
+    def chunks(self, start: int, end: int):
+        """Yield (ChunkInfo, data mmap) for every stored chunk overlapping [start, end)."""
+        count = self._chunk_count()
+        if count == 0:
+            return
+        with open(self.index_path, "rb") as index_file, open(self.data_path, "rb") as data_file:
+            with mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ) as index_map, \
+                    mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) as data_map:
+                # First chunk whose end is >= start (chunk ends are non-decreasing)
+                lo, hi = 0, count
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if self._read_index(mid, index_map).end < start:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                for i in range(lo, count):
+                    info = self._read_index(i, index_map)
+                    if info.start >= end:
+                        break
+                    yield info, data_map
+
+    def pending(self, start: int, end: int) -> List[Tuple[int, int]]:
+        return [(t, v) for t, v in zip(self.pending_ts, self.pending_values) if start <= t < end]
+
+
+class TimeSeriesStore:
+    """Chunked columnar store keyed by (device, metric)."""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.series: Dict[Tuple[str, str], Series] = {}
+        os.makedirs(root, exist_ok=True)
+
+    def _series(self, device: str, metric: str) -> Series:
+        """The series to append to, created on first use."""
+        key = (device, metric)
+        series = self.series.get(key)
+        if series is None:
+            directory = os.path.join(self.root, device)
+            os.makedirs(directory, exist_ok=True)
+            base = os.path.join(directory, metric)
+            series = self.series[key] = Series(base + ".dat", base + ".idx", base + ".log")
+        return series
+
+    def _stored(self, device: str, metric: str) -> Optional[Series]:
+        """The series to read, None if it was never written - a query creates nothing."""
+        key = (device, metric)
+        series = self.series.get(key)
+        if series is None:
+            base = os.path.join(self.root, device, metric)
+            if not os.path.exists(base + ".idx") and not os.path.exists(base + ".log"):
+                return None
+            series = self.series[key] = Series(base + ".dat", base + ".idx", base + ".log")
+        return series
+
+    def append(self, device: str, metric: str, timestamp: int, value: int) -> None:
+        self._series(device, metric).append(timestamp, value)
+
+    def append_reading(self, device: str, timestamp: int, fields: Dict[str, int]) -> None:
+        """Store every field of one parsed notification (see FleetAggregator.parse_payload)."""
+        for metric, value in fields.items():
+            if metric != "TS":
+                self.append(device, metric, timestamp, value)
+
+    def flush(self) -> None:
+        """Make every open tail durable without sealing it."""
+        for series in self.series.values():
+            series.flush()
+
+    def devices(self) -> List[str]:
+        return sorted(d for d in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, d)))
+
+    def range(self, device: str, metric: str, start: int, end: int) -> Tuple[List[int], List[int]]:
+        """All points with start <= timestamp < end."""
+        series = self._stored(device, metric)
+        out_ts: List[int] = []
+        out_values: List[int] = []
+        if series is None:
+            return out_ts, out_values
+        for info, data_map in series.chunks(start, end):
+            timestamps, values = decode_chunk(data_map[info.offset:info.offset + info.length])
+            if info.start >= start and info.end < end:
+                out_ts.extend(timestamps)
+                out_values.extend(values)
+            else:
+                for t, v in zip(timestamps, values):
+                    if start <= t < end:
+                        out_ts.append(t)
+                        out_values.append(v)
+        for t, v in series.pending(start, end):
+            out_ts.append(t)
+            out_values.append(v)
+        return out_ts, out_values
+
+    def downsample(self, device: str, metric: str, start: int, end: int, step: int) -> List[Bucket]:
+        """Mean/min/max per 'step' ms bucket over [start, end), empty buckets omitted."""
+        series = self._stored(device, metric)
+        if series is None:
+            return []
+        buckets: Dict[int, List[int]] = {}  # bucket index -> [count, sum, min, max]
+
+        def add(index: int, count: int, total: int, low: int, high: int) -> None:
+            bucket = buckets.get(index)
+            if bucket is None:
+                buckets[index] = [count, total, low, high]
+            else:
+                bucket[0] += count
+                bucket[1] += total
+                if low < bucket[2]:
+                    bucket[2] = low
+                if high > bucket[3]:
+                    bucket[3] = high
+
+        for info, data_map in series.chunks(start, end):
+            first = (info.start - start) // step
+            if info.start >= start and info.end < end and first == (info.end - start) // step:
+                # Whole chunk inside one bucket - the index already has the answer
+                add(first, info.count, info.sum, info.min, info.max)
+                continue
+            timestamps, values = decode_chunk(data_map[info.offset:info.offset + info.length])
+            # Timestamps are sorted, so each bucket is one slice found by bisect and
+            # reduced with the C builtins instead of a Python loop per point
+            lo = bisect_left(timestamps, start)
+            stop = bisect_left(timestamps, end, lo)
+            while lo < stop:
+                index = (timestamps[lo] - start) // step
+                hi = bisect_left(timestamps, start + (index + 1) * step, lo, stop)
+                chunk_values = values[lo:hi]
+                add(index, hi - lo, sum(chunk_values), min(chunk_values), max(chunk_values))
+                lo = hi
+        for t, v in series.pending(start, end):
+            add((t - start) // step, 1, v, v, v)
+
+        return [Bucket(start + index * step, b[0], b[1] / b[0], b[2], b[3])
+                for index, b in sorted(buckets.items())]
+
+
+def benchmark(root: str, devices: int, hours: float, rate: float, metrics: List[str]) -> None:
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    store = TimeSeriesStore(root)
+    points = int(hours * 3600 * rate)
+    step = int(1000 / rate)
+    t0 = 1_700_000_000_000
+
+    # Ingest round-robin across devices, the way the aggregator delivers readings
+    start = time.perf_counter()
+    for i in range(points):
+        timestamp = t0 + i * step
+        for d in range(devices):
+            device = f"dev{d:04d}"
+            for m, metric in enumerate(metrics):
+                store.append(device, metric, timestamp, 60 + (i // 60 + d + m) % 40)
+    store.flush()
+    elapsed = time.perf_counter() - start
+    total = points * devices * len(metrics)
+    size = sum(os.path.getsize(os.path.join(dirpath, f))
+               for dirpath, _, files in os.walk(root) for f in files)
+    print(f"Ingested {total} points ({devices} devices x {len(metrics)} metrics x {points}) "
+          f"in {elapsed:.1f} s: {total / elapsed:.0f} points/s")
+    print(f"On disk: {size / 1e6:.1f} MB, {size / total:.2f} bytes/point")
+
+    # Query a fresh store so nothing is served from write buffers
+    store = TimeSeriesStore(root)
+    end = t0 + points * step
+    day_start = end - 24 * 3600 * 1000
+    for label, step_ms in (("1-minute", 60_000), ("1-hour", 3_600_000)):
+        timings = []
+        for d in range(min(devices, 20)):
+            q_start = time.perf_counter()
+            buckets = store.downsample(f"dev{d:04d}", metrics[0], day_start, end, step_ms)
+            timings.append(time.perf_counter() - q_start)
+        timings.sort()
+        print(f"Last 24 h at {label} resolution: {len(buckets)} buckets, "
+              f"median {1000 * timings[len(timings) // 2]:.1f} ms, max {1000 * timings[-1]:.1f} ms")
+
+    q_start = time.perf_counter()
+    timestamps, _ = store.range("dev0000", metrics[0], end - 3600 * 1000, end)
+    print(f"Raw range, last 1 h: {len(timestamps)} points in {1000 * (time.perf_counter() - q_start):.1f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Chunked columnar time-series store")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    bench = sub.add_parser("bench", help="ingest synthetic history and time queries")
+    bench.add_argument("--root", default="tsdb_bench")
+    bench.add_argument("--devices", type=int, default=300)
+    bench.add_argument("--hours", type=float, default=24.0)
+    bench.add_argument("--rate", type=float, default=1.0, help="points per second per metric")
+    bench.add_argument("--metrics", default="HR,HYD,MOTOR")
+
+    query = sub.add_parser("query", help="downsample one series")
+    query.add_argument("--root", required=True)
+    query.add_argument("device")
+    query.add_argument("metric")
+    query.add_argument("--hours", type=float, default=24.0, help="window ending now")
+    query.add_argument("--step", type=int, default=60, help="bucket size in seconds")
+
+    args = parser.parse_args()
+    if args.command == "bench":
+        benchmark(args.root, args.devices, args.hours, args.rate, args.metrics.split(","))
+    else:
+        store = TimeSeriesStore(args.root)
+        end = int(time.time() * 1000)
+        start = end - int(args.hours * 3600 * 1000)
+        for bucket in store.downsample(args.device, args.metric, start, end, args.step * 1000):
+            print(f"{bucket.start} n={bucket.count} mean={bucket.mean:.1f} min={bucket.min} max={bucket.max}")
+
+
+if __name__ == "__main__":
+    main()
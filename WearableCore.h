@@ -0,0 +1,2021 @@
+/*
+  Wearable Core - components shared by the sensing and display sketches
+  The stepper driver, touch edge queue, publish policy, beat-rate averaging,
+  reading-message parsing, LED AGC, heap watch, boot timing, runtime configuration
+  and the BLE plumbing used to be pasted into every sketch and had drifted apart.
+  Each one now lives here once and is compiled in only when the sketch asks for it,
+  so an image carries just the parts it uses:
+
+    #define WEARABLE_STEPPER 1          // Full-step driver for the 4-wire stepper
+    #define WEARABLE_TOUCH_QUEUE 1      // Debounced edges of a digital touch pin, from its interrupt
+    #define WEARABLE_PUBLISH_POLICY 1   // Deadband / threshold / keepalive gate for notifications
+    #define WEARABLE_RATE_AVERAGE 1     // Rolling BPM average over the last beats
+    #define WEARABLE_BPM_ESTIMATOR 1    // Autocorrelation BPM, valid ~2 s after finger placement
+    #define WEARABLE_SIGNAL_QUALITY 1   // Per-window SQI gate: perfusion, beat regularity, clipping
+    #define WEARABLE_HYDRATION_LEVEL 1  // Graded hydration from touchRead() bursts
+    #define WEARABLE_HR_MESSAGE 1       // "HR:X,HYD:Y[,GLU:Z][,TS:T][,SQ:Q]", "HYDL:L,CONF:C" parsers
+    #define WEARABLE_LED_AGC 1          // MAX3010x IR LED current / ADC range control, LED charge
+    #define WEARABLE_HEAP_WATCH 1       // Free heap / live blocks against a baseline
+    #define WEARABLE_BOOT_PROFILE 1     // Time spent in each setup() step
+    #define WEARABLE_ENERGY 1           // Charge used per subsystem, LiPo state of charge
+    #define WEARABLE_ADVERTISING 1      // Fast/slow advertising phases, discovery time and radio cost
+    #define WEARABLE_CONN_PROFILE 1     // Live/background connection parameters from recent activity
+    #define WEARABLE_BLE_SERVER 1       // Server setup, CCCD-aware publishValue()
+    #define WEARABLE_CONFIG 1           // CFG commands over BLE, values kept in NVS
+    #define WEARABLE_SCAN 1             // Fast/slow scan bursts, discovery time and radio cost
+    #define WEARABLE_LINK_SUPERVISOR 1  // Stale -> resubscribe -> reconnect for a silent link
+    #define WEARABLE_BLE_CLIENT 1       // Client setup, connect to one service characteristic
+    #include "WearableCore.h"
+
+  Pin maps, thresholds, UUIDs and message contents stay in the sketches. SizeReport.py
+  builds a probe per feature to show what each one costs in flash and static RAM,
+  and reads the boot profile back from a serial log. Everything defined here is inline
+  (C++17 inline variables for the shared state) or has internal linkage, so the header
+  can be included from more than one file of a sketch.
+
+  RATE_AVERAGE, BPM_ESTIMATOR, SIGNAL_QUALITY, HYDRATION_LEVEL and HR_MESSAGE have no Arduino
+  dependencies, so the same code also builds in the host harnesses
+  (BpmEstimatorHost.cpp, HydrationLevelHost.cpp).
+*/
+
+#ifndef WEARABLE_CORE_H
+#define WEARABLE_CORE_H
+
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+
+#ifndef WEARABLE_STEPPER
+#define WEARABLE_STEPPER 0
+#endif
+#ifndef WEARABLE_TOUCH_QUEUE
+#define WEARABLE_TOUCH_QUEUE 0
+#endif
+#ifndef WEARABLE_PUBLISH_POLICY
+#define WEARABLE_PUBLISH_POLICY 0
+#endif
+#ifndef WEARABLE_RATE_AVERAGE
+#define WEARABLE_RATE_AVERAGE 0
+#endif
+#ifndef WEARABLE_BPM_ESTIMATOR
+#define WEARABLE_BPM_ESTIMATOR 0
+#endif
+#ifndef WEARABLE_SIGNAL_QUALITY
+#define WEARABLE_SIGNAL_QUALITY 0
+#endif
+#ifndef WEARABLE_HYDRATION_LEVEL
+#define WEARABLE_HYDRATION_LEVEL 0
+#endif
+#ifndef WEARABLE_HR_MESSAGE
+#define WEARABLE_HR_MESSAGE 0
+#endif
+#ifndef WEARABLE_LED_AGC
+#define WEARABLE_LED_AGC 0
+#endif
+#ifndef WEARABLE_HEAP_WATCH
+#define WEARABLE_HEAP_WATCH 0
+#endif
+#ifndef WEARABLE_BOOT_PROFILE
+#define WEARABLE_BOOT_PROFILE 0
+#endif
+#ifndef WEARABLE_ENERGY
+#define WEARABLE_ENERGY 0
+#endif
+#ifndef WEARABLE_ADVERTISING
+#define WEARABLE_ADVERTISING 0
+#endif
+#ifndef WEARABLE_CONN_PROFILE
+#define WEARABLE_CONN_PROFILE 0
+#endif
+#ifndef WEARABLE_BLE_SERVER
+#define WEARABLE_BLE_SERVER 0
+#endif
+#ifndef WEARABLE_CONFIG
+#define WEARABLE_CONFIG 0
+#endif
+#ifndef WEARABLE_SCAN
+#define WEARABLE_SCAN 0
+#endif
+#ifndef WEARABLE_LINK_SUPERVISOR
+#define WEARABLE_LINK_SUPERVISOR 0
+#endif
+#ifndef WEARABLE_BLE_CLIENT
+#define WEARABLE_BLE_CLIENT 0
+#endif
+
+#define WEARABLE_BLE (WEARABLE_ADVERTISING || WEARABLE_CONN_PROFILE || WEARABLE_BLE_SERVER || \
+                      WEARABLE_SCAN || WEARABLE_LINK_SUPERVISOR || WEARABLE_BLE_CLIENT)
+
+#if WEARABLE_STEPPER || WEARABLE_TOUCH_QUEUE || WEARABLE_PUBLISH_POLICY || WEARABLE_LED_AGC || \
+    WEARABLE_HEAP_WATCH || WEARABLE_BOOT_PROFILE || WEARABLE_ENERGY || WEARABLE_BLE
+#include <Arduino.h>
+#endif
+#if WEARABLE_LED_AGC
+#include "MAX30105.h"
+#endif
+#if WEARABLE_BLE
+#include <BLEDevice.h>
+#endif
+#if WEARABLE_CONN_PROFILE || WEARABLE_BLE_SERVER
+#include <BLEServer.h>
+#endif
+#if WEARABLE_BLE_SERVER
+#include <BLE2902.h>
+#endif
+#if WEARABLE_CONFIG
+#include <Preferences.h>
+#endif
+#if WEARABLE_HEAP_WATCH
+#include "esp_heap_caps.h"
+#endif
+
+#if WEARABLE_ENERGY
+// Energy accounting - every subsystem's estimated current integrated over the time it
+// is on. Switched loads (LEDs, coils, backlight) use energySet(), duty-cycled ones (radio,
+// MAX3010x LEDs) add their on-time and current with energyAccrue(). The currents are
+// datasheet estimates: good enough to see which subsystem eats the battery, not a fuel
+// gauge. Charge is kept in uA x us so a day of small increments loses nothing.
+struct EnergyChannel {
+  const char* name;
+  uint32_t activeUa;        // Draw while switched on with energySet()
+  bool on;
+  unsigned long onSince;    // millis() when switched on
+  uint64_t onUs;            // Time on, closed intervals
+  uint64_t charge;          // uA x us, closed intervals
+};
+
+inline void energyAccrue(EnergyChannel &channel, uint64_t onUs, uint32_t currentUa) {
+  channel.onUs += onUs;
+  channel.charge += (uint64_t)onUs * currentUa;
+}
+
+inline void energySet(EnergyChannel &channel, bool on, unsigned long now) {
+  if (on == channel.on) {
+    return;
+  }
+  if (on) {
+    channel.onSince = now;
+  } else {
+    energyAccrue(channel, (uint64_t)(now - channel.onSince) * 1000, channel.activeUa);
+  }
+  channel.on = on;
+}
+
+// Charge so far including a load that is still on, in mAh
+inline float energyMah(const EnergyChannel &channel, unsigned long now) {
+  uint64_t charge = channel.charge;
+  if (channel.on) {
+    charge += (uint64_t)(now - channel.onSince) * 1000 * channel.activeUa;
+  }
+  return charge / 3.6e12f;
+}
+
+inline float energyOnSeconds(const EnergyChannel &channel, unsigned long now) {
+  uint64_t onUs = channel.onUs;
+  if (channel.on) {
+    onUs += (uint64_t)(now - channel.onSince) * 1000;
+  }
+  return onUs / 1e6f;
+}
+
+// Rough LiPo state of charge from the resting voltage
+inline int batteryPercent(int millivolts) {
+  static const int curve[][2] = {
+    {4200, 100}, {4100, 90}, {4000, 78}, {3900, 62}, {3800, 45},
+    {3700, 25}, {3600, 10}, {3500, 3}, {3300, 0}
+  };
+  const int points = sizeof(curve) / sizeof(curve[0]);
+  if (millivolts >= curve[0][0]) {
+    return 100;
+  }
+  for (int i = 1; i < points; i++) {
+    if (millivolts >= curve[i][0]) {
+      int span = curve[i - 1][0] - curve[i][0];
+      return curve[i][1] + (millivolts - curve[i][0]) * (curve[i - 1][1] - curve[i][1]) / span;
+    }
+  }
+  return 0;
+}
+
+// Diagnostics record: "DIAG:BAT=<mV>,PCT=<%>,<name>=<mAh>,...,UP=<s>" with the charge of
+// every channel since boot. Returns the length, truncated to fit like snprintf.
+inline int formatEnergyRecord(char* out, size_t size, EnergyChannel* const* channels, uint8_t count,
+                              int batteryMillivolts, int batteryLevel, unsigned long now) {
+  int length = snprintf(out, size, "DIAG:BAT=%d,PCT=%d", batteryMillivolts, batteryLevel);
+  for (uint8_t i = 0; i < count && length < (int)size; i++) {
+    length += snprintf(out + length, size - length, ",%s=%.2f", channels[i]->name,
+                       energyMah(*channels[i], now));
+  }
+  if (length < (int)size) {
+    length += snprintf(out + length, size - length, ",UP=%lu", now / 1000);
+  }
+  return length < (int)size ? length : (int)size - 1;
+}
+
+// One line per channel with its share of the total, and how long a full 'capacityMah'
+// cell would last at the average current since boot
+inline void reportEnergy(EnergyChannel* const* channels, uint8_t count, uint16_t capacityMah,
+                         unsigned long now) {
+  float total = 0;
+  for (uint8_t i = 0; i < count; i++) {
+    total += energyMah(*channels[i], now);
+  }
+  float hours = now / 3.6e6f;
+  float average = hours > 0 ? total / hours : 0.0f;
+  Serial.print("Energy since boot: ");
+  Serial.print(total, 3);
+  Serial.print(" mAh, average ");
+  Serial.print(average, 2);
+  Serial.print(" mA, ~");
+  Serial.print(average > 0 ? capacityMah / average : 0.0f, 0);
+  Serial.print(" h on ");
+  Serial.print(capacityMah);
+  Serial.println(" mAh");
+  for (uint8_t i = 0; i < count; i++) {
+    float charge = energyMah(*channels[i], now);
+    Serial.print("  ");
+    Serial.print(channels[i]->name);
+    Serial.print(": ");
+    Serial.print(charge, 3);
+    Serial.print(" mAh (");
+    Serial.print(total > 0 ? 100.0f * charge / total : 0.0f, 1);
+    Serial.print(" %), on ");
+    Serial.print(energyOnSeconds(*channels[i], now), 1);
+    Serial.println(" s");
+  }
+}
+#endif
+
+#if WEARABLE_STEPPER
+// Coil pins of a 4-wire stepper
+struct StepperPins {
+  uint8_t a1;
+  uint8_t a2;
+  uint8_t b1;
+  uint8_t b2;
+};
+
+// Full-step sequence, one row per phase: A1, A2, B1, B2
+const uint8_t STEPPER_SEQUENCE[4][4] = {
+  {1, 0, 1, 0},
+  {0, 1, 1, 0},
+  {0, 1, 0, 1},
+  {1, 0, 0, 1}
+};
+
+#if WEARABLE_ENERGY
+// Two coils are energised in every full-step phase. 28BYJ-48 style coils on 3.3 V draw
+// about 65 mA each - override before the include for a different motor.
+#ifndef STEPPER_COIL_UA
+#define STEPPER_COIL_UA 130000
+#endif
+inline EnergyChannel stepperEnergy = {"stepper", STEPPER_COIL_UA, false, 0, 0, 0};
+#endif
+
+// Drive the coils for one phase of the sequence (0-3)
+inline void stepperWrite(const StepperPins &pins, uint8_t phase) {
+  const uint8_t* coils = STEPPER_SEQUENCE[phase & 3];
+#if WEARABLE_ENERGY
+  energySet(stepperEnergy, true, millis());
+#endif
+  digitalWrite(pins.a1, coils[0] ? HIGH : LOW);
+  digitalWrite(pins.a2, coils[1] ? HIGH : LOW);
+  digitalWrite(pins.b1, coils[2] ? HIGH : LOW);
+  digitalWrite(pins.b2, coils[3] ? HIGH : LOW);
+}
+
+// Turn off all coils to save power and reduce heat
+inline void stepperRelease(const StepperPins &pins) {
+  digitalWrite(pins.a1, LOW);
+  digitalWrite(pins.a2, LOW);
+  digitalWrite(pins.b1, LOW);
+  digitalWrite(pins.b2, LOW);
+#if WEARABLE_ENERGY
+  energySet(stepperEnergy, false, millis());
+#endif
+}
+
+inline void stepperBegin(const StepperPins &pins) {
+  pinMode(pins.a1, OUTPUT);
+  pinMode(pins.a2, OUTPUT);
+  pinMode(pins.b1, OUTPUT);
+  pinMode(pins.b2, OUTPUT);
+  stepperRelease(pins);
+}
+
+// Blocking move of 'steps' full sequences (4 phases each), coils released afterwards
+inline void stepperMove(const StepperPins &pins, bool clockwise, int steps, int stepDelay) {
+  for (int i = 0; i < steps; i++) {
+    for (uint8_t phase = 0; phase < 4; phase++) {
+      stepperWrite(pins, clockwise ? phase : 3 - phase);
+      delay(stepDelay);
+    }
+  }
+  stepperRelease(pins);
+}
+#endif
+
+#if WEARABLE_TOUCH_QUEUE
+#include "esp_timer.h"
+#include "hal/gpio_ll.h"
+
+// Touch edge queue - filled by the GPIO interrupt, drained by loop(). The ISR stays in
+// IRAM and only touches IRAM-safe code: the level comes straight from the GPIO input
+// register and the timestamp from esp_timer (the clock millis() counts), so an edge
+// during a flash write (Preferences, OTA) is neither lost nor a cache-miss crash.
+#define TOUCH_QUEUE_SIZE 8                   // Edges buffered between loop() passes
+const unsigned long TOUCH_DEBOUNCE_MS = 30;  // Edges closer together than this are bounce
+
+struct TouchEdge {
+  unsigned long timestamp;  // millis() when the edge was seen
+  int level;                // Pin level after the edge (HIGH / LOW)
+};
+
+inline volatile TouchEdge touchQueue[TOUCH_QUEUE_SIZE];
+inline volatile uint8_t touchQueueHead = 0;    // Next slot written by the ISR
+inline volatile uint8_t touchQueueTail = 0;    // Next slot read by loop()
+inline volatile int lastQueuedTouchLevel = LOW;
+inline volatile unsigned long lastTouchEdgeTime = 0;
+inline volatile bool touchSettlePending = false;
+inline volatile unsigned long droppedTouchEdges = 0;
+inline uint8_t touchQueuePin = 0;
+inline portMUX_TYPE touchQueueMux = portMUX_INITIALIZER_UNLOCKED;
+
+// Queue a new level if it differs from the last one and is outside the debounce window.
+// Must be called with touchQueueMux held.
+static void IRAM_ATTR queueTouchLevel(unsigned long now, int level) {
+  if (level == lastQueuedTouchLevel) {
+    return;
+  }
+  if (now - lastTouchEdgeTime < TOUCH_DEBOUNCE_MS) {
+    touchSettlePending = true;  // Re-check once the debounce window closes
+    return;
+  }
+
+  uint8_t next = (touchQueueHead + 1) % TOUCH_QUEUE_SIZE;
+  if (next == touchQueueTail) {
+    droppedTouchEdges = droppedTouchEdges + 1;  // loop() fell behind, keep the older edges
+    return;
+  }
+
+  touchQueue[touchQueueHead].timestamp = now;
+  touchQueue[touchQueueHead].level = level;
+  touchQueueHead = next;
+  lastQueuedTouchLevel = level;
+  lastTouchEdgeTime = now;
+}
+
+// GPIO interrupt - timestamp every edge on the touch pin. digitalRead() and millis()
+// live in flash, gpio_ll_get_level() is an inline register read.
+static void IRAM_ATTR onTouchEdge() {
+  unsigned long now = (unsigned long)(esp_timer_get_time() / 1000);
+  int level = gpio_ll_get_level(&GPIO, touchQueuePin) ? HIGH : LOW;
+  portENTER_CRITICAL_ISR(&touchQueueMux);
+  queueTouchLevel(now, level);
+  portEXIT_CRITICAL_ISR(&touchQueueMux);
+}
+
+// Pop the oldest queued edge, returns false if nothing is waiting
+inline bool popTouchEdge(TouchEdge &edge) {
+  bool available = false;
+  portENTER_CRITICAL(&touchQueueMux);
+  if (touchQueueTail != touchQueueHead) {
+    edge.timestamp = touchQueue[touchQueueTail].timestamp;
+    edge.level = touchQueue[touchQueueTail].level;
+    touchQueueTail = (touchQueueTail + 1) % TOUCH_QUEUE_SIZE;
+    available = true;
+  }
+  portEXIT_CRITICAL(&touchQueueMux);
+  return available;
+}
+
+// An edge that lands inside the debounce window is swallowed by the ISR, so read
+// the pin once after the window closes to make sure the settled level is queued
+inline void checkTouchSettled() {
+  if (!touchSettlePending || millis() - lastTouchEdgeTime < TOUCH_DEBOUNCE_MS) {
+    return;
+  }
+  int level = digitalRead(touchQueuePin);
+  unsigned long now = millis();
+  portENTER_CRITICAL(&touchQueueMux);
+  touchSettlePending = false;
+  queueTouchLevel(now, level);
+  portEXIT_CRITICAL(&touchQueueMux);
+}
+
+// Attach the edge interrupt to 'pin' (already an input) and seed the queue state with
+// its current level
+inline void initTouchInterrupt(uint8_t pin) {
+  touchQueuePin = pin;
+  lastQueuedTouchLevel = digitalRead(pin);
+  lastTouchEdgeTime = millis();
+  attachInterrupt(digitalPinToInterrupt(pin), onTouchEdge, CHANGE);
+}
+#endif
+
+#if WEARABLE_PUBLISH_POLICY
+// Publish policy - decides when a reading is worth a notification. The sketch evaluates
+// each value on its own timer and settles the policy with finishPublish() once it knows
+// whether the notification went on air.
+const int NO_THRESHOLD = -1;
+
+enum PublishReason {
+  PUBLISH_NONE = 0,
+  PUBLISH_CHANGE,     // Value moved past the deadband or crossed the threshold
+  PUBLISH_KEEPALIVE   // Nothing changed but maxInterval has passed
+};
+
+struct PublishPolicy {
+  int deadband;               // Send when the value moves more than this from the last sent value
+  int threshold;              // Send when the value crosses this level (NO_THRESHOLD to disable)
+  unsigned long minInterval;  // Changes closer together than this are coalesced into one send
+  unsigned long maxInterval;  // Keepalive - send at least this often even without changes
+  int lastSentValue;
+  unsigned long lastSentTime;
+  bool pending;               // A change is waiting for minInterval to pass
+  int pendingValue;           // Latest changed value, the one the pending send will carry
+  unsigned long sentCount;
+  unsigned long suppressedCount;  // Evaluations that did not go on air
+  unsigned long coalescedCount;   // Changed values replaced by a newer one before they were sent
+};
+
+// Decide whether this value should be published now
+inline PublishReason checkPublish(PublishPolicy &policy, int value, unsigned long now) {
+  bool moved = abs(value - policy.lastSentValue) > policy.deadband;
+  bool crossed = policy.threshold != NO_THRESHOLD &&
+                 ((policy.lastSentValue >= policy.threshold) != (value >= policy.threshold));
+  if (moved || crossed) {
+    // Re-evaluating the same held-back value is not a coalesce, a different one is
+    if (policy.pending && value != policy.pendingValue) {
+      policy.coalescedCount++;
+    }
+    policy.pending = true;
+    policy.pendingValue = value;
+  }
+
+  unsigned long elapsed = now - policy.lastSentTime;
+  if (policy.pending && elapsed >= policy.minInterval) {
+    return PUBLISH_CHANGE;
+  }
+  if (elapsed >= policy.maxInterval) {
+    return PUBLISH_KEEPALIVE;
+  }
+  return PUBLISH_NONE;
+}
+
+// Record that the value went on air
+inline void markPublished(PublishPolicy &policy, int value, unsigned long now) {
+  policy.lastSentValue = value;
+  policy.lastSentTime = now;
+  policy.pending = false;
+  policy.sentCount++;
+}
+
+// Record that an evaluation was kept off the air
+inline void markSuppressed(PublishPolicy &policy) {
+  policy.suppressedCount++;
+}
+
+// Settle a policy after an evaluation - only a notification that went on air counts as sent
+inline void finishPublish(PublishPolicy &policy, PublishReason reason, bool sent, int value,
+                          unsigned long now) {
+  if (reason != PUBLISH_NONE && sent) {
+    markPublished(policy, value, now);
+  } else {
+    markSuppressed(policy);
+  }
+}
+
+inline void printPublishStats(const char* name, const PublishPolicy &policy) {
+  Serial.print("Publish ");
+  Serial.print(name);
+  Serial.print(": sent=");
+  Serial.print(policy.sentCount);
+  Serial.print(", suppressed=");
+  Serial.print(policy.suppressedCount);
+  Serial.print(", coalesced=");
+  Serial.println(policy.coalescedCount);
+}
+#endif
+
+#if WEARABLE_RATE_AVERAGE
+#define RATE_AVERAGE_MAX 16
+
+// Rolling average of the last 'size' beat rates. Slots that have not been filled yet
+// are left out, so the average is usable from the first beat instead of climbing up
+// from 0 while the buffer fills.
+struct RateAverager {
+  uint8_t rates[RATE_AVERAGE_MAX];
+  uint8_t size;
+  uint8_t spot;
+  uint8_t count;
+};
+
+inline void resetRates(RateAverager &avg, uint8_t size) {
+  memset(avg.rates, 0, sizeof(avg.rates));
+  avg.size = (size == 0 || size > RATE_AVERAGE_MAX) ? RATE_AVERAGE_MAX : size;
+  avg.spot = 0;
+  avg.count = 0;
+}
+
+inline int averageRate(const RateAverager &avg) {
+  if (avg.count == 0) {
+    return 0;
+  }
+  int sum = 0;
+  for (uint8_t x = 0; x < avg.count; x++) {
+    sum += avg.rates[x];
+  }
+  return sum / avg.count;
+}
+
+// Store one beat (BPM) and return the new average
+inline int addRate(RateAverager &avg, uint8_t bpm) {
+  avg.rates[avg.spot++] = bpm;
+  avg.spot %= avg.size;
+  if (avg.count < avg.size) {
+    avg.count++;
+  }
+  return averageRate(avg);
+}
+#endif
+
+#if WEARABLE_BPM_ESTIMATOR
+#include <math.h>
+
+// Sliding-window BPM from the autocorrelation of the PPG, running next to the beat
+// detector. A beat average needs several good beats before it means anything; this has
+// a reading about 2 s after the finger goes down. Samples are averaged down to about
+// BPM_TARGET_RATE and every BPM_HOP_MS the newest (up to) BPM_WINDOW_MAX of them are
+// detrended, differenced over BPM_DIFFERENCE_MS and correlated with themselves over the
+// lags of BPM_MAX..BPM_MIN. The difference keeps the pulse upstroke and drops the
+// respiration wander that otherwise swamps a weak pulse. The correlation is integer
+// (the C3 has no FPU) and an update never costs more than BPM_WINDOW_MAX multiply-adds
+// per lag, however long the finger stays on.
+#define BPM_TARGET_RATE 25         // Hz after averaging
+#define BPM_WINDOW_MAX 128         // Newest averaged samples used per update (~5 s)
+#define BPM_MIN_WINDOW_MS 1500     // No estimate before this much signal is in
+#define BPM_HOP_MS 250             // Time between updates
+#define BPM_DIFFERENCE_MS 120      // Span of the difference (3 samples at 25 Hz)
+#define BPM_MIN 40
+#define BPM_MAX 200
+#define BPM_MIN_CONFIDENCE 0.5f    // Normalised autocorrelation needed at the chosen lag
+#define BPM_HARMONIC_RATIO 0.85f   // Prefer the shortest lag this close to the best peak
+#define BPM_AGREEMENT 0.1f         // Two updates in a row within this fraction -> valid
+#define BPM_LAGS_MAX (BPM_WINDOW_MAX / 2 + 2)
+
+struct BpmEstimator {
+  uint16_t factor;                 // Input samples per averaged sample
+  float rate;                      // Averaged sample rate (Hz)
+  uint8_t hop;                     // Averaged samples between updates
+  uint8_t minWindow;               // Averaged samples before the first update
+  uint8_t difference;              // Averaged samples spanned by the difference
+  int32_t sum;                     // Input samples of the average in progress
+  uint16_t summed;
+  int32_t window[BPM_WINDOW_MAX];  // Ring of averaged samples
+  uint8_t head;                    // Next write position
+  uint8_t filled;
+  uint8_t sinceUpdate;
+  float bpm;                       // Latest estimate, 0 if the last update found no rhythm
+  float confidence;                // Its normalised autocorrelation, 0-1
+  bool valid;                      // Confident and agreeing with the update before
+  uint32_t updates;
+};
+
+// Start over with the same rate settings, e.g. after the finger was lifted
+inline void clearBpmEstimator(BpmEstimator &est) {
+  est.sum = 0;
+  est.summed = 0;
+  est.head = 0;
+  est.filled = 0;
+  est.sinceUpdate = est.hop - 1;   // First update as soon as minWindow is reached
+  est.bpm = 0;
+  est.confidence = 0;
+  est.valid = false;
+}
+
+// inputRate is the rate samples are fed at (sensor rate / FIFO averaging)
+inline void resetBpmEstimator(BpmEstimator &est, uint16_t inputRate) {
+  est.factor = inputRate > BPM_TARGET_RATE ? (inputRate + BPM_TARGET_RATE / 2) / BPM_TARGET_RATE : 1;
+  est.rate = (float)inputRate / est.factor;
+  est.hop = est.rate * BPM_HOP_MS / 1000 > 1 ? est.rate * BPM_HOP_MS / 1000 : 1;
+  est.minWindow = est.rate * BPM_MIN_WINDOW_MS / 1000;
+  est.difference = est.rate * BPM_DIFFERENCE_MS / 1000 + 0.5f;
+  if (est.difference < 1) {
+    est.difference = 1;
+  }
+  est.updates = 0;
+  clearBpmEstimator(est);
+}
+
+// Estimate from the current window, called every hop
+inline void updateBpmEstimate(BpmEstimator &est) {
+  static int32_t x[BPM_WINDOW_MAX];
+  static int64_t energy[BPM_WINDOW_MAX + 1];   // energy[i] = sum of x[n]^2 for n < i
+  static float r[BPM_LAGS_MAX];
+  int n = est.filled;
+  est.updates++;
+
+  // Oldest first, minus the least-squares line so slow drift does not look like a rhythm
+  int start = (est.head + BPM_WINDOW_MAX - n) % BPM_WINDOW_MAX;
+  int64_t sumX = 0, sumIX = 0;
+  for (int i = 0; i < n; i++) {
+    x[i] = est.window[(start + i) % BPM_WINDOW_MAX];
+    sumX += x[i];
+    sumIX += (int64_t)i * x[i];
+  }
+  float meanI = (n - 1) / 2.0f;
+  float meanX = (float)sumX / n;
+  float slope = ((float)sumIX - meanI * sumX) / (n * (n * (float)n - 1) / 12.0f);
+  for (int i = 0; i < n; i++) {
+    x[i] = (int32_t)(x[i] - meanX - slope * (i - meanI));
+  }
+  // Newest first so each difference still sees the undifferenced sample it needs
+  for (int i = n - 1; i >= 0; i--) {
+    x[i] = i >= est.difference ? x[i] - x[i - est.difference] : 0;
+  }
+  energy[0] = 0;
+  for (int i = 0; i < n; i++) {
+    energy[i + 1] = energy[i] + (int64_t)x[i] * x[i];
+  }
+
+  // Normalised autocorrelation over the candidate lags, with two full periods in the window
+  int minLag = (int)(60.0f * est.rate / BPM_MAX);
+  int maxLag = (int)(60.0f * est.rate / BPM_MIN + 1);
+  if (maxLag > n / 2) {
+    maxLag = n / 2;
+  }
+  if (minLag < 2) {
+    minLag = 2;
+  }
+  float best = 0;
+  int bestLag = 0;
+  for (int k = minLag - 1; k <= maxLag + 1; k++) {
+    int64_t acc = 0;
+    for (int i = k; i < n; i++) {
+      acc += (int64_t)x[i] * x[i - k];
+    }
+    float norm = sqrtf((float)(energy[n] - energy[k]) * (float)energy[n - k]);
+    r[k] = norm > 0 ? acc / norm : 0;
+  }
+  for (int k = minLag; k <= maxLag; k++) {
+    if (r[k] > r[k - 1] && r[k] >= r[k + 1] && r[k] > best) {
+      best = r[k];
+    }
+  }
+  // A rhythm at period T also peaks at 2T, 3T - take the shortest lag nearly as strong
+  for (int k = minLag; k <= maxLag && best > 0; k++) {
+    if (r[k] > r[k - 1] && r[k] >= r[k + 1] && r[k] >= BPM_HARMONIC_RATIO * best) {
+      bestLag = k;
+      break;
+    }
+  }
+
+  float previous = est.bpm;
+  if (bestLag == 0 || r[bestLag] < BPM_MIN_CONFIDENCE) {
+    est.bpm = 0;
+    est.confidence = best;
+    est.valid = false;
+    return;
+  }
+  // Parabolic interpolation between lags - at 25 Hz one lag is several BPM
+  float curve = r[bestLag - 1] - 2 * r[bestLag] + r[bestLag + 1];
+  float offset = curve < 0 ? 0.5f * (r[bestLag - 1] - r[bestLag + 1]) / curve : 0;
+  est.bpm = 60.0f * est.rate / (bestLag + offset);
+  est.confidence = r[bestLag];
+  est.valid = previous > 0 && fabsf(est.bpm - previous) <= BPM_AGREEMENT * previous;
+}
+
+// Feed one sample, returns true when a new estimate was made
+inline bool addBpmSample(BpmEstimator &est, uint32_t ir) {
+  est.sum += ir;
+  if (++est.summed < est.factor) {
+    return false;
+  }
+  est.window[est.head] = est.sum / est.summed;
+  est.head = (est.head + 1) % BPM_WINDOW_MAX;
+  if (est.filled < BPM_WINDOW_MAX) {
+    est.filled++;
+  }
+  est.sum = 0;
+  est.summed = 0;
+  if (est.filled < est.minWindow || ++est.sinceUpdate < est.hop) {
+    return false;
+  }
+  est.sinceUpdate = 0;
+  updateBpmEstimate(est);
+  return true;
+}
+#endif
+
+#if WEARABLE_SIGNAL_QUALITY
+// Signal quality index - every SQI_WINDOW_MS the window of IR samples gets a 0-100 score
+// from three cheap checks, all updated per sample or per beat:
+//   perfusion index  AC / DC of the IR signal; too small is no pulse, too large is motion
+//   regularity       share of beats whose interval is within 30 % of the previous one
+//   clipping         share of samples at the ADC rail (pressure or ambient light)
+// Readings are only trusted while the last window scored at least SQI_GOOD and the
+// current one has neither clipped nor swung wider than the pulse did, so artefacts never
+// reach the average, the radio or the actuators - motion is caught as it starts, not when
+// its window closes. Samples are only fed while a finger is on; after a restart (finger
+// lifted) the window in progress is judged from SQI_FIRST_VERDICT_MS on, so a fresh
+// placement is not held back for a whole window.
+#define SQI_WINDOW_MS 3000
+#define SQI_FIRST_VERDICT_MS 1500
+#define SQI_GOOD 60
+#define SQI_PI_MIN 0.05f          // % - below this there is no usable pulse
+#define SQI_PI_MAX 5.0f           // % - above this the swing is motion, not blood volume
+#define SQI_CLIP_LEVEL 260000     // Close to the 18-bit ADC full scale
+#define SQI_RR_TOLERANCE 0.3f     // Allowed change between successive intervals
+#define SQI_SWING_RATIO 1.5f      // Current window swinging this much wider than the last is motion
+
+// All zero is a valid start
+struct SignalQuality {
+  unsigned long windowStart;
+  long irMin;             // Valid while samples > 0
+  long irMax;
+  uint64_t irSum;
+  uint16_t samples;
+  uint16_t clipped;
+  uint8_t beats;
+  uint8_t irregular;
+  long lastInterval;      // ms, previous raw beat interval (0 = none yet)
+  float perfusion;        // % - of the last scored window
+  float earlySwing;       // % - of the current window's first SQI_FIRST_VERDICT_MS (0 = not yet)
+  uint8_t sqi;            // Score of the last completed window
+  bool good;
+  bool scored;            // A window has been scored since the last restart
+  unsigned long windows;
+  unsigned long lowWindows;
+};
+
+// Drop the samples collected so far in this window without scoring it - used after an
+// AGC step so the jump in DC level is not mistaken for motion
+inline void discardQualitySamples(SignalQuality &quality) {
+  quality.irSum = 0;
+  quality.samples = 0;
+  quality.clipped = 0;
+  quality.earlySwing = 0.0f;
+}
+
+// Forget the signal so far, e.g. when the finger is lifted; the totals are kept
+inline void restartSignalQuality(SignalQuality &quality) {
+  discardQualitySamples(quality);
+  quality.beats = 0;
+  quality.irregular = 0;
+  quality.lastInterval = 0;
+  quality.perfusion = 0.0f;
+  quality.sqi = 0;
+  quality.good = false;
+  quality.scored = false;
+}
+
+// Perfusion index (%) of the samples in the window so far
+inline float qualityPerfusion(const SignalQuality &quality) {
+  if (quality.samples == 0 || quality.irSum == 0) {
+    return 0.0f;
+  }
+  float dc = (float)quality.irSum / quality.samples;
+  return 100.0f * (quality.irMax - quality.irMin) / dc;
+}
+
+// 0-100 score of the samples and beats in the window so far
+inline uint8_t scoreQualityWindow(const SignalQuality &quality) {
+  float score = 0.0f;
+  if (quality.samples > 0 && quality.irSum > 0) {
+    float perfusion = qualityPerfusion(quality);
+    float regularity = quality.beats > 0 ? (float)(quality.beats - quality.irregular) / quality.beats : 0.0f;
+    float clipFraction = (float)quality.clipped / quality.samples;
+    float clipScore = clipFraction > 0.01f ? 0.0f : 1.0f - 100.0f * clipFraction;
+    bool perfusionOk = perfusion >= SQI_PI_MIN && perfusion <= SQI_PI_MAX;
+    score = perfusionOk ? 100.0f * regularity * clipScore : 0.0f;
+  }
+  return (uint8_t)(score + 0.5f);
+}
+
+// Score the finished window and start a new one
+inline void closeQualityWindow(SignalQuality &quality, unsigned long now) {
+  quality.perfusion = qualityPerfusion(quality);
+  quality.sqi = scoreQualityWindow(quality);
+  // A window that ended much wider than its first half swung had motion in its tail and
+  // must not become the reference the next window's live swing is checked against
+  quality.good = quality.sqi >= SQI_GOOD &&
+                 (quality.earlySwing == 0.0f || quality.perfusion <= SQI_SWING_RATIO * quality.earlySwing);
+  quality.scored = true;
+  quality.windows++;
+  if (!quality.good) {
+    quality.lowWindows++;
+  }
+
+  quality.windowStart = now;
+  quality.beats = 0;
+  quality.irregular = 0;
+  discardQualitySamples(quality);
+}
+
+// Per IR sample while a finger is on - a few compares and an add
+inline void addQualitySample(SignalQuality &quality, long irValue, unsigned long now) {
+  if (quality.samples > 0 && now - quality.windowStart >= SQI_WINDOW_MS) {
+    closeQualityWindow(quality, now);
+  } else if (quality.samples > 0 && now - quality.windowStart >= SQI_FIRST_VERDICT_MS) {
+    if (quality.earlySwing == 0.0f) {
+      quality.earlySwing = qualityPerfusion(quality);
+      if (!quality.scored) {
+        quality.perfusion = quality.earlySwing;   // Live swing reference until a window closes
+      }
+    }
+    if (!quality.scored) {
+      quality.sqi = scoreQualityWindow(quality);
+      quality.good = quality.sqi >= SQI_GOOD;
+    }
+  }
+  if (quality.samples == 0) {
+    quality.windowStart = now;   // An empty window is not scored, the next one starts here
+    quality.irMin = irValue;
+    quality.irMax = irValue;
+  }
+  if (irValue < quality.irMin) {
+    quality.irMin = irValue;
+  }
+  if (irValue > quality.irMax) {
+    quality.irMax = irValue;
+  }
+  quality.irSum += irValue;
+  quality.samples++;
+  if (irValue >= SQI_CLIP_LEVEL) {
+    quality.clipped++;
+  }
+}
+
+// Per detected beat, before any range check
+inline void addQualityBeat(SignalQuality &quality, long deltaMs) {
+  quality.beats++;
+  if (quality.lastInterval > 0 &&
+      labs(deltaMs - quality.lastInterval) > SQI_RR_TOLERANCE * quality.lastInterval) {
+    quality.irregular++;
+  }
+  quality.lastInterval = deltaMs;
+}
+
+// True when readings from the current window can be trusted
+inline bool signalGood(const SignalQuality &quality) {
+  float swing = qualityPerfusion(quality);
+  return quality.good && quality.clipped == 0 && swing <= SQI_PI_MAX &&
+         swing <= SQI_SWING_RATIO * quality.perfusion;
+}
+#endif
+
+#if WEARABLE_HYDRATION_LEVEL
+// Graded hydration from a bare electrode read with the touch peripheral (touchRead()).
+// Moist skin couples more charge than dry skin, so the contact delta over the no-contact
+// baseline grows with hydration. Each reading is a burst of samples: the burst is sorted,
+// its middle half averaged (spikes from the radio or a shifting contact fall away) and its
+// interquartile range kept as the noise. A burst too short to trim (under 4 samples) reads
+// as its median and leaves the noise as it was - one or two samples say nothing about it. The baseline follows slow drift (temperature,
+// moisture on the electrode) only while nothing touches it and is frozen during contact;
+// like the TTP223B's power-on calibration it takes the first burst as no contact. The
+// delta is smoothed and placed between dryDelta (dry skin, 0 %) and wetDelta (100 %).
+// Confidence drops with noise, right after contact and outside the calibrated span.
+#define HYDRATION_BURST_MAX 32
+#define HYDRATION_BASELINE_SHIFT 6     // Baseline takes 1/64 of each no-contact error
+#define HYDRATION_RELEASE_SHIFT 2      // ... and 1/4 once the reading falls past it
+#define HYDRATION_FILTER_SHIFT 2       // Delta smoothing, 1/4 of each new burst
+#define HYDRATION_FRACTION_BITS 4      // Fixed-point fraction of the smoothed delta and noise
+#define HYDRATION_SETTLE_READINGS 8    // Confidence ramps up over this many contact readings
+#define HYDRATION_HYDRATED_LEVEL 50    // Lowest level that still counts as "Hydrated" (HYD:1)
+
+struct HydrationSensor {
+  bool rising;              // Contact raises the reading (S2/S3) instead of lowering it (ESP32)
+  int32_t dryDelta;         // Contact delta of dry skin - contact starts at half of it
+  int32_t wetDelta;         // Contact delta at full hydration
+  int32_t baseline;         // No-contact reading << HYDRATION_BASELINE_SHIFT
+  int32_t filtered;         // Smoothed contact delta, HYDRATION_FRACTION_BITS fixed point
+  int32_t noise;            // Smoothed burst interquartile range, same fixed point
+  int32_t delta;            // Contact delta of the last burst
+  bool contact;
+  uint8_t sinceContact;     // Readings since contact began, saturates at the settle count
+  uint8_t level;            // 0-100 %, 0 without contact
+  uint8_t confidence;       // 0-100 %, 0 without contact
+  uint32_t readings;
+};
+
+inline void resetHydrationSensor(HydrationSensor &h, bool rising, int32_t dryDelta, int32_t wetDelta) {
+  memset(&h, 0, sizeof(h));
+  h.rising = rising;
+  h.dryDelta = dryDelta;
+  h.wetDelta = wetDelta;
+}
+
+inline int32_t hydrationBaseline(const HydrationSensor &h) {
+  return h.baseline >> HYDRATION_BASELINE_SHIFT;
+}
+
+// One burst of raw touchRead() values (sorted in place), updates level and confidence
+inline void addHydrationBurst(HydrationSensor &h, uint32_t* samples, uint8_t count) {
+  if (count == 0) {
+    return;
+  }
+  if (count > HYDRATION_BURST_MAX) {
+    count = HYDRATION_BURST_MAX;
+  }
+  for (uint8_t i = 1; i < count; i++) {
+    uint32_t sample = samples[i];
+    uint8_t j = i;
+    for (; j > 0 && samples[j - 1] > sample; j--) {
+      samples[j] = samples[j - 1];
+    }
+    samples[j] = sample;
+  }
+  bool trimmed = count >= 4;
+  uint8_t first = trimmed ? count / 4 : (count - 1) / 2;
+  uint8_t last = trimmed ? count - count / 4 : count / 2 + 1;   // Exclusive
+  int64_t sum = 0;
+  for (uint8_t i = first; i < last; i++) {
+    sum += samples[i];
+  }
+  int32_t value = (int32_t)(sum / (last - first));
+  int32_t spread = (int32_t)(samples[last - 1] - samples[first]);
+
+  if (h.readings++ == 0) {
+    h.baseline = value * (1 << HYDRATION_BASELINE_SHIFT);
+    h.noise = spread << HYDRATION_FRACTION_BITS;
+  }
+  if (trimmed) {
+    h.noise += ((spread << HYDRATION_FRACTION_BITS) - h.noise) >> 3;
+  }
+  int32_t baseline = hydrationBaseline(h);
+  h.delta = h.rising ? value - baseline : baseline - value;
+
+  // Hysteresis so a delta hovering at the threshold does not chatter. The baseline cannot
+  // follow drift during contact, so lifting off is also a fall to half the contact delta,
+  // and the baseline restarts from the reading it fell to.
+  if (!h.contact && h.delta >= h.dryDelta / 2) {
+    h.contact = true;
+    h.sinceContact = 0;
+    h.filtered = h.delta * (1 << HYDRATION_FRACTION_BITS);
+  } else if (h.contact && (h.delta < h.dryDelta / 4 ||
+                           h.delta < (h.filtered >> HYDRATION_FRACTION_BITS) / 2)) {
+    h.contact = false;
+    h.baseline = value * (1 << HYDRATION_BASELINE_SHIFT);
+    h.delta = 0;
+  }
+  if (!h.contact) {
+    int shift = h.delta < 0 ? HYDRATION_RELEASE_SHIFT : HYDRATION_BASELINE_SHIFT;
+    h.baseline += (value - baseline) * (1 << (HYDRATION_BASELINE_SHIFT - shift));
+    h.level = 0;
+    h.confidence = 0;
+    return;
+  }
+
+  h.filtered += (h.delta * (1 << HYDRATION_FRACTION_BITS) - h.filtered) >> HYDRATION_FILTER_SHIFT;
+  if (h.sinceContact < HYDRATION_SETTLE_READINGS) {
+    h.sinceContact++;
+  }
+  int32_t span = h.wetDelta > h.dryDelta ? h.wetDelta - h.dryDelta : 1;
+  int32_t delta = h.filtered >> HYDRATION_FRACTION_BITS;
+  int32_t level = (int32_t)((int64_t)(delta - h.dryDelta) * 100 / span);
+  h.level = level < 0 ? 0 : (level > 100 ? 100 : level);
+
+  // One interquartile range of the burst, as a share of the span, costs twice that in confidence
+  int32_t uncertainty = (int32_t)((int64_t)h.noise * 100 / span >> HYDRATION_FRACTION_BITS);
+  int32_t confidence = 100 - 2 * uncertainty;
+  if (confidence < 0) {
+    confidence = 0;
+  }
+  confidence = confidence * h.sinceContact / HYDRATION_SETTLE_READINGS;
+  // Light contact below dry skin or a water film far above wet reads as a level, but a poor one
+  if (delta < h.dryDelta || delta > h.wetDelta + span / 2) {
+    confidence /= 2;
+  }
+  h.confidence = confidence;
+}
+#endif
+
+#if WEARABLE_HR_MESSAGE
+// One reading from the sensing device
+struct HrMessage {
+  int heartRate;
+  bool hydrated;
+  int glucose;              // Photodiode reading, -1 when the server does not send it
+  int quality;              // Signal quality index 0-100, -1 when not sent
+  bool hasTimestamp;
+  unsigned long timestamp;  // Sensing device millis() when the sample was taken
+};
+
+// Parse "HR:X,HYD:Y[,GLU:Z][,TS:T][,SQ:Q]" in place, returns false for anything else
+inline bool parseHrMessage(const char* message, HrMessage &out) {
+  if (strncmp(message, "HR:", 3) != 0) {
+    return false;
+  }
+  const char* hyd = strstr(message, ",HYD:");
+  if (hyd == NULL) {
+    return false;
+  }
+  out.heartRate = atoi(message + 3);
+  out.hydrated = (atoi(hyd + 5) == 1);
+
+  const char* glu = strstr(message, ",GLU:");
+  out.glucose = (glu != NULL) ? atoi(glu + 5) : -1;
+  const char* sq = strstr(message, ",SQ:");
+  out.quality = (sq != NULL) ? atoi(sq + 4) : -1;
+  const char* ts = strstr(message, ",TS:");
+  out.hasTimestamp = (ts != NULL);
+  out.timestamp = (ts != NULL) ? strtoul(ts + 4, NULL, 10) : 0;
+  return true;
+}
+
+// Parse "HYDL:L,CONF:C" (graded hydration from a capacitive-mode server), false for anything else
+inline bool parseHydrationLevel(const char* message, int &level, int &confidence) {
+  if (strncmp(message, "HYDL:", 5) != 0) {
+    return false;
+  }
+  const char* conf = strstr(message, ",CONF:");
+  if (conf == NULL) {
+    return false;
+  }
+  level = atoi(message + 5);
+  confidence = atoi(conf + 6);
+  return true;
+}
+#endif
+
+#if WEARABLE_LED_AGC
+// LED AGC - holds the IR DC level inside a target band by stepping the IR LED current, and
+// the ADC range once the current runs out. It adjusts at most once per AGC_INTERVAL_MS and
+// only when the DC level leaves the band, so a steady finger sees no changes at all. Beats
+// are ignored for AGC_SETTLE_MS after a step while checkForBeat()'s DC filter catches up.
+// The sketch owns the LedAgc and the MAX30105; with WEARABLE_ENERGY the LEDs' charge can
+// also go to an energy channel, red LED included.
+#define AGC_INTERVAL_MS 1000
+#define AGC_SETTLE_MS 600
+#define AGC_TARGET 150000          // IR counts, 18-bit ADC
+#define AGC_TARGET_LOW 100000
+#define AGC_TARGET_HIGH 200000
+#define AGC_PRESENCE_LEVEL 20000   // Below this there is no finger to regulate
+#define AGC_MIN_AMPLITUDE 0x04
+#define AGC_MAX_AMPLITUDE 0xFF
+#define AGC_MAX_STEP 1.5f          // Largest current ratio in one step
+#define AGC_PULSE_WIDTH_US 411
+#define LED_MA_PER_STEP 0.2f       // MAX3010x LED current per amplitude step
+#define AGC_DEFAULT_RANGE 1        // 4096 nA, what setup() selects
+
+const uint8_t agcAdcRanges[] = {MAX30105_ADCRANGE_2048, MAX30105_ADCRANGE_4096,
+                                MAX30105_ADCRANGE_8192, MAX30105_ADCRANGE_16384};
+const uint8_t AGC_RANGE_COUNT = sizeof(agcAdcRanges) / sizeof(agcAdcRanges[0]);
+
+struct LedAgc {
+  uint8_t amplitude;        // IR LED setting in use
+  uint8_t fixedAmplitude;   // The configured setting - used with no finger and as the baseline
+  uint8_t redAmplitude;     // Red LED setting, fixed - only counted in the charge estimate
+  uint8_t rangeIndex;       // Into agcAdcRanges
+  long sampleRate;          // LED pulses per second, for the charge estimate
+  uint32_t dcSum;
+  uint16_t dcSamples;
+  unsigned long lastAdjust;
+  unsigned long settleUntil;
+  unsigned long steps;
+  unsigned long lastAccount;
+  unsigned long hourStart;
+  uint32_t driveActual;     // Amplitude x ms this hour
+  uint32_t driveFixed;      // The same at the fixed setting
+#if WEARABLE_ENERGY
+  EnergyChannel* energy;    // Both LEDs' charge goes here, NULL for none
+#endif
+};
+
+// Start over from the configured setting (called after the sensor's setup())
+inline void resetLedAgc(LedAgc &agc, uint8_t fixedAmplitude, long sampleRate) {
+  unsigned long now = millis();
+  agc.amplitude = fixedAmplitude;
+  agc.fixedAmplitude = fixedAmplitude;
+  agc.rangeIndex = AGC_DEFAULT_RANGE;
+  agc.sampleRate = sampleRate;
+  agc.dcSum = 0;
+  agc.dcSamples = 0;
+  agc.lastAdjust = now;
+  agc.settleUntil = now;
+  agc.lastAccount = now;
+  if (agc.hourStart == 0) {
+    agc.hourStart = now;
+  }
+}
+
+#if WEARABLE_ENERGY
+// The same, with the red LED setting and the channel both LEDs are accounted on
+inline void resetLedAgc(LedAgc &agc, uint8_t fixedAmplitude, long sampleRate, uint8_t redAmplitude,
+                        EnergyChannel &energy) {
+  resetLedAgc(agc, fixedAmplitude, sampleRate);
+  agc.redAmplitude = redAmplitude;
+  agc.energy = &energy;
+}
+#endif
+
+// Average IR LED current in mA over 'drive' amplitude-ms, as mAh
+inline float ledChargeMah(const LedAgc &agc, uint32_t drive) {
+  float duty = AGC_PULSE_WIDTH_US * 1e-6f * agc.sampleRate;
+  return drive * LED_MA_PER_STEP * duty / 3600000.0f;
+}
+
+inline void reportLedEnergy(const LedAgc &agc) {
+  float actual = ledChargeMah(agc, agc.driveActual);
+  float fixed = ledChargeMah(agc, agc.driveFixed);
+  Serial.print("LED AGC: last hour ");
+  Serial.print(actual, 3);
+  Serial.print(" mAh vs ");
+  Serial.print(fixed, 3);
+  Serial.print(" mAh fixed (");
+  Serial.print(fixed > 0 ? 100.0f * (fixed - actual) / fixed : 0.0f, 1);
+  Serial.print(" % saved), ");
+  Serial.print(agc.steps);
+  Serial.println(" steps");
+}
+
+inline void accountLedCharge(LedAgc &agc, unsigned long now) {
+  unsigned long elapsed = now - agc.lastAccount;
+  agc.lastAccount = now;
+#if WEARABLE_ENERGY
+  if (agc.energy != NULL) {
+    // Both LEDs pulse once per sample, each for the pulse width
+    float duty = AGC_PULSE_WIDTH_US * 1e-6f * agc.sampleRate;
+    energyAccrue(*agc.energy, elapsed * 1000.0f * duty,
+                 (agc.amplitude + agc.redAmplitude) * LED_MA_PER_STEP * 1000);
+  }
+#endif
+  agc.driveActual += agc.amplitude * elapsed;
+  agc.driveFixed += agc.fixedAmplitude * elapsed;
+  if (now - agc.hourStart >= 3600000UL) {
+    reportLedEnergy(agc);
+    agc.hourStart = now;
+    agc.driveActual = 0;
+    agc.driveFixed = 0;
+    agc.steps = 0;
+  }
+}
+
+inline bool setAgcLevel(LedAgc &agc, MAX30105 &sensor, int amplitude, uint8_t rangeIndex,
+                        unsigned long now) {
+  if (amplitude == agc.amplitude && rangeIndex == agc.rangeIndex) {
+    return false;
+  }
+  agc.amplitude = amplitude;
+  agc.rangeIndex = rangeIndex;
+  sensor.setPulseAmplitudeIR(agc.amplitude);
+  sensor.setADCRange(agcAdcRanges[agc.rangeIndex]);
+  agc.settleUntil = now + AGC_SETTLE_MS;
+  agc.steps++;
+  return true;
+}
+
+// Feed every IR sample, returns true when the LED current or ADC range changed
+inline bool serviceLedAgc(LedAgc &agc, MAX30105 &sensor, long irValue, unsigned long now) {
+  accountLedCharge(agc, now);
+  agc.dcSum += irValue;
+  agc.dcSamples++;
+  if (now - agc.lastAdjust < AGC_INTERVAL_MS) {
+    return false;
+  }
+  long dc = agc.dcSum / agc.dcSamples;
+  agc.dcSum = 0;
+  agc.dcSamples = 0;
+  agc.lastAdjust = now;
+
+  // No finger - go back to the configured setting so finger detection works as before
+  if (dc < AGC_PRESENCE_LEVEL) {
+    return setAgcLevel(agc, sensor, agc.fixedAmplitude, AGC_DEFAULT_RANGE, now);
+  }
+  if (dc >= AGC_TARGET_LOW && dc <= AGC_TARGET_HIGH) {
+    return false;
+  }
+
+  // DC follows the LED current, so step straight toward the middle of the band
+  float ratio = constrain((float)AGC_TARGET / dc, 1.0f / AGC_MAX_STEP, AGC_MAX_STEP);
+  int amplitude = (int)(agc.amplitude * ratio + 0.5f);
+  if (amplitude == agc.amplitude) {
+    amplitude += dc < AGC_TARGET_LOW ? 1 : -1;
+  }
+  uint8_t rangeIndex = agc.rangeIndex;
+  if (amplitude > AGC_MAX_AMPLITUDE) {
+    amplitude = AGC_MAX_AMPLITUDE;
+    if (rangeIndex > 0) {
+      rangeIndex--;   // Smaller full scale - more counts for the same light
+    }
+  } else if (amplitude < AGC_MIN_AMPLITUDE) {
+    amplitude = AGC_MIN_AMPLITUDE;
+    if (rangeIndex < AGC_RANGE_COUNT - 1) {
+      rangeIndex++;
+    }
+  }
+  return setAgcLevel(agc, sensor, amplitude, rangeIndex, now);
+}
+
+// True while the signal is still settling after an AGC step
+inline bool agcSettling(const LedAgc &agc, unsigned long now) {
+  return (long)(agc.settleUntil - now) > 0;
+}
+#endif
+
+#if WEARABLE_HEAP_WATCH
+// Heap watch - once setup() is done nothing should be allocated for good, so free heap
+// and the number of live blocks must come back to the same level after every reconnect
+const unsigned long HEAP_REPORT_INTERVAL = 60000;
+inline unsigned long lastHeapReport = 0;
+inline size_t heapBaselineFree = 0;     // Taken at the end of setup()
+inline size_t heapBaselineBlocks = 0;
+
+inline void markHeapBaseline() {
+  multi_heap_info_t info;
+  heap_caps_get_info(&info, MALLOC_CAP_DEFAULT);
+  heapBaselineFree = info.total_free_bytes;
+  heapBaselineBlocks = info.allocated_blocks;
+}
+
+inline void reportHeap(const char* reason) {
+  multi_heap_info_t info;
+  heap_caps_get_info(&info, MALLOC_CAP_DEFAULT);
+  Serial.print("Heap (");
+  Serial.print(reason);
+  Serial.print("): free=");
+  Serial.print(info.total_free_bytes);
+  Serial.print(", min free=");
+  Serial.print(info.minimum_free_bytes);
+  Serial.print(", largest block=");
+  Serial.print(info.largest_free_block);
+  Serial.print(", live blocks=");
+  Serial.print(info.allocated_blocks);
+  Serial.print(" (");
+  Serial.print((long)info.allocated_blocks - (long)heapBaselineBlocks);
+  Serial.print(" since setup), free change=");
+  Serial.println((long)info.total_free_bytes - (long)heapBaselineFree);
+}
+
+inline void serviceHeapReport() {
+  if (millis() - lastHeapReport >= HEAP_REPORT_INTERVAL) {
+    lastHeapReport = millis();
+    reportHeap("periodic");
+  }
+}
+#endif
+
+#if WEARABLE_BOOT_PROFILE
+// Boot profile - setup() calls bootMark() after each step, reportBootProfile() prints
+// one "Boot step" line per step that SizeReport.py picks up from a serial log
+#define BOOT_PROFILE_MAX 12
+
+struct BootStep {
+  const char* name;
+  uint32_t duration;   // us
+};
+
+inline BootStep bootSteps[BOOT_PROFILE_MAX];
+inline uint8_t bootStepCount = 0;
+inline uint32_t bootStepStart = 0;   // micros() counts from power-on, so the first step includes the ROM boot
+
+// Close the step that just finished
+inline void bootMark(const char* name) {
+  uint32_t now = micros();
+  if (bootStepCount < BOOT_PROFILE_MAX) {
+    bootSteps[bootStepCount].name = name;
+    bootSteps[bootStepCount].duration = now - bootStepStart;
+    bootStepCount++;
+  }
+  bootStepStart = now;
+}
+
+inline void reportBootProfile() {
+  for (uint8_t i = 0; i < bootStepCount; i++) {
+    Serial.print("Boot step ");
+    Serial.print(bootSteps[i].name);
+    Serial.print(": ");
+    Serial.print(bootSteps[i].duration);
+    Serial.println(" us");
+  }
+  Serial.print("Boot total: ");
+  Serial.print(bootStepStart);
+  Serial.println(" us");
+}
+#endif
+
+#if WEARABLE_ENERGY && (WEARABLE_BLE_SERVER || WEARABLE_SCAN)
+// Radio charge - notifications and scans are counted here, the sketch adds the empty
+// connection and advertising events it knows about. Override before the include.
+#ifndef RADIO_ON_UA
+#define RADIO_ON_UA 100000         // Extra while the radio is on air
+#endif
+#ifndef NOTIFY_RADIO_US
+#define NOTIFY_RADIO_US 500        // Extra radio-on time of a connection event carrying a notification
+#endif
+inline EnergyChannel radioEnergy = {"radio", RADIO_ON_UA, false, 0, 0, 0};
+#endif
+
+#if WEARABLE_ADVERTISING
+// Advertising duty cycle - fast right after boot, a disconnect or user interaction so the
+// display reconnects quickly, then slow to save the radio. Intervals are in 0.625 ms units.
+struct AdvertisingPhase {
+  const char* name;
+  uint16_t minInterval;
+  uint16_t maxInterval;
+};
+
+inline const AdvertisingPhase FAST_ADVERTISING = {"fast", 32, 48};      // 20-30 ms
+inline const AdvertisingPhase SLOW_ADVERTISING = {"slow", 1636, 1656};  // 1022.5-1035 ms
+const unsigned long FAST_ADVERTISING_PERIOD = 30000;  // How long the fast phase lasts
+const float ADV_EVENT_RADIO_MS = 1.5;                  // Estimated radio-on time of one event (3 channels)
+
+inline const AdvertisingPhase* advertisingPhase = NULL;  // NULL while connected
+inline unsigned long advertisingPhaseStart = 0;
+inline unsigned long advertisingRunStart = 0;            // When advertising (re)started, for discovery time
+inline unsigned long fastAdvertisingUntil = 0;
+inline float fastAdvertisingRadioMs = 0;
+inline float slowAdvertisingRadioMs = 0;
+
+// Add the estimated radio-on time of the phase that is ending
+inline void closeAdvertisingPhase() {
+  if (advertisingPhase == NULL) {
+    return;
+  }
+  float averageInterval = (advertisingPhase->minInterval + advertisingPhase->maxInterval) * 0.625 / 2;
+  float radioMs = (millis() - advertisingPhaseStart) / averageInterval * ADV_EVENT_RADIO_MS;
+  if (advertisingPhase == &FAST_ADVERTISING) {
+    fastAdvertisingRadioMs += radioMs;
+  } else {
+    slowAdvertisingRadioMs += radioMs;
+  }
+}
+
+inline void startAdvertisingPhase(const AdvertisingPhase* phase) {
+  closeAdvertisingPhase();
+  BLEAdvertising* pAdvertising = BLEDevice::getAdvertising();
+  pAdvertising->stop();
+  pAdvertising->setMinInterval(phase->minInterval);
+  pAdvertising->setMaxInterval(phase->maxInterval);
+  BLEDevice::startAdvertising();
+  advertisingPhase = phase;
+  advertisingPhaseStart = millis();
+
+  float averageInterval = (phase->minInterval + phase->maxInterval) * 0.625 / 2;
+  Serial.print("Advertising ");
+  Serial.print(phase->name);
+  Serial.print(": ~");
+  Serial.print(averageInterval, 1);
+  Serial.print(" ms interval, radio duty ~");
+  Serial.print(100.0 * ADV_EVENT_RADIO_MS / averageInterval, 2);
+  Serial.println(" %");
+}
+
+// Start a new advertising run (boot or disconnect) in the fast phase
+inline void restartAdvertising() {
+  advertisingRunStart = millis();
+  fastAdvertisingUntil = millis() + FAST_ADVERTISING_PERIOD;
+  fastAdvertisingRadioMs = 0;
+  slowAdvertisingRadioMs = 0;
+  startAdvertisingPhase(&FAST_ADVERTISING);
+}
+
+// Back off once the fast period has passed, speed up again while someone uses the device
+inline void serviceAdvertising(bool connected, bool interaction) {
+  if (advertisingPhase == NULL || connected) {
+    return;
+  }
+  if (interaction) {
+    fastAdvertisingUntil = millis() + FAST_ADVERTISING_PERIOD;
+  }
+  bool fast = (long)(fastAdvertisingUntil - millis()) > 0;
+  const AdvertisingPhase* wanted = fast ? &FAST_ADVERTISING : &SLOW_ADVERTISING;
+  if (wanted != advertisingPhase) {
+    startAdvertisingPhase(wanted);
+  }
+}
+
+// The display found us - report how long it took and what the radio spent
+inline void reportAdvertisingDiscovery() {
+  const char* phaseName = advertisingPhase != NULL ? advertisingPhase->name : "unknown";
+  closeAdvertisingPhase();
+  advertisingPhase = NULL;
+  Serial.print("Discovered after ");
+  Serial.print(millis() - advertisingRunStart);
+  Serial.print(" ms (");
+  Serial.print(phaseName);
+  Serial.print(" phase), advertising radio on: fast=");
+  Serial.print(fastAdvertisingRadioMs, 1);
+  Serial.print(" ms, slow=");
+  Serial.print(slowAdvertisingRadioMs, 1);
+  Serial.println(" ms");
+}
+#endif
+
+#if WEARABLE_CONN_PROFILE
+// Connection parameter profiles - a short interval while the device is in use, a long
+// interval plus peripheral latency while it sits idle. Intervals are in 1.25 ms units,
+// the supervision timeout in 10 ms units.
+struct ConnectionProfile {
+  const char* name;
+  uint16_t minInterval;
+  uint16_t maxInterval;
+  uint16_t latency;   // Connection events we may skip when there is nothing to send
+  uint16_t timeout;
+};
+
+inline const ConnectionProfile LIVE_PROFILE = {"live", 12, 24, 0, 200};                 // 15-30 ms, 2 s timeout
+inline const ConnectionProfile BACKGROUND_PROFILE = {"background", 320, 400, 4, 600};  // 400-500 ms, skip 4, 6 s timeout
+const unsigned long PROFILE_IDLE_TIMEOUT = 30000;  // No activity for this long drops to background
+const float CONN_EVENT_RADIO_MS = 1.0;             // Estimated radio-on time of an empty connection event
+
+inline esp_bd_addr_t peerAddress;
+inline const ConnectionProfile* requestedProfile = NULL;
+inline unsigned long lastActivityTime = 0;
+inline volatile bool connParamsUpdated = false;
+inline volatile uint8_t connParamsStatus = 0;
+inline volatile uint16_t achievedInterval = 0;   // As granted by the central
+inline volatile uint16_t achievedLatency = 0;
+inline volatile uint16_t achievedTimeout = 0;
+
+// GAP events - the controller reports the parameters the central actually granted
+inline void onGapEvent(esp_gap_ble_cb_event_t event, esp_ble_gap_cb_param_t* param) {
+  if (event == ESP_GAP_BLE_UPDATE_CONN_PARAMS_EVT) {
+    connParamsStatus = param->update_conn_params.status;
+    achievedInterval = param->update_conn_params.conn_int;
+    achievedLatency = param->update_conn_params.latency;
+    achievedTimeout = param->update_conn_params.timeout;
+    connParamsUpdated = true;
+  }
+}
+
+// From the server's onConnect(server, param) - the link starts on the stack defaults
+inline void beginConnectionProfile(esp_ble_gatts_cb_param_t* param) {
+  memcpy(peerAddress, param->connect.remote_bda, sizeof(esp_bd_addr_t));
+  requestedProfile = NULL;      // Stack defaults until loop() picks a profile
+  lastActivityTime = millis();  // A fresh connection starts live
+}
+
+// Ask the central for a profile, only when it differs from the last request
+inline void applyConnectionProfile(BLEServer* server, const ConnectionProfile* profile) {
+  if (profile == requestedProfile) {
+    return;
+  }
+  requestedProfile = profile;
+  server->updateConnParams(peerAddress, profile->minInterval, profile->maxInterval,
+                           profile->latency, profile->timeout);
+  Serial.print("Requesting ");
+  Serial.print(profile->name);
+  Serial.println(" connection profile");
+}
+
+// Pick the profile from recent activity (finger on the sensor, touch, alerts)
+inline void updateConnectionProfile(BLEServer* server, bool connected, bool active) {
+  if (active) {
+    lastActivityTime = millis();
+  }
+  if (!connected) {
+    return;
+  }
+  bool live = millis() - lastActivityTime < PROFILE_IDLE_TIMEOUT;
+  applyConnectionProfile(server, live ? &LIVE_PROFILE : &BACKGROUND_PROFILE);
+}
+
+// Print what was granted: notifications wait at most one interval, writes from the
+// central up to (latency + 1) intervals, and when idle the radio wakes once every
+// (latency + 1) intervals
+inline void reportConnectionParams() {
+  if (!connParamsUpdated) {
+    return;
+  }
+  connParamsUpdated = false;
+  float intervalMs = achievedInterval * 1.25;
+  float writeLatencyMs = intervalMs * (achievedLatency + 1);
+  float dutyCycle = 100.0 * CONN_EVENT_RADIO_MS / writeLatencyMs;
+
+  Serial.print("Connection ");
+  Serial.print(requestedProfile != NULL ? requestedProfile->name : "default");
+  Serial.print(connParamsStatus == 0 ? "" : " (request refused)");
+  Serial.print(": interval=");
+  Serial.print(intervalMs);
+  Serial.print(" ms, latency=");
+  Serial.print(achievedLatency);
+  Serial.print(", timeout=");
+  Serial.print(achievedTimeout * 10);
+  Serial.print(" ms, notify latency<=");
+  Serial.print(intervalMs);
+  Serial.print(" ms, write latency<=");
+  Serial.print(writeLatencyMs);
+  Serial.print(" ms, idle radio duty~");
+  Serial.print(dutyCycle, 2);
+  Serial.println(" %");
+}
+#endif
+
+#if WEARABLE_BLE_SERVER
+#define CCCD_UUID BLEUUID((uint16_t)0x2902)
+
+// Bring up the stack and the GATT server (with the GAP handler the connection profiles
+// need, when they are compiled in)
+inline BLEServer* beginBleServer(const char* name, BLEServerCallbacks* callbacks) {
+  BLEDevice::init(name);
+#if WEARABLE_CONN_PROFILE
+  BLEDevice::setCustomGapHandler(onGapEvent);
+#endif
+  BLEServer* server = BLEDevice::createServer();
+  server->setCallbacks(callbacks);
+  return server;
+}
+
+// True when the connected client has enabled notifications on this characteristic
+inline bool notificationsEnabled(BLECharacteristic* characteristic) {
+  BLE2902* cccd = (BLE2902*)characteristic->getDescriptorByUUID(CCCD_UUID);
+  return cccd != NULL && cccd->getNotifications();
+}
+
+// Update the readable value and notify only if the client subscribed, returns true if it went on air
+inline bool publishValue(BLECharacteristic* characteristic, uint8_t* data, size_t length) {
+  characteristic->setValue(data, length);
+  if (!notificationsEnabled(characteristic)) {
+    return false;
+  }
+  characteristic->notify();
+#if WEARABLE_ENERGY
+  energyAccrue(radioEnergy, NOTIFY_RADIO_US, RADIO_ON_UA);
+#endif
+  return true;
+}
+
+// A new client starts with every notification off until it writes the CCCDs itself
+inline void resetSubscriptions(BLECharacteristic* const* characteristics, uint8_t count) {
+  for (uint8_t i = 0; i < count; i++) {
+    BLE2902* cccd = (BLE2902*)characteristics[i]->getDescriptorByUUID(CCCD_UUID);
+    if (cccd != NULL) {
+      cccd->setNotifications(false);
+    }
+  }
+}
+#endif
+
+#if WEARABLE_CONFIG
+#if !WEARABLE_BLE_SERVER
+#error "WEARABLE_CONFIG replies through publishValue() - define WEARABLE_BLE_SERVER as well"
+#endif
+// Runtime configuration - the sketch's tunables are kept in NVS and can be read or changed
+// by writing a command to a characteristic, so a device is re-tuned without a rebuild.
+//   CFG?               list every parameter, one "CFG:<key>=<value>" notification each
+//   CFG:<key>          read one parameter
+//   CFG:<key>=<value>  set a parameter, apply it at once and persist it
+//   CFG!               restore the compiled-in defaults
+// Unknown keys and out-of-range values are answered with "CFGERR:<key>". The parameter
+// table, its NVS namespace and how a value reaches the variables and hardware stay in the
+// sketch. The first sensorParams entries only take effect together (the sensor's setup()
+// resets all of them), through applySensor().
+#define CONFIG_COMMAND_SIZE 32
+
+struct ConfigParam {
+  const char* key;    // Command name and NVS key (15 characters at most)
+  long defaultValue;
+  long minValue;
+  long maxValue;
+  long value;
+  bool (*accepts)(long value);   // Check on top of the range, NULL for none
+};
+
+struct RuntimeConfig {
+  const char* nvsNamespace;
+  ConfigParam* params;
+  int count;
+  int sensorParams;
+  void (*apply)(int index);      // Push one parameter into the variables and hardware that use it
+  void (*applySensor)();         // Reconfigure the sensor from the first sensorParams entries
+  Preferences store;
+  char command[CONFIG_COMMAND_SIZE];   // Written by queueConfigCommand(), handled from loop()
+  volatile bool pending;
+};
+
+// The MAX30102 only runs at a handful of rates, and with 411 us pulses (18-bit ADC)
+// nothing above 400 Hz fits - 800-3200 Hz need pulses of 215 us or less
+inline bool isSupportedSampleRate(long rate) {
+  static const long rates[] = {50, 100, 200, 400};
+  for (size_t i = 0; i < sizeof(rates) / sizeof(rates[0]); i++) {
+    if (rates[i] == rate) {
+      return true;
+    }
+  }
+  return false;
+}
+
+inline bool isValidConfigValue(const RuntimeConfig &config, int index, long value) {
+  const ConfigParam &param = config.params[index];
+  if (value < param.minValue || value > param.maxValue) {
+    return false;
+  }
+  return param.accepts == NULL || param.accepts(value);
+}
+
+inline int findConfig(const RuntimeConfig &config, const char* key) {
+  for (int i = 0; i < config.count; i++) {
+    if (strcmp(config.params[i].key, key) == 0) {
+      return i;
+    }
+  }
+  return -1;
+}
+
+// Push every parameter's value, the sensor ones together at the end
+inline void applyAllConfig(RuntimeConfig &config) {
+  for (int i = config.sensorParams; i < config.count; i++) {
+    config.apply(i);
+  }
+  config.applySensor();
+}
+
+// Load the stored values (anything missing or out of range falls back to the default)
+// and apply them - called once from setup()
+inline void loadConfig(RuntimeConfig &config) {
+  config.store.begin(config.nvsNamespace, false);
+  for (int i = 0; i < config.count; i++) {
+    ConfigParam &param = config.params[i];
+    long stored = config.store.getLong(param.key, param.defaultValue);
+    param.value = isValidConfigValue(config, i, stored) ? stored : param.defaultValue;
+  }
+  applyAllConfig(config);
+}
+
+// From a write callback - a command that arrives while the previous one is still queued is dropped
+inline void queueConfigCommand(RuntimeConfig &config, const uint8_t* data, size_t length) {
+  if (config.pending) {
+    return;
+  }
+  length = min(length, (size_t)CONFIG_COMMAND_SIZE - 1);
+  memcpy(config.command, data, length);
+  config.command[length] = '\0';
+  config.pending = true;
+}
+
+// Replies go out like any reading - only to a client that subscribed
+inline void sendConfigReply(BLECharacteristic* characteristic, const char* reply) {
+  publishValue(characteristic, (uint8_t*)reply, strlen(reply));
+}
+
+inline void sendConfigValue(const RuntimeConfig &config, BLECharacteristic* characteristic, int index) {
+  char reply[CONFIG_COMMAND_SIZE];
+  snprintf(reply, sizeof(reply), "CFG:%s=%ld", config.params[index].key, config.params[index].value);
+  sendConfigReply(characteristic, reply);
+}
+
+inline void sendConfigError(BLECharacteristic* characteristic, const char* key) {
+  char reply[CONFIG_COMMAND_SIZE];
+  snprintf(reply, sizeof(reply), "CFGERR:%s", key);
+  sendConfigReply(characteristic, reply);
+}
+
+// Handle a pending CFG command from loop(), so replies never race a data notification
+inline void handleConfigCommand(RuntimeConfig &config, BLECharacteristic* characteristic) {
+  if (!config.pending) {
+    return;
+  }
+  char command[CONFIG_COMMAND_SIZE];
+  memcpy(command, config.command, sizeof(command));
+  config.pending = false;
+
+  if (strcmp(command, "CFG?") == 0) {
+    for (int i = 0; i < config.count; i++) {
+      sendConfigValue(config, characteristic, i);
+    }
+    return;
+  }
+
+  if (strcmp(command, "CFG!") == 0) {
+    config.store.clear();
+    for (int i = 0; i < config.count; i++) {
+      config.params[i].value = config.params[i].defaultValue;
+    }
+    applyAllConfig(config);
+    Serial.println("Config: defaults restored");
+    sendConfigReply(characteristic, "CFG!");
+    return;
+  }
+
+  // "CFG:<key>" or "CFG:<key>=<value>" - "CFGx..." or a bare "CFG" is not a command
+  if (command[3] != ':' || command[4] == '\0') {
+    sendConfigError(characteristic, command);
+    return;
+  }
+  char* key = command + 4;
+  char* equals = strchr(key, '=');
+  if (equals != NULL) {
+    *equals = '\0';
+  }
+  int index = findConfig(config, key);
+  if (index < 0) {
+    sendConfigError(characteristic, key);
+    return;
+  }
+
+  if (equals != NULL) {
+    char* end;
+    long value = strtol(equals + 1, &end, 10);
+    if (end == equals + 1 || *end != '\0' || !isValidConfigValue(config, index, value)) {
+      sendConfigError(characteristic, key);
+      return;
+    }
+    config.params[index].value = value;
+    config.store.putLong(key, value);
+    if (index < config.sensorParams) {
+      config.applySensor();
+    } else {
+      config.apply(index);
+    }
+    Serial.print("Config: ");
+    Serial.print(key);
+    Serial.print(" = ");
+    Serial.println(value);
+  }
+  sendConfigValue(config, characteristic, index);
+}
+#endif
+
+#if WEARABLE_SCAN
+// Scan duty cycle - a fast phase right after boot, a disconnect or user interaction
+// catches the server's fast advertising, then short bursts at a low duty. Interval and
+// window are in 0.625 ms units.
+struct ScanPhase {
+  const char* name;
+  uint16_t interval;
+  uint16_t window;
+  uint32_t burstSeconds;  // Length of one scan
+  unsigned long pause;    // ms between scans
+};
+
+inline const ScanPhase FAST_SCAN = {"fast", 96, 48, 5, 0};            // 30 ms every 60 ms, back to back (50 %)
+inline const ScanPhase SLOW_SCAN = {"slow", 1760, 1760, 2, 18000};    // 2 s continuous every 20 s (10 %)
+const unsigned long FAST_SCAN_PERIOD = 30000;  // How long the fast phase lasts
+
+inline const ScanPhase* scanPhase = &FAST_SCAN;
+inline bool scanning = false;
+inline unsigned long scanStart = 0;
+inline unsigned long lastScanEnd = 0;
+inline unsigned long fastScanUntil = 0;
+inline unsigned long discoveryStart = 0;  // When the current search began, for discovery time
+inline float fastScanRadioMs = 0;
+inline float slowScanRadioMs = 0;
+
+// Close the running scan and add its estimated radio-on time (window / interval of it)
+inline void endScan() {
+  if (!scanning) {
+    return;
+  }
+  scanning = false;
+  lastScanEnd = millis();
+  float radioMs = (float)(lastScanEnd - scanStart) * scanPhase->window / scanPhase->interval;
+  if (scanPhase == &FAST_SCAN) {
+    fastScanRadioMs += radioMs;
+  } else {
+    slowScanRadioMs += radioMs;
+  }
+#if WEARABLE_ENERGY
+  energyAccrue(radioEnergy, radioMs * 1000, RADIO_ON_UA);
+#endif
+}
+
+// Scan finished its burst without finding the server
+inline void onScanComplete(BLEScanResults results) {
+  endScan();
+  BLEDevice::getScan()->clearResults();
+}
+
+// Begin a new search (boot, disconnect, failed connection) in the fast phase
+inline void restartScanning() {
+  discoveryStart = millis();
+  fastScanUntil = millis() + FAST_SCAN_PERIOD;
+  lastScanEnd = 0;
+  fastScanRadioMs = 0;
+  slowScanRadioMs = 0;
+}
+
+// Start the next scan burst when the phase allows it. 'busy' is a link that is up or
+// about to be made. Never blocks.
+inline void serviceScan(bool busy, bool interaction) {
+  if (interaction) {
+    fastScanUntil = millis() + FAST_SCAN_PERIOD;
+  }
+  if (busy || scanning) {
+    return;
+  }
+
+  bool fast = (long)(fastScanUntil - millis()) > 0;
+  const ScanPhase* wanted = fast ? &FAST_SCAN : &SLOW_SCAN;
+  if (wanted != scanPhase) {
+    scanPhase = wanted;
+    Serial.print("Scan phase ");
+    Serial.print(scanPhase->name);
+    Serial.print(": radio duty ~");
+    Serial.print(100.0 * scanPhase->window / scanPhase->interval *
+                 (scanPhase->burstSeconds * 1000.0) / (scanPhase->burstSeconds * 1000.0 + scanPhase->pause), 1);
+    Serial.println(" %");
+  }
+  if (lastScanEnd != 0 && millis() - lastScanEnd < scanPhase->pause) {
+    return;
+  }
+
+  BLEScan* pBLEScan = BLEDevice::getScan();
+  pBLEScan->setInterval(scanPhase->interval);
+  pBLEScan->setWindow(scanPhase->window);
+  scanning = true;
+  scanStart = millis();
+  pBLEScan->start(scanPhase->burstSeconds, onScanComplete, false);
+}
+
+// The server was found - report how long it took and what the radio spent
+inline void reportScanDiscovery() {
+  Serial.print("Discovered server after ");
+  Serial.print(millis() - discoveryStart);
+  Serial.print(" ms (");
+  Serial.print(scanPhase->name);
+  Serial.print(" phase), scan radio on: fast=");
+  Serial.print(fastScanRadioMs, 1);
+  Serial.print(" ms, slow=");
+  Serial.print(slowScanRadioMs, 1);
+  Serial.println(" ms");
+}
+#endif
+
+#if WEARABLE_BLE_CLIENT
+// Bring up the stack for a passive scan - the service UUID is in the advertising data,
+// no scan requests needed
+inline void beginBleClient(const char* name, BLEAdvertisedDeviceCallbacks* callbacks) {
+  BLEDevice::init(name);
+  BLEScan* pBLEScan = BLEDevice::getScan();
+  pBLEScan->setAdvertisedDeviceCallbacks(callbacks);
+  pBLEScan->setActiveScan(false);
+}
+
+// Print a BLE address without building a String
+inline void printAddress(const esp_bd_addr_t address) {
+  for (int i = 0; i < ESP_BD_ADDR_LEN; i++) {
+    if (address[i] < 0x10) {
+      Serial.print('0');
+    }
+    Serial.print(address[i], HEX);
+    if (i < ESP_BD_ADDR_LEN - 1) {
+      Serial.print(':');
+    }
+  }
+}
+
+// Connect 'client' (created once, reused on every reconnect) and look up one
+// characteristic of one service. On any failure the link is dropped and NULL returned.
+inline BLERemoteCharacteristic* connectCharacteristic(BLEClient* client, esp_bd_addr_t address,
+                                                      esp_ble_addr_type_t addressType,
+                                                      BLEUUID serviceUuid, BLEUUID charUuid) {
+  Serial.print("Connecting to ");
+  printAddress(address);
+  Serial.println();
+  if (!client->connect(BLEAddress(address), addressType)) {
+    Serial.println("Connection failed");
+    return NULL;
+  }
+
+  BLERemoteService* pRemoteService = client->getService(serviceUuid);
+  if (pRemoteService == nullptr) {
+    Serial.print("Failed to find our service UUID: ");
+    Serial.println(serviceUuid.toString().c_str());
+    client->disconnect();
+    return NULL;
+  }
+  BLERemoteCharacteristic* characteristic = pRemoteService->getCharacteristic(charUuid);
+  if (characteristic == nullptr) {
+    Serial.print("Failed to find our characteristic UUID: ");
+    Serial.println(charUuid.toString().c_str());
+    client->disconnect();
+    return NULL;
+  }
+  Serial.println("Found our service and characteristic");
+  return characteristic;
+}
+#endif
+
+#if WEARABLE_LINK_SUPERVISOR
+// Link supervisor - a link can look connected while nothing arrives any more (lost
+// subscription, half-open link after the server reset). Counted from the last reading:
+//   LINK_STALE_MS        the readings are marked stale
+//   LINK_RESUBSCRIBE_MS  notifications are enabled again (the CCCD is rewritten)
+//   LINK_RECONNECT_MS    the link is dropped and the normal scan/reconnect path takes over
+// Each outage is reported when readings come back: how long nothing arrived, how long the
+// recovery took once it was flagged, and which stage fixed it. The defaults suit a
+// server with a 5 s keepalive - override before the include for a slower one.
+#ifndef LINK_STALE_MS
+#define LINK_STALE_MS 8000
+#endif
+#ifndef LINK_RESUBSCRIBE_MS
+#define LINK_RESUBSCRIBE_MS 12000
+#endif
+#ifndef LINK_RECONNECT_MS
+#define LINK_RECONNECT_MS 20000
+#endif
+
+enum LinkStage { LINK_OK, LINK_STALE, LINK_RESUBSCRIBED, LINK_RECONNECTING };
+const char* const LINK_STAGE_NAMES[] = {"ok", "none (came back)", "resubscribe", "reconnect"};
+
+// Stamped by the notify callback for every reading
+inline volatile unsigned long lastDataTime = 0;
+inline volatile unsigned long dataCount = 0;
+
+inline LinkStage linkStage = LINK_OK;
+inline LinkStage linkAction = LINK_OK;       // Furthest stage reached in the current outage
+inline unsigned long outageStart = 0;        // Last reading before the outage
+inline unsigned long staleSince = 0;         // When the outage was flagged
+inline unsigned long dataCountAtStale = 0;
+inline unsigned long linkOutages = 0;
+inline unsigned long outagesFixedBy[4] = {0, 0, 0, 0};
+inline unsigned long longestOutage = 0;
+
+// From the notify callback
+inline void markLinkData() {
+  lastDataTime = millis();
+  dataCount = dataCount + 1;  // Not ++, that is deprecated on a volatile since C++20
+}
+
+// A new connection gets a full LINK_STALE_MS to deliver its first reading
+inline void startLinkSupervision() {
+  lastDataTime = millis();
+  if (linkStage == LINK_RECONNECTING) {
+    linkStage = LINK_STALE;  // The outage stays open until readings actually arrive
+  }
+}
+
+inline void reportLinkRecovery(unsigned long now) {
+  unsigned long outage = now - outageStart;
+  if (outage > longestOutage) {
+    longestOutage = outage;
+  }
+  outagesFixedBy[linkAction]++;
+  Serial.print("Link: data back after ");
+  Serial.print(outage);
+  Serial.print(" ms without data, recovered ");
+  Serial.print(now - staleSince);
+  Serial.print(" ms after it was flagged, fixed by: ");
+  Serial.println(LINK_STAGE_NAMES[linkAction]);
+  Serial.print("Link: ");
+  Serial.print(linkOutages);
+  Serial.print(" outages (came back ");
+  Serial.print(outagesFixedBy[LINK_STALE]);
+  Serial.print(", resubscribe ");
+  Serial.print(outagesFixedBy[LINK_RESUBSCRIBED]);
+  Serial.print(", reconnect ");
+  Serial.print(outagesFixedBy[LINK_RECONNECTING]);
+  Serial.print("), longest ");
+  Serial.print(longestOutage);
+  Serial.println(" ms");
+}
+
+// Run from loop() while connected, returns true when the stage changed. 'characteristic'
+// is resubscribed with 'callback', 'client' is dropped for the reconnect.
+inline bool superviseLink(BLEClient* client, BLERemoteCharacteristic* characteristic,
+                          notify_callback callback) {
+  unsigned long now = millis();
+  if (linkStage != LINK_OK && dataCount != dataCountAtStale) {
+    reportLinkRecovery(now);
+    linkStage = LINK_OK;
+    return true;
+  }
+
+  unsigned long silent = now - lastDataTime;
+  switch (linkStage) {
+    case LINK_OK:
+      if (silent >= LINK_STALE_MS) {
+        linkStage = LINK_STALE;
+        linkAction = LINK_STALE;
+        outageStart = lastDataTime;
+        staleSince = now;
+        dataCountAtStale = dataCount;
+        linkOutages++;
+        Serial.print("Link: no data for ");
+        Serial.print(silent);
+        Serial.println(" ms, marked stale");
+        return true;
+      }
+      break;
+    case LINK_STALE:
+      if (silent >= LINK_RESUBSCRIBE_MS) {
+        Serial.println("Link: still silent, enabling notifications again");
+        linkStage = LINK_RESUBSCRIBED;
+        if (linkAction < LINK_RESUBSCRIBED) {
+          linkAction = LINK_RESUBSCRIBED;
+        }
+        if (characteristic != NULL && characteristic->canNotify()) {
+          characteristic->registerForNotify(callback);  // Writes the CCCD again
+        }
+        return true;
+      }
+      break;
+    case LINK_RESUBSCRIBED:
+      if (silent >= LINK_RECONNECT_MS) {
+        Serial.println("Link: resubscribing did not help, forcing a reconnect");
+        linkStage = LINK_RECONNECTING;
+        linkAction = LINK_RECONNECTING;
+        client->disconnect();
+        return true;
+      }
+      break;
+    case LINK_RECONNECTING:
+      break;  // startLinkSupervision() moves on once the new link is up
+  }
+  return false;
+}
+#endif
+
+#endif